@@ -0,0 +1,365 @@
+"""An alternative PAD server built on asyncio streams.
+
+Connections are handled on the event loop, so slow clients never hold a
+worker. Once a request has been fully read, the command is run in a
+bounded thread pool, which means that network bound rules (DNS, Pyzor,
+Razor) of several messages are waiting concurrently instead of one
+after the other.
+
+This requires Python 3.5 or later.
+"""
+
+from __future__ import absolute_import
+
+import io
+import os
+import stat
+import time
+import socket
+import signal
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+import oa
+import oa.errors
+import oa.server
+import oa.metrics
+
+
+class _Deadline(oa.server.Deadline):
+    """Like `oa.server.Deadline`, for the asyncio streams."""
+
+    async def read(self, coro):
+        """Wait for the read, but not past the deadline."""
+        try:
+            data = await asyncio.wait_for(coro, self.get_timeout())
+        except asyncio.TimeoutError:
+            self.timed_out()
+        self.received += len(data)
+        return data
+
+
+class AsyncServer(oa.server.AdmissionMixIn, oa.server.RulesetMixIn):
+    """The PAD server using asyncio. Handles incoming connections
+    on a event loop and runs the commands in a pool of threads.
+
+    Uses the same commands as `oa.server.Server`. The requests that
+    wait for a free thread are subject to the admission control of
+    `oa.server.AdmissionMixIn`.
+    """
+    server_logger = "oa-logger"
+    # Custom signal handling
+    signal_reload = signal.SIGUSR1
+    signal_shutdown = signal.SIGTERM
+    # Socket options.
+    allow_reuse_address = True
+    request_queue_size = 128
+    # Number of threads that run the commands.
+    max_workers = 4
+    chunk_size = 8192
+    # Persistent connections, see `oa.server.RequestHandler`.
+    keepalive_timeout = 5.0
+    max_keepalive_requests = 100
+    # Number of messages of a BATCH request checked at the same time.
+    batch_workers = 4
+    # Maximum size of a message in bytes, None for no limit.
+    max_message_size = None
+    # Slow client protection, see `oa.server.RequestHandler`.
+    header_timeout = 30.0
+    body_timeout = 60.0
+    min_transfer_rate = None
+    # Maximum number of connections handled at the same time, None
+    # for no limit.
+    max_connections = None
+
+    def __init__(self, address, sitepath, configpath, paranoid=False,
+                 ignore_unknown=True, max_workers=None):
+        self.log = logging.getLogger(self.server_logger)
+        self.paranoid = paranoid
+        self.ignore_unknown = ignore_unknown
+        self._ruleset = None
+        self._user_rulesets = {}
+        self._parser_results = None
+        self._ruleset_lock = threading.RLock()
+        self.sitepath = sitepath
+        self.configpath = configpath
+        if max_workers is not None:
+            self.max_workers = max_workers
+        self.server_address = address
+        self.socket = None
+        self._loop = None
+        self._executor = None
+        self._stopped = None
+        self._connections = 0
+        # Requests waiting for a free thread in the pool.
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self._admission = threading.local()
+        self.log.debug("Listening on %s", address)
+        self.load_config()
+        self._setup_socket()
+
+    def _setup_socket(self):
+        """Create, bind and activate the listening socket. If the
+        address is a path, listen on a Unix domain socket.
+        """
+        if not isinstance(self.server_address, tuple):
+            address_family = socket.AF_UNIX
+            try:
+                if stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                    os.remove(self.server_address)
+            except OSError:
+                pass
+        elif ":" in self.server_address[0]:
+            address_family = socket.AF_INET6
+        else:
+            address_family = socket.AF_INET
+        self.socket = socket.socket(address_family, socket.SOCK_STREAM)
+        if self.allow_reuse_address and address_family != socket.AF_UNIX:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(False)
+
+    def serve_forever(self):
+        """Run the event loop until the server is shutdown."""
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        )
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            self._executor.shutdown(wait=True)
+            self._loop.close()
+            self.socket.close()
+
+    async def _serve(self):
+        """Accept connections until the shutdown is requested."""
+        self._stopped = asyncio.Event()
+        if self.signal_reload is not None:
+            self._loop.add_signal_handler(self.signal_reload,
+                                          self.reload_handler)
+        if self.signal_shutdown is not None:
+            self._loop.add_signal_handler(self.signal_shutdown,
+                                          self.shutdown_handler)
+        server = await asyncio.start_server(self.handle_connection,
+                                            sock=self.socket)
+        try:
+            await self._stopped.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    def shutdown(self):
+        """Stop accepting connections and stop the event loop once
+        the requests in progress are done. Can be called from any
+        thread.
+        """
+        self._loop.call_soon_threadsafe(self._stopped.set)
+
+    def shutdown_handler(self):
+        """Handler for the SIGTERM signal."""
+        self.log.info("SIGTERM received. Shutting down.")
+        self.shutdown()
+
+    def reload_handler(self):
+        """Handler for the SIGUSR1 signal. The configuration is loaded
+        in the thread pool to keep the event loop responsive.
+        """
+        self.log.info("SIGUSR1 received. Reloading configuration.")
+        self._loop.run_in_executor(self._executor, self.load_config)
+
+    async def read_request(self, reader, handler, deadline=None):
+        """Read the rest of the request for this command handler
+        from the client.
+
+        Only the data that the command expects is read, the options
+        and message are parsed later by the command itself. The
+        options must be received before the `deadline` of the header
+        phase, and the message in `body_timeout` seconds.
+
+        :return: The raw request data as bytes, and True or False if
+          the client wants to keep the connection open, or None if
+          it didn't say.
+        """
+        data = io.BytesIO()
+        content_length = None
+        keep_alive = None
+        if deadline is None:
+            deadline = _Deadline("header", self.header_timeout)
+        if handler.has_options:
+            while True:
+                line = await deadline.read(reader.readline())
+                data.write(line)
+                line = line.strip()
+                if not line:
+                    break
+                name, sep, value = line.partition(b":")
+                if not sep:
+                    # The command will reply with the error.
+                    return data.getvalue(), False
+                name = name.strip().lower()
+                if name == b"content-length":
+                    try:
+                        content_length = int(value)
+                    except ValueError:
+                        return data.getvalue(), False
+                    if content_length < 0:
+                        return data.getvalue(), False
+                    if (self.max_message_size and
+                            content_length > self.max_message_size):
+                        # The command rejects it without the message.
+                        return data.getvalue(), False
+                elif name == b"keep-alive":
+                    keep_alive = value.strip().lower() == b"yes"
+        if handler.has_message:
+            deadline = _Deadline("body", self.body_timeout,
+                                 self.min_transfer_rate)
+            if content_length is None:
+                # Read everything until the client shuts down its side
+                # of the connection, or the message is too large.
+                size = 0
+                while True:
+                    chunk = await deadline.read(reader.read(self.chunk_size))
+                    if not chunk:
+                        break
+                    data.write(chunk)
+                    size += len(chunk)
+                    if (self.max_message_size and
+                            size > self.max_message_size):
+                        return data.getvalue(), False
+            while content_length is not None and content_length > 0:
+                chunk = await deadline.read(
+                    reader.read(min(content_length, self.chunk_size))
+                )
+                if not chunk:
+                    break
+                data.write(chunk)
+                content_length -= len(chunk)
+        return data.getvalue(), keep_alive
+
+    def run_command(self, handler, request, queued=None):
+        """Run the command handler on the request data and
+        return the response as bytes. This runs in the pool.
+
+        :param queued: The time the request was queued, if it was
+          counted as pending.
+        """
+        if queued is not None:
+            with self._pending_lock:
+                self._pending -= 1
+                oa.metrics.set_gauge("queue_depth", self._pending)
+            self.start_request(queued)
+        rfile = io.BytesIO(request)
+        wfile = io.BytesIO()
+        try:
+            handler(rfile, wfile, self)
+        except Exception:
+            self.log.error("Error while processing request", exc_info=True)
+        finally:
+            self.end_request()
+        return wfile.getvalue()
+
+    async def read_command(self, reader, keep_alive=False, deadline=None):
+        """Read the command line of the next request. Between requests
+        on a persistent connection wait at most `keepalive_timeout`
+        seconds, and skip any empty lines. Otherwise the command line
+        must be received before the `deadline` of the header phase.
+        """
+        if keep_alive:
+            deadline = _Deadline("keepalive", self.keepalive_timeout)
+        elif deadline is None:
+            deadline = _Deadline("header", self.header_timeout)
+        try:
+            while True:
+                line = await deadline.read(reader.readline())
+                if not keep_alive or not line or line.strip():
+                    return line.decode("utf8").strip()
+        except oa.errors.ReadTimeout as e:
+            if not keep_alive:
+                raise
+            self.log.debug("Closing connection: %s", e)
+            return ""
+
+    async def handle_connection(self, reader, writer):
+        """Get the commands from the client and pass them to the
+        correct handler. See `oa.server.RequestHandler` for the
+        persistent connections.
+        """
+        self._connections += 1
+        oa.metrics.set_gauge("connections", self._connections)
+        try:
+            if (self.max_connections and
+                    self._connections > self.max_connections):
+                oa.metrics.incr("connections_refused")
+                self.log.warning("Refusing connection, %s connections open",
+                                 self._connections - 1)
+                error_line = ("SPAMD/%s 75 EX_TEMPFAIL: (too many "
+                              "connections)\r\n" % oa.__version__)
+                writer.write(error_line.encode("utf8"))
+                writer.close()
+                return
+            await self.handle_requests(reader, writer)
+        finally:
+            self._connections -= 1
+            oa.metrics.set_gauge("connections", self._connections)
+
+    async def handle_requests(self, reader, writer):
+        """Handle the requests sent on this connection."""
+        keep_alive = False
+        served = 0
+        try:
+            while True:
+                deadline = _Deadline("header", self.header_timeout)
+                line = await self.read_command(reader, keep_alive, deadline)
+                if not line and keep_alive:
+                    break
+                if keep_alive:
+                    # The headers of the next request.
+                    deadline = _Deadline("header", self.header_timeout)
+                try:
+                    command, proto_version = line.split()
+                    handler = oa.server.COMMANDS[command.upper()]
+                except (ValueError, KeyError):
+                    error_line = ("SPAMD/%s 76 Bad header line: %s\r\n" %
+                                  (oa.__version__, line))
+                    writer.write(error_line.encode("utf8"))
+                    return
+                try:
+                    request, request_keep_alive = await self.read_request(
+                        reader, handler, deadline
+                    )
+                except oa.errors.ReadTimeout as e:
+                    self.log.info("Timed out reading request: %s", e)
+                    error_line = ("SPAMD/%s 79 EX_TIMEOUT: (%s)\r\n" %
+                                  (oa.__version__, e))
+                    writer.write(error_line.encode("utf8"))
+                    return
+                with self._pending_lock:
+                    if self.queue_full(self._pending):
+                        error_line = ("SPAMD/%s 75 EX_TEMPFAIL: (server "
+                                      "busy)\r\n" % oa.__version__)
+                        writer.write(error_line.encode("utf8"))
+                        return
+                    self._pending += 1
+                response = await self._loop.run_in_executor(
+                    self._executor, self.run_command, handler, request,
+                    time.time()
+                )
+                writer.write(response)
+                await writer.drain()
+                served += 1
+                if request_keep_alive is not None:
+                    keep_alive = request_keep_alive
+                if not keep_alive or served >= self.max_keepalive_requests:
+                    break
+        except (ConnectionError, UnicodeDecodeError,
+                oa.errors.ReadTimeout) as e:
+            self.log.info("Error while reading request: %s", e)
+        finally:
+            writer.close()
@@ -1,5 +1,7 @@
 """Manage configuration option parsing."""
 
+import copy
+
 import oa.errors
 
 from datetime import timedelta
@@ -38,7 +40,9 @@ class Conf(object):
         self._plugin_name = self.__class__.__name__
         if self.options:
             for key, (dummy, value) in self.options.items():
-                self.set_global(key, value)
+                # The defaults are shared by every instance, the
+                # "append" options must not change them.
+                self.set_global(key, copy.copy(value))
 
     def __setitem__(self, key, value):
         self.set_global(key, value)
@@ -222,8 +226,14 @@ class PADConf(Conf):
         "dns_local_ports_permit": ("append_split", []),
         "dns_local_ports_avoid": ("append_split", []),
         "dns_test_interval": ("str", "600"),
+        "dns_test_failures": ("int", 3),
+        "dns_test_successes": ("int", 2),
         "dns_options": ("str", "norotate, nodns0x20, edns=4096"),
         "dns_query_restriction": ("append", []),
+        "dns_cache_size": ("int", 10000),
+        "dns_cache_max_ttl": ("int", 86400),
+        "dns_cache_negative_ttl": ("int", 300),
+        "dns_message_budget": ("float", 30.0),
         "autolearn": ("bool", False),
         "training": ("bool", False),
         "user_config": ("bool", True),
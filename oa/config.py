@@ -1,7 +1,16 @@
 """Load and set-up various configurations."""
 
 import os
+import atexit
 import logging
+import logging.handlers
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import oa.metrics
 
 try:
     from raven.handlers.logging import SentryHandler
@@ -31,11 +40,85 @@ SITE_RULES_PATHS = (
 
 LAZY_MODE = True
 
+# Set by `setup_logging` when the records are passed to the handlers
+# through a queue.
+_log_queue = None
+
+
+class DroppingQueueHandler(getattr(logging.handlers, "QueueHandler",
+                                   logging.Handler)):
+    """Put the records in a bounded queue without blocking. When the
+    queue is full the record is dropped and counted.
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            oa.metrics.incr("log_records_dropped")
+
+
+class LogQueue(object):
+    """Pass the log records to the handlers in a background thread, so
+    writing them doesn't block the threads checking messages.
+
+    :param handlers: The handlers that write the records.
+    :param max_size: The maximum number of records waiting to be
+      written, the records logged while the queue is full are dropped.
+    """
+
+    def __init__(self, handlers, max_size=10000):
+        self.handlers = handlers
+        self.max_size = max_size
+        self.handler = DroppingQueueHandler(queue.Queue(max_size))
+        self.listener = None
+
+    def start(self):
+        """Start the thread writing the records."""
+        self.listener = logging.handlers.QueueListener(
+            self.handler.queue, *self.handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+    def stop(self):
+        """Write the remaining records and stop the thread."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def after_fork(self):
+        """The thread isn't running in the child process, start a new one
+        with an empty queue.
+        """
+        self.handler.queue = queue.Queue(self.max_size)
+        self.listener = None
+        self.start()
+
+
+def flush_logging():
+    """Write the records waiting in the log queue, if any. Called before
+    the process exits.
+    """
+    if _log_queue is not None:
+        _log_queue.stop()
+
+
+def restart_logging():
+    """Restart the log queue in a forked child process, if any."""
+    if _log_queue is not None:
+        _log_queue.after_fork()
+
+
 def setup_logging(log_name, debug=False, filepath=None, sentry_dsn=None,
-                  file_lvl="INFO", sentry_lvl="WARN"):
+                  file_lvl="INFO", sentry_lvl="WARN", queue_size=None):
     """Setup logging according to the specified options. Return the Logger
     object.
+
+    If `queue_size` is set the records are written by a background
+    thread and at most that many records wait in the queue, the others
+    are dropped and counted in the "log_records_dropped" metric.
     """
+    global _log_queue
     fmt = logging.Formatter(
             '%(asctime)s [%(process)d] %(levelname)s %(message)s'
     )
@@ -54,19 +137,32 @@ def setup_logging(log_name, debug=False, filepath=None, sentry_dsn=None,
 
     stream_handler.setLevel(stream_log_level)
     stream_handler.setFormatter(fmt)
-    logger.addHandler(stream_handler)
+    handlers = [stream_handler]
 
     if filepath:
         file_handler = logging.FileHandler(filepath)
         file_handler.setLevel(file_log_level)
         file_handler.setFormatter(fmt)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
 
     if sentry_dsn and _HAS_RAVEN:
         sentry_level = getattr(logging, sentry_lvl)
         sentry_handler = SentryHandler(sentry_dsn)
         sentry_handler.setLevel(sentry_level)
-        logger.addHandler(sentry_handler)
+        handlers.append(sentry_handler)
+
+    if queue_size and hasattr(logging.handlers, "QueueListener"):
+        flush_logging()
+        _log_queue = LogQueue(handlers, queue_size)
+        _log_queue.start()
+        atexit.register(flush_logging)
+        logger.addHandler(_log_queue.handler)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+        if queue_size:
+            logger.warning("The log queue is not supported on this "
+                           "version of Python")
 
     return logger
 
@@ -150,6 +150,8 @@ class GlobalContext(_Context):
         self.networks = oa.networks.NetworkList()
         self.conf = oa.conf.PADConf(self)
         self.username = getpass.getuser()
+        # The user preferences file of the user rulesets.
+        self.userprefs = None
 
     def err(self, *args, **kwargs):
         """Log a error according to the paranoid and
@@ -320,7 +322,14 @@ class GlobalContext(_Context):
                           cport)
             self.dns.namerservers = nameservers
             self.dns.port = int(cport)
+        self.dns.test_interval = self.conf["dns_test_interval"]
+        self.dns.test_failures = self.conf["dns_test_failures"]
+        self.dns.test_successes = self.conf["dns_test_successes"]
         self.dns.available = self.conf['dns_available']
+        self.dns.cache.max_size = self.conf["dns_cache_size"]
+        self.dns.cache.max_ttl = self.conf["dns_cache_max_ttl"]
+        self.dns.cache.negative_ttl = self.conf["dns_cache_negative_ttl"]
+        self.dns.message_budget = self.conf["dns_message_budget"]
 
     def _add_networks(self):
         for network in self.conf['trusted_networks']:
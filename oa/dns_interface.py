@@ -1,15 +1,460 @@
 """ DNS wrapper that takes the user options into consideration
-when performing queries"""
+when performing queries
+Answers are kept in a `DNSCache` for as long as their TTL allows, and
+optionally in a `SharedDNSCache` used by all the pre forked workers.
 
+Queries can also be started in the background with
+`DNSInterface.query_async` and their answers collected later.
+
+The lookups of a message can be limited with a `DNSBudget`, the total
+time they may take.
+
+When the availability of DNS is tested, the tests run periodically in a
+background thread and queries only check the last known state.
+"""
+
+import os
+import mmap
+import time
+import zlib
 import random
 import struct
+import hashlib
 import logging
+import functools
 import datetime
+import threading
+import collections
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import dns
+import dns.name
+import dns.message
+import dns.exception
+import dns.rdataclass
+import dns.rdatatype
 import dns.resolver
 import dns.reversename
 
+import oa.metrics
+
+
+class SharedDNSCache(object):
+    """Hash table of DNS responses in anonymous shared memory.
+
+    The table is created by the parent process before forking and is
+    inherited by all the workers. It has a fixed number of slots, a key
+    is stored in one of `ways` consecutive slots and replaces the one
+    that expires first when they are all used.
+
+    Readers and writers never lock. Each slot has a checksum, so a slot
+    that is being written by another process, or that was left half
+    written by a worker that crashed, is treated as empty. Responses
+    that don't fit in a slot are not shared.
+
+    :param slots: The number of slots in the table.
+    :param slot_size: The size of a slot in bytes.
+    :param ways: The number of slots a key can be stored in.
+    """
+    # Key hash, expiration time, data length and checksum.
+    _header = struct.Struct("<QdII")
+
+    def __init__(self, slots=16384, slot_size=1024, ways=4):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = min(ways, slots)
+        self.max_data = slot_size - self._header.size
+        self._map = mmap.mmap(-1, slots * slot_size)
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.sha1(key.encode("utf8")).digest()
+        # 0 marks an empty slot.
+        return struct.unpack("<Q", digest[:8])[0] or 1
+
+    def _checksum(self, key_hash, expires, data):
+        return zlib.crc32(struct.pack("<Qd", key_hash, expires) +
+                          data) & 0xffffffff
+
+    def _read(self, slot):
+        """Return the key hash, expiration and data of the slot, or
+        None if the slot is empty or corrupted.
+        """
+        offset = slot * self.slot_size
+        key_hash, expires, length, checksum = self._header.unpack_from(
+            self._map, offset)
+        if not key_hash or length > self.max_data:
+            return None
+        start = offset + self._header.size
+        data = self._map[start:start + length]
+        if self._checksum(key_hash, expires, data) != checksum:
+            return None
+        return key_hash, expires, data
+
+    def _candidates(self, key_hash):
+        first = key_hash % self.slots
+        return [(first + i) % self.slots for i in range(self.ways)]
+
+    def get(self, key):
+        """Return the expiration time and the data for this key, or
+        None if it's not in the table.
+        """
+        key_hash = self._hash(key)
+        now = time.time()
+        for slot in self._candidates(key_hash):
+            entry = self._read(slot)
+            if entry is None or entry[0] != key_hash:
+                continue
+            if entry[1] <= now:
+                return None
+            return entry[1], entry[2]
+        return None
+
+    def set(self, key, data, expires):
+        """Store the data for this key until `expires`."""
+        if len(data) > self.max_data:
+            return
+        key_hash = self._hash(key)
+        now = time.time()
+        target = None
+        oldest = None
+        for slot in self._candidates(key_hash):
+            entry = self._read(slot)
+            if entry is None or entry[0] == key_hash or entry[1] <= now:
+                target = slot
+                break
+            if oldest is None or entry[1] < oldest:
+                oldest = entry[1]
+                target = slot
+        offset = target * self.slot_size
+        # Invalidate the slot first, so a partial write is never read.
+        self._header.pack_into(self._map, offset, 0, 0, 0, 0)
+        start = offset + self._header.size
+        self._map[start:start + len(data)] = data
+        self._header.pack_into(self._map, offset, key_hash, expires,
+                               len(data),
+                               self._checksum(key_hash, expires, data))
+
+    def clear(self):
+        """Remove all the entries."""
+        for slot in range(self.slots):
+            self._header.pack_into(self._map, slot * self.slot_size,
+                                   0, 0, 0, 0)
+
+
+class DNSCache(object):
+    """Bounded LRU cache for DNS answers keyed by (qname, qtype).
+
+    Answers are kept until their TTL expires, but never longer than
+    `max_ttl`. NXDOMAIN and NoAnswer results are cached as empty answers
+    with the negative TTL from the SOA record of the response, or
+    `negative_ttl` if there is none. Failures like timeouts are never
+    cached.
+
+    If `backend` is set to a `SharedDNSCache`, the responses are also
+    stored there in wire format and the answers missing from this
+    cache are looked up in it.
+
+    :param max_size: The number of answers kept, 0 disables the cache.
+    :param max_ttl: The maximum number of seconds an answer is kept.
+    :param negative_ttl: The default number of seconds negative
+      answers are kept.
+    """
+    backend = None
+
+    def __init__(self, max_size=10000, max_ttl=86400, negative_ttl=300):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._stats = {"hits": 0, "shared_hits": 0, "misses": 0,
+                       "evictions": 0}
+
+    def __getstate__(self):
+        odict = self.__dict__.copy()
+        del odict['_lock']
+        # The shared memory is only inherited by forking.
+        odict.pop('backend', None)
+        odict['_entries'] = collections.OrderedDict()
+        return odict
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Remove all the cached answers, including the shared ones."""
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+    def stats(self):
+        """Return the hits (from this cache and from the shared one),
+        misses and evictions and the current size of the cache.
+        """
+        with self._lock:
+            result = dict(self._stats)
+            result["size"] = len(self._entries)
+        return result
+
+    def _count(self, name):
+        self._stats[name] += 1
+        oa.metrics.incr("dns_cache_%s" % name)
+
+    def get(self, qname, qtype):
+        """Return the cached answer or None if there is no valid
+        answer in the cache.
+        """
+        key = (qname.lower(), qtype)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] > time.time():
+                # Most recently used.
+                self._entries[key] = entry
+                self._count("hits")
+                return entry[1]
+        if self.backend is not None and self.max_size > 0:
+            answer = self._get_shared(qname, qtype)
+            if answer is not None:
+                with self._lock:
+                    self._count("shared_hits")
+                return answer
+        with self._lock:
+            self._count("misses")
+        return None
+
+    def _get_shared(self, qname, qtype):
+        """Get the answer from the shared cache and keep it in
+        this one too.
+        """
+        entry = self.backend.get(self._shared_key(qname, qtype))
+        if entry is None:
+            return None
+        expires, data = entry
+        if not data:
+            answer = []
+        else:
+            try:
+                answer = self._load_answer(qname, qtype, data)
+            except (dns.exception.DNSException, ValueError,
+                    struct.error) as e:
+                logging.getLogger("oa-logger").info(
+                    "Invalid shared DNS answer for %s (%s): %s",
+                    qname, qtype, e)
+                return None
+            answer.expiration = expires
+        self._store(qname, qtype, answer, expires)
+        return answer
+
+    @staticmethod
+    def _shared_key(qname, qtype):
+        return "%s/%s" % (qname.lower(), qtype)
+
+    @staticmethod
+    def _load_answer(qname, qtype, data):
+        """Create the answer from the response in wire format."""
+        if qtype == "PTR":
+            name = dns.reversename.from_address(qname)
+        else:
+            name = dns.name.from_text(qname)
+        if not isinstance(qtype, int):
+            qtype = dns.rdatatype.from_text(qtype)
+        response = dns.message.from_wire(data)
+        return dns.resolver.Answer(name, qtype, dns.rdataclass.IN, response)
+
+    def set(self, qname, qtype, answer, ttl, data=b""):
+        """Cache the answer for `ttl` seconds. If there is a shared
+        cache `data` is stored in it, the response in wire format or
+        nothing for negative answers.
+        """
+        ttl = min(ttl, self.max_ttl)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+        expires = time.time() + ttl
+        self._store(qname, qtype, answer, expires)
+        if self.backend is not None and data is not None:
+            self.backend.set(self._shared_key(qname, qtype), data, expires)
+
+    def _store(self, qname, qtype, answer, expires):
+        key = (qname.lower(), qtype)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, answer)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._count("evictions")
+
+    def set_answer(self, qname, qtype, answer):
+        """Cache a positive answer according to its TTL."""
+        try:
+            ttl = float(answer.expiration) - time.time()
+        except (AttributeError, TypeError, ValueError):
+            return
+        data = None
+        if self.backend is not None:
+            try:
+                data = answer.response.to_wire()
+            except (AttributeError, dns.exception.DNSException) as e:
+                logging.getLogger("oa-logger").debug(
+                    "Unable to share DNS answer for %s (%s): %s",
+                    qname, qtype, e)
+        self.set(qname, qtype, answer, ttl, data)
+
+    def set_negative(self, qname, qtype, error):
+        """Cache an empty answer for a NXDOMAIN or NoAnswer error."""
+        self.set(qname, qtype, [], self._negative_ttl(error))
+
+    def _negative_ttl(self, error):
+        """Get the negative TTL from the SOA record in the authority
+        section of the response (RFC 2308), if there is one.
+        """
+        try:
+            response = error.kwargs["response"]
+        except (AttributeError, KeyError, TypeError):
+            try:
+                response = error.response(error.kwargs["qnames"][0])
+            except (AttributeError, IndexError, KeyError, TypeError):
+                return self.negative_ttl
+        try:
+            for rrset in response.authority:
+                if rrset.rdtype == dns.rdatatype.SOA:
+                    return min(rrset.ttl, rrset[0].minimum)
+        except (AttributeError, IndexError, TypeError):
+            pass
+        return self.negative_ttl
+
+
+class PendingQuery(object):
+    """A query started with `DNSInterface.query_async`."""
+
+    def __init__(self, qname, qtype):
+        self.qname = qname
+        self.qtype = qtype
+        self._result = []
+        self._done = threading.Event()
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait at most `timeout` seconds for the answer. An empty
+        answer is returned if it's not available by then.
+        """
+        if not self._done.wait(timeout):
+            return []
+        return self._result
+
+
+class DNSBudget(object):
+    """The total number of seconds the DNS lookups of one message may
+    take, counted from when it is created. Once it's spent the lookups
+    are treated as unavailable.
+
+    :param seconds: The budget, 0 for no limit.
+    """
+
+    def __init__(self, seconds=0):
+        self.log = logging.getLogger("oa-logger")
+        self.deadline = None
+        if seconds:
+            self.deadline = time.time() + seconds
+        # Number of lookups skipped or abandoned.
+        self.skipped = 0
+
+    @property
+    def exhausted(self):
+        return self.skipped > 0
+
+    def spent(self):
+        return self.deadline is not None and self.deadline <= time.time()
+
+    def get_timeout(self, timeout=None):
+        """Limit the timeout to what is left of the budget, None
+        means no limit.
+        """
+        if self.deadline is None:
+            return timeout
+        remaining = max(0, self.deadline - time.time())
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+    def skip(self, qname, qtype):
+        """Count a lookup that isn't done because the budget is
+        spent.
+        """
+        if not self.skipped:
+            oa.metrics.incr("dns_budget_exhausted")
+        self.skipped += 1
+        oa.metrics.incr("dns_budget_skipped")
+        self.log.info("DNS budget spent, skipping %s (%s)", qname, qtype)
+
+    def wait(self, pending, timeout=None):
+        """Wait for the answer of a `PendingQuery`, at most `timeout`
+        seconds and no longer than the budget allows.
+        """
+        result = pending.result(self.get_timeout(timeout))
+        if not pending.done() and self.spent():
+            self.skip(pending.qname, pending.qtype)
+        return result
+
+
+class _QueryPool(object):
+    """The threads that run the queries started in the background. They
+    are shared by all the interfaces of the process, and started again
+    in forked processes.
+    """
+    size = 16
+
+    def __init__(self):
+        self.log = logging.getLogger("oa-logger")
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+
+    def submit(self, func, pending):
+        """Call `func` with the query name and type in a thread, and
+        set the result of the pending query.
+        """
+        pid = os.getpid()
+        with self._lock:
+            if self._pid != pid:
+                self._queue = queue.Queue()
+                self._pid = pid
+                for dummy in range(self.size):
+                    thread = threading.Thread(target=self._run,
+                                              args=(self._queue,))
+                    thread.daemon = True
+                    thread.start()
+            self._queue.put((func, pending))
+
+    def _run(self, query_queue):
+        while True:
+            func, pending = query_queue.get()
+            try:
+                result = func(pending.qname, pending.qtype)
+            except Exception as e:
+                self.log.warning("Failed to query %s (%s): %s",
+                                 pending.qname, pending.qtype, e)
+                result = []
+            pending.set_result(result)
+
+
+_query_pool = _QueryPool()
+
 
 class DNSInterface(object):
     """Interface for various dns related actions"""
@@ -37,25 +482,44 @@ class DNSInterface(object):
         "yahoo.com",
     ]
 
+    # The DNS budget of each message in seconds, 0 for no limit.
+    message_budget = 0
+    # The number of failed probes in a row after which DNS is
+    # considered unavailable, and successful ones after which it is
+    # considered available again.
+    test_failures = 3
+    test_successes = 2
+
     def __init__(self):
         self.log = logging.getLogger("oa-logger")
         self._resolver = dns.resolver.Resolver()
-        self.query_restrictions = {}
-        self.next_test = datetime.datetime.now()
+        self.cache = DNSCache()
+        self._query_restrictions = {}
         self._test_interval = datetime.timedelta(seconds=600)
         self.test = False
         self._resolver.edns = 0
         self._resolver.rotate = False
         self._available = True
+        self._test_lock = threading.Lock()
+        self._probe_stop = threading.Event()
+        self._probe_pid = None
+        self._probe_failures = 0
+        self._probe_successes = 0
+        self._probed = False
 
     def __getstate__(self):
         odict = self.__dict__.copy()  # copy the dict since we change it
         del odict['_resolver']
+        del odict['_test_lock']
+        del odict['_probe_stop']
+        odict['_probe_pid'] = None
         return odict
 
     def __setstate__(self, d):
         self.__dict__.update(d)
         self._resolver = dns.resolver.Resolver()
+        self._test_lock = threading.Lock()
+        self._probe_stop = threading.Event()
 
     @property
     def port(self):
@@ -65,6 +529,22 @@ class DNSInterface(object):
     def port(self, port):
         self._resolver.port = port
 
+    @property
+    def timeout(self):
+        return self._resolver.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._resolver.timeout = timeout
+
+    @property
+    def lifetime(self):
+        return self._resolver.lifetime
+
+    @lifetime.setter
+    def lifetime(self, lifetime):
+        self._resolver.lifetime = lifetime
+
     @property
     def rotate_nameservers(self):
         return self._resolver.rotate
@@ -117,28 +597,120 @@ class DNSInterface(object):
     @property
     def available(self):
         """Checks whether the dns is available. Depending on how it is
-        configured a test may be performed to determine the result"""
-        if self.test and self.next_test <= datetime.datetime.now():
-            for qname in random.sample(
-                    set(self.test_qnames), min(3, len(self.test_qnames))):
-                if self._query(qname, "A"):
-                    self._available = True
-                    break
-            else:
-                self._available = False
-            self.next_test = datetime.datetime.now() + self.test_interval
-
+        configured it is tested in the background, and this is the
+        result of the last tests.
+        """
+        if self.test:
+            self._start_probe()
         return self._available
 
     @available.setter
     def available(self, value):
+        self._stop_probe()
         self._available = value == "yes"
+        self.invalidate_cache()
+        self.test = False
         if value.startswith("test"):
+            # Assume it's available until the first test is done.
+            self._available = True
             self.test = True
             if ":" in value:
                 test_servers = value.split(":")[1].split()
                 self.test_qnames = test_servers
 
+    def _start_probe(self):
+        """Start the thread that tests the availability, if it's not
+        already running in this process.
+        """
+        pid = os.getpid()
+        if self._probe_pid == pid:
+            return
+        with self._test_lock:
+            if self._probe_pid == pid:
+                return
+            self._probe_pid = pid
+            thread = threading.Thread(target=self._run_probe,
+                                      args=(self._probe_stop,))
+            thread.daemon = True
+            thread.start()
+
+    def _stop_probe(self):
+        with self._test_lock:
+            self._probe_stop.set()
+            self._probe_stop = threading.Event()
+            self._probe_pid = None
+            self._probe_failures = 0
+            self._probe_successes = 0
+            self._probed = False
+
+    def _run_probe(self, stop):
+        while not stop.is_set():
+            try:
+                self.probe()
+            except Exception as e:
+                self.log.warning("Failed to test the DNS availability: %s",
+                                 e)
+            stop.wait(self.test_interval.total_seconds())
+
+    def probe(self):
+        """Query some of the test names and update the availability.
+
+        The result of the first test is used as is, after that the
+        availability only changes after `test_failures` failed or
+        `test_successes` successful tests in a row.
+
+        :return: True if any of the names could be resolved.
+        """
+        qnames = sorted(set(self.test_qnames))
+        qnames = random.sample(qnames, min(3, len(qnames)))
+        success = any(self._query(qname, "A") for qname in qnames)
+        if success:
+            self._probe_failures = 0
+            self._probe_successes += 1
+            if not self._probed or (
+                    not self._available and
+                    self._probe_successes >= self.test_successes):
+                self._set_available(True)
+        else:
+            self._probe_successes = 0
+            self._probe_failures += 1
+            if not self._probed or (
+                    self._available and
+                    self._probe_failures >= self.test_failures):
+                self._set_available(False)
+        self._probed = True
+        oa.metrics.set_gauge("dns_available", int(self._available))
+        return success
+
+    def _set_available(self, available):
+        if available != self._available:
+            oa.metrics.incr("dns_available_changes")
+            if available:
+                self.log.info("DNS is available again")
+            else:
+                self.log.warning("DNS is not available")
+        self._available = available
+
+    def invalidate_cache(self):
+        """Remove all the cached answers, called whenever the options
+        that change the result of the queries are changed.
+        """
+        self.cache.clear()
+
+    @property
+    def query_restrictions(self):
+        return self._query_restrictions
+
+    @query_restrictions.setter
+    def query_restrictions(self, restrictions):
+        self._query_restrictions = restrictions
+        self.invalidate_cache()
+
+    def add_query_restriction(self, qname, deny):
+        """Allow or deny querying this domain and its subdomains."""
+        self._query_restrictions[qname] = deny
+        self.invalidate_cache()
+
     def is_query_restricted(self, qname):
         """Checks whether the qname is restricted by the dns_query_restriction
         option if the qname or one of it's parent domains matches an entry in
@@ -161,13 +733,27 @@ class DNSInterface(object):
             except IndexError:
                 return False
 
-    def query(self, qname, qtype="A"):
+    def new_budget(self):
+        """Return a new `DNSBudget` for a message."""
+        return DNSBudget(self.message_budget)
+
+    def query(self, qname, qtype="A", budget=None):
         """This method should be used for any DNS queries.
 
         :param qname: The DNS question.
         :param qtype: The DNS query type.
+        :param budget: The optional `DNSBudget` of the message. The
+          query is skipped if it's spent, and abandoned once it's
+          spent.
         :return: The result of the DNS query.
         """
+        lifetime = None
+        if budget is not None and budget.deadline is not None:
+            if budget.spent():
+                budget.skip(qname, qtype)
+                return []
+            # Resolved in this thread, in what is left of the budget.
+            lifetime = budget.get_timeout(self.lifetime)
 
         if self.is_query_restricted(qname):
             self.log.debug("Querying %s is restricted", qname)
@@ -177,25 +763,72 @@ class DNSInterface(object):
             self.log.debug("DNS querying is not available")
             return []
 
-        self.log.debug("Querying %s for %s record", qname, qtype)
-        return self._query(qname, qtype)
+        result = self.cache.get(qname, qtype)
+        if result is not None:
+            return result
+        result = self._query(qname, qtype, cache=True, lifetime=lifetime)
+        if not result and lifetime is not None and budget.spent():
+            # Abandoned when the budget ran out.
+            budget.skip(qname, qtype)
+        return result
+
+    def query_async(self, qname, qtype="A"):
+        """Start the query in the background, like `query`.
 
-    def _query(self, qname, qtype):
-        self.log.debug("Querying %s %s", qname, qtype)
+        :return: A `PendingQuery` to get the result from.
+        """
+        pending = PendingQuery(qname, qtype)
+        if self.is_query_restricted(qname) or not self.available:
+            # Never queried.
+            pending.set_result(self.query(qname, qtype))
+            return pending
+        result = self.cache.get(qname, qtype)
+        if result is not None:
+            pending.set_result(result)
+        else:
+            _query_pool.submit(functools.partial(self._query, cache=True),
+                               pending)
+        return pending
+
+    def _query(self, qname, qtype, cache=False, lifetime=None):
+        debug = self.log.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.log.debug("Querying %s %s", qname, qtype)
+        key = qname
         if qtype == "PTR":
             qname = dns.reversename.from_address(qname)
         try:
-            result = self._resolver.query(qname, qtype)
-            self.log.debug("Got %s for %s %s", result, qname, qtype)
+            if lifetime is None:
+                result = self._resolver.query(qname, qtype)
+            else:
+                result = self._resolver.query(qname, qtype,
+                                              lifetime=lifetime)
+            if debug:
+                self.log.debug("Got %s for %s %s", result, qname, qtype)
+            if cache:
+                self.cache.set_answer(key, qtype, result)
             return result
-        except (dns.resolver.NoAnswer, dns.resolver.NoNameservers,
-                dns.resolver.NXDOMAIN, dns.exception.Timeout) as e:
+        except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN) as e:
+            self.log.warn("Failed to resolve %s (%s): %s", qname, qtype, e)
+            if cache:
+                self.cache.set_negative(key, qtype, e)
+            return []
+        except (dns.resolver.NoNameservers, dns.exception.Timeout) as e:
             self.log.warn("Failed to resolve %s (%s): %s", qname, qtype, e)
             return []
         except (ValueError, IndexError, struct.error) as e:
             self.log.info("Invalid DNS entry %s (%s): %s", qname, qtype, e)
             return []
 
-    def reverse_ip(self, ip):
-        reversed_ip = str(dns.reversename.from_address(ip.exploded))
-        return reversed_ip.rstrip(".").rsplit(".", 2)[0]
+    @staticmethod
+    def reverse_ip(ip):
+        """Get the labels of this `ipaddress` address in the order
+        they are looked up in the DNS lists, without the in-addr.arpa
+        or ip6.arpa suffix.
+        """
+        if ip.version == 6 and ip.ipv4_mapped:
+            # Looked up as the IPv4 address, like dns.reversename does.
+            ip = ip.ipv4_mapped
+        if ip.version == 4:
+            return ".".join(reversed(str(ip).split(".")))
+        return ".".join(reversed(ip.exploded.replace(":", "")))
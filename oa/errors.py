@@ -90,3 +90,15 @@ class ProtocolError(PADError):
 
 class InvalidOption(ProtocolError):
     """Invalid command option provided."""
+
+
+class InvalidMessage(ProtocolError):
+    """The message sent by the client can't be used."""
+
+
+class MessageTooLarge(InvalidMessage):
+    """The message is larger than the maximum size accepted."""
+
+
+class ReadTimeout(ProtocolError):
+    """The client took too long to send the request."""
@@ -0,0 +1,165 @@
+"""Locality sensitive fingerprints to find near duplicate messages.
+
+Campaigns often personalize each copy of a message (a greeting, a
+tracking URL), so the copies never have the same digest. The simhash of
+the body tokens only changes a few bits for such small changes, and the
+messages whose fingerprints differ in at most `max_distance` bits are
+considered near duplicates.
+"""
+
+from __future__ import absolute_import
+
+import re
+import time
+import hashlib
+import threading
+import collections
+
+from oa.regex import Regex
+
+# Like the tokens used by the Bayes plugin.
+_TOKEN_RE = Regex(r"[\w,@*!'\"$.-]+", re.UNICODE)
+_TRIM_RE = Regex(r"^[-'\".,]+|[-'\".,]+$")
+MAX_TOKEN_LENGTH = 15
+FINGERPRINT_BITS = 64
+
+
+def body_tokens(text):
+    """Split the text of the message in tokens, like the Bayes plugin
+    does. Tokens shorter than 3 characters are skipped and the long
+    ones are shortened.
+    """
+    for token in _TOKEN_RE.findall(text):
+        token = _TRIM_RE.sub("", token).lower()
+        if len(token) < 3:
+            continue
+        if len(token) > MAX_TOKEN_LENGTH:
+            token = "sk:" + token[:7]
+        yield token
+
+
+def simhash(tokens, bits=FINGERPRINT_BITS):
+    """Return the simhash of the tokens as an integer. Each token is
+    weighted by the number of times it appears.
+    """
+    weights = [0] * bits
+    for token, count in collections.Counter(tokens).items():
+        digest = hashlib.md5(token.encode("utf8", "ignore")).hexdigest()
+        value = int(digest[:bits // 4], 16)
+        for bit in range(bits):
+            if value & (1 << bit):
+                weights[bit] += count
+            else:
+                weights[bit] -= count
+    fingerprint = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def distance(fingerprint1, fingerprint2):
+    """Return the number of bits that differ between the fingerprints."""
+    return bin(fingerprint1 ^ fingerprint2).count("1")
+
+
+def message_fingerprint(msg, min_tokens=20):
+    """Return the fingerprint of the text of the message, or None if
+    it's too short to be compared with others.
+    """
+    tokens = list(body_tokens(msg.text))
+    if len(tokens) < min_tokens:
+        return None
+    return simhash(tokens)
+
+
+class NearDuplicateIndex(object):
+    """In-memory index of the recent fingerprints and their values.
+
+    The fingerprints are split in `max_distance + 1` bands. Two
+    fingerprints that differ in at most `max_distance` bits have at
+    least one band in common, so only the fingerprints with a common
+    band are compared.
+
+    :param max_size: The number of fingerprints kept in the index.
+    :param max_distance: The number of bits that can differ.
+    :param ttl: Number of seconds the values are used for.
+    """
+
+    def __init__(self, max_size=1024, max_distance=3, ttl=300,
+                 bits=FINGERPRINT_BITS):
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.bits = bits
+        if not 0 <= max_distance < bits:
+            raise ValueError("The distance must be between 0 and %s" %
+                             (bits - 1))
+        bands = max_distance + 1
+        width = bits // bands
+        # The last band also takes the remaining bits.
+        self._bands = [(i * width, width if i < bands - 1 else
+                        bits - i * width) for i in range(bands)]
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._index = collections.defaultdict(set)
+
+    def _keys(self, fingerprint):
+        """Return the band keys of this fingerprint."""
+        return [(i, (fingerprint >> start) & ((1 << width) - 1))
+                for i, (start, width) in enumerate(self._bands)]
+
+    def _remove(self, fingerprint):
+        """Remove the fingerprint from the index."""
+        del self._entries[fingerprint]
+        for key in self._keys(fingerprint):
+            candidates = self._index[key]
+            candidates.discard(fingerprint)
+            if not candidates:
+                del self._index[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, fingerprint, value):
+        """Add the fingerprint with its value to the index."""
+        with self._lock:
+            if fingerprint in self._entries:
+                self._remove(fingerprint)
+            self._entries[fingerprint] = (time.time() + self.ttl, value)
+            for key in self._keys(fingerprint):
+                self._index[key].add(fingerprint)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def find(self, fingerprint, accept=None):
+        """Return the value of the closest fingerprint in the index and
+        its distance, or None if there isn't any close enough.
+
+        :param accept: Optional function called with the values of the
+          close fingerprints, the ones it returns False for are ignored.
+        """
+        now = time.time()
+        best = None
+        with self._lock:
+            candidates = set()
+            for key in self._keys(fingerprint):
+                candidates.update(self._index.get(key, ()))
+            for candidate in candidates:
+                expires, value = self._entries[candidate]
+                if expires <= now:
+                    self._remove(candidate)
+                    continue
+                dist = distance(fingerprint, candidate)
+                if dist > self.max_distance or (best is not None and
+                                                dist >= best[1]):
+                    continue
+                if accept is None or accept(value):
+                    best = (value, dist)
+        return best
+
+    def clear(self):
+        """Remove all the fingerprints."""
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
@@ -130,13 +130,27 @@ DEFAULT_SENDERH = (
 class Message(oa.context.MessageContext):
     """Internal representation of an email message. Used for rule matching."""
 
-    def __init__(self, global_context, raw_msg):
+    def __init__(self, global_context, raw_msg, local_only=False):
         """Parse the message, extracts and decode all headers and all
-        text parts.
+        text parts. The raw message can be passed as bytes.
+
+        If `local_only` is set, the network and Bayes rules are not
+        checked for this message (plugins should also avoid any
+        network lookups).
         """
+        self.local_only = local_only
+        # The total time the DNS lookups of this message may take.
+        self.dns_budget = global_context.dns.new_budget()
         self.missing_boundary_header = False
         self.missing_header_body_separator = False
         super(Message, self).__init__(global_context)
+        if type(raw_msg) is bytes and PY3:
+            try:
+                raw_msg = raw_msg.decode("utf-8")
+            except UnicodeDecodeError:
+                # 8-bit messages in other charsets, keep every byte
+                # so the parts can be decoded with their own charset.
+                raw_msg = raw_msg.decode("iso-8859-1")
         self.raw_msg = self.translate_line_breaks(raw_msg)
         self.msg = email.message_from_string(self.raw_msg)
         self.headers = _Headers()
@@ -164,7 +178,13 @@ class Message(oa.context.MessageContext):
         self.last_trusted_relay_index = 0
         self.trusted_relays = []
         self.untrusted_relays = []
+        # The names the DNS lookups of the plugins are built from.
+        self.untrusted_ips = []
+        self.reversed_untrusted_ips = []
+        self.sender_domain = ""
+        self.from_domains = []
         self._parse_message()
+        self._parse_lookup_names()
         self._hook_parsed_metadata()
 
     def clear_matches(self):
@@ -246,6 +266,19 @@ class Message(oa.context.MessageContext):
                if ip not in self.ctxt.networks.trusted]
         return ips
 
+    def _parse_lookup_names(self):
+        """Compute the untrusted IPs, their reversed labels and the
+        sender domains once, for all the plugins and rules that look
+        them up.
+        """
+        self.untrusted_ips = self.get_untrusted_ips()
+        reverse_ip = self.ctxt.dns.reverse_ip
+        self.reversed_untrusted_ips = [reverse_ip(ip)
+                                       for ip in self.untrusted_ips]
+        self.sender_domain = self.sender_address.rpartition("@")[2].strip()
+        self.from_domains = [addr.rpartition("@")[2].strip()
+                             for addr in self.get_addr_header("From")]
+
     def get_header_ips(self):
         values = list()
         for header in self.received_headers:
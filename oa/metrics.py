@@ -0,0 +1,67 @@
+"""Counters and gauges that describe the state of the daemon.
+
+The values are kept per process and are safe to update from several
+threads. Counters only go up (e.g. the number of timeouts), gauges are
+set to the current value of something (e.g. the open connections).
+
+Pre forked workers send their values to the main process, which logs the
+totals with the load of the workers. The STATS command returns the values
+of the process that handles it.
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+
+
+def incr(name, value=1):
+    """Increment the counter with this name."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    """Set the current value of the gauge with this name."""
+    with _lock:
+        _gauges[name] = value
+
+
+def add_gauge(name, value=1):
+    """Add to the current value of the gauge with this name,
+    the value can be negative.
+    """
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0) + value
+
+
+def get(name, default=0):
+    """Return the current value of a counter or gauge."""
+    with _lock:
+        if name in _gauges:
+            return _gauges[name]
+        return _counters.get(name, default)
+
+
+def get_counters():
+    """Return a copy of the counters only."""
+    with _lock:
+        return dict(_counters)
+
+
+def snapshot():
+    """Return a copy of all the counters and gauges as a dictionary."""
+    with _lock:
+        result = dict(_counters)
+        result.update(_gauges)
+    return result
+
+
+def reset():
+    """Clear all the values, e.g. in a newly forked worker."""
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
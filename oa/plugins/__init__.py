@@ -47,6 +47,8 @@ REIMPLEMENTED_PLUGINS = {
         "oa.plugins.mime_eval.MIMEEval",
     "Mail::SpamAssassin::Plugin::URIEval":
         "oa.plugins.uri_eval.URIEvalPlugin",
+    "Mail::SpamAssassin::Plugin::URIDNSBL":
+        "oa.plugins.uri_dnsbl.URIDNSBLPlugin",
     "Mail::SpamAssassin::Plugin::AutoLearnThreshold":
         "oa.plugins.auto_learn_threshold.AutoLearnThreshold",
     "Mail::SpamAssassin::Plugin::Bayes": "oa.plugins.bayes.BayesPlugin",
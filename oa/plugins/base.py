@@ -77,6 +77,11 @@ class BasePlugin(oa.conf.Conf, object):
     been initialized.
     """
     eval_rules = tuple()
+    # The eval rules whose result only depends on the body, the untrusted
+    # relays, the sender domain and the usual sender headers (From,
+    # Subject, ...), so it can be reused for copies of the same message.
+    # All the other eval rules are checked again, see oa.result_cache.
+    cacheable_eval_rules = tuple()
     # Defines any new rules that the plugins implements.
     cmds = None
     # See oa.conf.Conf for details on options.
@@ -20,7 +20,9 @@ The results are incorporated into SpamAssassin as the BAYES_* rules.
 import re
 import time
 import math
+import logging
 import hashlib
+import threading
 
 import oa.plugins.base
 from oa.regex import Regex
@@ -485,6 +487,12 @@ class BayesPlugin(oa.plugins.base.BasePlugin):
     eval_rules = ("check_bayes",)
     store = None
 
+    def __init__(self, ctxt):
+        super(BayesPlugin, self).__init__(ctxt)
+        # The store keeps the database tied between calls, so only
+        # one message at a time can use it.
+        self.store_lock = threading.RLock()
+
     @property
     def dsn(self):
         return self['bayes_sql_dsn']
@@ -499,34 +507,40 @@ class BayesPlugin(oa.plugins.base.BasePlugin):
         return self['bayes_sql_password']
 
     def check_start(self, msg):
-        self['use_bayes'] = self.ctxt.conf['use_bayes']
         self.set_local(msg, 'learned', 0)
         self.set_local(msg, 'bayes_token_info_hammy', [])
         self.set_local(msg, 'bayes_token_info_spammy', [])
         self.set_local(msg, 'count', 0)
-        self['rendered'] = [msg.msg['subject'] or '\n']
-        self['visible_rendered'] = [msg.msg['subject'] or '\n']
-        self['invisible_rendered'] = []
+        self.set_local(msg, 'rendered', [msg.msg['subject'] or '\n'])
+        self.set_local(msg, 'visible_rendered', [msg.msg['subject'] or '\n'])
+        self.set_local(msg, 'invisible_rendered', [])
 
     def extract_metadata(self, msg, payload, text, part):
         if part.get_content_type() == 'text/plain':
-            self['rendered'].append(text)
-            self['visible_rendered'].append(text)
+            self.get_local(msg, 'rendered').append(text)
+            self.get_local(msg, 'visible_rendered').append(text)
         if part.get_content_type() == 'text/html':
             # XXX SA parses these and checks for [in]visible content
             pass
 
     def parsed_metadata(self, msg):
-        self.ctxt.log.debug("rendered body %s", self['rendered'])
-        self.ctxt.log.debug("invisible body %s", self['invisible_rendered'])
-        self['rendered'] = "\n".join(self['rendered'])
-        self['invisible_rendered'] = "\n".join(self['invisible_rendered'])
-        self[u"bayes_token_body"] = self.get_body_text_array_common(self["rendered"])
-        self[u'bayes_token_inviz'] = self.get_body_text_array_common(self["invisible_rendered"])
-        self[u'bayes_token_uris'] = []  # self.get_uri_list()
+        rendered = self.get_local(msg, 'rendered')
+        invisible_rendered = self.get_local(msg, 'invisible_rendered')
+        self.ctxt.log.debug("rendered body %s", rendered)
+        self.ctxt.log.debug("invisible body %s", invisible_rendered)
+        rendered = "\n".join(rendered)
+        invisible_rendered = "\n".join(invisible_rendered)
+        self.set_local(msg, 'rendered', rendered)
+        self.set_local(msg, 'invisible_rendered', invisible_rendered)
+        self.set_local(msg, u"bayes_token_body",
+                       self.get_body_text_array_common(rendered))
+        self.set_local(msg, u'bayes_token_inviz',
+                       self.get_body_text_array_common(invisible_rendered))
+        self.set_local(msg, u'bayes_token_uris', [])  # self.get_uri_list()
 
     def finish_parsing_end(self, ruleset):
         super(BayesPlugin, self).finish_parsing_end(ruleset)
+        self['use_bayes'] = self.ctxt.conf['use_bayes']
         self.store = Store(self)
 
     def check_end(self, ruleset, msg):
@@ -614,11 +628,12 @@ class BayesPlugin(oa.plugins.base.BasePlugin):
         if not self["use_bayes"]:
             return
         # XXX In SA, there is a time limit set here.
-        if self.store.tie_db_writeable():
-            ret = self._learn_trapped(isspam, msg)
-            if not self.learn_caller_will_untie:
-                self.store.untie_db()
-            return ret
+        with self.store_lock:
+            if self.store.tie_db_writeable():
+                ret = self._learn_trapped(isspam, msg)
+                if not self.learn_caller_will_untie:
+                    self.store.untie_db()
+                return ret
         return None
 
     def _learn_trapped(self, isspam, msg):
@@ -694,11 +709,12 @@ class BayesPlugin(oa.plugins.base.BasePlugin):
         if not self["use_bayes"]:
             return
         # XXX SA wraps this in a timer.
-        if self.store.tie_db_writeable():
-            ret = self._forget_trapped(msg, msgid)
-            if not self.learn_caller_will_untie:
-                self.store.untie_db()
-            return ret
+        with self.store_lock:
+            if self.store.tie_db_writeable():
+                ret = self._forget_trapped(msg, msgid)
+                if not self.learn_caller_will_untie:
+                    self.store.untie_db()
+                return ret
         return None
 
     def _forget_trapped(self, msg, msgid):
@@ -765,11 +781,11 @@ class BayesPlugin(oa.plugins.base.BasePlugin):
     def tokenise(self, msg):
         """Convert the message to a sequence of tokens."""
         tokens = []
-        for line in self["bayes_token_body"]:
+        for line in self.get_local(msg, "bayes_token_body"):
             tokens.extend(self._tokenise_line(line, "", 1))
-        for line in self['bayes_token_uris']:
+        for line in self.get_local(msg, 'bayes_token_uris'):
             tokens.extend(self._tokenise_line(line, "", 2))
-        for line in self['bayes_token_inviz']:
+        for line in self.get_local(msg, 'bayes_token_inviz'):
             if ADD_INVIZ_TOKENS_I_PREFIX:
                 tokens.extend(self._tokenise_line(line, "I*:", 1))
             if ADD_INVIZ_TOKENS_NO_PREFIX:
@@ -954,8 +970,8 @@ class BayesPlugin(oa.plugins.base.BasePlugin):
             parsed[header] = u"%s %s" % (parsed[header], val)
         else:
             parsed[header] = val
-        self.ctxt.log.debug(
-            u'bayes: header tokens for %s = "%s"' % (header, parsed[header]))
+        self.ctxt.log.debug(u'bayes: header tokens for %s = "%s"',
+                            header, parsed[header])
         return header
 
     @staticmethod
@@ -1069,7 +1085,8 @@ class BayesPlugin(oa.plugins.base.BasePlugin):
             return False
 
         # XXX SA has a timer here.
-        bayes_score = self.scan(msg)
+        with self.store_lock:
+            bayes_score = self.scan(msg)
         self.set_local(msg, 'bayes_score', bayes_score)
         if bayes_score and (min_score < bayes_score <= max_score):
 
@@ -1200,6 +1217,7 @@ class BayesPlugin(oa.plugins.base.BasePlugin):
 
         sorted_tokens = []
         touch_tokens = []
+        debug = self.ctxt.log.isEnabledFor(logging.DEBUG)
         for tok in pw_keys:
             if tok_strength[tok] < MIN_PROB_STRENGTH:
                 continue
@@ -1224,7 +1242,9 @@ class BayesPlugin(oa.plugins.base.BasePlugin):
             # Update the atime on this token; it proved useful.
             touch_tokens.append(tok)
 
-            self.ctxt.log.debug("bayes: token '%s' => %s", raw_token, pw_prob)
+            if debug:
+                self.ctxt.log.debug("bayes: token '%s' => %s", raw_token,
+                                    pw_prob)
 
         if not sorted_tokens or (0 < len(sorted_tokens) <= REQUIRE_SIGNIFICANT_TOKENS_TO_SCORE):
             self.ctxt.log.debug("bayes: cannot use bayes on this message; "
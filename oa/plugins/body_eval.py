@@ -37,6 +37,7 @@ class BodyEval(oa.plugins.base.BasePlugin):
         "tvd_vertical_words",
         "check_stock_info",
     )
+    cacheable_eval_rules = eval_rules
 
     def check_start(self, msg):
         """Initialize a empty list that will contain all
@@ -18,16 +18,6 @@ FROM_HEADERS = ('From', "Envelope-Sender", 'Resent-From', 'X-Envelope-From',
 class DKIMPlugin(oa.plugins.base.BasePlugin):
     signatures = ""
     valid_signatures = ""
-    author_addresses = []
-    author_domains = []
-
-    dkim_checked_signature = 0
-    dkim_signed = 0
-    dkim_valid = 0
-    dkim_has_valid_author_sig = 0
-    dkim_signatures_dependable = 0
-    is_valid = 1
-    match_adsp = 0
 
     eval_rules = (
         "check_dkim_adsp",
@@ -57,29 +47,34 @@ class DKIMPlugin(oa.plugins.base.BasePlugin):
         "U": "unknown"
     }
 
-    def get_txt(self, name):
+    def get_txt(self, name, budget=None):
         """Return a TXT record associated with a DNS name.
 
         @param name: The bytestring domain name to look up.
+        @param budget: The DNS budget of the message, if any.
         """
         try:
             unicode_name = name.decode('ascii')
         except UnicodeDecodeError:
             return None
-        txt = self.get_txt_dnspython(unicode_name)
+        txt = self.get_txt_dnspython(unicode_name, budget)
         if txt:
             txt = txt.encode('utf-8')
         return txt
 
-    def get_txt_dnspython(self, name):
+    def get_txt_dnspython(self, name, budget=None):
         """Return a TXT record associated with a DNS name."""
         try:
-            a = self.ctxt.dns.query(name, dns.rdatatype.TXT)
-            for r in a.response.answer:
-                if r.rdtype == dns.rdatatype.TXT:
-                    return "".join(r.items[0].strings)
+            a = self.ctxt.dns.query(name, dns.rdatatype.TXT, budget=budget)
         except dns.resolver.NXDOMAIN:
-            pass
+            return None
+        if not a:
+            # No answer, or DNS isn't available.
+            return None
+        for r in a.response.answer:
+            if r.rdtype == dns.rdatatype.TXT:
+                for rdata in r:
+                    return b"".join(rdata.strings).decode("utf-8")
         return None
 
     def get_from_addresses(self, msg):
@@ -110,48 +105,60 @@ class DKIMPlugin(oa.plugins.base.BasePlugin):
                     parsed_list[line[0].encode().replace(b'*', b'.*')] = ""
         return parsed_list
 
+    def check_start(self, msg):
+        """Reset the results of the DKIM checks for this message."""
+        self.set_local(msg, "author_addresses", [])
+        self.set_local(msg, "author_domains", [])
+        self.set_local(msg, "dkim_checked_signature", 0)
+        self.set_local(msg, "dkim_signed", 0)
+        self.set_local(msg, "dkim_valid", 0)
+        self.set_local(msg, "dkim_has_valid_author_sig", 0)
+        self.set_local(msg, "dkim_signatures_dependable", 0)
+        self.set_local(msg, "is_valid", 1)
+        self.set_local(msg, "match_adsp", 0)
+
     def check_dkim_adsp(self, msg, adsp_char="", domains_list=None,
                         target=None):
         """Check Author Domain Signing Practices from any author domains or
         from specified author domains only when there is no valid signature. """
-        if not self.dkim_checked_signature:
+        if not self.get_local(msg, "dkim_checked_signature"):
             self.check_dkim_signature(msg)
-        if self.dkim_valid:
+        if self.get_local(msg, "dkim_valid"):
             return False
         if len(self["adsp_override"]) > 3:
             return False
         parsed_adsp_override = self.parse_input("adsp_override")
-        for author in self.author_domains:
+        for author in self.get_local(msg, "author_domains"):
             if domains_list and domains_list.encode() != author:
                 continue
             if not parsed_adsp_override[author]:
                 if adsp_char == 'D':
-                    self.match_adsp = 1
+                    self.set_local(msg, "match_adsp", 1)
                     return True
             if adsp_char == "*":
-                self.match_adsp = 1
+                self.set_local(msg, "match_adsp", 1)
                 return True
             try:
                 for key in parsed_adsp_override.keys():
                     if Regex(key).search(author) and parsed_adsp_override[key]:
                         if self.adsp_options[adsp_char] == \
                                 parsed_adsp_override[key].lower():
-                            self.match_adsp = 1
+                            self.set_local(msg, "match_adsp", 1)
                             return True
             except KeyError:
                 return False
             except AttributeError:
                 continue
-        if not self.match_adsp and adsp_char == 'U':
+        if not self.get_local(msg, "match_adsp") and adsp_char == 'U':
             return True
         return False
 
     def check_dkim_signed(self, msg, *args, **kwargs):
         """Check if message has a DKIM signature, not necessarily valid.
         """
-        if not self.dkim_checked_signature:
+        if not self.get_local(msg, "dkim_checked_signature"):
             self.check_dkim_signature(msg)
-        if not self.dkim_signed:
+        if not self.get_local(msg, "dkim_signed"):
             return False
         if not args:
             return True
@@ -164,9 +171,9 @@ class DKIMPlugin(oa.plugins.base.BasePlugin):
     def check_dkim_valid(self, msg, *args, **kwargs):
         """Check if message has at least one valid DKIM signature.
         """
-        if not self.dkim_checked_signature:
+        if not self.get_local(msg, "dkim_checked_signature"):
             self.check_dkim_signature(msg)
-        if not self.dkim_valid:
+        if not self.get_local(msg, "dkim_valid"):
             return False
         if not args:
             return True
@@ -179,9 +186,9 @@ class DKIMPlugin(oa.plugins.base.BasePlugin):
     def check_dkim_valid_author_sig(self, msg, *args, **kwargs):
         """Check if message has a valid DKIM signature from author's domain.
         """
-        if not self.dkim_checked_signature:
+        if not self.get_local(msg, "dkim_checked_signature"):
             self.check_dkim_signature(msg)
-        if not self.dkim_has_valid_author_sig:
+        if not self.get_local(msg, "dkim_has_valid_author_sig"):
             return False
         if not args:
             return True
@@ -192,9 +199,9 @@ class DKIMPlugin(oa.plugins.base.BasePlugin):
         return False
 
     def check_dkim_dependable(self, msg, target=None):
-        if not self.dkim_checked_signature:
+        if not self.get_local(msg, "dkim_checked_signature"):
             self.check_dkim_signature(msg)
-        return self.dkim_signatures_dependable
+        return self.get_local(msg, "dkim_signatures_dependable")
 
     def check_for_dkim_whitelist_from(self, msg, target=None):
         """Get all the from addresses and check if they match the
@@ -209,27 +216,30 @@ class DKIMPlugin(oa.plugins.base.BasePlugin):
         return self._check_dkim_whitelist(msg, "def_whitelist_from_dkim")
 
     def _check_dkim_whitelist(self, msg, list_name):
-        if not self.dkim_checked_signature:
+        if not self.get_local(msg, "dkim_checked_signature"):
             self.check_dkim_signature(msg)
-        if not self.dkim_valid:
+        if not self.get_local(msg, "dkim_valid"):
             return False
         whitelist_address = self.parse_input(list_name)
-        for author in self.author_addresses:
+        author_domains = self.get_local(msg, "author_domains")
+        for author in self.get_local(msg, "author_addresses"):
             for key, value in whitelist_address.items():
                 if re.match(key, author.encode()):
                     if value == "":
                         return True
-                    elif value.encode() in self.author_domains:
+                    elif value.encode() in author_domains:
                         return True
         return False
 
     def _get_authors(self, msg):
-        self.author_addresses = msg.get_addr_header("From")
-        for header in self.author_addresses:
+        author_addresses = msg.get_addr_header("From")
+        author_domains = self.get_local(msg, "author_domains")
+        for header in author_addresses:
             match_domain = Regex("@([^@]+?)[ \t]*$").search(header)
             if match_domain:
                 domain = match_domain.group(1)
-                self.author_domains.append(domain.encode())
+                author_domains.append(domain.encode())
+        self.set_local(msg, "author_addresses", author_addresses)
 
     def _check_dkim_signed_by(self, msg, must_be_valid,
                               must_be_author_domain_signature,
@@ -238,16 +248,16 @@ class DKIMPlugin(oa.plugins.base.BasePlugin):
         signature = msg.msg.get('DKIM-Signature', "")
         parsed_signature = dkim.util.parse_tag_value(signature.encode())
         if must_be_valid and acceptable_domains:
-            if not self.is_valid:
+            if not self.get_local(msg, "is_valid"):
                 return False
         try:
             signature_domain = parsed_signature[b'd']
         except KeyError:
             return False
         if must_be_author_domain_signature:
-            if not self.author_domains:
+            if not self.get_local(msg, "author_domains"):
                 self._get_authors(msg)
-            if signature_domain not in self.author_domains:
+            if signature_domain not in self.get_local(msg, "author_domains"):
                 return False
 
         parts = acceptable_domains.split('.')
@@ -260,55 +270,54 @@ class DKIMPlugin(oa.plugins.base.BasePlugin):
         return result
 
     def check_dkim_signature(self, msg):
-        self.dkim_checked_signature = 1
-        self.dkim_signed = 1
-        self.dkim_valid = 1
-        self.dkim_signatures_dependable = 1
-        self.dkim_has_valid_author_sig = 1
+        dkim_signed = 1
+        dkim_valid = 1
+        dkim_signatures_dependable = 1
+        dkim_has_valid_author_sig = 1
         message = msg.raw_msg
 
-        if not self.author_domains:
+        if not self.get_local(msg, "author_domains"):
             self._get_authors(msg)
+        author_domains = self.get_local(msg, "author_domains")
         signature = msg.msg.get('DKIM-Signature', "")
         if not signature:
-            self.dkim_signed = 0
+            dkim_signed = 0
         parsed_signature = dkim.util.parse_tag_value(signature.encode())
         try:
-            if parsed_signature[b'd'] not in self.author_domains:
-                self.dkim_valid = 0
-                self.dkim_signed = 0
-                self.dkim_has_valid_author_sig = 0
-                self.dkim_signatures_dependable = 0
+            if parsed_signature[b'd'] not in author_domains:
+                dkim_valid = 0
+                dkim_signed = 0
+                dkim_has_valid_author_sig = 0
+                dkim_signatures_dependable = 0
         except KeyError:
-            self.dkim_valid = 0
+            dkim_valid = 0
 
         try:
             minimum_key_bits = self["dkim_minimum_key_bits"]
             if minimum_key_bits < 0:
                 minimum_key_bits = 0
-            result = dkim.verify(message.encode(), dnsfunc=self.get_txt,
+            budget = getattr(msg, "dns_budget", None)
+            result = dkim.verify(message.encode(),
+                                 dnsfunc=lambda name, **kwargs: self.get_txt(
+                                     name, budget),
                                  minkey=minimum_key_bits)
             if not result:
-                self.is_valid = 0
-                self.dkim_valid = 0
+                self.set_local(msg, "is_valid", 0)
+                dkim_valid = 0
             dkim.validate_signature_fields(parsed_signature)
         except dkim.MessageFormatError:
-            self.dkim_valid = 0
-            self.dkim_has_valid_author_sig = 0
+            dkim_valid = 0
+            dkim_has_valid_author_sig = 0
         except dkim.ValidationError:
-            self.dkim_valid = 0
-            self.dkim_has_valid_author_sig = 0
+            dkim_valid = 0
+            dkim_has_valid_author_sig = 0
         except dkim.KeyFormatError:
-            self.dkim_valid = 0
-            self.dkim_has_valid_author_sig = 0
-
-
-
-
-
-
-
-
-
-
-
+            dkim_valid = 0
+            dkim_has_valid_author_sig = 0
+        self.set_local(msg, "dkim_checked_signature", 1)
+        self.set_local(msg, "dkim_signed", dkim_signed)
+        self.set_local(msg, "dkim_valid", dkim_valid)
+        self.set_local(msg, "dkim_signatures_dependable",
+                       dkim_signatures_dependable)
+        self.set_local(msg, "dkim_has_valid_author_sig",
+                       dkim_has_valid_author_sig)
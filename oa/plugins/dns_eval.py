@@ -1,13 +1,23 @@
-"""Expose some eval rules that do checks on DNS lists."""
+"""Expose some eval rules that do checks on DNS lists.
+
+All the lookups the rules need for a message are started in the
+background as soon as the message is parsed, the rules only wait
+for the answers that are still missing.
+
+Lists that are mirrored locally can be answered from their rbldnsd
+zone files instead, see `oa.rbldnsd`.
+"""
 
 from __future__ import division
 from __future__ import absolute_import
 
 import re
+import time
 import ipaddress
 
 from builtins import str
 
+import oa.rbldnsd
 import oa.rules.eval_
 import oa.plugins.base
 
@@ -29,6 +39,21 @@ class DNSEval(oa.plugins.base.BasePlugin):
         # Deprecated in SA
         # "check_rbl_results_for",
     )
+    # Only check the untrusted relays, the sender and the From header.
+    cacheable_eval_rules = tuple(rule for rule in eval_rules
+                                 if rule != "check_rbl_accreditor")
+    options = {
+        "rbl_timeout": ("timevalue", 15),
+        "rbl_local_zone": ("append", []),
+        "rbl_local_zone_dir": ("str", ""),
+        "rbl_local_zone_check": ("timevalue", 60),
+    }
+    # The eval rules that look up the untrusted IPs.
+    ip_eval_rules = {
+        "check_rbl": "A",
+        "check_rbl_txt": "TXT",
+        "check_rbl_accreditor": "A",
+    }
 
     def finish_parsing_end(self, ruleset):
         """Configure any multi results RBL checks."""
@@ -48,19 +73,200 @@ class DNSEval(oa.plugins.base.BasePlugin):
             "check_rbl_sub",
         )
         zones = {}
+        # The lookups of each rule, started when a message is parsed.
+        lookups = set()
+        # The subtests and masks of the rules, parsed only once.
+        self["subtests"] = {}
+        self["masks"] = {}
         for rule_list in (ruleset.checked, ruleset.not_checked):
             for rule in rule_list.values():
                 if not isinstance(rule, oa.rules.eval_.EvalRule):
                     continue
                 name = rule.eval_rule_name
+                if name == "check_dns_sender":
+                    lookups.add((name, None, None))
+                if name == "check_rbl_sub" and len(rule.eval_args) > 1:
+                    self._get_mask(rule.eval_args[1])
+                elif (name in self.eval_rules and
+                      len(rule.eval_args) > 2 and rule.eval_args[2]):
+                    self._get_subtest(rule.eval_args[2])
                 if name in ignore_evals or name not in self.eval_rules:
                     continue
+                accreditor = None
+                if name == "check_rbl_accreditor":
+                    try:
+                        accreditor = rule.eval_args[3]
+                    except IndexError:
+                        pass
+                lookups.add((name, rule.eval_args[1], accreditor))
                 # This eval rule actually check one rbl servers
                 # and adds a zone id.
                 zone_id = rule.eval_args[0].rsplit("-")[0].strip()
                 rbl_server = rule.eval_args[1]
                 zones[zone_id] = rbl_server
         self["zones"] = zones
+        self["lookups"] = sorted(lookups, key=str)
+        self["local_zones"] = self._load_local_zones()
+
+    def _load_local_zones(self):
+        """Load the lists that are answered from local zone files,
+        configured as::
+
+            rbl_local_zone <list> <ip4set|ip4trie|dnset> <path>
+        """
+        local_zones = oa.rbldnsd.LocalZones()
+        for line in self["rbl_local_zone"]:
+            try:
+                name, kind, path = line.split(None, 2)
+                local_zones.add(oa.rbldnsd.Zone(
+                    name, kind, path.strip(), self["rbl_local_zone_dir"],
+                    self["rbl_local_zone_check"]))
+            except (ValueError, IOError, OSError) as e:
+                self.ctxt.err("Invalid rbl_local_zone %r: %s", line, e)
+        return local_zones
+
+    def parsed_metadata(self, msg):
+        """Start all the lookups the rules need for this message."""
+        self.set_local(msg, "lookups", {})
+        self.set_local(msg, "answers", {})
+        if self.ctxt.skip_rbl_checks or msg.local_only:
+            return
+        local_zones = self["local_zones"]
+        local_zones.check()
+        queries = []
+        for name, rbl_server, accreditor in self["lookups"]:
+            if name == "check_dns_sender":
+                domain = msg.sender_domain
+                if domain:
+                    queries.extend(((domain, "A"), (domain, "MX")))
+            elif name in self.ip_eval_rules:
+                if (accreditor is not None and
+                        accreditor not in self._get_accreditor_tags(msg)):
+                    continue
+                qtype = self.ip_eval_rules[name]
+                queries.extend((qname, qtype) for qname in
+                               self._get_ip_qnames(msg, rbl_server))
+            elif name == "check_rbl_envfrom":
+                if msg.sender_address:
+                    queries.extend((qname, "A") for qname in
+                                   self._get_domain_qnames(
+                                       [msg.sender_domain], rbl_server))
+            else:
+                queries.extend((qname, "A") for qname in
+                               self._get_domain_qnames(msg.from_domains,
+                                                       rbl_server))
+        lookups = {}
+        for qname, qtype in queries:
+            if local_zones.get_zone(qname)[0] is not None:
+                # Answered from memory when the rules need it.
+                continue
+            if (qname, qtype) not in lookups:
+                lookups[(qname, qtype)] = self.ctxt.dns.query_async(qname,
+                                                                    qtype)
+        self.set_local(msg, "lookups", lookups)
+        self.set_local(msg, "deadline", time.time() + self["rbl_timeout"])
+
+    def _get_subtest(self, subtest):
+        """Get the compiled regex for this subtest, or None if it's
+        invalid.
+        """
+        try:
+            subtests = self["subtests"]
+        except KeyError:
+            subtests = {}
+        try:
+            return subtests[subtest]
+        except KeyError:
+            pass
+        try:
+            regex = Regex(subtest)
+        except re.error as e:
+            self.ctxt.err("Invalid regex %s: %s", subtest, e)
+            return None
+        subtests[subtest] = regex
+        return regex
+
+    def _get_mask(self, mask):
+        """Get the integer value of this mask, or None if it's
+        invalid.
+        """
+        try:
+            masks = self["masks"]
+        except KeyError:
+            masks = {}
+        try:
+            return masks[mask]
+        except (KeyError, TypeError):
+            pass
+        try:
+            value = int(mask)
+        except (ValueError, TypeError):
+            try:
+                value = int(ipaddress.ip_address(str(mask)))
+            except ValueError as e:
+                self.ctxt.err("Invalid mask %s: %s", mask, e)
+                return None
+        masks[mask] = value
+        return value
+
+    def _get_answers(self, msg, qname, qtype):
+        """Get the answers of this lookup as text. Every rule that
+        checks the same zone for this message shares them, whatever
+        its subtest or mask.
+        """
+        try:
+            answers = self.get_local(msg, "answers")
+        except KeyError:
+            answers = None
+        if answers is not None and (qname, qtype) in answers:
+            return answers[(qname, qtype)]
+        result = [str(rdata) for rdata in self._query(msg, qname, qtype)]
+        if answers is not None:
+            answers[(qname, qtype)] = result
+        return result
+
+    def _query(self, msg, qname, qtype):
+        """Get the answer of a lookup started when the message was
+        parsed, waiting until the deadline of the message if it's not
+        available yet. Other lookups are done now, and the lists that
+        are mirrored locally are answered from their zone files.
+        """
+        try:
+            local = self["local_zones"].lookup(qname, qtype)
+        except KeyError:
+            local = None
+        if local is not None:
+            return local
+        budget = getattr(msg, "dns_budget", None)
+        try:
+            pending = self.get_local(msg, "lookups")[(qname, qtype)]
+        except KeyError:
+            return self.ctxt.dns.query(qname, qtype, budget=budget)
+        if not pending.done():
+            timeout = max(0, self.get_local(msg, "deadline") - time.time())
+            if budget is not None:
+                result = budget.wait(pending, timeout)
+            else:
+                result = pending.result(timeout)
+            if not pending.done():
+                self.ctxt.log.info("Lookup of %s (%s) timed out", qname,
+                                   qtype)
+            return result
+        return pending.result()
+
+    @staticmethod
+    def _get_ip_qnames(msg, rbl_server):
+        """The names to look up for the untrusted IPs of the message
+        on this list, from the reversed IPs computed when it was
+        parsed.
+        """
+        return ["%s.%s" % (reversed_ip, rbl_server)
+                for reversed_ip in msg.reversed_untrusted_ips]
+
+    @staticmethod
+    def _get_domain_qnames(domains, rbl_server):
+        """The names to look up for these domains on this list."""
+        return ["%s.%s" % (domain, rbl_server) for domain in domains]
 
     def _check_rbl(self, msg, rbl_server, qtype="A", subtest=None):
         """Checks all the IPs of this message on the specified
@@ -79,21 +285,18 @@ class DNSEval(oa.plugins.base.BasePlugin):
             return False
 
         if subtest is not None:
-            try:
-                subtest = Regex(subtest)
-            except re.error as e:
-                self.ctxt.err("Invalid regex %s: %s", subtest, e)
+            subtest = self._get_subtest(subtest)
+            if subtest is None:
                 return False
 
-        for ip in msg.get_untrusted_ips():
-            rev = self.ctxt.dns.reverse_ip(ip)
-            results = self.ctxt.dns.query("%s.%s" % (rev, rbl_server), qtype)
+        for qname in self._get_ip_qnames(msg, rbl_server):
+            results = self._get_answers(msg, qname, qtype)
 
             if results and not subtest:
                 return True
 
             for result in results:
-                if subtest.match(str(result)):
+                if subtest.match(result):
                     return True
         return False
 
@@ -112,36 +315,36 @@ class DNSEval(oa.plugins.base.BasePlugin):
             return False
 
         if mask is not None:
-            try:
-                mask = int(mask)
-            except (ValueError, TypeError):
-                try:
-                    mask = int(ipaddress.ip_address(str(mask)))
-                except ValueError as e:
-                    self.ctxt.err("Invalid mask %s: %s", mask, e)
-                    return False
+            mask = self._get_mask(mask)
+            if mask is None:
+                return False
 
-        for ip in msg.get_untrusted_ips():
-            rev = self.ctxt.dns.reverse_ip(ip)
-            results = self.ctxt.dns.query("%s.%s" % (rev, rbl_server), "A")
+        for qname in self._get_ip_qnames(msg, rbl_server):
+            results = self._get_answers(msg, qname, "A")
 
             if results and not mask:
                 return True
 
             for result in results:
-                result = ipaddress.ip_address(str(result))
+                try:
+                    result = ipaddress.ip_address(result)
+                except ValueError:
+                    continue
                 if int(result) & mask:
                     return True
         return False
 
-    def _check_rbl_addr(self, addresses, rbl_server, subtest=None):
-        """Checks the specified addresses on the specified list.
+    def _check_rbl_domains(self, domains, rbl_server, subtest=None,
+                           msg=None):
+        """Checks the specified domains on the specified list.
 
-        :param addresses: A list of addresses to check
+        :param domains: A list of domains to check
         :param rbl_server: The RBL list to check
         :param subtest: If specified then an additional check
           is done on the result of the DNS lookup by matching
           this regular expression against the result.
+        :param msg: The message the domains are from, to use the
+          lookups started when it was parsed.
         :return: True if there is a match and the subtest
           passes and False otherwise.
         """
@@ -150,24 +353,18 @@ class DNSEval(oa.plugins.base.BasePlugin):
             return False
 
         if subtest is not None:
-            try:
-                subtest = Regex(subtest)
-            except re.error as e:
-                self.ctxt.err("Invalid regex %s: %s", subtest, e)
+            subtest = self._get_subtest(subtest)
+            if subtest is None:
                 return False
 
-        for addr in addresses:
-            if "@" in addr:
-                domain = addr.rsplit("@", 1)[1].strip()
-            else:
-                domain = addr.strip()
-            results = self.ctxt.dns.query("%s.%s" % (domain, rbl_server), "A")
+        for qname in self._get_domain_qnames(domains, rbl_server):
+            results = self._get_answers(msg, qname, "A")
 
             if results and not subtest:
                 return True
 
             for result in results:
-                if subtest.match(str(result)):
+                if subtest.match(result):
                     return True
         return False
 
@@ -207,6 +404,15 @@ class DNSEval(oa.plugins.base.BasePlugin):
         :return: True if there is a match and the subtest
           passes and False otherwise.
         """
+        tags = self._get_accreditor_tags(msg)
+        if accreditor not in tags:
+            self.ctxt.log.debug("Accreditor %s not in message tags %s",
+                                accreditor, tags)
+            return False
+        return self.check_rbl(msg, zone_set, rbl_server, subtest, target)
+
+    def _get_accreditor_tags(self, msg):
+        """Get the accreditor tags of the sender of the message."""
         tags = []
         try:
             tags.append(ACCREDITOR_RE.search(msg.sender_address).groups()[0])
@@ -221,11 +427,7 @@ class DNSEval(oa.plugins.base.BasePlugin):
                 self.ctxt.log.info("Unable to parse Accreditor header %r: %s",
                                    header, e)
                 continue
-        if accreditor not in tags:
-            self.ctxt.log.debug("Accreditor %s not in message tags %s",
-                                accreditor, tags)
-            return False
-        return self.check_rbl(msg, zone_set, rbl_server, subtest, target)
+        return tags
 
     def check_rbl_txt(self, msg, zone_set, rbl_server, subtest=None,
                       target=None):
@@ -269,14 +471,10 @@ class DNSEval(oa.plugins.base.BasePlugin):
             self.ctxt.log.debug("Message has no envelope sender")
             return False
 
-        if "@" in msg.sender_address:
-            domain = msg.sender_address.rsplit("@", 1)[1]
-        else:
-            domain = msg.sender_address
-
-        if self.ctxt.dns.query(domain, "A"):
+        domain = msg.sender_domain
+        if self._get_answers(msg, domain, "A"):
             return False
-        if self.ctxt.dns.query(domain, "MX"):
+        if self._get_answers(msg, domain, "MX"):
             return False
         self.ctxt.log.debug("Sending domain %s has no MX or A records",
                             domain)
@@ -301,7 +499,8 @@ class DNSEval(oa.plugins.base.BasePlugin):
         if not msg.sender_address:
             self.ctxt.log.debug("Message has no envelope sender")
             return False
-        return self._check_rbl_addr([msg.sender_address], rbl_server, subtest)
+        return self._check_rbl_domains([msg.sender_domain], rbl_server,
+                                       subtest, msg)
 
     def check_rbl_from_domain(self, msg, zone_set, rbl_server, subtest=None,
                               target=None):
@@ -316,11 +515,11 @@ class DNSEval(oa.plugins.base.BasePlugin):
         :return: True if there is a match and the subtest
           passes and False otherwise.
         """
-        from_addrs = msg.get_addr_header("From")
-        if not from_addrs:
+        if not msg.from_domains:
             self.ctxt.log.debug("Message has no From header")
             return False
-        return self._check_rbl_addr(from_addrs, rbl_server, subtest)
+        return self._check_rbl_domains(msg.from_domains, rbl_server, subtest,
+                                       msg)
 
     # This two do the same thing
     check_rbl_from_host = check_rbl_from_domain
@@ -54,17 +54,21 @@ class FreeMail(oa.plugins.base.BasePlugin):
         "util_rb_3tld": ("append_split", [])
     }
 
-    def check_start(self, msg):
+    def finish_parsing_end(self, ruleset):
         """Verify that the domains are valid and separate wildcard
-        domains from the rest."""
+        domains from the rest. The regular expressions are compiled
+        once here and shared by all the messages checked.
+        """
+        super(FreeMail, self).finish_parsing_end(ruleset)
         domain_re = Regex(r'^[a-z0-9.*?-]+$')
-        freemail_domains = self.get_global('freemail_domains')
+        freemail_domains = []
         freemail_temp_wc = []
-        for domain in freemail_domains[:]:
+        for domain in self.get_global('freemail_domains'):
             if not domain_re.search(domain):
-                freemail_domains.remove(domain)
                 self.ctxt.log.warn(
                     "FreeMail::Plugin Invalid freemail domain: %s", domain)
+                continue
+            freemail_domains.append(domain)
             if '*' in domain:
                 temp = domain.replace('.', '\.')
                 temp = temp.replace('?', '.')
@@ -91,17 +95,19 @@ class FreeMail(oa.plugins.base.BasePlugin):
               (?!(?:[a-z0-9-]|\.[a-z0-9]))		# make sure domain ends here
         """.format(tld=tlds_re), re.X | re.I)
         self.set_global('email_re', email_re)
-        self.set_global('body_emails', set())
-        self.set_global("check_if_parsed", False)
+
+    def check_start(self, msg):
+        """Reset the emails found in the body for this message."""
+        self.set_local(msg, 'body_emails', set())
+        self.set_local(msg, "check_if_parsed", False)
 
     def extract_metadata(self, msg, payload, text, part):
         """Parse all emails from text/plain and text/html parts."""
         if part.get_content_type() in ("text/plain", "text/html"):
-            get_global = self.get_global
-            body_emails = get_global('body_emails')
-            for email in get_global('email_re').findall(part.get_payload()):
+            body_emails = self.get_local(msg, 'body_emails')
+            email_re = self.get_global('email_re')
+            for email in email_re.findall(part.get_payload()):
                 body_emails.add(email)
-            self.set_global('body_emails', body_emails)
 
     def check_freemail_replyto(self, msg, option=None, target=None):
         """Checks/compares freemail addresses found from headers and body
@@ -162,11 +168,11 @@ class FreeMail(oa.plugins.base.BasePlugin):
                                    "No Reply-To and From is not freemail, "
                                    "skipping check")
                 return False
-        if not self._parse_body():
+        if not self._parse_body(msg):
             return False
         reply = reply_to if reply_to_frm else from_email
         check = reply_to if option == 'replyto' else reply
-        for email in get_global("freemail_body_emails"):
+        for email in self.get_local(msg, "freemail_body_emails"):
             if email != check:
                 self.ctxt.log.warn("FreeMail::Plugin check_freemail_replyto "
                                    "HIT! %s and %s are different freemails",
@@ -293,7 +299,7 @@ class FreeMail(oa.plugins.base.BasePlugin):
         """
         self.ctxt.log.debug("FreeMail::Plugin check_freemail_body"
                             " %s", 'with regex: ' + regex if regex else '')
-        body_emails = self.get_global('body_emails')
+        body_emails = self.get_local(msg, 'body_emails')
         if not len(body_emails):
             self.ctxt.log.debug("FreeMail::Plugin check_freemail_body "
                                 "No emails found in body of the message")
@@ -307,10 +313,10 @@ class FreeMail(oa.plugins.base.BasePlugin):
                 return False
         else:
             check_re = None
-        if not self._parse_body():
+        if not self._parse_body(msg):
             return False
         if check_re:
-            for email in self.get_global("freemail_body_emails"):
+            for email in self.get_local(msg, "freemail_body_emails"):
                 if check_re.search(email):
                     self.ctxt.log.debug(
                         "FreeMail::Plugin check_freemail_body"
@@ -321,8 +327,9 @@ class FreeMail(oa.plugins.base.BasePlugin):
                         result = result + "\n\t" + _email
                     return str(result)
         else:
-            if len(self.get_global("freemail_body_emails")):
-                emails = " ,".join(self.get_global("freemail_body_emails"))
+            freemail_body_emails = self.get_local(msg, "freemail_body_emails")
+            if len(freemail_body_emails):
+                emails = " ,".join(freemail_body_emails)
                 self.ctxt.log.debug("FreeMail::Plugin check_freemail_body"
                                     " HIT! body has freemails: %s", emails)
                 result = "Body has freemails"
@@ -332,14 +339,14 @@ class FreeMail(oa.plugins.base.BasePlugin):
                 return str(result)
         return False
 
-    def _parse_body(self):
+    def _parse_body(self, msg):
         """Parse all the emails from body and check
         if all conditions are accepted
         """
         get_global = self.get_global
-        if get_global("check_if_parsed"):
+        if self.get_local(msg, "check_if_parsed"):
             return True
-        body_emails = get_global('body_emails')
+        body_emails = self.get_local(msg, 'body_emails')
         freemail_body_emails = []
         if (len(body_emails) >= get_global("freemail_max_body_emails") and
                 get_global("freemail_skip_when_over_max")):
@@ -356,8 +363,8 @@ class FreeMail(oa.plugins.base.BasePlugin):
                     "FreeMail::Plugin check_freemail_body "
                     "too many unique free emails found in body")
                 return False
-        self.set_global("freemail_body_emails", freemail_body_emails)
-        self.set_global("check_if_parsed", True)
+        self.set_local(msg, "freemail_body_emails", freemail_body_emails)
+        self.set_local(msg, "check_if_parsed", True)
         return True
 
     def _is_freemail(self, email):
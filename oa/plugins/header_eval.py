@@ -19,8 +19,6 @@ from oa.regex import Regex
 
 
 class HeaderEval(oa.plugins.base.BasePlugin):
-    hotmail_addr_with_forged_hotmail_received = 0
-    hotmail_addr_but_no_hotmail_received = 0
     tocc_sorted_count = 7
     tocc_similar_count = 5
     tocc_similar_length = 2
@@ -197,16 +195,18 @@ class HeaderEval(oa.plugins.base.BasePlugin):
     def check_for_forged_hotmail_received_headers(self, msg, target=None):
         """Check for forged hotmail received headers"""
         self._check_for_forged_hotmail_received_headers(msg)
-        return self.hotmail_addr_with_forged_hotmail_received
+        return self.get_local(msg,
+                              "hotmail_addr_with_forged_hotmail_received")
 
     def check_for_no_hotmail_received_headers(self, msg, target=None):
         """Check for no hotmail received headers"""
         self._check_for_forged_hotmail_received_headers(msg)
-        return self.hotmail_addr_but_no_hotmail_received
+        return self.get_local(msg,
+                              "hotmail_addr_but_no_hotmail_received")
 
     def _check_for_forged_hotmail_received_headers(self, msg):
-        self.hotmail_addr_but_no_hotmail_received = 0
-        self.hotmail_addr_with_forged_hotmail_received = 0
+        self.set_local(msg, "hotmail_addr_but_no_hotmail_received", 0)
+        self.set_local(msg, "hotmail_addr_with_forged_hotmail_received", 0)
         rcvd = msg.msg.get("Received")
         if not rcvd:
             return False
@@ -233,14 +233,15 @@ class HeaderEval(oa.plugins.base.BasePlugin):
 
         helo_hotmail_regex = Regex(r"(?:from |HELO |helo=)\S*hotmail\.com\b")
         if helo_hotmail_regex.search(rcvd):
-            self.hotmail_addr_with_forged_hotmail_received = 1
+            self.set_local(msg,
+                           "hotmail_addr_with_forged_hotmail_received", 1)
         else:
             from_address = msg.msg.get("From")
             if not from_address:
                 from_address = ""
             if "hotmail.com" not in from_address:
                 return False
-            self.hotmail_addr_but_no_hotmail_received = 1
+            self.set_local(msg, "hotmail_addr_but_no_hotmail_received", 1)
 
     def check_for_msn_groups_headers(self, msg, target=None):
         """Check if the email's destination is a msn group"""
@@ -10,6 +10,8 @@ import oa.plugins.base
 
 class PyzorPlugin(oa.plugins.base.BasePlugin):
     eval_rules = ("check_pyzor",)
+    # The digest is computed from the body.
+    cacheable_eval_rules = eval_rules
     options = {"use_pyzor": ("bool", True),
                "pyzor_max": ("int", 5),
                "pyzor_timeout": ("float", 3.5),
@@ -14,6 +14,8 @@ def kill_process(process, log):
 class Razor2Plugin(oa.plugins.base.BasePlugin):
     eval_rules = ("check_razor2",
                   "check_razor2_range")
+    # The signatures are computed from the body.
+    cacheable_eval_rules = eval_rules
 
     options = {"use_razor2": ("bool", True),
                "razor_timeout": ("int", 5),
@@ -127,27 +127,27 @@ class RelayEval(oa.plugins.base.BasePlugin):
         """Check if there are more than one untrusted relays and verify if
         rdns is different than the other relay's by."""
         try:
-            mismatch_from = self.get_global("mismatch_from")
+            mismatch_from = self.get_local(msg, "mismatch_from")
         except KeyError:
             mismatch_from = None
         if mismatch_from is None:
             self._check_for_forged_received(msg)
         else:
             return bool(mismatch_from > 1)
-        return bool(self.get_global("mismatch_from") > 1)
+        return bool(self.get_local(msg, "mismatch_from") > 1)
 
     def check_for_forged_received_ip_helo(self, msg, option=None, target=None):
         """Verify if helo and ip are IP ADDRESSES and if they are different,
         this means that received ip is forged"""
         try:
-            mismatch_ip_helo = self.get_global("mismatch_ip_helo")
+            mismatch_ip_helo = self.get_local(msg, "mismatch_ip_helo")
         except KeyError:
             mismatch_ip_helo = None
         if mismatch_ip_helo is None:
             self._check_for_forged_received(msg)
         else:
             return bool(mismatch_ip_helo > 0)
-        return bool(self.get_global("mismatch_ip_helo") > 0)
+        return bool(self.get_local(msg, "mismatch_ip_helo") > 0)
 
     def helo_ip_mismatch(self, msg, option=None, target=None):
         """Check untrusted relays and verify if helo and ip are different
@@ -233,5 +233,5 @@ class RelayEval(oa.plugins.base.BasePlugin):
                     self.ctxt.log.debug("eval: forged-HELO: mismatch on from: "
                                         "%s != %s" % (prev_from_host, by_host))
                     mismatch_from += 1
-        self.set_global("mismatch_from", mismatch_from)
-        self.set_global("mismatch_ip_helo", mismatch_ip_helo)
+        self.set_local(msg, "mismatch_from", mismatch_from)
+        self.set_local(msg, "mismatch_ip_helo", mismatch_ip_helo)
@@ -24,9 +24,6 @@ AUTHRES_RE = Regex(r"""
 
 
 class SpfPlugin(oa.plugins.base.BasePlugin):
-    spf_check = False
-    spf_check_helo = False
-    no_valid_identity = False
     eval_rules = (
         "check_for_spf_pass",
         "check_for_spf_neutral",
@@ -73,6 +70,13 @@ class SpfPlugin(oa.plugins.base.BasePlugin):
         "check_def_spf_whitelist_from": 0
     }
 
+    def check_start(self, msg):
+        """Reset the SPF results for this message."""
+        self.set_local(msg, "check_result", dict(self.check_result))
+        self.set_local(msg, "spf_check", False)
+        self.set_local(msg, "spf_check_helo", False)
+        self.set_local(msg, "no_valid_identity", False)
+
     def parsed_metadata(self, msg):
         if self.get_global("ignore_received_spf_header"):
             # The plugin will ignore the spf headers and will perform
@@ -88,46 +92,46 @@ class SpfPlugin(oa.plugins.base.BasePlugin):
             self.check_spf_header(msg)
 
     def check_for_spf_pass(self, msg, target=None):
-        return self.check_result["check_spf_pass"] == 1
+        return self.get_local(msg, "check_result")["check_spf_pass"] == 1
 
     def check_for_spf_neutral(self, msg, target=None):
-        return self.check_result["check_spf_neutral"] == 1
+        return self.get_local(msg, "check_result")["check_spf_neutral"] == 1
 
     def check_for_spf_none(self, msg, target=None):
-        return self.check_result["check_spf_none"] == 1
+        return self.get_local(msg, "check_result")["check_spf_none"] == 1
 
     def check_for_spf_fail(self, msg, target=None):
-        return self.check_result["check_spf_fail"] == 1
+        return self.get_local(msg, "check_result")["check_spf_fail"] == 1
 
     def check_for_spf_softfail(self, msg, target=None):
-        return self.check_result["check_spf_softfail"] == 1
+        return self.get_local(msg, "check_result")["check_spf_softfail"] == 1
 
     def check_for_spf_permerror(self, msg, target=None):
-        return self.check_result["check_spf_permerror"] == 1
+        return self.get_local(msg, "check_result")["check_spf_permerror"] == 1
 
     def check_for_spf_temperror(self, msg, target=None):
-        return self.check_result["check_spf_temperror"] == 1
+        return self.get_local(msg, "check_result")["check_spf_temperror"] == 1
 
     def check_for_spf_helo_pass(self, msg, target=None):
-        return self.check_result["check_spf_helo_pass"] == 1
+        return self.get_local(msg, "check_result")["check_spf_helo_pass"] == 1
 
     def check_for_spf_helo_neutral(self, msg, target=None):
-        return self.check_result["check_spf_helo_neutral"] == 1
+        return self.get_local(msg, "check_result")["check_spf_helo_neutral"] == 1
 
     def check_for_spf_helo_none(self, msg, target=None):
-        return self.check_result["check_spf_helo_none"] == 1
+        return self.get_local(msg, "check_result")["check_spf_helo_none"] == 1
 
     def check_for_spf_helo_fail(self, msg, target=None):
-        return self.check_result["check_spf_helo_fail"] == 1
+        return self.get_local(msg, "check_result")["check_spf_helo_fail"] == 1
 
     def check_for_spf_helo_softfail(self, msg, target=None):
-        return self.check_result["check_spf_helo_softfail"] == 1
+        return self.get_local(msg, "check_result")["check_spf_helo_softfail"] == 1
 
     def check_for_spf_helo_permerror(self, msg, target=None):
-        return self.check_result["check_spf_helo_permerror"] == 1
+        return self.get_local(msg, "check_result")["check_spf_helo_permerror"] == 1
 
     def check_for_spf_helo_temperror(self, msg, target=None):
-        return self.check_result["check_spf_helo_temperror"] == 1
+        return self.get_local(msg, "check_result")["check_spf_helo_temperror"] == 1
 
     def check_for_spf_whitelist_from(self, msg, target=None):
         return self.check_spf_whitelist(msg, "whitelist_from_spf")
@@ -164,22 +168,25 @@ class SpfPlugin(oa.plugins.base.BasePlugin):
         if not self["use_newest_received_spf_header"]:
             received_spf_headers.reverse()
         if received_spf_headers:
-            self.check_spf_received_header(received_spf_headers)
-            if not self.no_valid_identity:
+            self.check_spf_received_header(msg, received_spf_headers)
+            if not self.get_local(msg, "no_valid_identity"):
                 self.received_headers(msg, '')
         elif authres_header:
-            self.check_authres_header(authres_header)
+            self.check_authres_header(msg, authres_header)
 
         if msg.msg["received"]:
             if not received_spf_headers:
                 self.received_headers(msg, '')
             if msg.sender_address:
-                if self.spf_check_helo:
+                if self.get_local(msg, "spf_check_helo"):
                     self.received_headers(msg, msg.sender_address)
                 else:
                     self.received_headers(msg, '')
 
-    def check_spf_received_header(self, received_spf_headers):
+    def check_spf_received_header(self, msg, received_spf_headers):
+        check_result = self.get_local(msg, "check_result")
+        spf_check = self.get_local(msg, "spf_check")
+        spf_check_helo = self.get_local(msg, "spf_check_helo")
         for spf_header in received_spf_headers:
             match = RECEIVED_RE.match(spf_header)
             if not match:
@@ -195,33 +202,33 @@ class SpfPlugin(oa.plugins.base.BasePlugin):
                 continue
             if identity:
                 if identity.lower() in ('mfrom', 'mailfrom'):
-                    if self.spf_check:
+                    if spf_check:
                         continue
                     identity = ''
-                    self.spf_check = True
+                    spf_check = True
                 elif identity == 'helo':
-                    if self.spf_check_helo:
+                    if spf_check_helo:
                         continue
-                    self.spf_check_helo = True
+                    spf_check_helo = True
                 else:
                     continue
-            elif self.spf_check:
+            elif spf_check:
                 continue
 
             if not identity:
-                self.no_valid_identity = True
+                self.set_local(msg, "no_valid_identity", True)
 
             result.replace("error", "temperror")
             if identity:
                 spf_identity = "check_spf_%s_%s" % (identity, result)
             else:
                 spf_identity = "check_spf_%s" % result
-                self.spf_check = True
-            self.check_result[spf_identity] = 1
-        if self.spf_check and self.spf_check_helo:
-            return
+                spf_check = True
+            check_result[spf_identity] = 1
+        self.set_local(msg, "spf_check", spf_check)
+        self.set_local(msg, "spf_check_helo", spf_check_helo)
 
-    def check_authres_header(self, authres_header):
+    def check_authres_header(self, msg, authres_header):
         self.ctxt.log.debug("PLUGIN::SPF: %s",
                             "found an Authentication-Results header "
                             "added by an internal host")
@@ -242,27 +249,36 @@ class SpfPlugin(oa.plugins.base.BasePlugin):
                 spf_identity = "check_spf_%s_%s" % (identity, result)
             else:
                 spf_identity = "check_spf_%s" % result
-            self.check_result[spf_identity] = 1
+            self.get_local(msg, "check_result")[spf_identity] = 1
 
     def received_headers(self, msg, sender):
         timeout = self.get_global("spf_timeout")
-        if not msg.external_relays:
+        if not msg.external_relays or msg.local_only:
+            # No network lookups for messages checked locally.
             return
         mx = msg.external_relays[0]['helo']
         ip = msg.external_relays[0]['ip']
 
+        budget = getattr(msg, "dns_budget", None)
+        if budget is not None:
+            if budget.spent():
+                budget.skip(ip, "SPF")
+                return
+            timeout = budget.get_timeout(timeout)
+
         spf_result = self._query_spf(timeout, ip, mx, sender)
         if spf_result == "error":
             spf_result = "temperror"
-        if self.spf_check_helo:
+        check_result = self.get_local(msg, "check_result")
+        if self.get_local(msg, "spf_check_helo"):
             spf_identity = "check_spf_%s" % spf_result
-            self.check_result[spf_identity] = 1
+            check_result[spf_identity] = 1
         elif re.match(".*\..*", mx):
             spf_identity = "check_spf_helo_%s" % spf_result
-            self.spf_check_helo = True
-            self.check_result[spf_identity] = 1
+            self.set_local(msg, "spf_check_helo", True)
+            check_result[spf_identity] = 1
         else:
-            self.spf_check_helo = True
+            self.set_local(msg, "spf_check_helo", True)
 
     def _query_spf(self, timeout, ip, mx, sender_address):
         self.ctxt.log.debug("SPF::Plugin %s",
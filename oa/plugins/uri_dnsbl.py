@@ -0,0 +1,251 @@
+"""Check the domains of the URIs of a message on DNS lists, like the
+URIDNSBL plugin of SA.
+
+The registrable domains of the links are found with a public suffix
+list, deduplicated and limited to `uridnsbl_max_domains`. All the
+lookups of the lists are started in the background as soon as the
+message is parsed, the rules only wait for the answers that are still
+missing.
+"""
+
+from __future__ import absolute_import
+
+import re
+import time
+import ipaddress
+
+from builtins import str
+
+import oa.html_parser
+import oa.plugins.base
+import oa.public_suffix
+import oa.dns_interface
+
+from oa.regex import Regex
+
+# The host of an absolute URI, or of one that starts with "www." or
+# "ftp." like the ones found in the text of the message.
+URI_HOST_RE = Regex(r"""
+^\s*
+(?:
+    [a-z][a-z0-9+.-]*://        # the scheme
+    |(?=(?:www|ftp)\.)          # or a www.x or ftp.x host
+)
+(?:[^/?\#@\s]*@)?               # the user info
+([^/?\#:@\s\\\[\]]+)            # the host
+""", re.I | re.X)
+MAILTO_HOST_RE = Regex(r"^\s*mailto:[^@?]*@([^?&>\s]+)", re.I)
+IPV4_RE = Regex(r"^\d+\.\d+\.\d+\.\d+$")
+
+
+def get_uri_host(uri):
+    """Get the lowercase host name of this URI, or None if it doesn't
+    have one (e.g. relative links).
+    """
+    match = URI_HOST_RE.match(uri) or MAILTO_HOST_RE.match(uri)
+    if match is None:
+        return None
+    return match.group(1).rstrip(".").lower() or None
+
+
+class URIDNSBLPlugin(oa.plugins.base.BasePlugin):
+    """Look up the domains of the URIs on DNS lists."""
+    eval_rules = ("check_uridnsbl",)
+    cacheable_eval_rules = eval_rules
+    options = {
+        "urirhsbl": ("append", []),
+        "urirhssub": ("append", []),
+        "uridnsbl_max_domains": ("int", 20),
+        "uridnsbl_skip_domain": ("append_split", []),
+        "uridnsbl_timeout": ("timevalue", 15),
+        "uridnsbl_public_suffix_list": ("str", ""),
+        "util_rb_tld": ("append_split", []),
+        "util_rb_2tld": ("append_split", []),
+        "util_rb_3tld": ("append_split", []),
+    }
+
+    def finish_parsing_end(self, ruleset):
+        """Parse the lists of the rules and load the public
+        suffixes.
+        """
+        super(URIDNSBLPlugin, self).finish_parsing_end(ruleset)
+        rules = {}
+        for line in self["urirhsbl"]:
+            try:
+                name, zone, qtype = line.split()
+            except ValueError:
+                self.ctxt.err("Invalid urirhsbl: %s", line)
+                continue
+            rules[name] = (zone, qtype.upper(), None)
+        for line in self["urirhssub"]:
+            try:
+                name, zone, qtype, subtest = line.split()
+            except ValueError:
+                self.ctxt.err("Invalid urirhssub: %s", line)
+                continue
+            subtest = self._get_subtest(subtest)
+            if subtest is not None:
+                rules[name] = (zone, qtype.upper(), subtest)
+        self["rules"] = rules
+        # The lists each domain is looked up on, whatever the subtest.
+        self["lookups"] = sorted(set((zone, qtype) for zone, qtype, dummy
+                                     in rules.values()))
+        self["skip_domains"] = frozenset(
+            domain.lower() for domain in self["uridnsbl_skip_domain"])
+        self["suffixes"] = self._load_public_suffixes()
+
+    def _get_subtest(self, subtest):
+        """Parse the subtest of a urirhssub rule. An IP address must be
+        one of the answers, a number is a mask of the bits that must be
+        set in one of them.
+        """
+        try:
+            return int(subtest)
+        except ValueError:
+            pass
+        try:
+            return str(ipaddress.ip_address(str(subtest)))
+        except ValueError as e:
+            self.ctxt.err("Invalid urirhssub subtest %s: %s", subtest, e)
+            return None
+
+    def _load_public_suffixes(self):
+        suffixes = oa.public_suffix.PublicSuffixList()
+        path = self["uridnsbl_public_suffix_list"]
+        if path:
+            try:
+                suffixes.load_file(path)
+            except (IOError, OSError, UnicodeError) as e:
+                self.ctxt.err("Unable to load the public suffix list %s: %s",
+                              path, e)
+        for key in ("util_rb_tld", "util_rb_2tld", "util_rb_3tld"):
+            suffixes.load(self[key])
+        return suffixes
+
+    def _get_uri_domain(self, host):
+        """Get the name looked up for this host: the registrable
+        domain, or the reversed address of a public IPv4 address.
+        """
+        if IPV4_RE.match(host):
+            try:
+                ip = ipaddress.ip_address(str(host))
+            except ValueError:
+                return None
+            if ip.is_private or ip.is_loopback or ip.is_reserved:
+                return None
+            return oa.dns_interface.DNSInterface.reverse_ip(ip)
+        if "." not in host:
+            return None
+        return self["suffixes"].get_registrable_domain(host)
+
+    def get_domains(self, msg):
+        """Get the domains of the URIs of the message to look up. The
+        links of the HTML parts come first, then the other URIs.
+        """
+        if not hasattr(msg, "uri_detail_links"):
+            oa.html_parser.parsed_metadata(msg, self.ctxt)
+        uris = list(msg.uri_detail_links)
+        uris.extend(sorted(msg.uri_list))
+        skip_domains = self["skip_domains"]
+        max_domains = self["uridnsbl_max_domains"]
+        hosts = set()
+        domains = []
+        for uri in uris:
+            host = get_uri_host(uri)
+            if host is None or host in hosts:
+                continue
+            hosts.add(host)
+            domain = self._get_uri_domain(host)
+            if domain is None or domain in skip_domains or domain in domains:
+                continue
+            if len(domains) >= max_domains:
+                self.ctxt.log.debug("Only looking up the first %s URI "
+                                    "domains", max_domains)
+                break
+            domains.append(domain)
+        return domains
+
+    def parsed_metadata(self, msg):
+        """Start the lookups of the URI domains on all the lists."""
+        self.set_local(msg, "lookups", {})
+        self.set_local(msg, "answers", {})
+        if self.ctxt.skip_rbl_checks or msg.local_only:
+            self.set_local(msg, "domains", [])
+            return
+        domains = self.get_domains(msg)
+        self.set_local(msg, "domains", domains)
+        lookups = {}
+        for domain in domains:
+            for zone, qtype in self["lookups"]:
+                qname = "%s.%s" % (domain, zone)
+                lookups[(qname, qtype)] = self.ctxt.dns.query_async(qname,
+                                                                    qtype)
+        self.set_local(msg, "lookups", lookups)
+        self.set_local(msg, "deadline", time.time() + self["uridnsbl_timeout"])
+
+    def _get_answers(self, msg, qname, qtype):
+        """Get the answers of this lookup as text, shared by all the
+        rules that check the same list.
+        """
+        answers = self.get_local(msg, "answers")
+        if (qname, qtype) not in answers:
+            answers[(qname, qtype)] = [str(rdata) for rdata in
+                                       self._query(msg, qname, qtype)]
+        return answers[(qname, qtype)]
+
+    def _query(self, msg, qname, qtype):
+        """Get the answer of a lookup started when the message was
+        parsed, waiting until the deadline of the message if it's not
+        available yet.
+        """
+        budget = getattr(msg, "dns_budget", None)
+        try:
+            pending = self.get_local(msg, "lookups")[(qname, qtype)]
+        except KeyError:
+            return self.ctxt.dns.query(qname, qtype, budget=budget)
+        if pending.done():
+            return pending.result()
+        timeout = max(0, self.get_local(msg, "deadline") - time.time())
+        if budget is not None:
+            result = budget.wait(pending, timeout)
+        else:
+            result = pending.result(timeout)
+        if not pending.done():
+            self.ctxt.log.info("Lookup of %s (%s) timed out", qname, qtype)
+        return result
+
+    @staticmethod
+    def _match(answer, subtest):
+        if subtest is None:
+            return True
+        if isinstance(subtest, int):
+            try:
+                return bool(int(ipaddress.ip_address(answer)) & subtest)
+            except ValueError:
+                return False
+        return answer == subtest
+
+    def check_uridnsbl(self, msg, rule, target=None):
+        """Check the domains of the URIs of the message on the list of
+        this rule, defined with::
+
+            urirhsbl  <rule> <list> <A|TXT>
+            urirhssub <rule> <list> <A|TXT> <subtest>
+
+        :param rule: The name of the rule.
+        :return: True if one of the domains is listed and the answer
+          passes the subtest, False otherwise.
+        """
+        if self.ctxt.skip_rbl_checks:
+            return False
+        try:
+            zone, qtype, subtest = self["rules"][rule]
+        except KeyError:
+            self.ctxt.err("No urirhsbl or urirhssub defined for %s", rule)
+            return False
+        for domain in self.get_local(msg, "domains"):
+            for answer in self._get_answers(msg, "%s.%s" % (domain, zone),
+                                            qtype):
+                if self._match(answer, subtest):
+                    return True
+        return False
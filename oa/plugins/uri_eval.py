@@ -29,6 +29,7 @@ class URIEvalPlugin(oa.plugins.base.BasePlugin):
                   "check_https_ip_mismatch",
                   "check_uri_truncated"
                   )
+    cacheable_eval_rules = eval_rules
 
     def check_for_http_redirector(self, msg, target=None):
         """Checks if the uri has been redirected.
@@ -66,13 +66,11 @@ class WLBLEvalPlugin(oa.plugins.base.BasePlugin):
         "parsed_blacklist_uri_host": ("dict", {})
     }
 
-    def check_start(self, msg):
+    def finish_parsing_end(self, ruleset):
         """Parses all the required white and blacklists. Stores
         the results in the the "parsed" versions.
         """
-        self.set_local(msg, "from_in_whitelist", 0)
-        self.set_local(msg, "from_in_default_whitelist", 0)
-
+        super(WLBLEvalPlugin, self).finish_parsing_end(ruleset)
         self['parsed_whitelist_from'] = self.parse_list('whitelist_from')
         self['parsed_whitelist_to'] = self.parse_list('whitelist_to')
         self['parsed_blacklist_from'] = self.parse_list('blacklist_from')
@@ -94,6 +92,10 @@ class WLBLEvalPlugin(oa.plugins.base.BasePlugin):
             'blacklist_uri_host')
         self['parsed_enlist_uri_host'] = self.parse_list_uri('enlist_uri_host')
 
+    def check_start(self, msg):
+        self.set_local(msg, "from_in_whitelist", 0)
+        self.set_local(msg, "from_in_default_whitelist", 0)
+
     def check_input(self, address):
         characters = ["?", "@", ".", "*@"]
         return len([e for e in characters if e in address])
@@ -16,6 +16,9 @@ class BaseProtocol(object):
     has_message = False
     chunk_size = 8192
     ok_code = "EX_OK"
+    # Set from the "Keep-Alive" option of the request. None if the
+    # client didn't send it.
+    keep_alive = None
 
     def __init__(self, rfile, wfile, server):
         self.rfile = rfile
@@ -48,8 +51,12 @@ class BaseProtocol(object):
     def get_message(self, options):
         """Retrieve the message from the client.
 
-        The data is read in chunks and returned as a joined string.
+        The data is read in chunks and returned as bytes. If the
+        message is compressed it's decompressed while it's read. A
+        message larger than the `max_message_size` of the server is
+        rejected as soon as possible.
         """
+        max_size = self.server.max_message_size
         message_chunks = list()
         # If the Content-Length is available it's much easier to
         # retrieve the data.
@@ -62,17 +69,87 @@ class BaseProtocol(object):
                 raise oa.errors.InvalidOption(error_msg)
             if content_length < 0:
                 raise oa.errors.InvalidOption(error_msg)
+            if max_size and content_length > max_size:
+                # Don't bother reading it.
+                raise oa.errors.MessageTooLarge(
+                    "%s bytes over the %s bytes limit" %
+                    (content_length, max_size)
+                )
+        decompressor = None
+        if options.get('compress') == "zlib":
+            decompressor = zlib.decompressobj()
+        size = 0
         while content_length is None or content_length > 0:
             chunk = self.rfile.read(min(content_length or self.chunk_size,
                                         self.chunk_size))
             if not chunk:
                 break
-            message_chunks.append(chunk.decode("utf8"))
             if content_length is not None:
                 content_length -= len(chunk)
-        if options.get('compress') == "zlib":
-            return zlib.decompress("".join(message_chunks))
-        return "".join(message_chunks)
+            if decompressor is not None:
+                chunk = self._decompress(decompressor, chunk, max_size, size)
+            size = self._add_chunk(message_chunks, chunk, max_size, size)
+        if decompressor is not None:
+            try:
+                chunk = decompressor.flush()
+            except zlib.error as e:
+                raise oa.errors.InvalidMessage("Invalid compressed data: %s"
+                                               % e)
+            self._add_chunk(message_chunks, chunk, max_size, size)
+            # Python 2 doesn't tell when the end of the stream is
+            # reached.
+            if not getattr(decompressor, "eof", True):
+                raise oa.errors.InvalidMessage("Truncated compressed data")
+        return b"".join(message_chunks)
+
+    @staticmethod
+    def _add_chunk(message_chunks, chunk, max_size, size):
+        """Add the chunk to the message, unless it makes it larger
+        than the maximum size.
+
+        :return: The new size of the message.
+        """
+        size += len(chunk)
+        if max_size and size > max_size:
+            raise oa.errors.MessageTooLarge(
+                "over the %s bytes limit" % max_size
+            )
+        message_chunks.append(chunk)
+        return size
+
+    @staticmethod
+    def _decompress(decompressor, chunk, max_size, size):
+        """Decompress the chunk, but never more than one byte over
+        the maximum size of the message.
+        """
+        try:
+            if not max_size:
+                return decompressor.decompress(chunk)
+            # Once the output hits the limit the rest of the input
+            # is left unconsumed, and the message is rejected.
+            return decompressor.decompress(chunk, max(max_size - size, 0) + 1)
+        except zlib.error as e:
+            raise oa.errors.InvalidMessage("Invalid compressed data: %s" % e)
+
+    def set_deadline(self, phase, timeout, min_rate=None):
+        """Limit the time allowed to read the next part of the request,
+        if the connection supports it (see `oa.server.DeadlineFile`).
+        """
+        try:
+            set_deadline = self.rfile.set_deadline
+        except AttributeError:
+            return
+        set_deadline(phase, timeout, min_rate)
+
+    def read_message(self, options):
+        """Retrieve the message from the client and parse it. If
+        the server is overloaded, only the local rules are checked.
+        """
+        message = self.get_message(options)
+        if self.server.degraded:
+            return oa.message.Message(self.ruleset.ctxt, message,
+                                      local_only=True)
+        return oa.message.Message(self.ruleset.ctxt, message)
 
     def get_and_handle(self):
         """Get data from the client and call the handle method."""
@@ -81,22 +158,44 @@ class BaseProtocol(object):
         try:
             if self.has_options:
                 options = self.get_options()
+            keep_alive = options.get("keep-alive")
+            if keep_alive is not None:
+                self.keep_alive = keep_alive.lower() == "yes"
             user = options.get("user")
             self.ruleset = self.server.get_user_ruleset(user)
             if self.has_message:
-                message = self.get_message(options)
-                message = oa.message.Message(self.ruleset.ctxt, message)
+                self.set_deadline("body", self.server.body_timeout,
+                                  self.server.min_transfer_rate)
+                message = self.read_message(options)
         except oa.errors.InvalidOption as e:
+            # The rest of the request can't be read reliably.
+            self.keep_alive = False
             error_line = ("SPAMD/%s 76 Bad header line: (%s)\r\n" %
                           (oa.__version__, e))
             self.wfile.write(error_line.encode("utf8"))
             return
+        except oa.errors.ReadTimeout as e:
+            self.keep_alive = False
+            self.log.info("Timed out reading request: %s", e)
+            error_line = ("SPAMD/%s 79 EX_TIMEOUT: (%s)\r\n" %
+                          (oa.__version__, e))
+            self.wfile.write(error_line.encode("utf8"))
+            return
+        except oa.errors.InvalidMessage as e:
+            self.keep_alive = False
+            self.log.info("Rejected message: %s", e)
+            error_line = ("SPAMD/%s 65 EX_DATAERR: (%s)\r\n" %
+                          (oa.__version__, e))
+            self.wfile.write(error_line.encode("utf8"))
+            return
 
         ok_line = "SPAMD/%s 0 %s\r\n" % (oa.__version__, self.ok_code)
         self.wfile.write(ok_line.encode("utf8"))
         for response in self.handle(message, options):
             self.log.debug("Writing response: %s", response)
-            self.wfile.write(response.encode("utf8"))
+            if not isinstance(response, bytes):
+                response = response.encode("utf8")
+            self.wfile.write(response)
 
     def handle(self, msg, options):
         """Perform the actual command and return a response for
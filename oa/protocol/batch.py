@@ -0,0 +1,182 @@
+"""Implement the BATCH command that checks several messages in one
+request.
+
+The messages are sent after the options, each one prefixed by a line with
+its length in bytes. A length of 0 (or the end of the stream) ends the
+batch::
+
+    BATCH SPAMC/1.5
+    Batch-Command: SYMBOLS
+    User: alex
+
+    1234
+    <message of 1234 bytes>5678
+    <message of 5678 bytes>0
+
+The messages are checked at the same time by a few threads, so the
+network lookups of several messages overlap. The results are sent back
+as soon as each message is done, so they are not always in the order of
+the messages. Each one starts with the index of the message in the
+batch, and the batch ends with the total number of messages::
+
+    SPAMD/1.5 0 EX_OK
+    Message: 1
+    Spam: True ; 7.0 / 5.0
+    Content-length: 5
+
+    GTUBEMessage: 0
+    Spam: False ; 0.0 / 5.0
+    Content-length: 0
+
+    Messages: 2
+
+"""
+
+from __future__ import absolute_import
+
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import oa.errors
+import oa.message
+import oa.protocol.check
+
+
+class BatchCommand(oa.protocol.check.SymbolsCommand):
+    """Check a batch of messages and return the score and the
+    symbols of each one.
+
+    The "Batch-Command" option selects the result returned for each
+    message, either CHECK or SYMBOLS (the default). The user ruleset
+    is only looked up once for the whole batch.
+    """
+    has_options = True
+    has_message = True
+    # Number of messages checked at the same time, unless the server
+    # defines `batch_workers`.
+    workers = 4
+
+    def read_message(self, options):
+        """The messages are read while the batch is handled."""
+        command = options.get("batch-command", "SYMBOLS").upper()
+        if command not in ("CHECK", "SYMBOLS"):
+            raise oa.errors.InvalidOption("Invalid Batch-Command: %s" %
+                                          command)
+        return self.read_frames()
+
+    def read_frames(self):
+        """Read the length-prefixed messages from the client and
+        yield them until the end of the batch.
+        """
+        while True:
+            # Each message gets the full time to be sent.
+            self.set_deadline("body", self.server.body_timeout,
+                              self.server.min_transfer_rate)
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                length = int(line)
+            except ValueError:
+                raise oa.errors.InvalidOption("Invalid message length: %r" %
+                                              line)
+            if length <= 0:
+                return
+            max_size = self.server.max_message_size
+            if max_size and length > max_size:
+                raise oa.errors.MessageTooLarge(
+                    "%s bytes over the %s bytes limit" % (length, max_size)
+                )
+            data = self.rfile.read(length)
+            if len(data) != length:
+                raise oa.errors.InvalidOption("Incomplete message")
+            yield data
+
+    def extra_details(self, msg, options):
+        """Return the symbols only for the SYMBOLS batch command."""
+        if options.get("batch-command", "SYMBOLS").upper() == "CHECK":
+            yield ""
+            return
+        result = super(BatchCommand, self).extra_details(msg, options)
+        for line in result:
+            yield line
+
+    def check_messages(self, tasks, results, local_only=False):
+        """Check the messages from the tasks queue until a `None`
+        is received.
+        """
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            index, raw_msg = task
+            try:
+                msg = oa.message.Message(self.ruleset.ctxt, raw_msg,
+                                         local_only=local_only)
+                self.match(msg)
+            except Exception as e:
+                self.log.error("Unable to check message %s of the batch",
+                               index, exc_info=True)
+                results.put((index, None, e))
+            else:
+                results.put((index, msg, None))
+        results.put(None)
+
+    def queue_messages(self, messages, tasks, results, workers):
+        """Queue the messages for the workers as they are read."""
+        count = 0
+        try:
+            for index, raw_msg in enumerate(messages):
+                tasks.put((index, raw_msg))
+                count += 1
+        except (oa.errors.ProtocolError, IOError, OSError) as e:
+            # The rest of the batch can't be read reliably.
+            self.keep_alive = False
+            results.put((count, None, e))
+        finally:
+            for dummy in range(workers):
+                tasks.put(None)
+
+    def handle(self, messages, options):
+        workers = getattr(self.server, "batch_workers", None) or self.workers
+        # Limit the number of messages waiting to be checked.
+        tasks = queue.Queue(workers * 2)
+        results = queue.Queue()
+        # The degraded mode is only known in the thread of the request.
+        local_only = self.server.degraded
+        threads = [threading.Thread(target=self.check_messages,
+                                    args=(tasks, results, local_only))
+                   for dummy in range(workers)]
+        threads.append(threading.Thread(
+            target=self.queue_messages,
+            args=(messages, tasks, results, workers)
+        ))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        done = 0
+        count = 0
+        while done < workers:
+            result = results.get()
+            if result is None:
+                done += 1
+                continue
+            index, msg, error = result
+            yield "Message: %s\r\n" % index
+            if error is not None:
+                yield "Error: %s\r\n\r\n" % error
+                continue
+            count += 1
+            for line in self.get_result(msg, options):
+                yield line
+        for thread in threads:
+            thread.join()
+        yield "Messages: %s\r\n\r\n" % count
@@ -2,6 +2,8 @@
 
 from __future__ import absolute_import
 
+import zlib
+
 import oa.protocol
 import oa.protocol.base
 
@@ -10,17 +12,48 @@ class CheckCommand(oa.protocol.base.BaseProtocol):
     """Check if the message is spam and return the score."""
     has_options = True
     has_message = True
+    # Compress the response if the client sent the
+    # "Accept-Compress: zlib" option.
+    can_compress = False
 
     def handle(self, msg, options):
-        self.ruleset.match(msg)
+        self.match(msg)
+        for line in self.get_result(msg, options):
+            yield line
+
+    def match(self, msg):
+        """Match the message against the ruleset, using the result
+        cache of the server if there is one.
+        """
+        if self.server.result_cache is None:
+            self.ruleset.match(msg)
+        else:
+            self.server.result_cache.match(self.ruleset, msg)
+
+    def get_result(self, msg, options):
+        """Return the response for a message that was already
+        matched against the ruleset.
+        """
         if msg.score >= self.ruleset.conf["required_score"]:
             spam = True
         else:
             spam = False
         yield "Spam: %s ; %.1f / %s\r\n" % (spam, msg.score,
                                             self.ruleset.conf["required_score"])
+        if getattr(msg, "local_only", False):
+            # The network and Bayes rules were skipped.
+            yield "Degraded: local-only\r\n"
+        elif msg.dns_budget.exhausted:
+            # Some DNS lookups were skipped.
+            yield "Degraded: dns-budget\r\n"
         result = "".join(self.extra_details(msg, options))
-        yield "Content-length: %s\r\n\r\n" % len(result)
+        if (self.can_compress and
+                options.get("accept-compress", "").lower() == "zlib"):
+            result = zlib.compress(result.encode("utf8"))
+            yield "Compress: zlib\r\n"
+            yield "Content-length: %s\r\n\r\n" % len(result)
+        else:
+            yield "Content-length: %s\r\n\r\n" % len(result.encode("utf8"))
         yield result
 
     def extra_details(self, msg, options):
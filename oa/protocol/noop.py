@@ -2,6 +2,9 @@
 
 from __future__ import absolute_import
 
+import os
+
+import oa.metrics
 import oa.protocol.base
 
 
@@ -21,3 +24,17 @@ class SkipCommand(oa.protocol.base.BaseProtocol):
 
     def get_and_handle(self):
         """Do nothing."""
+
+
+class StatsCommand(oa.protocol.base.BaseProtocol):
+    """Return the counters and gauges from `oa.metrics`, one
+    "name: value" line each. These are the values of the process
+    that handled the command.
+    """
+
+    def handle(self, msg, options):
+        result = "".join("%s: %s\r\n" % item
+                         for item in sorted(oa.metrics.snapshot().items()))
+        yield "Pid: %s\r\n" % os.getpid()
+        yield "Content-length: %s\r\n\r\n" % len(result)
+        yield result
@@ -12,6 +12,7 @@ class ProcessCommand(oa.protocol.check.CheckCommand):
     """
     has_options = True
     has_message = True
+    can_compress = True
 
     def extra_details(self, msg, options):
         """Add any extra details to the response."""
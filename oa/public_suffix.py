@@ -0,0 +1,105 @@
+"""Find the registrable domain of a host name with a public suffix list.
+
+The rules are in the format of the Mozilla public suffix list
+(https://publicsuffix.org/list/)::
+
+    // A comment
+    uk
+    co.uk
+    *.ck
+    !www.ck
+
+The SA `util_rb_tld`, `util_rb_2tld` and `util_rb_3tld` lists are plain
+rules. Names that no rule covers have a one label suffix, as if the list
+had a "*" rule.
+
+The rules are kept in sets, so finding the suffix of a name only takes
+one lookup per label.
+"""
+
+from __future__ import absolute_import
+
+import io
+
+
+class PublicSuffixList(object):
+    """The rules of a public suffix list.
+
+    :param rules: The initial rules.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = set()
+        self.wildcards = set()
+        self.exceptions = set()
+        for rule in rules:
+            self.add(rule)
+
+    def __len__(self):
+        return len(self.rules) + len(self.wildcards) + len(self.exceptions)
+
+    def add(self, rule):
+        """Add a rule, comments and empty lines are ignored. Rules
+        with international names are added in their IDNA form too.
+        """
+        rule = rule.split(None, 1)[0] if rule.strip() else ""
+        if not rule or rule.startswith("//"):
+            return
+        rule = rule.lower().rstrip(".")
+        self._add(rule)
+        try:
+            ascii_rule = rule.encode("idna").decode("ascii")
+        except (UnicodeError, ValueError):
+            return
+        if ascii_rule != rule:
+            self._add(ascii_rule)
+
+    def _add(self, rule):
+        if rule.startswith("!"):
+            self.exceptions.add(rule[1:])
+        elif rule.startswith("*."):
+            self.wildcards.add(rule[2:])
+        else:
+            self.rules.add(rule)
+
+    def load(self, lines):
+        """Add the rules of these lines."""
+        for line in lines:
+            self.add(line)
+
+    def load_file(self, path):
+        """Add the rules of a public suffix list file."""
+        with io.open(path, encoding="utf-8") as suffix_file:
+            self.load(suffix_file)
+
+    def get_suffix_length(self, labels):
+        """Get the number of labels of the public suffix of the name
+        with these labels.
+        """
+        count = len(labels)
+        # The longest match is the first one found.
+        for i in range(count):
+            name = ".".join(labels[i:])
+            if name in self.exceptions:
+                return count - i - 1
+            if name in self.rules:
+                return count - i
+            if i + 1 < count and ".".join(labels[i + 1:]) in self.wildcards:
+                return count - i
+        return 1
+
+    def get_registrable_domain(self, host):
+        """Get the public suffix of this host name and the label before
+        it, e.g. "example.co.uk" for "www.example.co.uk".
+
+        :return: The domain, or None if the host is itself a public
+          suffix.
+        """
+        host = host.lower().rstrip(".")
+        labels = host.split(".")
+        if not all(labels):
+            return None
+        suffix = self.get_suffix_length(labels)
+        if suffix >= len(labels):
+            return None
+        return ".".join(labels[-suffix - 1:])
@@ -0,0 +1,530 @@
+"""Answer DNS lists from local copies of their rbldnsd zone files.
+
+Zone files in the ip4set, ip4trie and dnset formats are compiled into
+snapshot files:
+
+* IPv4 entries are flattened into sorted, non overlapping ranges, so
+  the most specific entry that covers an address is found with a
+  binary search.
+* Domain entries are sorted by the hash of the name, exact names and
+  wildcards being stored separately.
+
+The snapshots are mmap'd read only, so the pre forked workers and the
+per user rulesets share the same pages. When the zone file changes a
+new snapshot is written next to the old one, renamed into place, and
+the zone switches to it in one assignment.
+"""
+
+from __future__ import absolute_import
+
+import io
+import os
+import glob
+import mmap
+import time
+import heapq
+import struct
+import hashlib
+import logging
+import tempfile
+import threading
+
+ZONE_TYPES = ("ip4set", "ip4trie", "dnset")
+
+# The answer of the entries without a value, until the zone sets a
+# different default.
+DEFAULT_A = "127.0.0.2"
+
+_MAGIC = b"OAZ1"
+_IP4, _DOMAIN = 0, 1
+# Magic, kind, values, entries, entries offset, strings offset
+_HEADER = struct.Struct("<4sIIIII")
+# A record, TXT offset, TXT length
+_VALUE = struct.Struct("<III")
+# First address, last address, value
+_IP4_ENTRY = struct.Struct("<III")
+# Name hash, name offset, name length, value
+_DOMAIN_ENTRY = struct.Struct("<QIII")
+# The value of the entries that are excluded with "!".
+_EXCLUDED = 0xFFFFFFFF
+
+_snapshots_lock = threading.Lock()
+_snapshots = {}
+
+
+def _ip_to_int(ip):
+    parts = ip.split(".")
+    if len(parts) != 4:
+        raise ValueError("Invalid IP address %r" % ip)
+    value = 0
+    for part in parts:
+        octet = int(part)
+        if not 0 <= octet <= 255:
+            raise ValueError("Invalid IP address %r" % ip)
+        value = value << 8 | octet
+    return value
+
+
+def _int_to_ip(value):
+    return "%d.%d.%d.%d" % (value >> 24 & 255, value >> 16 & 255,
+                            value >> 8 & 255, value & 255)
+
+
+def _parse_ip4(entry):
+    """Get the first and last address of an ip4set entry. Entries can
+    be an address, a CIDR network, a range or a partial address (e.g.
+    "10.1" for 10.1.0.0/16).
+    """
+    if "/" in entry:
+        network, length = entry.split("/", 1)
+        length = int(length)
+        if not 0 <= length <= 32:
+            raise ValueError("Invalid network %r" % entry)
+        parts = network.split(".")
+        parts.extend(["0"] * (4 - len(parts)))
+        first = _ip_to_int(".".join(parts))
+        size = 1 << (32 - length)
+        first &= ~(size - 1) & 0xFFFFFFFF
+        return first, first + size - 1
+    if "-" in entry:
+        start, end = entry.split("-", 1)
+        first = _ip_to_int(start)
+        if "." in end:
+            last = _ip_to_int(end)
+        elif 0 <= int(end) <= 255:
+            last = first & 0xFFFFFF00 | int(end)
+        else:
+            raise ValueError("Invalid range %r" % entry)
+        if last < first:
+            raise ValueError("Invalid range %r" % entry)
+        return first, last
+    parts = entry.split(".")
+    missing = 4 - len(parts)
+    if missing < 0:
+        raise ValueError("Invalid IP address %r" % entry)
+    first = _ip_to_int(".".join(parts + ["0"] * missing))
+    return first, first + (1 << (8 * missing)) - 1
+
+
+def _parse_value(value, default):
+    """Parse the ":A:TXT" value of an entry, the parts that are
+    missing are taken from the default.
+    """
+    value = value.strip()
+    if not value:
+        return default
+    if not value.startswith(":"):
+        return default[0], value
+    parts = value[1:].split(":", 1)
+    a = parts[0].strip()
+    if not a:
+        a = default[0]
+    elif "." not in a:
+        a = "127.0.0.%d" % int(a)
+    _ip_to_int(a)
+    if len(parts) > 1:
+        return a, parts[1]
+    return a, default[1]
+
+
+def parse_zone(kind, lines, log=None):
+    """Parse the lines of a rbldnsd zone file.
+
+    :param kind: The type of the zone, one of `ZONE_TYPES`.
+    :param lines: The lines of the zone file.
+    :return: A list of (key, value) pairs, where the key is a
+      (first, last) address range for the IPv4 zones or a name for
+      the domain zones. Names of wildcards start with "*.". The value
+      is an (A, TXT) tuple or None for the excluded entries.
+    """
+    if kind not in ZONE_TYPES:
+        raise ValueError("Unknown zone type %r" % kind)
+    default = (DEFAULT_A, "")
+    entries = []
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line[0] in "#;$":
+            continue
+        try:
+            if line.startswith(":"):
+                default = _parse_value(line, default)
+                continue
+            parts = line.split(None, 1)
+            entry = parts[0]
+            value = _parse_value(parts[1] if len(parts) > 1 else "",
+                                 default)
+            if entry.startswith("!"):
+                entry = entry[1:]
+                value = None
+            if kind == "dnset":
+                entry = entry.lower().rstrip(".")
+                if entry.startswith("."):
+                    entries.append((entry[1:], value))
+                    entries.append(("*" + entry, value))
+                else:
+                    entries.append((entry, value))
+            else:
+                entries.append((_parse_ip4(entry), value))
+        except (ValueError, IndexError) as e:
+            if log is not None:
+                log.warning("Invalid %s entry on line %s: %s", kind,
+                            lineno, e)
+    return entries
+
+
+def _flatten(ranges):
+    """Flatten the (first, last, value) ranges into sorted, non
+    overlapping ranges. Where ranges overlap the smallest one wins,
+    and the first one listed if they have the same size. Excluded
+    ranges are left out.
+    """
+    events = []
+    for order, (first, last, value) in enumerate(ranges):
+        events.append((first, 1, order))
+        events.append((last + 1, 0, order))
+    events.sort()
+    active = []
+    ended = set()
+    result = []
+    i = 0
+    while i < len(events):
+        point = events[i][0]
+        while i < len(events) and events[i][0] == point:
+            dummy, start, order = events[i]
+            if start:
+                first, last, value = ranges[order]
+                heapq.heappush(active, (last - first, order))
+            else:
+                ended.add(order)
+            i += 1
+        while active and active[0][1] in ended:
+            heapq.heappop(active)
+        if not active or i >= len(events):
+            continue
+        value = ranges[active[0][1]][2]
+        if value == _EXCLUDED:
+            continue
+        last = events[i][0] - 1
+        if result and result[-1][1] == point - 1 and result[-1][2] == value:
+            result[-1] = (result[-1][0], last, value)
+        else:
+            result.append((point, last, value))
+    return result
+
+
+def _hash_name(name):
+    return struct.unpack("<Q", hashlib.sha1(
+        name.encode("utf-8")).digest()[:8])[0]
+
+
+def build_snapshot(kind, entries):
+    """Build the snapshot of the parsed entries of a zone.
+
+    :return: The snapshot as a bytestring.
+    """
+    values = {}
+    strings = []
+    strings_size = [0]
+
+    def add_string(text):
+        data = text.encode("utf-8")
+        offset = strings_size[0]
+        strings.append(data)
+        strings_size[0] += len(data)
+        return offset, len(data)
+
+    packed_values = []
+
+    def get_value(value):
+        if value is None:
+            return _EXCLUDED
+        try:
+            return values[value]
+        except KeyError:
+            pass
+        offset, length = add_string(value[1])
+        packed_values.append(_VALUE.pack(_ip_to_int(value[0]), offset,
+                                         length))
+        values[value] = len(packed_values) - 1
+        return values[value]
+
+    packed_entries = []
+    if kind == "dnset":
+        seen = set()
+        records = []
+        for name, value in entries:
+            # The first entry of a name wins.
+            if name in seen:
+                continue
+            seen.add(name)
+            records.append((_hash_name(name), name, get_value(value)))
+        records.sort()
+        for name_hash, name, value in records:
+            offset, length = add_string(name)
+            packed_entries.append(_DOMAIN_ENTRY.pack(name_hash, offset,
+                                                     length, value))
+        zone_kind = _DOMAIN
+    else:
+        ranges = [(first, last, get_value(value))
+                  for (first, last), value in entries]
+        for first, last, value in _flatten(ranges):
+            packed_entries.append(_IP4_ENTRY.pack(first, last, value))
+        zone_kind = _IP4
+
+    entries_offset = (_HEADER.size + _VALUE.size * len(packed_values))
+    entry_size = _DOMAIN_ENTRY.size if zone_kind == _DOMAIN \
+        else _IP4_ENTRY.size
+    strings_offset = entries_offset + entry_size * len(packed_entries)
+    header = _HEADER.pack(_MAGIC, zone_kind, len(packed_values),
+                          len(packed_entries), entries_offset,
+                          strings_offset)
+    return b"".join([header] + packed_values + packed_entries + strings)
+
+
+class Snapshot(object):
+    """Read the entries of a zone snapshot, from a bytestring or from
+    a mmap'd file.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        if len(data) < _HEADER.size:
+            raise ValueError("Truncated zone snapshot")
+        (magic, self.kind, self.values, self.entries, self.entries_offset,
+         self.strings_offset) = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError("Invalid zone snapshot")
+        self.entry = _DOMAIN_ENTRY if self.kind == _DOMAIN else _IP4_ENTRY
+        if self.strings_offset > len(data) or (
+                self.entries_offset + self.entry.size * self.entries !=
+                self.strings_offset):
+            raise ValueError("Truncated zone snapshot")
+
+    def __len__(self):
+        return self.entries
+
+    def _get_entry(self, index):
+        return self.entry.unpack_from(
+            self.data, self.entries_offset + self.entry.size * index)
+
+    def _get_string(self, offset, length):
+        offset += self.strings_offset
+        return self.data[offset:offset + length].decode("utf-8")
+
+    def get_value(self, index):
+        """Get the (A, TXT) value with this index."""
+        a, offset, length = _VALUE.unpack_from(
+            self.data, _HEADER.size + _VALUE.size * index)
+        return _int_to_ip(a), self._get_string(offset, length)
+
+    def find_ip(self, ip):
+        """Get the index of the value listed for this IPv4 address as
+        an integer, or None if it's not listed.
+        """
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            first, last, value = self._get_entry(middle)
+            if ip < first:
+                high = middle
+            elif ip > last:
+                low = middle + 1
+            else:
+                return value
+        return None
+
+    def find_name(self, name):
+        """Get the index of the value listed for this name, or None if
+        it's not listed.
+        """
+        name_hash = _hash_name(name)
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_entry(middle)[0] < name_hash:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.entries:
+            entry_hash, offset, length, value = self._get_entry(low)
+            if entry_hash != name_hash:
+                break
+            if self._get_string(offset, length) == name:
+                return value
+            low += 1
+        return None
+
+
+def _open_snapshot(path, kind, stat, directory, log):
+    """Open the snapshot of this version of the zone file, building
+    it if no other process did it already.
+    """
+    prefix = "%s-%s-" % (kind, hashlib.sha1(
+        os.path.abspath(path).encode("utf-8")).hexdigest()[:16])
+    snapshot_path = os.path.join(directory, "%s%d-%d-%d.zone" % (
+        prefix, stat.st_ino, int(stat.st_mtime * 1000000), stat.st_size))
+    with _snapshots_lock:
+        try:
+            return _snapshots[snapshot_path]
+        except KeyError:
+            pass
+        snapshot = None
+        try:
+            with open(snapshot_path, "rb") as snapshot_file:
+                snapshot = Snapshot(mmap.mmap(snapshot_file.fileno(), 0,
+                                              access=mmap.ACCESS_READ))
+        except (IOError, OSError, ValueError):
+            pass
+        if snapshot is None:
+            start = time.time()
+            with io.open(path, encoding="utf-8", errors="replace") as zone:
+                entries = parse_zone(kind, zone, log)
+            data = build_snapshot(kind, entries)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            tmp_path = "%s.%d.tmp" % (snapshot_path, os.getpid())
+            with open(tmp_path, "wb") as snapshot_file:
+                snapshot_file.write(data)
+            os.rename(tmp_path, snapshot_path)
+            for old_path in glob.glob(os.path.join(directory,
+                                                   prefix + "*.zone")):
+                if old_path != snapshot_path:
+                    try:
+                        os.remove(old_path)
+                    except OSError:
+                        pass
+            log.info("Compiled %s zone %s (%s entries) in %.2fs", kind,
+                     path, len(entries), time.time() - start)
+            with open(snapshot_path, "rb") as snapshot_file:
+                snapshot = Snapshot(mmap.mmap(snapshot_file.fileno(), 0,
+                                              access=mmap.ACCESS_READ))
+        for old_path in list(_snapshots):
+            if os.path.basename(old_path).startswith(prefix):
+                del _snapshots[old_path]
+        _snapshots[snapshot_path] = snapshot
+        return snapshot
+
+
+class Zone(object):
+    """A DNS list answered from a local rbldnsd zone file.
+
+    :param name: The name of the list, e.g. "zen.example.com".
+    :param kind: The type of the zone file, one of `ZONE_TYPES`.
+    :param path: The path of the zone file.
+    :param directory: Where the snapshots are stored, the temporary
+      directory by default.
+    :param check_interval: How often the zone file is checked for
+      changes, in seconds.
+    """
+
+    def __init__(self, name, kind, path, directory=None, check_interval=60):
+        if kind not in ZONE_TYPES:
+            raise ValueError("Unknown zone type %r" % kind)
+        self.log = logging.getLogger("oa-logger")
+        self.name = name.lower().rstrip(".")
+        self.kind = kind
+        self.path = path
+        if not directory:
+            directory = os.path.join(tempfile.gettempdir(), "oa-zones")
+        self.directory = directory
+        self.check_interval = check_interval
+        self.snapshot = None
+        self._version = None
+        self._next_check = 0
+        self.load()
+
+    def load(self):
+        """Load the current version of the zone file. If it can't be
+        loaded, the previous version is still used.
+        """
+        self._next_check = time.time() + self.check_interval
+        try:
+            stat = os.stat(self.path)
+            version = (stat.st_ino, stat.st_mtime, stat.st_size)
+            if version == self._version:
+                return
+            self.snapshot = _open_snapshot(self.path, self.kind, stat,
+                                           self.directory, self.log)
+            self._version = version
+        except (IOError, OSError, ValueError) as e:
+            if self.snapshot is None:
+                raise
+            self.log.warning("Unable to reload zone %s from %s: %s",
+                             self.name, self.path, e)
+
+    def check(self):
+        """Reload the zone file if it changed, at most once every
+        `check_interval` seconds.
+        """
+        if self._next_check <= time.time():
+            self.load()
+
+    def lookup(self, labels, qtype="A"):
+        """Get the answers for the labels that precede the name of the
+        zone in a query, as text, like they would be returned by
+        `DNSInterface.query`.
+        """
+        snapshot = self.snapshot
+        if self.kind == "dnset":
+            subject = ".".join(labels)
+            index = snapshot.find_name(subject)
+            for i in range(1, len(labels)):
+                if index is not None:
+                    break
+                index = snapshot.find_name("*." + ".".join(labels[i:]))
+        else:
+            try:
+                ip = _ip_to_int(".".join(reversed(labels)))
+            except ValueError:
+                return []
+            subject = _int_to_ip(ip)
+            index = snapshot.find_ip(ip)
+        if index is None or index == _EXCLUDED:
+            return []
+        a, txt = snapshot.get_value(index)
+        if qtype == "A":
+            return [a]
+        if qtype == "TXT":
+            txt = txt.replace("$", subject)
+            return ['"%s"' % txt.replace("\\", "\\\\").replace('"', '\\"')]
+        return []
+
+
+class LocalZones(object):
+    """The DNS lists that are answered locally, by name."""
+
+    def __init__(self):
+        self.zones = {}
+
+    def __len__(self):
+        return len(self.zones)
+
+    def add(self, zone):
+        self.zones[zone.name] = zone
+
+    def get_zone(self, qname):
+        """Get the local zone this name is in and the labels that
+        precede its name, or (None, None).
+        """
+        if not self.zones:
+            return None, None
+        labels = qname.lower().rstrip(".").split(".")
+        for i in range(1, len(labels)):
+            zone = self.zones.get(".".join(labels[i:]))
+            if zone is not None:
+                return zone, labels[:i]
+        return None, None
+
+    def check(self):
+        """Reload the zone files that changed."""
+        for zone in self.zones.values():
+            zone.check()
+
+    def lookup(self, qname, qtype="A"):
+        """Get the answers for this query, or None if the name isn't
+        in any of the local zones.
+        """
+        zone, labels = self.get_zone(qname)
+        if zone is None:
+            return None
+        return zone.lookup(labels, qtype)
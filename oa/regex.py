@@ -121,9 +121,15 @@ class Regex(object):
 
     def compile(self):
         from oa.config import LAZY_MODE
+        if self.compiled is not None:
+            return self.compiled
         if LAZY_MODE:
             return re.compile(self.pattern, self.flags)
-        elif not self.compiled:
+        return self.precompile()
+
+    def precompile(self):
+        """Compile the pattern now and keep it, even in lazy mode."""
+        if self.compiled is None:
             self.compiled = re.compile(self.pattern, self.flags)
         return self.compiled
 
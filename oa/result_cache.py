@@ -0,0 +1,367 @@
+"""Cache the results of the rules for near identical messages.
+
+Bulk campaigns deliver copies of the same message to many recipients.
+The results of the rules are cached under a digest of the message that
+only includes the parts the rules look at: the body, the headers that
+header rules inspect (without the ones that change for every recipient),
+the untrusted relays and the sender domain.
+
+When a copy is found in the cache, the rules that could see a part of
+the message that isn't in the digest are still checked: header rules on
+recipient headers (To, Cc, Received, Message-Id, ...), full and MIME
+header rules, the eval rules that plugins don't list in their
+`cacheable_eval_rules` (e.g. the whitelists, AWL, SPF and DKIM) and the
+meta rules using any of them. Only the results of the rules known to
+look at the body, or at the parts of the message in the digest, are
+reused. The score is always computed with the scores of the
+ruleset, so user preferences still apply, and the rulesets loaded from
+the preferences of a user (with `allow_user_rules`) have their own
+results.
+
+The results are kept in an in-process LRU and, optionally, in a SQLite
+database shared by the pre forked workers.
+
+Optionally, the results of the network rules are also reused for near
+duplicates, messages with a similar body (see `oa.fingerprint`) sent
+through the same untrusted relays from the same sender domain, since
+the network rules also look these up. All the other rules are checked
+again for these.
+"""
+
+from __future__ import absolute_import
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+import collections
+
+from weakref import WeakKeyDictionary
+
+import oa.metrics
+import oa.fingerprint
+import oa.rules.uri
+import oa.rules.body
+import oa.rules.meta
+import oa.rules.eval_
+import oa.rules.header
+
+# Headers that are different for each copy of a message.
+RECIPIENT_HEADERS = frozenset((
+    "to", "cc", "bcc", "delivered-to", "x-original-to", "envelope-to",
+    "x-envelope-to", "received", "message-id", "resent-message-id",
+    "x-message-id", "date", "return-path", "x-envelope-from",
+))
+# Headers that are always part of the digest.
+DEFAULT_HEADERS = frozenset((
+    "from", "sender", "reply-to", "subject", "content-type",
+    "mime-version", "x-mailer", "user-agent",
+))
+# Rules that only look at the body of the message, and the Subject that
+# is part of the extracted text.
+BODY_RULES = (oa.rules.body.BodyRule, oa.rules.uri.URIRule)
+
+
+def config_generation(paths):
+    """Return a short digest of the configuration files, so the
+    results of a different configuration are never used.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        digest.update(("%s:%s:%s\n" % (path, info.st_mtime, info.st_size))
+                      .encode("utf8"))
+    return digest.hexdigest()[:16]
+
+
+class _RulesetInfo(object):
+    """The rules of a ruleset that are checked for every recipient, the
+    network rules, the headers that are part of the digest and the
+    identity of the user ruleset.
+    """
+
+    def __init__(self, ruleset):
+        cacheable_evals = set()
+        for plugin in ruleset.ctxt.plugins.values():
+            cacheable_evals.update(getattr(plugin, "cacheable_eval_rules",
+                                           ()))
+        # Each user ruleset has its own results.
+        self.identity = ""
+        if ruleset.ctxt.userprefs:
+            self.identity = "%s:%s" % (
+                ruleset.ctxt.username,
+                config_generation([ruleset.ctxt.userprefs])
+            )
+        self.headers = set(DEFAULT_HEADERS)
+        self.recompute = set()
+        self.network = set()
+        metas = {}
+        for name, rule in ruleset.checked.items():
+            if rule.tflags and "net" in rule.tflags:
+                self.network.add(name)
+            if isinstance(rule, BODY_RULES):
+                continue
+            if isinstance(rule, oa.rules.header.HeaderRule):
+                names = getattr(rule, "_headers", None)
+                if names is None:
+                    names = (getattr(rule, "_header_name", None),)
+                if None in names:
+                    # Checks all the headers.
+                    self.recompute.add(name)
+                    continue
+                names = set(header.lower() for header in names)
+                if names & RECIPIENT_HEADERS:
+                    self.recompute.add(name)
+                else:
+                    self.headers.update(names)
+            elif isinstance(rule, oa.rules.eval_.EvalRule):
+                if rule.eval_rule_name not in cacheable_evals:
+                    self.recompute.add(name)
+            elif isinstance(rule, oa.rules.meta.MetaRule):
+                metas[name] = set(rule._location) - {"match", "__builtins__"}
+            else:
+                # Full, MIME header and any other rule that can see
+                # headers that are not part of the digest.
+                self.recompute.add(name)
+        # Meta rules that use a recomputed rule, directly or through
+        # other meta rules.
+        changed = True
+        while changed:
+            changed = False
+            for name, subrules in metas.items():
+                if name not in self.recompute and subrules & self.recompute:
+                    self.recompute.add(name)
+                    changed = True
+        self.headers = sorted(self.headers)
+
+
+class SQLiteBackend(object):
+    """Stores the results in a SQLite database that can be shared
+    by several processes.
+
+    Each process and thread uses its own connection. Expired results
+    are removed every `prune_interval` writes.
+    """
+    prune_interval = 1000
+    timeout = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self.log = logging.getLogger("oa-logger")
+        self._local = threading.local()
+        self._writes = 0
+
+    def _get_connection(self):
+        """Get the connection of this thread, or open a new one. A
+        connection is never used in a forked process.
+        """
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("CREATE TABLE IF NOT EXISTS results "
+                         "(digest TEXT PRIMARY KEY, expires REAL, "
+                         "results TEXT)")
+            self._local.conn = conn
+            self._local.pid = pid
+        return self._local.conn
+
+    def get(self, key):
+        """Return the results for this digest, or None."""
+        try:
+            row = self._get_connection().execute(
+                "SELECT results FROM results WHERE digest = ? AND "
+                "expires > ?", (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            self.log.warning("Unable to get cached results: %s", e)
+            return None
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, results, ttl):
+        """Store the results for this digest for `ttl` seconds."""
+        now = time.time()
+        try:
+            conn = self._get_connection()
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO results VALUES "
+                             "(?, ?, ?)", (key, now + ttl,
+                                           json.dumps(results)))
+                self._writes += 1
+                if self._writes % self.prune_interval == 0:
+                    conn.execute("DELETE FROM results WHERE expires <= ?",
+                                 (now,))
+        except sqlite3.Error as e:
+            self.log.warning("Unable to cache results: %s", e)
+
+
+class ResultCache(object):
+    """Cache for the results of the rules, see the module documentation.
+
+    :param max_size: The number of results kept in this process.
+    :param ttl: Number of seconds the results are used for.
+    :param backend: An optional shared backend, e.g. `SQLiteBackend`.
+    :param generation: The `config_generation` of the configuration,
+      changed when the configuration is reloaded.
+    :param near_duplicates: An optional
+      `oa.fingerprint.NearDuplicateIndex` for the network results.
+    :param min_tokens: Messages with fewer tokens are never considered
+      near duplicates.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, backend=None,
+                 generation="", near_duplicates=None, min_tokens=20):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self.generation = generation
+        self.near_duplicates = near_duplicates
+        self.min_tokens = min_tokens
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._info = WeakKeyDictionary()
+
+    def clear(self):
+        """Remove all the results kept in this process."""
+        with self._lock:
+            self._entries.clear()
+        if self.near_duplicates is not None:
+            self.near_duplicates.clear()
+
+    def get(self, key):
+        """Return the cached results for this key or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                expires, results = entry
+                if expires > time.time():
+                    # Most recently used.
+                    self._entries[key] = entry
+                    return results
+        if self.backend is None:
+            return None
+        results = self.backend.get(key)
+        if results is not None:
+            self._store(key, results)
+        return results
+
+    def set(self, key, results):
+        """Cache the results for this key."""
+        self._store(key, results)
+        if self.backend is not None:
+            self.backend.set(key, results, self.ttl)
+
+    def _store(self, key, results):
+        """Keep the results in the LRU of this process."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, results)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_info(self, ruleset):
+        """Return the `_RulesetInfo` for this ruleset."""
+        with self._lock:
+            try:
+                return self._info[ruleset]
+            except KeyError:
+                pass
+        info = _RulesetInfo(ruleset)
+        with self._lock:
+            self._info[ruleset] = info
+        return info
+
+    def get_key(self, msg, headers, identity=""):
+        """Return the digest of the parts of the message that the
+        cached rules look at, for the ruleset with this `identity`.
+        """
+        digest = hashlib.sha1()
+
+        def update(value):
+            digest.update(value.encode("utf8", "ignore"))
+            digest.update(b"\0")
+
+        update(self.generation)
+        update(identity)
+        for name in headers:
+            update(name)
+            for value in msg.get_raw_header(name):
+                update(" ".join(value.split()))
+        update(self.get_sender_key(msg))
+        body = msg.raw_msg.partition("\n\n")[2]
+        for part in msg.msg.walk():
+            boundary = part.get_boundary()
+            if boundary:
+                # Generated again for each copy.
+                body = body.replace(boundary, "")
+        update(" ".join(body.split()))
+        return digest.hexdigest()
+
+    @staticmethod
+    def get_sender_key(msg):
+        """Return the untrusted relays and the sender domain of the
+        message, that the network rules look up.
+        """
+        ips = " ".join(str(ip) for ip in msg.untrusted_ips)
+        return "%s %s" % (ips, msg.sender_address.rpartition("@")[2].lower())
+
+    def match(self, ruleset, msg):
+        """Match the message against the ruleset, using the cached
+        results if there are any.
+        """
+        info = self.get_info(ruleset)
+        key = self.get_key(msg, info.headers, info.identity)
+        results = self.get(key)
+        if results is not None:
+            oa.metrics.incr("result_cache_hits")
+            cached = dict((name, result) for name, result in results.items()
+                          if name not in info.recompute)
+            # The rules that depend on the recipient are checked
+            # again, the others use the results of the first copy.
+            ruleset.match(msg, cached=cached)
+            return
+        fingerprint = None
+        if self.near_duplicates is not None:
+            fingerprint = oa.fingerprint.message_fingerprint(
+                msg, self.min_tokens
+            )
+        sender_key = None
+        if fingerprint is not None:
+            sender_key = "%s %s" % (info.identity, self.get_sender_key(msg))
+            found = self.near_duplicates.find(
+                fingerprint, lambda value: value[0] == sender_key
+            )
+            if found is not None:
+                oa.metrics.incr("result_cache_near_hits")
+                (dummy, results), dist = found
+                cached = dict((name, result)
+                              for name, result in results.items()
+                              if name in info.network and
+                              name not in info.recompute)
+                ruleset.match(msg, cached=cached)
+                return
+        oa.metrics.incr("result_cache_misses")
+        ruleset.match(msg)
+        if msg.local_only or len(msg.rules_checked) < len(ruleset.checked):
+            # Not all the rules were checked.
+            return
+        results = {}
+        for name, result in msg.rules_checked.items():
+            if name in info.recompute:
+                continue
+            if result:
+                result = msg.rules_descriptions.get(name) or True
+            results[name] = result
+        self.set(key, results)
+        if fingerprint is not None:
+            self.near_duplicates.add(fingerprint, (sender_key, dict(
+                (name, result) for name, result in results.items()
+                if name in info.network
+            )))
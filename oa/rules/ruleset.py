@@ -6,6 +6,7 @@ from builtins import str
 
 import re
 import socket
+import logging
 import email.utils
 import collections
 import email.message
@@ -19,6 +20,22 @@ import oa.errors
 import oa.regex
 
 _TAG_RE = oa.regex.Regex(r"(_([A-Z_]*?)_)")
+_HEADER_END_RE = oa.regex.Regex(r"(\r?\n)\r?\n")
+_PLACEHOLDER_RE = oa.regex.Regex(r"%\((\w+)\)s")
+
+# A compiled report or header template: the literal text around the
+# tags, and the tags in the order they appear.
+Template = collections.namedtuple("Template", "literals tags")
+
+_hostname = None
+
+
+def get_hostname():
+    """Return the hostname, it's only looked up once."""
+    global _hostname
+    if _hostname is None:
+        _hostname = socket.gethostname()
+    return _hostname
 
 _DNS_OPTIONS_RE = oa.regex.Regex(r"""
 [
@@ -40,6 +57,25 @@ class RuleSet(object):
         self.ctxt = ctxt
         self.conf = ctxt.conf
         self.tags = set()
+        self._templates = dict()
+        self._static_tags = {
+            "HOSTNAME": get_hostname(),
+            "SUBVERSION": oa.__release_date__,
+            "VERSION": oa.__version__,
+        }
+        self._tag_getters = {
+            "CONTACTADDRESS": lambda msg: self.conf["report_contact"],
+            "YESNOCAPS": lambda msg: self._get_yesno(msg).upper(),
+            "YESNO": self._get_yesno,
+            "SCORE": lambda msg: "%0.1f" % msg.score,
+            "REQD": lambda msg: "%0.1f" % self.conf["required_score"],
+            "REPORT": self.get_matched_report,
+            "TESTS": self._get_tests,
+            "TESTSSCORES": self._get_tests_scores,
+            "SUMMARY": self.get_summary_report,
+            "PREVIEW": self._get_preview,
+            "DNSSKIPPED": lambda msg: str(msg.dns_budget.skipped),
+        }
         # Store modification that need to be done to the message in
         # the following format:
         # (True/False, header_name, value)
@@ -57,57 +93,72 @@ class RuleSet(object):
         self.use_bayes = True
         self.use_network = True
 
-    def _interpolate(self, text, msg):
-        if msg.interpolate_data:
-            return text % msg.interpolate_data
-
-        spam = msg.score >= self.conf["required_score"]
-        data = msg.interpolate_data
-        # Initialize all tags with a empty value
-        for tag in self.tags:
-            data[tag] = "@@%s@@" % tag
-
-        data["CONTACTADDRESS"] = self.conf["report_contact"]
-        data["HOSTNAME"] = socket.gethostname()
-        data["YESNOCAPS"] = "YES" if spam else "NO"
-        data["YESNO"] = "Yes" if spam else "No"
-        data["SCORE"] = "%0.1f" % msg.score
-        data["REQD"] = "%0.1f" % self.conf["required_score"]
-        data["SUBVERSION"] = oa.__release_date__
-        data["VERSION"] = oa.__version__
-
-        # Some of these tags are more expensive to create,
-        # so only add them if they are required.
-        if "REPORT" in self.tags:
-            data["REPORT"] = self.get_matched_report(msg)
-        if "TESTS" in self.tags:
-            matched_rules = [name for name, result in msg.rules_checked.items()
-                             if result]
-            if not matched_rules:
-                data["TESTS"] = "none"
-            else:
-                data["TESTS"] = ",".join(matched_rules)
-
-        if "TESTSSCORES" in self.tags:
-            matched_rules = ["%s=%s" % (name, int(result))
-                             for name, result in msg.rules_checked.items()
-                             if result]
-            if not matched_rules:
-                data["TESTSSCORES"] = "none"
-            else:
-                data["TESTSSCORES"] = ",".join(matched_rules)
-
-        if "SUMMARY" in self.tags:
-            data["SUMMARY"] = self.get_summary_report(msg)
-        if "PREVIEW" in self.tags:
-            preview = " ".join(msg.raw_text.split("\n", 3)[:3])[:200] + "[...]"
-            data["PREVIEW"] = preview
+    def _compile_template(self, text):
+        """Return the compiled template for this text, with the
+        placeholders already converted (see `_convert_tags`).
+        """
+        try:
+            return self._templates[text]
+        except KeyError:
+            pass
+        # The literals are at the even positions and the tags at the
+        # odd ones.
+        parts = _PLACEHOLDER_RE.split(text)
+        template = Template(
+            tuple(literal.replace("%%", "%") for literal in parts[::2]),
+            tuple(parts[1::2]),
+        )
+        self._templates[text] = template
+        return template
 
+    def _get_tag(self, tag, msg):
+        """Get the value of this tag for the message."""
         # Plugin can store custom tags in the the message
-        # after they perform check. Add them to the data
-        # as well.
-        data.update(msg.plugin_tags)
-        return text % msg.interpolate_data
+        # after they perform check.
+        if tag in msg.plugin_tags:
+            return msg.plugin_tags[tag]
+        if tag in self._static_tags:
+            return self._static_tags[tag]
+        getter = self._tag_getters.get(tag)
+        if getter is None:
+            return "@@%s@@" % tag
+        return getter(msg)
+
+    def _interpolate(self, text, msg):
+        """Render the template. Only the tags referenced are computed
+        and their values are kept in the message, so they are shared
+        by all the templates rendered for it.
+        """
+        template = self._compile_template(text)
+        data = msg.interpolate_data
+        literals = iter(template.literals)
+        result = [next(literals)]
+        for tag in template.tags:
+            try:
+                value = data[tag]
+            except KeyError:
+                value = data[tag] = self._get_tag(tag, msg)
+            result.append(str(value))
+            result.append(next(literals))
+        return "".join(result)
+
+    def _get_yesno(self, msg):
+        return "Yes" if msg.score >= self.conf["required_score"] else "No"
+
+    def _get_tests(self, msg):
+        matched_rules = [name for name, result in msg.rules_checked.items()
+                         if result]
+        return ",".join(matched_rules) or "none"
+
+    def _get_tests_scores(self, msg):
+        matched_rules = ["%s=%s" % (name, int(result))
+                         for name, result in msg.rules_checked.items()
+                         if result]
+        return ",".join(matched_rules) or "none"
+
+    @staticmethod
+    def _get_preview(msg):
+        return " ".join(msg.raw_text.split("\n", 3)[:3])[:200] + "[...]"
 
     def add_rule(self, rule):
         """Add a rule to the ruleset, execute any pre and post processing
@@ -170,23 +221,82 @@ class RuleSet(object):
         self.header_mod[msg_status].append((remove, header_name, header_value))
 
     def get_adjusted_message(self, msg, header_only=False):
-        """Get message adjusted by the rules."""
+        """Get message adjusted by the rules.
+
+        Unless the message is replaced by a report (see `report_safe`),
+        the headers are added to the original header block and the
+        body is returned untouched, without parsing the message again.
+        """
         spam = msg.score >= self.conf["required_score"]
-        if not spam or header_only or self.conf["report_safe"] == 0:
-            newmsg = email.message_from_string(msg.raw_msg)
+        if spam:
+            rules = self.header_mod["all"] + self.header_mod["spam"]
         else:
-            newmsg = self._get_bounce_message(msg)
-        if self.conf["report_safe"] == 0:
-            newmsg.add_header("X-Spam-Report",
-                              self.get_matched_report(msg))
+            rules = self.header_mod["all"] + self.header_mod["ham"]
+        if not spam or header_only or self.conf["report_safe"] == 0:
+            headers = [(remove, name, None if remove else
+                        self._interpolate(value, msg))
+                       for remove, name, value in rules]
+            if self.conf["report_safe"] == 0:
+                headers.insert(0, (False, "X-Spam-Report",
+                                   self.get_matched_report(msg)))
+            return self._splice_headers(msg, headers, header_only)
+        newmsg = self._get_bounce_message(msg)
         self._adjust_headers(msg, newmsg, self.header_mod["all"])
-        if spam:
-            self._adjust_headers(msg, newmsg, self.header_mod["spam"])
+        self._adjust_headers(msg, newmsg, self.header_mod["spam"])
+        return newmsg.as_string()
+
+    @staticmethod
+    def _splice_headers(msg, headers, header_only=False):
+        """Add and remove the headers in the raw header block of the
+        message and return it with the original body, or only the
+        headers followed by an empty line if `header_only` is set.
+
+        The headers are in the same format as the rules for
+        `_adjust_headers`, with the values already interpolated.
+        """
+        raw_msg = msg.raw_msg
+        if raw_msg.startswith(("\n", "\r\n")):
+            # No headers at all.
+            header_block, body = "", raw_msg
+            newline = "\r\n" if raw_msg.startswith("\r") else "\n"
         else:
-            self._adjust_headers(msg, newmsg, self.header_mod["ham"])
+            match = _HEADER_END_RE.search(raw_msg)
+            if match:
+                newline = match.group(1)
+                header_block = raw_msg[:match.end(1)]
+                body = raw_msg[match.end(1):]
+            else:
+                newline = "\r\n" if "\r\n" in raw_msg else "\n"
+                header_block = raw_msg
+                if not header_block.endswith("\n"):
+                    header_block += newline
+                body = newline
+
+        # Group the folded lines with their header.
+        fields = []
+        for line in header_block.splitlines(True):
+            if fields and line[:1] in (" ", "\t"):
+                fields[-1][1].append(line)
+            else:
+                fields.append((line.split(":", 1)[0].strip().lower(), [line]))
+
+        for remove, name, value in headers:
+            if remove:
+                fields = [field for field in fields
+                          if field[0] != name.lower()]
+                continue
+            lines = value.splitlines() or [""]
+            lines = [lines[0]] + [
+                line if line[:1] in (" ", "\t") else "\t" + line
+                for line in lines[1:]
+            ]
+            field = "%s: %s%s" % (name, newline.join(lines), newline)
+            fields.append((name.lower(), [field]))
+
+        header_block = "".join("".join(lines) for _, lines in fields)
         if header_only:
-            return newmsg.as_string().split("\n\n", 1)[0] + "\n\n"
-        return newmsg.as_string()
+            return header_block + newline
+        return header_block + body
 
     def _adjust_headers(self, msg, newmsg, rules):
         """Adjust the headers of this message according to
@@ -209,7 +319,7 @@ class RuleSet(object):
         newmsg = email.mime.multipart.MIMEMultipart("mixed")
         newmsg["Received"] = (
             "from localhost by %s with OrangeAssassin (version %s); %s" %
-            (socket.gethostname(), oa.__version__,
+            (get_hostname(), oa.__version__,
              email.utils.formatdate(localtime=True))
         )
         # Switched around
@@ -304,6 +414,13 @@ class RuleSet(object):
             self._add_header_rule(value, False)
         for value in self.conf["remove_header"]:
             self._add_header_rule(value, True)
+        # Compile the templates once, not for every message.
+        self._compile_template(self.conf["report"])
+        self._compile_template(self.conf["unsafe_report"])
+        for rules in self.header_mod.values():
+            for remove, name, value in rules:
+                if not remove:
+                    self._compile_template(value)
 
         for value in self.conf['dns_query_restriction']:
             try:
@@ -316,7 +433,7 @@ class RuleSet(object):
                 self.ctxt.log.info(
                     "Invalid value for dns_query_restriction %s", value)
                 continue
-            self.ctxt.dns.query_restrictions[qname] = option == "deny"
+            self.ctxt.dns.add_query_restriction(qname, option == "deny")
         dns_options = {"edns": "edns=4096",
                        "rotate": "norotate",
                        "dns0x20": "nodns0x20"}
@@ -338,24 +455,44 @@ class RuleSet(object):
                         raise
                     del rule_list[name]
 
-    def match(self, msg):
-        """Match the message against all the rules in this ruleset."""
+    def match(self, msg, cached=None):
+        """Match the message against all the rules in this ruleset.
+
+        For messages that should only be checked locally, the rules
+        flagged as "net" or "learn" are skipped and the message isn't
+        auto learned.
+
+        :param cached: Optional results of the rules for the same
+          message, as a dictionary that maps the rule name to the
+          result (see `oa.result_cache`). These rules are not checked
+          again.
+        """
+        local_only = getattr(msg, "local_only", False)
+        # Avoid building the debug records for every rule.
+        debug = self.ctxt.log.isEnabledFor(logging.DEBUG)
         try:
             for name, rule in self.checked.items():
-                try:
-                    result = rule.match(msg)
-                except oa.errors.StopProcessing as e:
-                    raise
-                except Exception as e:
-                    self.ctxt.log.critical("Unable to run rule %r: %s",
-                                           name, e, exc_info=True)
-                    result = False
+                if cached is not None and name in cached:
+                    result = cached[name]
+                elif local_only and rule.tflags and (
+                        "net" in rule.tflags or "learn" in rule.tflags):
+                    continue
+                else:
+                    try:
+                        result = rule.match(msg)
+                    except oa.errors.StopProcessing as e:
+                        raise
+                    except Exception as e:
+                        self.ctxt.log.critical("Unable to run rule %r: %s",
+                                               name, e, exc_info=True)
+                        result = False
                 if isinstance(result, str):
                     msg.rules_descriptions[name] = result
                     result = True
                 elif result:
                     msg.rules_descriptions[name] = rule.description
-                self.ctxt.log.debug("Checked rule %s: %s", rule, result)
+                if debug:
+                    self.ctxt.log.debug("Checked rule %s: %s", rule, result)
                 msg.rules_checked[name] = result
                 if result:
                     msg.score += rule.score
@@ -363,4 +500,5 @@ class RuleSet(object):
             self.ctxt.log.debug("Stop processing the messages as "
                                 "requested: %s", e)
         self.ctxt.hook_check_end(self, msg)
-        self.ctxt.hook_auto_learn(self, msg)
+        if not local_only:
+            self.ctxt.hook_auto_learn(self, msg)
@@ -3,18 +3,38 @@ returns the result.
 """
 from __future__ import absolute_import
 
+import gc
+import io
 import os
+import sys
 import copy
+import stat
+import errno
+import time
+import socket
+import select
+import resource
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import spoon.server
 
 import oa
+import oa.regex
 import oa.config
+import oa.errors
+import oa.metrics
 import oa.protocol
+import oa.result_cache
 import oa.rules.parser
 
 import oa.protocol.noop
 import oa.protocol.tell
+import oa.protocol.batch
 import oa.protocol.check
 import oa.protocol.process
 
@@ -22,63 +42,297 @@ COMMANDS = {
     "TELL": oa.protocol.tell.TellCommand,
     "PING": oa.protocol.noop.PingCommand,
     "SKIP": oa.protocol.noop.SkipCommand,
+    "STATS": oa.protocol.noop.StatsCommand,
     "CHECK": oa.protocol.check.CheckCommand,
     "SYMBOLS": oa.protocol.check.SymbolsCommand,
     "REPORT": oa.protocol.check.ReportCommand,
     "REPORT_IFSPAM": oa.protocol.check.ReportIfSpamCommand,
     "PROCESS": oa.protocol.process.ProcessCommand,
     "HEADERS": oa.protocol.process.HeadersCommand,
+    "BATCH": oa.protocol.batch.BatchCommand,
 }
 
 
+def get_rss():
+    """Return the resident set size of the current process in MiB."""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / (1024.0 * 1024.0)
+    except (IOError, OSError, ValueError, IndexError):
+        # Not on Linux, use the peak RSS instead (KiB on Linux,
+        # bytes on BSD and Mac OS X).
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            rss /= 1024.0
+        return rss / 1024.0
+
+
+class Deadline(object):
+    """The deadline for reading one phase of a request. The phase must
+    be received in `timeout` seconds and, after a short grace period,
+    at least at `min_rate` bytes per second.
+    """
+    # Seconds allowed before the minimum transfer rate is enforced.
+    rate_grace = 1.0
+
+    def __init__(self, phase, timeout, min_rate=None):
+        self.phase = phase
+        self.timeout = timeout
+        self.min_rate = min_rate
+        self.started = time.time()
+        self.received = 0
+
+    def get_timeout(self):
+        """Return the number of seconds left for the next read, or
+        None if there is no limit.
+
+        :raises oa.errors.ReadTimeout: If there is no time left.
+        """
+        deadlines = []
+        if self.timeout:
+            deadlines.append(self.started + self.timeout)
+        if self.min_rate:
+            deadlines.append(self.started + self.rate_grace +
+                             self.received / float(self.min_rate))
+        if not deadlines:
+            return None
+        timeout = min(deadlines) - time.time()
+        if timeout <= 0:
+            self.timed_out()
+        return timeout
+
+    def timed_out(self):
+        """Count the timeout and raise the error."""
+        oa.metrics.incr("timeouts_%s" % self.phase)
+        raise oa.errors.ReadTimeout("%s not received in time (%s bytes in "
+                                    "%.1fs)" % (self.phase, self.received,
+                                                time.time() - self.started))
+
+
+class _DeadlineSocketIO(io.RawIOBase):
+    """Read from a socket, but give up once the deadline of the current
+    phase of the request has passed. The socket timeout is updated
+    before every read, so a client can't extend the deadline by sending
+    the data a few bytes at a time.
+    """
+
+    def __init__(self, sock):
+        io.RawIOBase.__init__(self)
+        self._sock = sock
+        self.deadline = Deadline(None, None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        self._sock.settimeout(self.deadline.get_timeout())
+        try:
+            length = self._sock.recv_into(b)
+        except socket.timeout:
+            self.deadline.timed_out()
+        self.deadline.received += length
+        return length
+
+
+class DeadlineFile(io.BufferedReader):
+    """A buffered file that reads the request from the client socket,
+    with a deadline for each phase of the request. See
+    `_DeadlineSocketIO`.
+    """
+
+    def __init__(self, sock, buffer_size=io.DEFAULT_BUFFER_SIZE):
+        io.BufferedReader.__init__(self, _DeadlineSocketIO(sock), buffer_size)
+
+    def set_deadline(self, phase, timeout, min_rate=None):
+        """Limit the time allowed to read the next phase of the
+        request.
+        """
+        self.raw.deadline = Deadline(phase, timeout, min_rate)
+
+
 class RequestHandler(spoon.server.TCPGulp):
-    """Handle a single request."""
+    """Handle a single connection.
+
+    A client that adds the "Keep-Alive: yes" option to a request can send
+    more commands on the same connection, and may pipeline them. The
+    responses are written in order. The connection stays open until the
+    client sends "Keep-Alive: no" or closes it, is idle for more than
+    `keepalive_timeout` seconds or has sent `max_keepalive_requests`
+    commands.
+
+    The command line and the headers of a request must be received in
+    `header_timeout` seconds and the message in `body_timeout` seconds,
+    at least at `min_transfer_rate` bytes per second. Otherwise the
+    connection is closed, so slow clients can't hold the worker.
+    """
+
+    def setup(self):
+        super(RequestHandler, self).setup()
+        self.rfile.close()
+        self.rfile = DeadlineFile(self.connection)
 
     def handle(self):
-        """Get the command from the client and pass it to the
+        """Get the commands from the client and pass them to the
         correct handler.
         """
-        line = self.rfile.readline().decode("utf8").strip()
-        command, proto_version = line.split()
+        keep_alive = False
+        served = 0
+        while True:
+            line = self.read_command(keep_alive)
+            if not line:
+                break
+            if keep_alive:
+                # The headers of the next request.
+                self.rfile.set_deadline("header",
+                                        self.server.header_timeout)
+            command, proto_version = line.split()
+            try:
+                # Run the command handler
+                handler = COMMANDS[command.upper()](self.rfile, self.wfile,
+                                                    self.server)
+            except KeyError:
+                error_line = ("SPAMD/%s 76 Bad header line: %s\r\n" %
+                              (oa.__version__, line))
+                self.wfile.write(error_line.encode("utf8"))
+                break
+            served += 1
+            if handler.keep_alive is not None:
+                keep_alive = handler.keep_alive
+            if not keep_alive or served >= self.server.max_keepalive_requests:
+                break
+
+    def read_command(self, keep_alive=False):
+        """Read the command line of the next request. Between requests
+        on a persistent connection wait at most `keepalive_timeout`
+        seconds, and skip any empty lines.
+
+        :return: The command line, or an empty string if the
+          connection should be closed.
+        """
+        if not keep_alive:
+            self.rfile.set_deadline("header", self.server.header_timeout)
+        else:
+            self.rfile.set_deadline("keepalive",
+                                    self.server.keepalive_timeout)
         try:
-            # Run the command handler
-            COMMANDS[command.upper()](self.rfile, self.wfile, self.server)
-        except KeyError:
-            error_line = ("SPAMD/%s 76 Bad header line: %s\r\n" %
-                          (oa.__version__, line))
-            self.wfile.write(error_line.encode("utf8"))
+            while True:
+                line = self.rfile.readline()
+                if not keep_alive or not line or line.strip():
+                    return line.decode("utf8").strip()
+        except (IOError, OSError, oa.errors.ReadTimeout) as e:
+            # Timed out or the connection was reset.
+            self.server.log.debug("Closing connection: %s", e)
+            return ""
 
 
-class Server(spoon.server.TCPSpoon):
-    """The PAD server. Handles incoming connections in a single
-    thread and single process.
+class AdmissionMixIn(object):
+    """Admission control for the servers that queue the requests until
+    a worker thread is free.
+
+    At most `max_queue_size` requests are queued, the others are refused
+    with a temporary error. A request that waited more than
+    `max_queue_wait` seconds in the queue is checked in degraded mode:
+    only the local rules are checked and the network and Bayes rules are
+    skipped, so the client gets an answer quickly.
+
+    The class using this must create the `_admission` thread local.
     """
-    server_logger = "oa-logger"
-    handler_klass = RequestHandler
+    max_queue_size = None
+    max_queue_wait = None
 
-    def __init__(self, address, sitepath, configpath, paranoid=False,
-                 ignore_unknown=True):
-        self.paranoid = paranoid
-        self.ignore_unknown = ignore_unknown
-        self._ruleset = None
-        self._user_rulesets = {}
-        self._parser_results = None
-        self.sitepath = sitepath
-        self.configpath = configpath
+    @property
+    def degraded(self):
+        """True if the request handled by the current thread must be
+        checked in degraded mode.
+        """
+        return getattr(self._admission, "degraded", False)
 
-        super(Server, self).__init__(address)
+    def queue_full(self, depth):
+        """Check if a new request should be refused because there are
+        already `depth` requests queued.
+        """
+        oa.metrics.set_gauge("queue_depth", depth)
+        if not self.max_queue_size or depth < self.max_queue_size:
+            return False
+        oa.metrics.incr("requests_shed")
+        self.log.warning("Refusing request, %s requests queued", depth)
+        return True
+
+    def start_request(self, queued):
+        """Called by the worker thread before it handles a request
+        that was queued at the `queued` time.
+        """
+        wait = time.time() - queued
+        degraded = bool(self.max_queue_wait) and wait > self.max_queue_wait
+        if degraded:
+            oa.metrics.incr("requests_degraded")
+            self.log.info("Request waited %.2fs in the queue, checking it "
+                          "in degraded mode", wait)
+        self._admission.degraded = degraded
+
+    def end_request(self):
+        """Called by the worker thread once the request is done."""
+        self._admission.degraded = False
+
+
+class RulesetMixIn(object):
+    """Loads the main ruleset and the per-user rulesets for the PAD
+    servers.
+
+    The class using this must set the `paranoid`, `ignore_unknown`,
+    `sitepath`, `configpath` and `log` attributes. The rulesets are
+    guarded by the `_ruleset_lock`, so they can be used from several
+    threads.
+
+    If `result_cache` is set to a `oa.result_cache.ResultCache`, the
+    commands use it to match the messages.
+
+    The DNS caches of all the rulesets use the `dns_cache_backend`, see
+    `set_dns_cache_backend`.
+    """
+    _ruleset = None
+    _parser_results = None
+    result_cache = None
+    dns_cache_backend = None
+    config_generation = ""
+
+    def set_dns_cache_backend(self, backend):
+        """Share the DNS answers of all the rulesets through this
+        `oa.dns_interface.SharedDNSCache`. It must be set before the
+        workers are forked.
+        """
+        with self._ruleset_lock:
+            self.dns_cache_backend = backend
+            rulesets = list(self._user_rulesets.values())
+            if self._ruleset is not None:
+                rulesets.append(self._ruleset)
+            for ruleset in rulesets:
+                ruleset.ctxt.dns.cache.backend = backend
 
     def load_config(self):
         """Reads the configuration files and reloads the ruleset."""
-        self._user_rulesets.clear()
+        config_files = oa.config.get_config_files(self.configpath,
+                                                  self.sitepath)
         parser = oa.rules.parser.parse_pad_rules(
-            oa.config.get_config_files(self.configpath, self.sitepath),
-            paranoid=self.paranoid, ignore_unknown=self.ignore_unknown
+            config_files, paranoid=self.paranoid,
+            ignore_unknown=self.ignore_unknown
         )
-        self._ruleset = parser.get_ruleset()
-        # Store a copy of the parser results to generate user
-        # settings later
-        self._parser_results = parser.results
+        ruleset = parser.get_ruleset()
+        ruleset.ctxt.dns.cache.backend = self.dns_cache_backend
+        with self._ruleset_lock:
+            self._user_rulesets.clear()
+            self._ruleset = ruleset
+            # Store a copy of the parser results to generate user
+            # settings later
+            self._parser_results = parser.results
+            self.config_generation = oa.result_cache.config_generation(
+                config_files
+            )
+            if self.result_cache is not None:
+                # Results of the previous rules are never used again.
+                self.result_cache.clear()
+                self.result_cache.generation = self.config_generation
 
     def get_user_ruleset(self, user=None):
         """Get the corresponding ruleset for this user. If the
@@ -89,17 +343,20 @@ class Server(spoon.server.TCPSpoon):
           be returned.
         :return: a `oa.rules.ruleset.RuleSet` object
         """
-        if user is not None and self._ruleset.conf["allow_user_rules"]:
+        with self._ruleset_lock:
+            main_ruleset = self._ruleset
+            if user is None or not main_ruleset.conf["allow_user_rules"]:
+                return main_ruleset
             if user in self._user_rulesets:
                 return self._user_rulesets[user]
 
             path = oa.config.get_userprefs_path(user)
             if not os.path.exists(path):
                 self.log.warn("No user preference file: %s", path)
-                return self._ruleset
+                return main_ruleset
             parser = oa.rules.parser.PADParser(
-                self._ruleset.ctxt.paranoid,
-                self._ruleset.ctxt.ignore_unknown
+                main_ruleset.ctxt.paranoid,
+                main_ruleset.ctxt.ignore_unknown
             )
             # Use the already parsed results and pass the user
             # ones.
@@ -107,15 +364,493 @@ class Server(spoon.server.TCPSpoon):
             parser.parse_file(path)
             ruleset = parser.get_ruleset()
             ruleset.ctxt.username = user
+            ruleset.ctxt.userprefs = path
+            ruleset.ctxt.dns.cache.backend = self.dns_cache_backend
             # Cache the result
             self._user_rulesets[user] = ruleset
             return ruleset
-        return self._ruleset
+
+
+class Server(RulesetMixIn, spoon.server.TCPSpoon):
+    """The PAD server. Handles incoming connections in a single
+    thread and single process.
+    """
+    server_logger = "oa-logger"
+    handler_klass = RequestHandler
+    # Size of the listen backlog, connections over this are refused
+    # (or delayed by the client retrying on TCP).
+    request_queue_size = 128
+    # Persistent connections, see RequestHandler.
+    keepalive_timeout = 5.0
+    max_keepalive_requests = 100
+    # Number of messages of a BATCH request checked at the same time.
+    batch_workers = 4
+    # Maximum size of a message in bytes, None for no limit.
+    max_message_size = None
+    # Slow client protection, see RequestHandler.
+    header_timeout = 30.0
+    body_timeout = 60.0
+    min_transfer_rate = None
+    # Maximum number of connections handled or queued at the same
+    # time by this process, None for no limit.
+    max_connections = None
+    # Requests are never checked in degraded mode, see AdmissionMixIn.
+    degraded = False
+
+    def __init__(self, address, sitepath, configpath, paranoid=False,
+                 ignore_unknown=True):
+        """Create the server and start listening.
+
+        :param address: A (host, port) tuple to listen on TCP, or the
+          path of a Unix domain socket.
+        """
+        self.paranoid = paranoid
+        self.ignore_unknown = ignore_unknown
+        self._ruleset = None
+        self._user_rulesets = {}
+        self._parser_results = None
+        self._ruleset_lock = threading.RLock()
+        self.sitepath = sitepath
+        self.configpath = configpath
+        self._connections = 0
+        self._connections_lock = threading.Lock()
+
+        super(Server, self).__init__(address)
+
+    def _setup_socket(self):
+        """Like the super method, but listen on a Unix domain socket
+        if the address is a path. A stale socket left at that path is
+        removed first.
+        """
+        if not isinstance(self.server_address, tuple):
+            self.address_family = socket.AF_UNIX
+            try:
+                if stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                    os.remove(self.server_address)
+            except OSError:
+                pass
+        super(Server, self)._setup_socket()
+
+    def verify_request(self, request, client_address):
+        """Refuse the connection if this process already handles
+        `max_connections` connections.
+        """
+        with self._connections_lock:
+            self._connections += 1
+            connections = self._connections
+        oa.metrics.set_gauge("connections", connections)
+        if not self.max_connections or connections <= self.max_connections:
+            return True
+        oa.metrics.incr("connections_refused")
+        self.log.warning("Refusing connection from %s, %s connections "
+                         "open", client_address, connections - 1)
+        self.refuse_request(request, "too many connections")
+        return False
+
+    @staticmethod
+    def refuse_request(request, reason):
+        """Tell the client to try again later."""
+        error_line = ("SPAMD/%s 75 EX_TEMPFAIL: (%s)\r\n" %
+                      (oa.__version__, reason))
+        try:
+            request.sendall(error_line.encode("utf8"))
+        except (IOError, OSError):
+            pass
+
+    def shutdown_request(self, request):
+        """Close the connection, once it's been handled or refused."""
+        with self._connections_lock:
+            self._connections -= 1
+            connections = self._connections
+        oa.metrics.set_gauge("connections", connections)
+        super(Server, self).shutdown_request(request)
 
 
 class PreForkServer(Server, spoon.server.TCPSpork):
     """The same as Server, but prefork itself when starting the self, by
     forking a number of child-processes.
 
-    The parent process will then wait for all his child process to complete.
+    The parent process supervises the workers and replaces the ones that
+    exit. A worker exits on its own, after finishing the current request,
+    once it has served `max_requests` requests, uses more than `max_rss`
+    MiB of memory or is older than `max_age` seconds. Workers are not
+    replaced more often than once every `respawn_delay` seconds.
+
+    The workers report their load to the parent, which logs it every
+    `report_interval` seconds.
+
+    If `reuse_port` is set, every worker binds its own listening socket
+    with SO_REUSEPORT and the kernel spreads the connections evenly
+    between them, instead of all the workers waking up to accept on the
+    same socket.
+
+    Before forking, the parent builds everything that would otherwise be
+    created lazily and moves the objects out of the reach of the garbage
+    collector, so the memory pages stay shared with the workers.
     """
+    # Worker limits, None means unlimited.
+    max_requests = None
+    max_rss = None
+    max_age = None
+    # Minimum number of seconds between two respawns.
+    respawn_delay = 1.0
+    # Number of seconds between two load reports, None to disable.
+    report_interval = 300
+    # Use a SO_REUSEPORT listening socket per worker.
+    reuse_port = False
+
+    _stopping = False
+    _recycling = False
+    _last_spawn = 0
+    _status_w = None
+    _started = None
+    _served = 0
+    _busy = 0.0
+
+    def __init__(self, *args, **kwargs):
+        # Guards the list of workers against the shutdown.
+        self._workers_lock = threading.Lock()
+        super(PreForkServer, self).__init__(*args, **kwargs)
+
+    def serve_forever(self, poll_interval=0.1):
+        """Warm up the ruleset, fork the workers and supervise them
+        until the server is shutdown.
+        """
+        if self.prefork is None or self.prefork <= 1:
+            return super(PreForkServer, self).serve_forever(
+                poll_interval=poll_interval)
+        self.warm_up()
+        if self.reuse_port:
+            # Each worker binds its own socket, connections queued on
+            # the one of the parent would never be accepted.
+            self.socket.close()
+        self.pids = []
+        self.worker_load = {}
+        self._stopping = False
+        status_r, self._status_w = os.pipe()
+        try:
+            for dummy in range(self.prefork):
+                self.spawn_worker(status_r, poll_interval)
+            self.supervise(status_r, poll_interval)
+        finally:
+            os.close(status_r)
+            os.close(self._status_w)
+            self._status_w = None
+
+    def warm_up(self):
+        """Compile every lazy regex of the rules and plugins and freeze
+        the objects that are alive in the garbage collector.
+
+        A worker that compiles a pattern, or where the garbage collector
+        touches the header of an object inherited from the parent, gets
+        a private copy of that memory page.
+        """
+        count = 0
+        for obj in gc.get_objects():
+            if isinstance(obj, oa.regex.Regex):
+                obj.precompile()
+                count += 1
+        self.log.debug("Compiled %s patterns before forking", count)
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            # Python 3.7+
+            gc.freeze()
+
+    def spawn_worker(self, status_r, poll_interval=0.1):
+        """Fork a new worker. The child serves requests until it is
+        shutdown or recycled and then exits.
+        """
+        pid = os.fork()
+        if not pid:
+            os.close(status_r)
+            oa.config.restart_logging()
+            exit_code = 0
+            try:
+                self.serve_worker(poll_interval)
+            except Exception:
+                self.log.critical("Worker %s crashed", os.getpid(),
+                                  exc_info=True)
+                exit_code = 1
+            finally:
+                oa.config.flush_logging()
+                os._exit(exit_code)
+        self.log.info("Forked worker %s", pid)
+        self.pids.append(pid)
+        self.worker_load[pid] = {"requests": 0, "busy": 0.0, "rss": 0.0,
+                                 "started": time.time()}
+        self._last_spawn = time.time()
+        return pid
+
+    def supervise(self, status_r, poll_interval=0.1):
+        """Collect the load reports of the workers and replace the
+        ones that exit, until all of them have been shutdown.
+        """
+        last_report = time.time()
+        buf = b""
+        while self.pids:
+            readable = select.select([status_r], [], [], poll_interval)[0]
+            if readable:
+                buf = self._read_status(status_r, buf)
+            self._reap_workers()
+            with self._workers_lock:
+                # Don't fork while the workers are being stopped.
+                if (not self._stopping and len(self.pids) < self.prefork and
+                        time.time() - self._last_spawn >= self.respawn_delay):
+                    self.spawn_worker(status_r, poll_interval)
+            if (self.report_interval and
+                    time.time() - last_report >= self.report_interval):
+                self.report_load()
+                last_report = time.time()
+
+    def _read_status(self, status_r, buf):
+        """Read the status lines sent by the workers and update their
+        load. Returns any incomplete line left in the buffer.
+        """
+        buf += os.read(status_r, 65536)
+        lines = buf.split(b"\n")
+        for line in lines[:-1]:
+            fields = line.split()
+            try:
+                pid, requests, busy, rss = fields[:4]
+                pid = int(pid)
+                load = self.worker_load[pid]
+            except (ValueError, KeyError):
+                continue
+            load["requests"] = int(requests)
+            load["busy"] = float(busy)
+            load["rss"] = float(rss)
+            # The counters from `oa.metrics`, as name=value.
+            metrics = {}
+            for field in fields[4:]:
+                name, sep, value = field.decode("ascii").partition("=")
+                try:
+                    metrics[name] = int(value)
+                except ValueError:
+                    continue
+            if metrics:
+                load["metrics"] = metrics
+        return lines[-1]
+
+    def _reap_workers(self):
+        """Remove the workers that have exited."""
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                self.pids = []
+                return
+            if not pid:
+                return
+            if pid not in self.pids:
+                continue
+            self.pids.remove(pid)
+            load = self.worker_load.pop(pid, {})
+            # Keep the counters of the workers that exited in the
+            # totals.
+            for name, value in load.get("metrics", {}).items():
+                oa.metrics.incr(name, value)
+            self.log.info("Worker %s exited with status %s after %s "
+                          "requests", pid, status, load.get("requests"))
+
+    def report_load(self):
+        """Log the number of requests and the busy time of every worker,
+        useful to check that the connections are evenly distributed.
+        """
+        now = time.time()
+        total = sum(load["requests"] for load in self.worker_load.values())
+        for pid, load in sorted(self.worker_load.items()):
+            age = max(now - load["started"], 0.001)
+            share = 100.0 * load["requests"] / total if total else 0.0
+            self.log.info("Worker %s: %s requests (%.1f%%), busy %.1f%%, "
+                          "RSS %.1f MiB, age %ds", pid, load["requests"],
+                          share, 100.0 * load["busy"] / age, load["rss"],
+                          age)
+        totals = oa.metrics.get_counters()
+        for load in self.worker_load.values():
+            for name, value in load.get("metrics", {}).items():
+                totals[name] = totals.get(name, 0) + value
+        if totals:
+            self.log.info("Metrics: %s", ", ".join(
+                "%s=%s" % item for item in sorted(totals.items())
+            ))
+
+    def serve_worker(self, poll_interval=0.1):
+        """Serve requests in the worker process."""
+        self.pids = None
+        self._recycling = False
+        oa.metrics.reset()
+        self._started = time.time()
+        self._served = 0
+        self._busy = 0.0
+        if self.reuse_port:
+            self._setup_socket()
+        spoon.server.TCPSpoon.serve_forever(self, poll_interval=poll_interval)
+        if self.reuse_port:
+            # The connections already queued on the socket of this
+            # worker would be reset when it's closed.
+            while select.select([self.socket], [], [], 0)[0]:
+                self.handle_request()
+            self.server_close()
+
+    def server_bind(self):
+        """Set SO_REUSEPORT on the worker sockets before binding."""
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super(PreForkServer, self).server_bind()
+
+    def process_request(self, request, client_address):
+        """Handle the request and check if the worker should
+        be recycled afterwards.
+        """
+        start = time.time()
+        try:
+            super(PreForkServer, self).process_request(request,
+                                                       client_address)
+        finally:
+            self._served += 1
+            self._busy += time.time() - start
+            self._send_status()
+            self.check_limits()
+
+    def service_actions(self):
+        """Called by the serve loop of the worker, even when idle."""
+        super(PreForkServer, self).service_actions()
+        self.check_limits()
+
+    def check_limits(self):
+        """Recycle this worker if any of the limits has been reached.
+        The serve loop of the worker stops once the current request
+        is done.
+        """
+        if self._recycling or self._status_w is None:
+            return
+        reason = None
+        if self.max_requests and self._served >= self.max_requests:
+            reason = "served %s requests" % self._served
+        elif self.max_age and time.time() - self._started >= self.max_age:
+            reason = "reached the maximum age"
+        elif self.max_rss and get_rss() >= self.max_rss:
+            reason = "uses more than %s MiB" % self.max_rss
+        if reason is None:
+            return
+        self._recycling = True
+        self.log.info("Recycling worker %s: %s", os.getpid(), reason)
+        thread = threading.Thread(target=self.shutdown)
+        thread.start()
+
+    def _send_status(self):
+        """Report the load of this worker to the parent."""
+        if self._status_w is None:
+            return
+        status = "%s %s %.6f %.1f" % (os.getpid(), self._served,
+                                       self._busy, get_rss())
+        counters = sorted(oa.metrics.get_counters().items())
+        status += "".join(" %s=%s" % item for item in counters) + "\n"
+        try:
+            os.write(self._status_w, status.encode("ascii"))
+        except OSError:
+            pass
+
+    def shutdown(self):
+        """Stop the workers, without replacing them, if this is the
+        parent process. Otherwise stop the serve loop.
+        """
+        if self.pids is None:
+            return super(PreForkServer, self).shutdown()
+        with self._workers_lock:
+            self._stopping = True
+            pids = list(self.pids)
+        for pid in pids:
+            try:
+                os.kill(pid, self.signal_shutdown)
+            except OSError:
+                pass
+
+    def load_config(self):
+        """Reload the ruleset. In the parent process the workers are
+        also asked to reload theirs, and the new ruleset is warmed up
+        for the workers that are forked later.
+        """
+        super(PreForkServer, self).load_config()
+        if self.pids:
+            self.warm_up()
+            for pid in list(self.pids):
+                try:
+                    os.kill(pid, self.signal_reload)
+                except OSError:
+                    pass
+
+
+class ThreadPoolServer(AdmissionMixIn, Server):
+    """The same as Server, but handles the requests in a fixed pool of
+    threads that share the same ruleset.
+
+    The main thread accepts the connections and queues them, the worker
+    threads take them from the queue and run the commands. See
+    `AdmissionMixIn` for the limits on the queue.
+    """
+    # Number of worker threads.
+    threads = 4
+
+    def __init__(self, address, sitepath, configpath, paranoid=False,
+                 ignore_unknown=True, threads=None):
+        if threads is not None:
+            self.threads = threads
+        self._requests = queue.Queue()
+        self._workers = []
+        self._admission = threading.local()
+        super(ThreadPoolServer, self).__init__(
+            address, sitepath, configpath, paranoid=paranoid,
+            ignore_unknown=ignore_unknown
+        )
+
+    def serve_forever(self, poll_interval=0.1):
+        """Start the worker threads and accept connections until the
+        server is shutdown. The requests already queued are handled
+        before returning.
+        """
+        self._workers = []
+        for number in range(self.threads):
+            worker = threading.Thread(target=self.process_requests,
+                                      name="oa-worker-%s" % number)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        try:
+            super(ThreadPoolServer, self).serve_forever(
+                poll_interval=poll_interval
+            )
+        finally:
+            for dummy in self._workers:
+                self._requests.put(None)
+            for worker in self._workers:
+                worker.join()
+
+    def process_request(self, request, client_address):
+        """Queue the request for the worker threads, unless the
+        queue is full.
+        """
+        if self.queue_full(self._requests.qsize()):
+            self.refuse_request(request, "server busy")
+            self.shutdown_request(request)
+            return
+        self._requests.put((request, client_address, time.time()))
+
+    def process_requests(self):
+        """Handle the queued requests until a `None` is received."""
+        while True:
+            item = self._requests.get()
+            if item is None:
+                break
+            request, client_address, queued = item
+            oa.metrics.set_gauge("queue_depth", self._requests.qsize())
+            self.start_request(queued)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.end_request()
+                self.shutdown_request(request)
@@ -0,0 +1,163 @@
+#! /usr/bin/env python
+
+"""Evaluate the near duplicate detection on a corpus of messages.
+
+For each maximum distance, the messages are compared in order with the
+ones before them, like the daemon does with `--near-duplicate-distance`.
+Shows how many messages would reuse the network results of a near
+duplicate and, for the messages labelled as spam or ham, how often the
+near duplicate had the other label. With --match the rules are checked
+and the reused network results are compared with the actual ones.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import sys
+import argparse
+
+from future.utils import PY3
+
+import oa
+import oa.config
+import oa.message
+import oa.fingerprint
+import oa.rules.parser
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--spam", action="append", default=[],
+                        metavar="path", help="Paths to spam messages or "
+                                             "directories containing them")
+    parser.add_argument("--ham", action="append", default=[],
+                        metavar="path", help="Paths to ham messages or "
+                                             "directories containing them")
+    parser.add_argument("-d", "--distances", type=int, nargs="+",
+                        default=[0, 1, 2, 3, 4, 6, 8],
+                        help="The maximum distances to evaluate")
+    parser.add_argument("--min-tokens", type=int, default=20,
+                        help="Minimum number of tokens in the body of "
+                             "messages compared as near duplicates")
+    parser.add_argument("-m", "--match", action="store_true", default=False,
+                        help="Check the rules and compare the network "
+                             "results")
+    parser.add_argument("--show-unknown", action="store_true", default=False,
+                        help="Show warnings about unknown parsing errors")
+    parser.add_argument("-D", "--debug", action="store_true",
+                        help="Enable debugging output", default=False)
+    parser.add_argument("-v", "--version", action="version",
+                        version=oa.__version__)
+    parser.add_argument("-C", "--configpath", action="store",
+                        help="Path to standard configuration directory",
+                        **oa.config.get_default_configs(site=False))
+    parser.add_argument("-S", "--sitepath", "--siteconfigpath", action="store",
+                        help="Path to standard configuration directory",
+                        **oa.config.get_default_configs(site=True))
+    parser.add_argument("messages", nargs="*", metavar="path",
+                        help="Paths to unlabelled messages or directories "
+                             "containing them")
+    return parser.parse_args(args)
+
+
+def iter_paths(paths):
+    """Yield the paths of the messages, in the order given."""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def get_sample(ruleset, path, label, min_tokens, match=False):
+    """Parse the message and return its label, fingerprint and the
+    results of the network rules (if the rules are checked).
+    """
+    with open(path, "rb") as msgf:
+        raw_msg = msgf.read()
+    if type(raw_msg) is bytes and PY3:
+        raw_msg = raw_msg.decode("utf-8", "ignore")
+    msg = oa.message.Message(ruleset.ctxt, raw_msg)
+    fingerprint = oa.fingerprint.message_fingerprint(msg, min_tokens)
+    network = None
+    if match:
+        ruleset.match(msg)
+        network = frozenset(
+            name for name, rule in ruleset.checked.items()
+            if rule.tflags and "net" in rule.tflags and
+            msg.rules_checked.get(name)
+        )
+    return label, fingerprint, network
+
+
+def evaluate(samples, max_distance):
+    """Compare each sample with the previous ones and return the
+    statistics for this maximum distance.
+
+    :param samples: A list of (label, fingerprint, network results)
+      tuples, the label and results can be None.
+    """
+    index = oa.fingerprint.NearDuplicateIndex(max_size=len(samples) or 1,
+                                              max_distance=max_distance,
+                                              ttl=float("inf"))
+    stats = {"messages": len(samples), "fingerprinted": 0, "near_hits": 0,
+             "label_mismatches": 0, "network_mismatches": 0}
+    for label, fingerprint, network in samples:
+        if fingerprint is None:
+            continue
+        stats["fingerprinted"] += 1
+        found = index.find(fingerprint)
+        if found is None:
+            index.add(fingerprint, (label, network))
+            continue
+        stats["near_hits"] += 1
+        (other_label, other_network), dist = found
+        if None not in (label, other_label) and label != other_label:
+            stats["label_mismatches"] += 1
+        if None not in (network, other_network) and network != other_network:
+            stats["network_mismatches"] += 1
+    return stats
+
+
+def main():
+    options = parse_arguments(sys.argv[1:])
+    logger = oa.config.setup_logging("oa-logger", debug=options.debug)
+    config_files = oa.config.get_config_files(options.configpath,
+                                              options.sitepath)
+    if not config_files:
+        logger.critical("Config: no rules were found.")
+        sys.exit(1)
+    ruleset = oa.rules.parser.parse_pad_rules(
+        config_files, ignore_unknown=not options.show_unknown
+    ).get_ruleset()
+
+    samples = []
+    for label, paths in (("spam", options.spam), ("ham", options.ham),
+                         (None, options.messages)):
+        for path in iter_paths(paths):
+            samples.append(get_sample(ruleset, path, label,
+                                      options.min_tokens, options.match))
+
+    print("%8s %10s %13s %10s %9s %15s" % (
+        "distance", "messages", "fingerprinted", "near hits", "hit rate",
+        "mismatches"
+    ))
+    for max_distance in options.distances:
+        stats = evaluate(samples, max_distance)
+        rate = 100.0 * stats["near_hits"] / (stats["messages"] or 1)
+        print("%8s %10s %13s %10s %8.1f%% %7s/%-7s" % (
+            max_distance, stats["messages"], stats["fingerprinted"],
+            stats["near_hits"], rate, stats["label_mismatches"],
+            stats["network_mismatches"]
+        ))
+    print("Mismatches are near duplicates with a different label / "
+          "different network results.")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,7 @@ from __future__ import absolute_import
 
 import os
 import sys
+import socket
 import argparse
 
 import spoon.daemon
@@ -14,24 +15,102 @@ import spoon.daemon
 import oa
 import oa.config
 import oa.server
+import oa.fingerprint
+import oa.result_cache
+import oa.dns_interface
+
+try:
+    import oa.async_server
+    _HAS_ASYNCIO = True
+except (ImportError, SyntaxError):
+    # The asyncio server requires Python 3.5+
+    _HAS_ASYNCIO = False
+
+
+def socket_mode(value):
+    """Parse the octal permissions of the Unix domain socket."""
+    try:
+        mode = int(value, 8)
+    except ValueError:
+        mode = -1
+    if not 0 <= mode <= 0o777:
+        raise argparse.ArgumentTypeError("invalid octal mode: %r" % value)
+    return mode
 
 
 def run_daemon(args):
     """Start the daemon."""
     if args.daemonize:
         spoon.daemon.detach(pidfile=args.pidfile)
-    address = (args.listen, args.port)
-    if args.prefork is not None:
+        oa.config.restart_logging()
+    if args.socketpath:
+        address = args.socketpath
+    else:
+        address = (args.listen, args.port)
+    if args.use_async:
+        server = oa.async_server.AsyncServer(
+            address, args.sitepath, args.configpath, paranoid=args.paranoid,
+            ignore_unknown=not args.show_unknown,
+            max_workers=args.async_workers
+        )
+        server.max_queue_size = args.max_queue_size
+        server.max_queue_wait = args.max_queue_wait
+    elif args.prefork is not None:
         server = oa.server.PreForkServer(
             address, args.sitepath, args.configpath, paranoid=args.paranoid,
             ignore_unknown=not args.show_unknown
         )
         server.prefork = args.prefork
+        server.reuse_port = args.reuse_port
+        server.max_requests = args.worker_max_requests
+        server.max_rss = args.worker_max_rss
+        server.max_age = args.worker_max_age
+        server.respawn_delay = args.worker_respawn_delay
+        server.report_interval = args.worker_report_interval
+    elif args.threads is not None:
+        server = oa.server.ThreadPoolServer(
+            address, args.sitepath, args.configpath, paranoid=args.paranoid,
+            ignore_unknown=not args.show_unknown, threads=args.threads
+        )
+        server.max_queue_size = args.max_queue_size
+        server.max_queue_wait = args.max_queue_wait
     else:
         server = oa.server.Server(
             address, args.sitepath, args.configpath, paranoid=args.paranoid,
             ignore_unknown=not args.show_unknown
         )
+    server.keepalive_timeout = args.keepalive_timeout
+    server.max_keepalive_requests = args.max_keepalive_requests
+    server.batch_workers = args.batch_workers
+    server.max_message_size = args.max_message_size
+    server.header_timeout = args.header_timeout
+    server.body_timeout = args.body_timeout
+    server.min_transfer_rate = args.min_transfer_rate
+    server.max_connections = args.max_connections
+    if (args.result_cache_size or args.result_cache_db or
+            args.near_duplicate_distance is not None):
+        backend = None
+        near_duplicates = None
+        max_size = args.result_cache_size or 1024
+        if args.result_cache_db:
+            backend = oa.result_cache.SQLiteBackend(args.result_cache_db)
+        if args.near_duplicate_distance is not None:
+            near_duplicates = oa.fingerprint.NearDuplicateIndex(
+                max_size=max_size, max_distance=args.near_duplicate_distance,
+                ttl=args.result_cache_ttl
+            )
+        server.result_cache = oa.result_cache.ResultCache(
+            max_size=max_size, ttl=args.result_cache_ttl, backend=backend,
+            generation=server.config_generation,
+            near_duplicates=near_duplicates,
+            min_tokens=args.near_duplicate_min_tokens
+        )
+    if args.shared_dns_cache:
+        server.set_dns_cache_backend(oa.dns_interface.SharedDNSCache(
+            slots=args.shared_dns_cache
+        ))
+    if args.socketpath and args.socketmode is not None:
+        os.chmod(args.socketpath, args.socketmode)
     try:
         server.serve_forever()
     finally:
@@ -39,6 +118,11 @@ def run_daemon(args):
             os.remove(args.pidfile)
         except OSError:
             pass
+        if args.socketpath:
+            try:
+                os.remove(args.socketpath)
+            except OSError:
+                pass
 
 
 def main():
@@ -62,6 +146,81 @@ def main():
                         help="Detach the process")
     parser.add_argument("--prefork", type=int, default=None,
                         help="Pre fork the server with a number of workers")
+    parser.add_argument("--worker-max-requests", type=int, default=None,
+                        help="Replace a pre forked worker after it has "
+                             "served this many requests")
+    parser.add_argument("--worker-max-rss", type=float, default=None,
+                        help="Replace a pre forked worker once it uses more "
+                             "than this many MiB of memory")
+    parser.add_argument("--worker-max-age", type=float, default=None,
+                        help="Replace a pre forked worker after this many "
+                             "seconds")
+    parser.add_argument("--worker-respawn-delay", type=float, default=1.0,
+                        help="Minimum number of seconds between replacing "
+                             "two pre forked workers")
+    parser.add_argument("--worker-report-interval", type=float, default=300,
+                        help="Log the load of the pre forked workers every "
+                             "this many seconds, 0 to disable")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Handle the requests in a pool with a number "
+                             "of threads")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        default=False,
+                        help="Use the asyncio based server instead of the "
+                             "pre forking one")
+    parser.add_argument("--async-workers", type=int, default=4,
+                        help="Number of threads that run the commands "
+                             "for the asyncio based server")
+    parser.add_argument("--keepalive-timeout", type=float, default=5.0,
+                        help="Seconds to wait for the next request on a "
+                             "persistent connection")
+    parser.add_argument("--max-keepalive-requests", type=int, default=100,
+                        help="Maximum number of requests on a persistent "
+                             "connection")
+    parser.add_argument("--batch-workers", type=int, default=4,
+                        help="Number of messages of a BATCH request that "
+                             "are checked at the same time")
+    parser.add_argument("--max-message-size", type=int, default=None,
+                        help="Reject messages larger than this many bytes "
+                             "(after decompression)")
+    parser.add_argument("--header-timeout", type=float, default=30.0,
+                        help="Seconds allowed to receive the command and "
+                             "headers of a request")
+    parser.add_argument("--body-timeout", type=float, default=60.0,
+                        help="Seconds allowed to receive the message of a "
+                             "request")
+    parser.add_argument("--min-transfer-rate", type=int, default=None,
+                        help="Minimum rate in bytes per second at which the "
+                             "message must be received")
+    parser.add_argument("--max-connections", type=int, default=None,
+                        help="Maximum number of connections handled at the "
+                             "same time by each process")
+    parser.add_argument("--max-queue-size", type=int, default=None,
+                        help="Maximum number of requests waiting for a free "
+                             "thread, with --threads or --async")
+    parser.add_argument("--max-queue-wait", type=float, default=None,
+                        help="Requests that waited longer than this for a "
+                             "free thread are only checked against the "
+                             "local rules")
+    parser.add_argument("--result-cache-size", type=int, default=0,
+                        help="Cache the results of this many messages in "
+                             "each process")
+    parser.add_argument("--result-cache-db", default=None,
+                        help="Share the cached results between the "
+                             "processes in this SQLite database")
+    parser.add_argument("--result-cache-ttl", type=float, default=300,
+                        help="Number of seconds the cached results are "
+                             "used for")
+    parser.add_argument("--near-duplicate-distance", type=int, default=None,
+                        help="Reuse the network results of messages whose "
+                             "fingerprints differ in at most this many bits")
+    parser.add_argument("--near-duplicate-min-tokens", type=int, default=20,
+                        help="Minimum number of tokens in the body of "
+                             "messages compared as near duplicates")
+    parser.add_argument("--shared-dns-cache", type=int, default=None,
+                        metavar="SLOTS",
+                        help="Share the DNS answers between the pre forked "
+                             "workers in a table with this many slots")
     parser.add_argument("-i", "--listen", type=str, default="0.0.0.0",
                         help="Listen on IP addr and port")
     parser.add_argument("-p", "--port", type=int, default=783,
@@ -73,9 +232,23 @@ def main():
     parser.add_argument("-S", "--sitepath", "--siteconfigpath", action="store",
                         help="Path to standard configuration directory",
                         **oa.config.get_default_configs(site=True))
+    parser.add_argument("--socketpath", default=None,
+                        help="Listen on a Unix domain socket at this path "
+                             "instead of TCP")
+    parser.add_argument("--socketmode", type=socket_mode, default=None,
+                        help="Octal permissions of the Unix domain socket, "
+                             "e.g. 0660")
+    parser.add_argument("--reuse-port", action="store_true", default=False,
+                        help="Bind a separate SO_REUSEPORT socket in every "
+                             "pre forked worker")
     parser.add_argument("-r", "--pidfile", default="/var/run/oad.pid")
     parser.add_argument("--log-file", dest="log_file",
                         default="/var/log/oad.log")
+    parser.add_argument("--log-queue-size", type=int, default=None,
+                        help="Write the logs from a background thread, with "
+                             "at most this many records waiting. The "
+                             "records logged while the queue is full are "
+                             "dropped")
     parser.add_argument("-dl", "--deactivate-lazy", dest="lazy_mode",
                         action="store_true", default=False,
                         help="Deactivate lazy loading of rules/regex")
@@ -90,9 +263,27 @@ def main():
     parser.add_argument("-v", "--version", action="version",
                         version=oa.__version__)
     args = parser.parse_args()
+    if args.use_async and not _HAS_ASYNCIO:
+        parser.error("--async requires Python 3.5 or later")
+    if args.reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--reuse-port is not supported on this platform")
+    if args.reuse_port and args.socketpath:
+        parser.error("--reuse-port can't be used with --socketpath")
+    if args.use_async and (args.prefork is not None or
+                           args.threads is not None):
+        parser.error("--async can't be used with --prefork or --threads")
+    if args.prefork is not None and args.threads is not None:
+        parser.error("--threads can't be used with --prefork")
+    if ((args.max_queue_size is not None or
+         args.max_queue_wait is not None) and
+            args.threads is None and not args.use_async):
+        # Pre forked workers don't queue the requests.
+        parser.error("--max-queue-size and --max-queue-wait require "
+                     "--threads or --async")
     oa.config.LAZY_MODE = not args.lazy_mode
     logger = oa.config.setup_logging("oa-logger", debug=args.debug,
-                                     filepath=args.log_file)
+                                     filepath=args.log_file,
+                                     queue_size=args.log_queue_size)
     if args.action:
         spoon.daemon.send_action(args.action, args.pidfile)
     else:
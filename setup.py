@@ -41,7 +41,8 @@ distutils.core.setup(
     scripts=[
         'scripts/match.py',
         'scripts/oad.py',
-        'scripts/compile.py'
+        'scripts/compile.py',
+        'scripts/near_duplicates.py'
     ],
     packages=[
         'oa',
@@ -3,6 +3,7 @@ from __future__ import print_function
 
 import os
 import sys
+import zlib
 import time
 import email
 import socket
@@ -113,6 +114,8 @@ class TestDaemonBase(unittest.TestCase):
     pre_config = PRE_CONFIG
     port = 30783
     config = CONFIG
+    # Additional arguments for the daemon script
+    daemon_args = ()
     padd_procs = []
     content_len = len(GTUBE_MSG) + 2
     multipart_content_len = len(MULTIPART_MSG)
@@ -133,6 +136,7 @@ class TestDaemonBase(unittest.TestCase):
         args = [cls.daemon_script, "-D", "-C", cls.test_conf,
                 "--siteconfigpath", cls.test_conf, "--allow-tell",
                 "-i", "127.0.0.1", "-p", str(cls.port)]
+        args.extend(cls.daemon_args)
         if cls.daemon_script == "scripts/oad.py":
             args.append("--log-file")
             args.append(os.path.abspath("padd.log"))
@@ -155,10 +159,14 @@ class TestDaemonBase(unittest.TestCase):
             padd_proc.wait()
         shutil.rmtree(cls.test_conf, True)
 
-    def send_to_proc(self, text):
+    def connect(self):
         connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         connection.settimeout(5)
         connection.connect(("localhost", self.port))
+        return connection
+
+    def send_to_proc(self, text):
+        connection = self.connect()
         connection.send(text.encode("utf8"))
         response = []
         while True:
@@ -351,6 +359,100 @@ class TestDaemon(TestDaemonBase):
                     u'', u'GTUBE']
         self.assertEqual(result, expected)
 
+    def send_bytes(self, data):
+        connection = self.connect()
+        connection.sendall(data)
+        response = []
+        while True:
+            data = connection.recv(1024)
+            if not data:
+                break
+            response.append(data)
+        connection.close()
+        return b"".join(response)
+
+    def test_check_compressed(self):
+        """Send a compressed message."""
+        message = zlib.compress(GTUBE_MSG.encode("utf8"))
+        command = (b"CHECK SPAMC/1.2\r\nCompress: zlib\r\n"
+                   b"Content-length: " + str(len(message)).encode("utf8") +
+                   b"\r\n\r\n" + message)
+        result = self.send_bytes(command).decode("utf8").split(None, 1)[1]
+        self.assertEqual(result, "0 EX_OK\r\nSpam: True ; 1000.0 / 5.0\r\n"
+                                 "Content-length: 0\r\n\r\n")
+
+    def test_process_compressed_response(self):
+        """Get the adjusted message compressed."""
+        content_row = "Content-length: %s\r\n" % self.content_len
+        command = ("PROCESS SPAMC/1.2\r\nAccept-Compress: zlib\r\n"
+                   "%s\r\n%s\r\n" % (content_row, GTUBE_MSG))
+        headers, body = self.send_bytes(command.encode("utf8")).split(
+            b"\r\n\r\n", 1
+        )
+        self.assertIn(b"Compress: zlib", headers)
+        self.assertIn(("Content-length: %s" % len(body)).encode("utf8"),
+                      headers)
+        msg = email.message_from_string(zlib.decompress(body).decode("utf8"))
+        self.assertEqual(msg["Subject"], "test")
+
+    def test_batch(self):
+        """Check several messages in a single request."""
+        frames = "".join("%s\r\n%s" % (len(msg.encode("utf8")), msg)
+                         for msg in (GTUBE_MSG, TEST_MSG)) + "0\r\n"
+        command = ("BATCH SPAMC/1.2\r\nContent-length: %s\r\n\r\n%s" %
+                   (len(frames.encode("utf8")), frames))
+        connection = self.connect()
+        connection.sendall(command.encode("utf8"))
+        response = []
+        while True:
+            data = connection.recv(1024)
+            if not data:
+                break
+            response.append(data.decode("utf8"))
+        connection.close()
+        response = "".join(response)
+        self.assertTrue(response.startswith("SPAMD/"))
+        results = {}
+        for part in response.split("Message: ")[1:]:
+            index, sep, result = part.partition("\r\n")
+            results[index] = result.split("\r\n")[0]
+        self.assertEqual(results, {
+            "0": "Spam: True ; 1000.0 / 5.0",
+            "1": "Spam: False ; 0.0 / 5.0",
+        })
+        self.assertTrue(response.endswith("Messages: 2\r\n\r\n"))
+
+    def test_keep_alive_pipelined(self):
+        """Send several pipelined requests on the same connection and
+        get the responses in order.
+        """
+        content_row = "Content-length: %s\r\n" % self.content_len
+        command = ("CHECK SPAMC/1.2\r\n%sKeep-Alive: yes\r\n\r\n%s\r\n"
+                   "PING SPAMC/1.2\r\n\r\n"
+                   "SYMBOLS SPAMC/1.2\r\n%sKeep-Alive: no\r\n\r\n%s\r\n" %
+                   (content_row, GTUBE_MSG, content_row, GTUBE_MSG))
+        connection = self.connect()
+        connection.sendall(command.encode("utf8"))
+        response = []
+        while True:
+            data = connection.recv(1024)
+            if not data:
+                break
+            response.append(data.decode("utf8"))
+        connection.close()
+        result = [line.split(None, 1)[-1] if line.startswith("SPAMD/")
+                  else line for line in "".join(response).split("\r\n")]
+        expected = [u'0 EX_OK',
+                    u'Spam: True ; 1000.0 / 5.0',
+                    u'Content-length: 0',
+                    u'',
+                    u'0 PONG',
+                    u'0 EX_OK',
+                    u'Spam: True ; 1000.0 / 5.0',
+                    u'Content-length: 5',
+                    u'', u'GTUBE']
+        self.assertEqual(result, expected)
+
     def test_symbols_missing_key_content_error(self):
         """Check missing ":" in content-length input error"""
 
@@ -592,6 +694,149 @@ class TestUserConfigDaemon(TestDaemon):
         self.assertEqual(result, expected)
 
 
+@unittest.skipIf(sys.version_info < (3, 5), "Requires asyncio")
+class TestAsyncDaemon(TestDaemon):
+    """Runs ALL the tests from TestDaemon against the asyncio
+    based server.
+    """
+    port = 30784
+    daemon_args = ("--async",)
+
+
+class TestThreadPoolDaemon(TestDaemon):
+    """Runs ALL the tests from TestDaemon against the thread
+    pool server.
+    """
+    port = 30785
+    daemon_args = ("--threads", "4")
+
+
+class TestRecycledPreForkDaemon(TestDaemon):
+    """Runs ALL the tests from TestDaemon against pre forked
+    workers that are replaced after every few requests.
+    """
+    port = 30786
+    daemon_args = ("--prefork", "2", "--worker-max-requests", "3",
+                   "--worker-respawn-delay", "0")
+
+
+@unittest.skipIf(not hasattr(socket, "SO_REUSEPORT"),
+                 "Requires SO_REUSEPORT")
+class TestReusePortDaemon(TestDaemon):
+    """Runs ALL the tests from TestDaemon against pre forked
+    workers that each have their own listening socket.
+    """
+    port = 30787
+    daemon_args = ("--prefork", "2", "--reuse-port")
+
+
+@unittest.skipIf(not hasattr(socket, "AF_UNIX"), "Requires Unix sockets")
+class TestUnixSocketDaemon(TestDaemon):
+    """Runs ALL the tests from TestDaemon over a Unix domain socket."""
+    socket_path = os.path.abspath("tests/oad.sock")
+    daemon_args = ("--socketpath", socket_path)
+
+    def connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(5)
+        connection.connect(self.socket_path)
+        return connection
+
+
+class TestMaxMessageSizeDaemon(TestDaemonBase):
+    port = 30788
+    daemon_args = ("--max-message-size", "100")
+
+    def test_check(self):
+        content_row = "Content-length: %s\r\n" % self.content_len
+        command = "CHECK SPAMC/1.2\r\n%s\r\n%s\r\n" % (content_row,
+                                                          GTUBE_MSG)
+        result = self.send_to_proc(command)
+        self.assertEqual(result, "0 EX_OK\r\nSpam: True ; 1000.0 / 5.0\r\n"
+                                 "Content-length: 0\r\n\r\n")
+
+    def test_check_too_large(self):
+        content_row = "Content-length: %s\r\n" % self.multipart_content_len
+        command = "CHECK SPAMC/1.2\r\n%s\r\n%s" % (content_row,
+                                                     MULTIPART_MSG)
+        result = self.send_to_proc(command)
+        self.assertTrue(result.startswith("65 EX_DATAERR"))
+
+    def test_check_too_large_compressed(self):
+        message = zlib.compress(MULTIPART_MSG.encode("utf8"))
+        connection = self.connect()
+        connection.sendall(b"CHECK SPAMC/1.2\r\nCompress: zlib\r\n"
+                           b"Content-length: " +
+                           str(len(message)).encode("utf8") +
+                           b"\r\n\r\n" + message)
+        result = connection.recv(1024).decode("utf8")
+        connection.close()
+        self.assertIn(" 65 EX_DATAERR", result)
+
+
+class TestSlowClientDaemon(TestDaemonBase):
+    port = 30789
+    daemon_args = ("--header-timeout", "0.5", "--body-timeout", "0.5")
+
+    def read_all(self, connection):
+        response = []
+        while True:
+            data = connection.recv(1024)
+            if not data:
+                break
+            response.append(data)
+        connection.close()
+        return b"".join(response).decode("utf8")
+
+    def get_stats(self):
+        result = self.send_to_proc("STATS SPAMC/1.2\r\n\r\n")
+        body = result.split("\r\n\r\n", 1)[1]
+        return dict(line.split(": ", 1) for line in body.splitlines())
+
+    def test_header_timeout(self):
+        """A client that doesn't finish the headers in time is
+        disconnected.
+        """
+        before = int(self.get_stats().get("timeouts_header", 0))
+        connection = self.connect()
+        connection.sendall(b"CHECK SPAMC/1.2\r\nUser: ")
+        start = time.time()
+        result = self.read_all(connection)
+        self.assertLess(time.time() - start, 3)
+        self.assertIn(" 79 EX_TIMEOUT", result)
+        stats = self.get_stats()
+        self.assertEqual(int(stats["timeouts_header"]), before + 1)
+
+    def test_body_timeout(self):
+        connection = self.connect()
+        connection.sendall(("CHECK SPAMC/1.2\r\nContent-length: %s\r\n"
+                            "\r\nSubject" % self.content_len).encode("utf8"))
+        result = self.read_all(connection)
+        self.assertIn(" 79 EX_TIMEOUT", result)
+
+    def test_trickle(self):
+        """Sending a byte at a time doesn't extend the deadline."""
+        connection = self.connect()
+        start = time.time()
+        try:
+            for char in "CHECK SPAMC/1.2\r\nUser: alex\r\n":
+                connection.sendall(char.encode("utf8"))
+                time.sleep(0.1)
+        except socket.error:
+            pass
+        result = self.read_all(connection)
+        self.assertLess(time.time() - start, 3)
+        self.assertNotIn("EX_OK", result)
+
+    def test_check(self):
+        content_row = "Content-length: %s\r\n" % self.content_len
+        command = "CHECK SPAMC/1.2\r\n%s\r\n%s\r\n" % (content_row,
+                                                          GTUBE_MSG)
+        result = self.send_to_proc(command)
+        self.assertEqual(result, "0 EX_OK\r\nSpam: True ; 1000.0 / 5.0\r\n"
+                                 "Content-length: 0\r\n\r\n")
+
+
 class TestDaemonReload(TestDaemonBase):
     username = getpass.getuser()
     user_pref = USER_CONFIG
@@ -662,11 +907,35 @@ class TestDaemonReload(TestDaemonBase):
         self.assertEqual(result, expected)
 
 
+class TestResultCacheDaemon(TestDaemonBase):
+    port = 30790
+    daemon_args = ("--result-cache-size", "10")
+
+    def test_symbols_cached(self):
+        content_row = "Content-length: %s\r\n" % self.content_len
+        command = ("SYMBOLS SPAMC/1.2\r\n%s\r\n%s\r\n" %
+                   (content_row, GTUBE_MSG))
+        first = self.send_to_proc(command)
+        second = self.send_to_proc(command)
+        self.assertEqual(first, second)
+        self.assertTrue(second.endswith("GTUBE"))
+        result = self.send_to_proc("STATS SPAMC/1.2\r\n\r\n")
+        self.assertIn("result_cache_hits: ", result)
+
+
 def suite():
     """Gather all the tests from this package in a test suite."""
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(TestDaemon, "test"))
     test_suite.addTest(unittest.makeSuite(TestUserConfigDaemon, "test"))
+    test_suite.addTest(unittest.makeSuite(TestAsyncDaemon, "test"))
+    test_suite.addTest(unittest.makeSuite(TestThreadPoolDaemon, "test"))
+    test_suite.addTest(unittest.makeSuite(TestRecycledPreForkDaemon, "test"))
+    test_suite.addTest(unittest.makeSuite(TestReusePortDaemon, "test"))
+    test_suite.addTest(unittest.makeSuite(TestUnixSocketDaemon, "test"))
+    test_suite.addTest(unittest.makeSuite(TestMaxMessageSizeDaemon, "test"))
+    test_suite.addTest(unittest.makeSuite(TestSlowClientDaemon, "test"))
+    test_suite.addTest(unittest.makeSuite(TestResultCacheDaemon, "test"))
     test_suite.addTest(unittest.makeSuite(TestDaemonReload, "test"))
     return test_suite
 
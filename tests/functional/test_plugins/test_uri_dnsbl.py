@@ -0,0 +1,56 @@
+"""Tests the URIDNSBL Plugin"""
+
+from __future__ import absolute_import
+
+import unittest
+
+import oa.config
+import oa.message
+import oa.rules.parser
+
+import tests.util
+
+PRE_CONFIG = """
+loadplugin     Mail::SpamAssassin::Plugin::URIDNSBL
+"""
+
+CONFIG = """
+urirhssub URIBL_TEST multi.uribl.example.com. A 2
+body      URIBL_TEST eval:check_uridnsbl('URIBL_TEST')
+"""
+
+MSG = """Subject: test
+Content-Type: text/html; charset=UTF-8
+
+<html>
+<a href="http://www.example.org/offer">Offer</a>
+Visit http://www.example.com/
+</html>
+"""
+
+
+class TestFunctionalURIDNSBL(tests.util.TestBase):
+
+    def test_domains_without_uri_detail(self):
+        """The HTML links are parsed even if no other plugin did."""
+        self.setup_conf(config=CONFIG, pre_config=PRE_CONFIG)
+        config_files = oa.config.get_config_files(self.test_conf,
+                                                  self.test_conf)
+        ruleset = oa.rules.parser.parse_pad_rules(
+            config_files
+        ).get_ruleset()
+        msg = oa.message.Message(ruleset.ctxt, MSG)
+        plugin = ruleset.ctxt.plugins["URIDNSBLPlugin"]
+        self.assertEqual(plugin.get_domains(msg),
+                         ["example.org", "example.com"])
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestFunctionalURIDNSBL, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
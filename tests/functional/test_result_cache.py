@@ -0,0 +1,102 @@
+"""Check copies of the same message with and without the result cache."""
+
+from __future__ import absolute_import
+
+import unittest
+
+import oa.config
+import oa.message
+import oa.result_cache
+import oa.rules.parser
+
+import tests.util
+
+PRE_CONFIG = r"""
+loadplugin Mail::SpamAssassin::Plugin::HeaderEval
+"""
+
+CONFIG = r"""
+full TO_BOB     /To: bob\@example\.com/
+score TO_BOB    5
+header FORGED_HOTMAIL eval:check_for_forged_hotmail_received_headers()
+score FORGED_HOTMAIL  3
+body TEST_BODY  /special offer/
+score TEST_BODY 1
+"""
+
+MSG = """From: sender@example.net
+To: %s
+Subject: Offer
+
+Our special offer.
+"""
+
+HOTMAIL_MSG = """%s
+From: user@hotmail.com
+To: alice@example.com
+Subject: Offer
+
+Our special offer.
+"""
+
+RELAY_RECEIVED = """Received: from hotmail.com ([192.0.2.1]) by example.com
+ with SMTP; Mon, 2 Jul 2012 05:28:37 -0700"""
+# Same relays, but handed over by the hotmail pickup service first.
+PICKUP_RECEIVED = """Received: from mail pickup service by hotmail.com with
+ Microsoft SMTPSVC; Mon, 2 Jul 2012 05:28:38 -0700
+""" + RELAY_RECEIVED
+
+
+class TestResultCache(tests.util.TestBase):
+
+    def setUp(self):
+        tests.util.TestBase.setUp(self)
+        self.setup_conf(config=CONFIG, pre_config=PRE_CONFIG)
+        config_files = oa.config.get_config_files(self.test_conf,
+                                                  self.test_conf)
+        self.ruleset = oa.rules.parser.parse_pad_rules(
+            config_files
+        ).get_ruleset()
+        self.cache = oa.result_cache.ResultCache()
+
+    def check_message(self, raw_msg, cache=None):
+        msg = oa.message.Message(self.ruleset.ctxt, raw_msg)
+        if cache is None:
+            self.ruleset.match(msg)
+        else:
+            cache.match(self.ruleset, msg)
+        return msg.score
+
+    def test_different_recipients(self):
+        """A copy sent to another recipient gets the same score as
+        without the cache.
+        """
+        self.assertEqual(self.check_message(MSG % "bob@example.com",
+                                            self.cache), 6.0)
+        self.assertEqual(self.check_message(MSG % "alice@example.com",
+                                            self.cache),
+                         self.check_message(MSG % "alice@example.com"))
+        self.assertEqual(self.check_message(MSG % "alice@example.com",
+                                            self.cache), 1.0)
+
+    def test_different_received(self):
+        """Eval rules that read headers outside the digest are checked
+        again for every copy.
+        """
+        self.assertEqual(self.check_message(
+            HOTMAIL_MSG % RELAY_RECEIVED, self.cache), 4.0)
+        self.assertEqual(self.check_message(
+            HOTMAIL_MSG % PICKUP_RECEIVED, self.cache), 1.0)
+        self.assertEqual(self.check_message(
+            HOTMAIL_MSG % PICKUP_RECEIVED), 1.0)
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestResultCache, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
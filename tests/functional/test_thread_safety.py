@@ -0,0 +1,150 @@
+"""Check a shared ruleset from several threads at the same time and
+compare the results with the ones obtained when the messages are
+checked one after the other.
+"""
+
+from __future__ import absolute_import
+
+import threading
+import unittest
+
+import oa.config
+import oa.message
+import oa.rules.parser
+
+import tests.util
+
+PRE_CONFIG = r"""
+loadplugin Mail::SpamAssassin::Plugin::FreeMail
+loadplugin Mail::SpamAssassin::Plugin::HeaderEval
+loadplugin Mail::SpamAssassin::Plugin::RelayEval
+loadplugin Mail::SpamAssassin::Plugin::WLBLEval
+
+freemail_domains freemail.example.com
+util_rb_tld com
+whitelist_from friend@example.org
+"""
+
+CONFIG = r"""
+header CHECK_FREEMAIL_FROM          eval:check_freemail_from()
+header CHECK_FREEMAIL_BODY          eval:check_freemail_body()
+header CHECK_FREEMAIL_REPLY_TO      eval:check_freemail_replyto('replyto')
+header CHECK_FORGED_HOTMAIL         eval:check_for_forged_hotmail_received_headers()
+header CHECK_NO_HOTMAIL             eval:check_for_no_hotmail_received_headers()
+header CHECK_FORGED_RECEIVED_TRAIL  eval:check_for_forged_received_trail()
+header CHECK_FORGED_IP_HELO         eval:check_for_forged_received_ip_helo()
+header CHECK_FROM_IN_WHITELIST      eval:check_from_in_whitelist()
+body GTUBE /XJS\*C4JDBQADN1\.NSBN3\*2IDNEN\*GTUBE-STANDARD-ANTI-UBE-TEST-EMAIL\*C\.34X/
+"""
+
+MESSAGES = [
+    # Freemail sender, reply-to and body addresses.
+    """From: sender@freemail.example.com
+Reply-To: other@freemail.example.com
+Subject: test
+
+Write to me at body@freemail.example.com
+""",
+    # Forged hotmail received header.
+    """Received: from hotmail.com (example.com [1.2.3.4])
+by example.com
+(envelope-from <example.com.user@something>)
+From: user@hotmail.com
+Subject: test
+
+Hello
+""",
+    # Forged received trail.
+    """Received: from rdns.example.com (test.com [1.2.3.4])
+ by test.com with esmtps (ceva)
+Received: from rdns.example.com (test.com [1.2.3.4])
+ by example.org with esmtps (ceva)
+Received: from rdns.example.com (test.com [1.2.3.4])
+ by example.org with esmtps (ceva)
+Subject: test
+
+Hello
+""",
+    # Numeric HELO that doesn't match the IP.
+    """Received: from 1.2.3.4 ([4.4.4.4]) by example.com with esmtps (ceva)
+Subject: test
+
+Hello
+""",
+    # Whitelisted sender.
+    """From: friend@example.org
+Subject: test
+
+Hello
+""",
+    # GTUBE without anything else.
+    """Subject: test
+
+%s
+""" % tests.util.GTUBE,
+]
+
+
+class TestThreadSafety(tests.util.TestBase):
+    threads = 8
+    rounds = 25
+
+    def setUp(self):
+        tests.util.TestBase.setUp(self)
+        self.setup_conf(config=CONFIG, pre_config=PRE_CONFIG)
+        config_files = oa.config.get_config_files(self.test_conf,
+                                                  self.test_conf)
+        self.ruleset = oa.rules.parser.parse_pad_rules(
+            config_files
+        ).get_ruleset()
+
+    def check_message(self, raw_msg):
+        msg = oa.message.Message(self.ruleset.ctxt, raw_msg)
+        self.ruleset.match(msg)
+        return sorted(name for name, result in msg.rules_checked.items()
+                      if result)
+
+    def test_concurrent_results(self):
+        """The results from the threads are the same as
+        the serial ones.
+        """
+        expected = [self.check_message(raw_msg) for raw_msg in MESSAGES]
+        # Make sure every message actually hits something,
+        # otherwise the comparison is meaningless.
+        for rules in expected:
+            self.assertTrue(rules)
+
+        errors = []
+        start = threading.Event()
+
+        def worker(offset):
+            start.wait()
+            for i in range(self.rounds):
+                index = (i + offset) % len(MESSAGES)
+                try:
+                    result = self.check_message(MESSAGES[index])
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                if result != expected[index]:
+                    errors.append((index, result, expected[index]))
+
+        workers = [threading.Thread(target=worker, args=(offset,))
+                   for offset in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        start.set()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestThreadSafety, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,281 @@
+"""Concurrency benchmarks for the different daemon models.
+
+Each benchmark starts the daemon, opens a number of concurrent client
+connections and reports the throughput and the latency of the requests.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import time
+import socket
+import shutil
+import unittest
+import platform
+import threading
+import subprocess
+
+PRE_CONFIG = r"""
+loadplugin Mail::SpamAssassin::Plugin::Check
+"""
+
+CONFIG = r"""
+body GTUBE      /XJS\*C4JDBQADN1\.NSBN3\*2IDNEN\*GTUBE-STANDARD-ANTI-UBE-TEST-EMAIL\*C\.34X/
+describe GTUBE  Generic Test for Unsolicited Bulk Email
+score GTUBE     1000
+"""
+
+GTUBE_MSG = """Subject: test
+
+XJS*C4JDBQADN1.NSBN3*2IDNEN*GTUBE-STANDARD-ANTI-UBE-TEST-EMAIL*C.34X
+"""
+
+IS_PYPY = "pypy" in platform.python_implementation().lower()
+
+
+def percentile(values, percent):
+    """Return the percentile from a list of values."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(percent / 100 * len(values))))
+    return values[index]
+
+
+class DaemonBenchmark(unittest.TestCase):
+    """Base class for daemon benchmarks."""
+    daemon_script = "scripts/oad.py"
+    test_conf = os.path.abspath("tests/test_benchmark_conf/")
+    port = 30790
+    # Number of concurrent clients sending requests
+    clients = 16
+    # Number of requests each client sends
+    requests = 25
+    # Number of clients that send their request slowly
+    slow_clients = 4
+    # How long does a slow client take to send its request
+    slow_delay = 2.0
+    startup_time = 3.0
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.procs = []
+        try:
+            os.makedirs(self.test_conf)
+        except OSError:
+            pass
+        with open(os.path.join(self.test_conf, "v320.pre"), "w") as pref:
+            pref.write(PRE_CONFIG)
+        with open(os.path.join(self.test_conf, "10.cf"), "w") as conf:
+            conf.write(CONFIG)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        for proc in self.procs:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(self.test_conf, True)
+
+    def start_daemon(self, *extra_args):
+        args = [sys.executable, self.daemon_script, "-C", self.test_conf,
+                "--siteconfigpath", self.test_conf,
+                "-i", "127.0.0.1", "-p", str(self.port),
+                "--log-file", os.devnull]
+        args.extend(extra_args)
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [os.getcwd(), env.get("PYTHONPATH")])
+        )
+        self.procs.append(subprocess.Popen(args, env=env))
+        time.sleep(self.startup_time)
+
+    def connect(self):
+        return socket.create_connection(("127.0.0.1", self.port), timeout=60)
+
+    def send_request(self, slow=False, command="CHECK"):
+        """Send one request and return the time it took."""
+        if command == "PING":
+            request = b"PING SPAMC/1.2\r\n"
+        else:
+            request = ("%s SPAMC/1.2\r\nContent-length: %s\r\n\r\n%s" %
+                       (command, len(GTUBE_MSG), GTUBE_MSG)).encode("utf8")
+        start = time.time()
+        connection = self.connect()
+        try:
+            if slow:
+                half = len(request) // 2
+                connection.sendall(request[:half])
+                time.sleep(self.slow_delay)
+                connection.sendall(request[half:])
+            else:
+                connection.sendall(request)
+            while connection.recv(4096):
+                pass
+        finally:
+            connection.close()
+        return time.time() - start
+
+    def run_clients(self, command="CHECK"):
+        """Run all the clients concurrently and return the latency
+        of the requests that were not sent slowly.
+        """
+        latencies = []
+        lock = threading.Lock()
+
+        def client():
+            for dummy in range(self.requests):
+                latency = self.send_request(command=command)
+                with lock:
+                    latencies.append(latency)
+
+        def slow_client():
+            self.send_request(slow=True)
+
+        threads = [threading.Thread(target=slow_client)
+                   for dummy in range(self.slow_clients)]
+        threads.extend(threading.Thread(target=client)
+                       for dummy in range(self.clients))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies
+
+    def report(self, name, latencies, elapsed):
+        print("%s: %d requests in %.2fs, %.1f req/s, p50 %.1fms, "
+              "p99 %.1fms, max %.1fms" %
+              (name, len(latencies), elapsed, len(latencies) / elapsed,
+               percentile(latencies, 50) * 1000,
+               percentile(latencies, 99) * 1000,
+               max(latencies) * 1000),
+              file=sys.__stdout__)
+
+    def benchmark(self, name, *extra_args, **kwargs):
+        command = kwargs.get("command", "CHECK")
+        self.start_daemon(*extra_args)
+        start = time.time()
+        latencies = self.run_clients(command=command)
+        elapsed = time.time() - start
+        self.report(name, latencies, elapsed)
+        self.assertEqual(len(latencies), self.clients * self.requests)
+
+
+@unittest.skipIf(IS_PYPY, "Benchmarks are not comparable on PyPy")
+class ConcurrencyBenchmark(DaemonBenchmark):
+    workers = 4
+
+    def test_prefork(self):
+        """Benchmark the pre forking server."""
+        self.benchmark("Prefork (%s workers)" % self.workers,
+                       "--prefork", str(self.workers))
+
+    def test_threads(self):
+        """Benchmark the thread pool server."""
+        self.benchmark("Thread pool (%s threads)" % self.workers,
+                       "--threads", str(self.workers))
+
+    @unittest.skipIf(sys.version_info < (3, 5), "Requires asyncio")
+    def test_async(self):
+        """Benchmark the asyncio server."""
+        self.benchmark("Async (%s workers)" % self.workers,
+                       "--async", "--async-workers", str(self.workers))
+
+
+@unittest.skipIf(IS_PYPY, "Benchmarks are not comparable on PyPy")
+class ListenerBenchmark(DaemonBenchmark):
+    """Compare the ways the pre forked workers can accept connections.
+
+    PING requests barely do any work, so their latency is mostly the
+    time it takes for a worker to accept the connection. CHECK requests
+    show the throughput.
+    """
+    workers = 4
+    clients = 32
+    requests = 50
+    slow_clients = 0
+    socket_path = os.path.abspath("tests/oad-benchmark.sock")
+
+    def tearDown(self):
+        DaemonBenchmark.tearDown(self)
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+
+    def run_listener(self, name, *extra_args):
+        args = ("--prefork", str(self.workers)) + extra_args
+        self.benchmark("%s (%s workers) accept" % (name, self.workers),
+                       *args, command="PING")
+        self.tearDown()
+        self.setUp()
+        self.benchmark("%s (%s workers) check" % (name, self.workers),
+                       *args)
+
+    def test_shared_socket(self):
+        """Benchmark the workers accepting on the same socket."""
+        self.run_listener("Shared socket")
+
+    @unittest.skipIf(not hasattr(socket, "SO_REUSEPORT"),
+                     "Requires SO_REUSEPORT")
+    def test_reuse_port(self):
+        """Benchmark a SO_REUSEPORT socket per worker."""
+        self.run_listener("SO_REUSEPORT", "--reuse-port")
+
+    @unittest.skipIf(not hasattr(socket, "AF_UNIX"), "Requires Unix sockets")
+    def test_unix_socket(self):
+        """Benchmark the workers accepting on a Unix domain socket."""
+        self.connect = self.connect_unix
+        self.run_listener("Unix socket", "--socketpath", self.socket_path)
+
+    def connect_unix(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(60)
+        connection.connect(self.socket_path)
+        return connection
+
+
+@unittest.skipIf(IS_PYPY, "Benchmarks are not comparable on PyPy")
+class BatchBenchmark(DaemonBenchmark):
+    """Compare checking messages one request at a time with a single
+    BATCH request.
+    """
+    messages = 200
+    slow_clients = 0
+
+    def send_batch(self):
+        frames = "".join("%s\r\n%s" % (len(GTUBE_MSG), GTUBE_MSG)
+                         for dummy in range(self.messages)) + "0\r\n"
+        request = ("BATCH SPAMC/1.2\r\n\r\n%s" % frames).encode("utf8")
+        connection = self.connect()
+        try:
+            connection.sendall(request)
+            response = []
+            while True:
+                data = connection.recv(4096)
+                if not data:
+                    break
+                response.append(data)
+        finally:
+            connection.close()
+        return b"".join(response)
+
+    def test_batch(self):
+        """Benchmark a single BATCH request against CHECK requests."""
+        self.start_daemon("--batch-workers", "4")
+        start = time.time()
+        for dummy in range(self.messages):
+            self.send_request()
+        elapsed = time.time() - start
+        print("CHECK: %d messages in %.2fs, %.1f msg/s" %
+              (self.messages, elapsed, self.messages / elapsed),
+              file=sys.__stdout__)
+        start = time.time()
+        response = self.send_batch()
+        elapsed = time.time() - start
+        print("BATCH: %d messages in %.2fs, %.1f msg/s" %
+              (self.messages, elapsed, self.messages / elapsed),
+              file=sys.__stdout__)
+        self.assertTrue(response.endswith(
+            ("Messages: %s\r\n\r\n" % self.messages).encode("utf8")
+        ))
@@ -0,0 +1,107 @@
+"""Benchmark of the upstream DNS queries saved by the shared DNS cache.
+
+Several forked workers look up names from the same pool, like the
+pre forked workers of the daemon checking the same relays and senders,
+against a resolver that counts the queries it receives.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import time
+import random
+import logging
+import unittest
+
+import dns.name
+import dns.rrset
+import dns.message
+import dns.resolver
+import dns.rdataclass
+import dns.rdatatype
+
+import oa.dns_interface
+
+
+class CountingResolver(object):
+    """Answer every query with a A record and count the queries by
+    writing a byte to a pipe.
+    """
+
+    def __init__(self, count_w, ttl=300):
+        self.count_w = count_w
+        self.ttl = ttl
+
+    def query(self, qname, qtype):
+        os.write(self.count_w, b"q")
+        query = dns.message.make_query(qname, qtype)
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(
+            str(qname).rstrip(".") + ".", self.ttl, "IN", "A", "127.0.0.2"
+        ))
+        response = dns.message.from_wire(response.to_wire())
+        return dns.resolver.Answer(dns.name.from_text(qname),
+                                   dns.rdatatype.A, dns.rdataclass.IN,
+                                   response)
+
+
+class SharedDNSCacheBenchmark(unittest.TestCase):
+    workers = 8
+    # Number of queries for each worker
+    queries = 2000
+    # Number of distinct names queried
+    distinct_names = 1000
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        self.names = ["%d.0.0.127.zen.example.com" % i
+                      for i in range(self.distinct_names)]
+
+    def run_workers(self, backend=None):
+        """Run the workers and return the number of upstream queries
+        and the time it took.
+        """
+        count_r, count_w = os.pipe()
+        start = time.time()
+        pids = []
+        for worker in range(self.workers):
+            pid = os.fork()
+            if not pid:
+                try:
+                    self.worker(worker, count_w, backend)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        elapsed = time.time() - start
+        os.close(count_w)
+        upstream = 0
+        while True:
+            data = os.read(count_r, 4096)
+            if not data:
+                break
+            upstream += len(data)
+        os.close(count_r)
+        return upstream, elapsed
+
+    def worker(self, worker, count_w, backend):
+        dns_interface = oa.dns_interface.DNSInterface()
+        dns_interface._resolver = CountingResolver(count_w)
+        dns_interface.cache.backend = backend
+        rand = random.Random(worker)
+        for dummy in range(self.queries):
+            dns_interface.query(rand.choice(self.names), "A")
+
+    def test_upstream_queries(self):
+        local, local_time = self.run_workers()
+        shared, shared_time = self.run_workers(
+            oa.dns_interface.SharedDNSCache(slots=4 * self.distinct_names)
+        )
+        total = self.workers * self.queries
+        print("\n%d workers, %d queries: per process cache %d upstream "
+              "queries in %.2fs, shared cache %d upstream queries in %.2fs "
+              "(%.1fx fewer)" % (self.workers, total, local, local_time,
+                                 shared, shared_time, local / shared))
+        self.assertLess(shared, local)
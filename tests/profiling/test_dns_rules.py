@@ -0,0 +1,180 @@
+"""Benchmark the network rules against a local stub DNS server.
+
+The DNSEval, SPF and DKIM rules of a ruleset look up their names on a
+`tests.util.dns_stub.StubDNSServer`, which reproduces the latency,
+loss and NXDOMAIN rates of a real resolver without using the network.
+Each benchmark reports the messages checked per second and the latency
+of the checks.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import unittest
+
+import dns.resolver
+
+import oa.config
+import oa.message
+import oa.rules.parser
+
+from tests.util.dns_stub import StubDNSServer, parse_records
+from tests.profiling.test_daemon import percentile
+
+PRE_CONFIG = r"""
+loadplugin oa.plugins.dns_eval.DNSEval
+loadplugin oa.plugins.spf.SpfPlugin
+loadplugin oa.plugins.dkim.DKIMPlugin
+
+dns_server %(server)s
+default_dns_timeout 0.5
+default_dns_lifetime 1.0
+rbl_timeout 2
+spf_timeout 2
+envelope_sender_header X-From
+"""
+
+RBL_RULE = r"""
+header RBL_%(zone)s eval:check_rbl('bl%(zone)s-lastexternal', 'bl%(zone)s.example.com.')
+"""
+
+CONFIG = r"""
+header RBL_FROM_DOMAIN  eval:check_rbl_from_domain('dbl', 'dbl.example.com.')
+header SPF_PASS         eval:check_for_spf_pass()
+header SPF_FAIL         eval:check_for_spf_fail()
+full DKIM_SIGNED        eval:check_dkim_signed()
+full DKIM_VALID         eval:check_dkim_valid()
+"""
+
+MSG = """Received: from relay.example.net (relay.example.net [%(ip)s])
+ by mx.example.com with ESMTP id %(id)s; Mon, 29 Feb 2016 13:43:53 +0100
+DKIM-Signature: v=1; a=rsa-sha256; c=simple/simple;
+ d=%(domain)s; i=@%(domain)s; q=dns/txt;
+ s=sel; t=1481798029; h=Subject : From : To;
+ bh=FCPAsiuQWCFlrJ7iR/yrZ6aafRyUVew0I6JKFrP5atE=; b=gw/FqdTVCfo7SLK9ZvbU0dHf8h0M1MRXQ0b/gjA713MUJhwWsfuZCf3YWXiFuzJxwMHN/jO5tjjLif3igXxmXiijlOx+9dnsF1gYzKog4f1olUSGaw0Xxmx3OD1hzBMRpCP3zlYG4Hz9hziMgZnb8+jJXgAjHhWPmTpkhCW8lOA=
+X-From: user@%(domain)s
+From: user@%(domain)s
+To: test@example.com
+Subject: Test message %(id)s
+
+Hello World.
+"""
+
+DKIM_KEY = ("v=DKIM1; k=rsa; p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQC1TaNgLlSy"
+            "QMNWVLNLvyY/neDgaL2oqQE8T5illKqCgDtFHc8eHVAU+nlcaGmrKmDMw9dbgiGk1"
+            "ocgZ56NR4ycfUHwQhvQPMUZw0cveel/8EAGoi/UyPmqfcPibytH81NFtTMAxUeM4O"
+            "p8A6iHkvAwj5hVOMeLDbhvwXBE5gTz2QIDAQAB")
+
+
+class DNSRulesBenchmark(unittest.TestCase):
+    conf = os.path.abspath("tests/test_dns_rules_conf/")
+    # Number of messages checked
+    messages = 200
+    # Number of distinct relays and sender domains
+    relays = 100
+    domains = 50
+    # Number of DNS lists the relays are checked on
+    zones = 8
+    # Fraction of the relays and domains that are listed
+    listed = 0.1
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        rand = random.Random(0)
+        self.ips = ["%d.%d.%d.%d" % (rand.randint(1, 223),
+                                     rand.randint(0, 255),
+                                     rand.randint(0, 255),
+                                     rand.randint(1, 254))
+                    for dummy in range(self.relays)]
+        self.domains = ["sender%d.example.org" % i
+                        for i in range(self.domains)]
+        lines = []
+        for ip in self.ips:
+            reverse = ".".join(reversed(ip.split(".")))
+            for zone in range(self.zones):
+                if rand.random() < self.listed:
+                    lines.append("%s.bl%s.example.com A 127.0.0.2" %
+                                 (reverse, zone))
+        for domain in self.domains:
+            lines.append('%s TXT "v=spf1 ip4:%s -all"' %
+                         (domain, rand.choice(self.ips)))
+            lines.append('sel._domainkey.%s TXT "%s"' % (domain, DKIM_KEY))
+            if rand.random() < self.listed:
+                lines.append("%s.dbl.example.com A 127.0.1.2" % domain)
+        self.records = parse_records(lines)
+        self.rand = rand
+        self.default_resolver = dns.resolver.default_resolver
+
+    def tearDown(self):
+        dns.resolver.default_resolver = self.default_resolver
+        shutil.rmtree(self.conf, True)
+        unittest.TestCase.tearDown(self)
+
+    def get_ruleset(self, server):
+        try:
+            os.makedirs(self.conf)
+        except OSError:
+            pass
+        with open(os.path.join(self.conf, "v320.pre"), "w") as pre:
+            pre.write(PRE_CONFIG % {"server": server.address})
+        with open(os.path.join(self.conf, "10.cf"), "w") as conf:
+            for zone in range(self.zones):
+                conf.write(RBL_RULE % {"zone": zone})
+            conf.write(CONFIG)
+        # The SPF plugin uses the default resolver of dnspython.
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = [server.host]
+        resolver.port = server.port
+        dns.resolver.default_resolver = resolver
+        files = oa.config.get_config_files(self.conf, self.conf)
+        return oa.rules.parser.parse_pad_rules(files).get_ruleset()
+
+    def benchmark(self, name, **conditions):
+        server = StubDNSServer(self.records, seed=1, **conditions)
+        with server:
+            ruleset = self.get_ruleset(server)
+            latencies = []
+            start = time.time()
+            for i in range(self.messages):
+                raw_msg = MSG % {"ip": self.rand.choice(self.ips),
+                                 "domain": self.rand.choice(self.domains),
+                                 "id": i}
+                # The DNSEval lookups start when the message is parsed.
+                msg_start = time.time()
+                msg = oa.message.Message(ruleset.ctxt, raw_msg)
+                ruleset.match(msg)
+                latencies.append(time.time() - msg_start)
+            elapsed = time.time() - start
+        print("%s: %d messages in %.2fs, %.1f msg/s, p50 %.1fms, "
+              "p99 %.1fms, max %.1fms, %s queries (%s dropped, %s NXDOMAIN)" %
+              (name, len(latencies), elapsed, len(latencies) / elapsed,
+               percentile(latencies, 50) * 1000,
+               percentile(latencies, 99) * 1000, max(latencies) * 1000,
+               server.stats["queries"], server.stats["dropped"],
+               server.stats["nxdomain"]),
+              file=sys.__stdout__)
+        self.assertEqual(len(latencies), self.messages)
+
+    def test_local(self):
+        """Answers without any delay."""
+        self.benchmark("Local resolver")
+
+    def test_latency(self):
+        """Answers that take 20ms, with a long tail."""
+        self.benchmark("20ms latency", latency=0.02, jitter=0.03)
+
+    def test_loss(self):
+        """Some of the queries are lost and time out."""
+        self.benchmark("20ms latency, 2% loss", latency=0.02, jitter=0.03,
+                       loss=0.02)
+
+    def test_nxdomain(self):
+        """Most of the listed names are answered NXDOMAIN."""
+        self.benchmark("20ms latency, 50% NXDOMAIN", latency=0.02,
+                       nxdomain=0.5)
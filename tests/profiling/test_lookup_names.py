@@ -0,0 +1,80 @@
+"""Benchmark of the names the DNS list rules look up for a message.
+
+The untrusted IPs and their reversed labels are computed once when the
+message is parsed, instead of again for every rule. This compares
+building the query names of a ruleset with many lists both ways.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import time
+import logging
+import unittest
+
+import dns.reversename
+
+import oa.context
+import oa.message
+import oa.plugins.dns_eval
+
+RECEIVED = """Received: from relay%(i)d.example.net (relay%(i)d.example.net [%(ip)s])
+ by mx%(i)d.example.com with ESMTP id %(i)d; Mon, 29 Feb 2016 13:43:53 +0100
+"""
+
+
+def get_ip_qnames(msg, rbl_server):
+    """The names built for every rule before they were precomputed."""
+    qnames = []
+    for ip in msg.get_untrusted_ips():
+        reversed_ip = str(dns.reversename.from_address(ip.exploded))
+        qnames.append("%s.%s" % (reversed_ip.rstrip(".").rsplit(".", 2)[0],
+                                 rbl_server))
+    return qnames
+
+
+class LookupNamesBenchmark(unittest.TestCase):
+    # Number of messages
+    messages = 2000
+    # Number of Received headers of each message
+    relays = 5
+    # Number of DNS lists checked
+    zones = 30
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        ctxt = oa.context.GlobalContext()
+        ctxt.networks.add_trusted_network("10.0.0.0/8")
+        raw_msg = "".join(RECEIVED % {"i": i, "ip": "198.51.100.%d" % i}
+                          for i in range(self.relays))
+        raw_msg += "From: user@example.com\nSubject: Test\n\nHello World.\n"
+        self.msg = oa.message.Message(ctxt, raw_msg)
+        self.rbl_servers = ["bl%d.example.com" % i for i in range(self.zones)]
+
+    def run_rules(self, get_qnames):
+        start = time.time()
+        for dummy in range(self.messages):
+            for rbl_server in self.rbl_servers:
+                get_qnames(self.msg, rbl_server)
+        return time.time() - start
+
+    def test_ip_qnames(self):
+        expected = [get_ip_qnames(self.msg, rbl_server)
+                    for rbl_server in self.rbl_servers]
+        precomputed = oa.plugins.dns_eval.DNSEval._get_ip_qnames
+        self.assertEqual([precomputed(self.msg, rbl_server)
+                          for rbl_server in self.rbl_servers], expected)
+
+        per_rule = self.run_rules(get_ip_qnames)
+        parsed = time.time()
+        for dummy in range(self.messages):
+            self.msg._parse_lookup_names()
+        parsed = time.time() - parsed
+        once = self.run_rules(precomputed) + parsed
+        rules = self.messages * self.zones
+        print("\n%d messages, %d lists, %d relays: %.1f us per rule "
+              "computed per rule, %.1f us per rule computed once "
+              "(%.1fx)" % (self.messages, self.zones, self.relays,
+                           per_rule * 1000000 / rules,
+                           once * 1000000 / rules, per_rule / once))
+        self.assertLess(once, per_rule)
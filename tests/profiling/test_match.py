@@ -1,8 +1,17 @@
-from __future__ import absolute_import, print_function
+from __future__ import absolute_import, print_function, division
 
 import os
+import sys
+import time
+import socket
 import unittest
 import platform
+import subprocess
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 import tests.util
 
@@ -76,3 +85,82 @@ class IOReadTest(MemoryTest):
 @unittest.skipIf(IS_PYPY, "Psutil doesn't work on PyPy")
 class IOCountTest(MemoryTest):
     ptype = "io-count"
+
+
+@unittest.skipIf(IS_PYPY, "Psutil doesn't work on PyPy")
+@unittest.skipIf(psutil is None, "Requires psutil")
+class PreForkMemoryTest(tests.util.TestBase):
+    """Check the memory used by the workers of the pre forking daemon.
+
+    Most of the memory of a worker should stay shared with the parent,
+    so the unique set size (USS) of a worker must remain small compared
+    to its proportional set size (PSS).
+    """
+    daemon_script = "scripts/oad.py"
+    port = 30791
+    workers = 4
+    # Number of requests sent to the daemon before measuring.
+    requests = 40
+    startup_time = 3.0
+    limits = {
+        # Maximum USS of a single worker, in MiB.
+        "uss": None,
+        # Maximum PSS of all the workers together, in MiB.
+        "pss": None,
+    }
+
+    def setUp(self):
+        tests.util.TestBase.setUp(self)
+        self.proc = None
+
+    def tearDown(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+        tests.util.TestBase.tearDown(self)
+
+    def start_daemon(self):
+        args = [sys.executable, self.daemon_script, "-C", self.test_conf,
+                "--siteconfigpath", self.test_conf,
+                "-i", "127.0.0.1", "-p", str(self.port),
+                "--log-file", os.devnull, "--prefork", str(self.workers)]
+        env = os.environ.copy()
+        env["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [os.getcwd(), env.get("PYTHONPATH")])
+        )
+        self.proc = subprocess.Popen(args, env=env)
+        time.sleep(self.startup_time)
+
+    def send_request(self, msg):
+        request = ("CHECK SPAMC/1.2\r\nContent-length: %s\r\n\r\n%s" %
+                   (len(msg), msg)).encode("utf8")
+        connection = socket.create_connection(("127.0.0.1", self.port),
+                                              timeout=60)
+        try:
+            connection.sendall(request)
+            while connection.recv(4096):
+                pass
+        finally:
+            connection.close()
+
+    def test_workers_memory(self):
+        """Profile the memory of the pre forked workers."""
+        self.setup_conf(pre_config="report _SCORE_")
+        self.start_daemon()
+        for dummy in range(self.requests):
+            self.send_request("Subject: test\n\n" + GTUBE)
+
+        children = psutil.Process(self.proc.pid).children()
+        self.assertEqual(len(children), self.workers)
+        mib = 1024 * 1024
+        uss = [child.memory_full_info().uss / mib for child in children]
+        pss = [child.memory_full_info().pss / mib for child in children]
+        print("Prefork memory (%s workers): USS per worker %s MiB, "
+              "total USS %.1f MiB, total PSS %.1f MiB" %
+              (self.workers, ", ".join("%.1f" % value for value in uss),
+               sum(uss), sum(pss)),
+              file=sys.__stdout__)
+        if self.limits["uss"]:
+            self.assertLessEqual(max(uss), self.limits["uss"])
+        if self.limits["pss"]:
+            self.assertLessEqual(sum(pss), self.limits["pss"])
@@ -0,0 +1,65 @@
+"""Benchmark of the lookups answered from local rbldnsd zone files.
+
+A large ip4set zone is compiled once, then random addresses are looked
+up in it the way DNSEval does for a message.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import time
+import random
+import shutil
+import logging
+import tempfile
+import unittest
+
+import oa.rbldnsd
+
+
+class LocalZoneBenchmark(unittest.TestCase):
+    # Number of entries in the zone
+    entries = 200000
+    # Number of lookups
+    lookups = 100000
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "zone.txt")
+        rand = random.Random(0)
+        with open(self.path, "w") as zone_file:
+            zone_file.write(":127.0.0.2:Listed $\n")
+            for dummy in range(self.entries):
+                zone_file.write("%d.%d.%d.%d/%d\n" % (
+                    rand.randint(1, 223), rand.randint(0, 255),
+                    rand.randint(0, 255), rand.randint(0, 255),
+                    rand.choice((24, 28, 32))))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        oa.rbldnsd._snapshots.clear()
+        unittest.TestCase.tearDown(self)
+
+    def test_lookups(self):
+        start = time.time()
+        zones = oa.rbldnsd.LocalZones()
+        zones.add(oa.rbldnsd.Zone("zen.example.com", "ip4set", self.path,
+                                  os.path.join(self.directory, "snapshots")))
+        compile_time = time.time() - start
+        size = len(zones.zones["zen.example.com"].snapshot.data)
+
+        rand = random.Random(1)
+        qnames = ["%d.%d.%d.%d.zen.example.com" % (
+            rand.randint(0, 255), rand.randint(0, 255),
+            rand.randint(0, 255), rand.randint(1, 223))
+            for dummy in range(self.lookups)]
+        start = time.time()
+        listed = sum(1 for qname in qnames if zones.lookup(qname))
+        elapsed = time.time() - start
+        print("\n%d entries compiled in %.2fs (%d KiB snapshot), %d lookups "
+              "in %.2fs (%.1f us each, %d listed)" % (
+                  self.entries, compile_time, size // 1024, self.lookups,
+                  elapsed, elapsed * 1000000 / self.lookups, listed))
+        self.assertGreater(listed, 0)
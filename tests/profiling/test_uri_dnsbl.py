@@ -0,0 +1,170 @@
+"""Benchmark the URI DNS list rules on link heavy newsletters.
+
+The messages have a few hundred links to a few dozen hosts, most of them
+tracking links and images of the same domains. They are checked on three
+lists of a `tests.util.dns_stub.StubDNSServer` that answers in about
+20ms, with the URIDNSBL plugin and by looking up every host of every URI
+one after the other.
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import unittest
+
+import oa.config
+import oa.message
+import oa.rules.parser
+import oa.plugins.uri_dnsbl
+
+from tests.util.dns_stub import StubDNSServer, parse_records
+from tests.profiling.test_daemon import percentile
+
+PRE_CONFIG = r"""
+loadplugin Mail::SpamAssassin::Plugin::URIDetail
+loadplugin Mail::SpamAssassin::Plugin::URIDNSBL
+
+dns_server %(server)s
+default_dns_timeout 0.5
+default_dns_lifetime 1.0
+util_rb_2tld co.uk com.au
+"""
+
+CONFIG = r"""
+urirhsbl URIBL_BLACK black.uribl.example.com. A
+body     URIBL_BLACK eval:check_uridnsbl('URIBL_BLACK')
+urirhssub URIBL_GREY multi.uribl.example.com. A 4
+body      URIBL_GREY eval:check_uridnsbl('URIBL_GREY')
+urirhssub URIBL_DBL dbl.example.com. A 127.0.1.2
+body      URIBL_DBL eval:check_uridnsbl('URIBL_DBL')
+"""
+
+ZONES = ("black.uribl.example.com", "multi.uribl.example.com",
+         "dbl.example.com")
+
+MSG = """From: news@%(brand)s
+To: test@example.com
+Subject: Newsletter %(id)s
+MIME-Version: 1.0
+Content-Type: text/html; charset="utf-8"
+
+<html><body>
+%(links)s
+</body></html>
+"""
+
+
+class URIDNSBLBenchmark(unittest.TestCase):
+    conf = os.path.abspath("tests/test_uri_dnsbl_conf/")
+    # Number of messages checked with the plugin, and by looking up
+    # every URI host
+    messages = 100
+    naive_messages = 10
+    # Number of links of each message, and the hosts they point to
+    links = 300
+    hosts = 40
+    # Fraction of the domains that are listed
+    listed = 0.05
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        self.rand = random.Random(0)
+        suffixes = ("com", "net", "org", "co.uk", "com.au")
+        self.domains = ["brand%d.%s" % (i, self.rand.choice(suffixes))
+                        for i in range(2000)]
+        lines = []
+        for domain in self.domains:
+            for zone in ZONES:
+                if self.rand.random() < self.listed:
+                    lines.append("%s.%s A 127.0.1.2" % (domain, zone))
+        self.records = parse_records(lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.conf, True)
+        unittest.TestCase.tearDown(self)
+
+    def get_ruleset(self, server):
+        try:
+            os.makedirs(self.conf)
+        except OSError:
+            pass
+        with open(os.path.join(self.conf, "v320.pre"), "w") as pre:
+            pre.write(PRE_CONFIG % {"server": server.address})
+        with open(os.path.join(self.conf, "10.cf"), "w") as conf:
+            conf.write(CONFIG)
+        files = oa.config.get_config_files(self.conf, self.conf)
+        return oa.rules.parser.parse_pad_rules(files).get_ruleset()
+
+    def get_message(self, i):
+        """A newsletter, with the tracking links, images and social
+        links of a few domains.
+        """
+        domains = self.rand.sample(self.domains, self.hosts // 4)
+        hosts = [self.rand.choice(("www.", "click.", "img.", "")) + domain
+                 for domain in domains for dummy in range(4)]
+        links = []
+        for link in range(self.links):
+            host = self.rand.choice(hosts)
+            if link % 3:
+                links.append('<a href="https://%s/ls/click?upn=%d">Read '
+                             'more</a>' % (host, link))
+            else:
+                links.append('<img src="http://%s/i/%d.png">' % (host, link))
+        return MSG % {"brand": domains[0], "id": i,
+                      "links": "\n".join(links)}
+
+    def check(self, ruleset, check_message, messages):
+        latencies = []
+        start = time.time()
+        for i in range(messages):
+            raw_msg = self.get_message(i)
+            msg_start = time.time()
+            msg = oa.message.Message(ruleset.ctxt, raw_msg)
+            check_message(ruleset, msg)
+            latencies.append(time.time() - msg_start)
+        return time.time() - start, latencies
+
+    def report(self, name, server, elapsed, latencies):
+        print("%s: %d messages in %.2fs, %.1f msg/s, p50 %.1fms, "
+              "p99 %.1fms, %.1f queries per message" %
+              (name, len(latencies), elapsed, len(latencies) / elapsed,
+               percentile(latencies, 50) * 1000,
+               percentile(latencies, 99) * 1000,
+               server.stats["queries"] / len(latencies)),
+              file=sys.__stdout__)
+
+    def test_uridnsbl(self):
+        with StubDNSServer(self.records, latency=0.02, jitter=0.01,
+                           seed=1) as server:
+            ruleset = self.get_ruleset(server)
+            elapsed, latencies = self.check(
+                ruleset, lambda ruleset, msg: ruleset.match(msg),
+                self.messages)
+        self.report("URIDNSBL plugin", server, elapsed, latencies)
+        self.assertLessEqual(server.stats["queries"],
+                             self.messages * 20 * len(ZONES))
+
+    def test_naive(self):
+        """Every host of every URI is looked up on every list, one
+        after the other.
+        """
+        def check_message(ruleset, msg):
+            for uri in msg.uri_list:
+                host = oa.plugins.uri_dnsbl.get_uri_host(uri)
+                if host is None:
+                    continue
+                for zone in ZONES:
+                    ruleset.ctxt.dns.query("%s.%s" % (host, zone), "A")
+
+        with StubDNSServer(self.records, latency=0.02, jitter=0.01,
+                           seed=1) as server:
+            ruleset = self.get_ruleset(server)
+            elapsed, latencies = self.check(ruleset, check_message,
+                                            self.naive_messages)
+        self.report("Every URI host in turn", server, elapsed, latencies)
@@ -0,0 +1,368 @@
+"""Unittest for oa.async_server"""
+
+import sys
+import time
+import stat
+import logging
+import unittest
+
+try:
+    from unittest.mock import patch, Mock, MagicMock
+except ImportError:
+    from mock import patch, Mock, MagicMock
+
+import oa.metrics
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    import oa.async_server
+
+
+class MockWriter(object):
+    def __init__(self):
+        self.data = []
+        self.closed = False
+
+    def write(self, data):
+        self.data.append(data)
+
+    def drain(self):
+        future = asyncio.Future()
+        future.set_result(None)
+        return future
+
+    def close(self):
+        self.closed = True
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "Requires asyncio")
+class TestAsyncServer(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        self.mock_socket = patch("oa.async_server.socket").start()
+        self.mock_time = patch("oa.async_server.time").start()
+        self.mock_time.time.return_value = 100
+        patch("oa.server.oa.config.get_config_files").start()
+        self.mock_rules = patch("oa.server."
+                                "oa.rules.parser.parse_pad_rules").start()
+        self.mainset = self.mock_rules.return_value.get_ruleset.return_value
+        self.mainset.conf = {"allow_user_rules": False}
+        self.loop = asyncio.new_event_loop()
+        self.server = oa.async_server.AsyncServer(
+            ("127.0.0.1", 783), "/dev/null", "/etc/spamassassin/"
+        )
+        self.server._loop = self.loop
+        self.server._executor = Mock(name="executor")
+        self.mock_check = MagicMock(has_options=True, has_message=True)
+        self.mock_ping = MagicMock(has_options=False, has_message=False)
+        patch("oa.server.COMMANDS", {"CHECK": self.mock_check,
+                                     "PING": self.mock_ping}).start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.loop.close()
+        patch.stopall()
+
+    def get_reader(self, data):
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(data)
+        reader.feed_eof()
+        return reader
+
+    def handle(self, data, response=b""):
+        future = asyncio.Future(loop=self.loop)
+        future.set_result(response)
+        self.loop.run_in_executor = Mock(return_value=future)
+        writer = MockWriter()
+        self.loop.run_until_complete(
+            self.server.handle_connection(self.get_reader(data), writer)
+        )
+        return writer
+
+    def test_init_ruleset(self):
+        self.assertEqual(self.server._ruleset, self.mainset)
+        self.assertEqual(self.server.get_user_ruleset(), self.mainset)
+
+    def test_init_socket(self):
+        sock = self.mock_socket.socket.return_value
+        sock.bind.assert_called_with(("127.0.0.1", 783))
+        sock.listen.assert_called_with(self.server.request_queue_size)
+        sock.setblocking.assert_called_with(False)
+
+    def test_init_unix_socket(self):
+        mock_stat = patch("oa.async_server.os.stat").start()
+        mock_stat.return_value.st_mode = stat.S_IFSOCK
+        mock_remove = patch("oa.async_server.os.remove").start()
+        oa.async_server.AsyncServer(
+            "/var/run/oad.sock", "/dev/null", "/etc/spamassassin/"
+        )
+        self.mock_socket.socket.assert_called_with(
+            self.mock_socket.AF_UNIX, self.mock_socket.SOCK_STREAM
+        )
+        mock_remove.assert_called_with("/var/run/oad.sock")
+        sock = self.mock_socket.socket.return_value
+        sock.bind.assert_called_with("/var/run/oad.sock")
+
+    def test_init_unix_socket_not_socket(self):
+        mock_stat = patch("oa.async_server.os.stat").start()
+        mock_stat.return_value.st_mode = stat.S_IFREG
+        mock_remove = patch("oa.async_server.os.remove").start()
+        oa.async_server.AsyncServer(
+            "/var/run/oad.sock", "/dev/null", "/etc/spamassassin/"
+        )
+        self.assertFalse(mock_remove.called)
+
+    def test_max_workers(self):
+        server = oa.async_server.AsyncServer(
+            ("127.0.0.1", 783), "/dev/null", "/etc/spamassassin/",
+            max_workers=12
+        )
+        self.assertEqual(server.max_workers, 12)
+
+    def test_handle_ping(self):
+        writer = self.handle(b"PING SPAMC/1.2\r\n", b"SPAMD/1.5 0 PONG\r\n")
+        self.loop.run_in_executor.assert_called_with(
+            self.server._executor, self.server.run_command, self.mock_ping,
+            b"", 100
+        )
+        self.assertEqual(writer.data, [b"SPAMD/1.5 0 PONG\r\n"])
+        self.assertTrue(writer.closed)
+
+    def test_handle_content_length(self):
+        request = (b"Content-length: 12\r\nUser: alex\r\n\r\n"
+                   b"Subject: tes")
+        self.handle(b"CHECK SPAMC/1.2\r\n" + request + b"t\n\nextra data")
+        self.loop.run_in_executor.assert_called_with(
+            self.server._executor, self.server.run_command, self.mock_check,
+            request, 100
+        )
+
+    def test_handle_no_content_length(self):
+        request = b"User: alex\r\n\r\nSubject: test\n\nTest"
+        self.handle(b"CHECK SPAMC/1.2\r\n" + request)
+        self.loop.run_in_executor.assert_called_with(
+            self.server._executor, self.server.run_command, self.mock_check,
+            request, 100
+        )
+
+    def test_handle_max_size_content_length(self):
+        self.server.max_message_size = 10
+        request = b"Content-length: 12\r\n"
+        writer = self.handle(b"CHECK SPAMC/1.2\r\n" + request +
+                             b"\r\nSubject: test\n\nTest")
+        self.loop.run_in_executor.assert_called_with(
+            self.server._executor, self.server.run_command, self.mock_check,
+            request, 100
+        )
+        self.assertTrue(writer.closed)
+
+    def test_handle_max_size_no_content_length(self):
+        self.server.max_message_size = 10
+        self.server.chunk_size = 8
+        request = b"User: alex\r\n\r\n"
+        self.handle(b"CHECK SPAMC/1.2\r\n" + request +
+                    b"Subject: test\n\nTest message")
+        self.loop.run_in_executor.assert_called_with(
+            self.server._executor, self.server.run_command, self.mock_check,
+            request + b"Subject: test\n\nT", 100
+        )
+
+    def test_handle_invalid_content_length(self):
+        request = b"Content-length: abc\r\n"
+        self.handle(b"CHECK SPAMC/1.2\r\n" + request + b"\r\nSubject: test")
+        self.loop.run_in_executor.assert_called_with(
+            self.server._executor, self.server.run_command, self.mock_check,
+            request, 100
+        )
+
+    def test_handle_invalid_option(self):
+        request = b"Content-length 20\r\n"
+        self.handle(b"CHECK SPAMC/1.2\r\n" + request + b"\r\nSubject: test")
+        self.loop.run_in_executor.assert_called_with(
+            self.server._executor, self.server.run_command, self.mock_check,
+            request, 100
+        )
+
+    def test_handle_unknown_command(self):
+        writer = self.handle(b"PINasdfG SPAMC/1.2\r\n")
+        self.assertEqual(writer.data, [
+            ("SPAMD/%s 76 Bad header line: PINasdfG SPAMC/1.2\r\n" %
+             oa.__version__).encode("utf8")
+        ])
+        self.assertTrue(writer.closed)
+
+    def test_handle_invalid_line(self):
+        writer = self.handle(b"\r\n")
+        self.assertEqual(writer.data, [
+            ("SPAMD/%s 76 Bad header line: \r\n" %
+             oa.__version__).encode("utf8")
+        ])
+
+    def test_handle_keep_alive(self):
+        request = b"Content-length: 4\r\nKeep-Alive: yes\r\n\r\nTest"
+        writer = self.handle(b"CHECK SPAMC/1.2\r\n" + request +
+                             b"\r\nPING SPAMC/1.2\r\n"
+                             b"CHECK SPAMC/1.2\r\n" + request,
+                             b"SPAMD/1.5 0 EX_OK\r\n")
+        self.assertEqual(self.loop.run_in_executor.call_count, 3)
+        self.assertEqual(len(writer.data), 3)
+        self.assertTrue(writer.closed)
+
+    def test_handle_keep_alive_no(self):
+        request = b"Content-length: 4\r\nKeep-Alive: no\r\n\r\nTest"
+        writer = self.handle(b"CHECK SPAMC/1.2\r\n" + request +
+                             b"PING SPAMC/1.2\r\n",
+                             b"SPAMD/1.5 0 EX_OK\r\n")
+        self.assertEqual(self.loop.run_in_executor.call_count, 1)
+        self.assertEqual(len(writer.data), 1)
+
+    def test_handle_keep_alive_max_requests(self):
+        self.server.max_keepalive_requests = 2
+        request = b"Content-length: 4\r\nKeep-Alive: yes\r\n\r\nTest"
+        self.handle((b"CHECK SPAMC/1.2\r\n" + request) * 3,
+                    b"SPAMD/1.5 0 EX_OK\r\n")
+        self.assertEqual(self.loop.run_in_executor.call_count, 2)
+
+    def test_handle_keep_alive_invalid_length(self):
+        request = b"Content-length: -4\r\nKeep-Alive: yes\r\n\r\nTest"
+        self.handle(b"CHECK SPAMC/1.2\r\n" + request +
+                    b"PING SPAMC/1.2\r\n", b"SPAMD/1.5 0 EX_OK\r\n")
+        self.assertEqual(self.loop.run_in_executor.call_count, 1)
+
+    def test_handle_keep_alive_timeout(self):
+        self.server.keepalive_timeout = 0.01
+        request = b"Content-length: 4\r\nKeep-Alive: yes\r\n\r\nTest"
+        future = asyncio.Future(loop=self.loop)
+        future.set_result(b"SPAMD/1.5 0 EX_OK\r\n")
+        self.loop.run_in_executor = Mock(return_value=future)
+        reader = asyncio.StreamReader(loop=self.loop)
+        # The client never sends the next request or closes
+        # the connection.
+        reader.feed_data(b"CHECK SPAMC/1.2\r\n" + request)
+        writer = MockWriter()
+        self.loop.run_until_complete(
+            self.server.handle_connection(reader, writer)
+        )
+        self.assertEqual(len(writer.data), 1)
+        self.assertTrue(writer.closed)
+
+    def test_handle_header_timeout(self):
+        """A client that doesn't send the headers in time is
+        disconnected.
+        """
+        oa.metrics.reset()
+        self.server.header_timeout = 0.01
+        self.loop.run_in_executor = Mock()
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(b"CHECK SPAMC/1.2\r\nUser: alex\r\n")
+        writer = MockWriter()
+        self.loop.run_until_complete(
+            self.server.handle_connection(reader, writer)
+        )
+        self.assertFalse(self.loop.run_in_executor.called)
+        self.assertIn(b" 79 EX_TIMEOUT", writer.data[0])
+        self.assertTrue(writer.closed)
+        self.assertEqual(oa.metrics.get("timeouts_header"), 1)
+
+    def test_handle_command_timeout(self):
+        self.server.header_timeout = 0.01
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(b"CHE")
+        writer = MockWriter()
+        self.loop.run_until_complete(
+            self.server.handle_connection(reader, writer)
+        )
+        self.assertEqual(writer.data, [])
+        self.assertTrue(writer.closed)
+
+    def test_handle_body_timeout(self):
+        oa.metrics.reset()
+        self.server.body_timeout = 0.01
+        self.loop.run_in_executor = Mock()
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(b"CHECK SPAMC/1.2\r\nContent-length: 10\r\n\r\n"
+                         b"Subj")
+        writer = MockWriter()
+        self.loop.run_until_complete(
+            self.server.handle_connection(reader, writer)
+        )
+        self.assertFalse(self.loop.run_in_executor.called)
+        self.assertIn(b" 79 EX_TIMEOUT", writer.data[0])
+        self.assertEqual(oa.metrics.get("timeouts_body"), 1)
+
+    def test_handle_max_connections(self):
+        self.server.max_connections = 1
+        self.server._connections = 1
+        writer = self.handle(b"PING SPAMC/1.2\r\n")
+        self.assertFalse(self.loop.run_in_executor.called)
+        self.assertIn(b" 75 EX_TEMPFAIL", writer.data[0])
+        self.assertTrue(writer.closed)
+        self.assertEqual(self.server._connections, 1)
+
+    def test_handle_queue_full(self):
+        oa.metrics.reset()
+        self.server.max_queue_size = 2
+        self.server._pending = 2
+        writer = self.handle(b"PING SPAMC/1.2\r\n")
+        self.assertFalse(self.loop.run_in_executor.called)
+        self.assertIn(b" 75 EX_TEMPFAIL: (server busy)", writer.data[0])
+        self.assertEqual(oa.metrics.get("requests_shed"), 1)
+        self.assertEqual(self.server._pending, 2)
+
+    def test_handle_queue_pending(self):
+        self.server.max_queue_size = 2
+        self.handle(b"PING SPAMC/1.2\r\n")
+        self.assertTrue(self.loop.run_in_executor.called)
+        self.assertEqual(self.server._pending, 1)
+
+    def test_run_command_degraded(self):
+        oa.metrics.reset()
+        degraded = []
+
+        def command(rfile, wfile, server):
+            degraded.append(server.degraded)
+
+        self.server.max_queue_wait = 5
+        self.server._pending = 1
+        self.server.run_command(command, b"", time.time() - 10)
+        self.assertEqual(degraded, [True])
+        self.assertEqual(self.server._pending, 0)
+        self.assertFalse(self.server.degraded)
+        self.assertEqual(oa.metrics.get("requests_degraded"), 1)
+
+    def test_run_command_not_degraded(self):
+        degraded = []
+
+        def command(rfile, wfile, server):
+            degraded.append(server.degraded)
+
+        self.server.max_queue_wait = 5
+        self.server._pending = 1
+        self.server.run_command(command, b"", time.time())
+        self.assertEqual(degraded, [False])
+
+    def test_run_command(self):
+        def command(rfile, wfile, server):
+            self.assertEqual(rfile.read(), b"User: alex\r\n\r\n")
+            self.assertEqual(server, self.server)
+            wfile.write(b"SPAMD/1.5 0 EX_OK\r\n")
+
+        result = self.server.run_command(command, b"User: alex\r\n\r\n")
+        self.assertEqual(result, b"SPAMD/1.5 0 EX_OK\r\n")
+
+    def test_run_command_error(self):
+        command = Mock(side_effect=ValueError)
+        result = self.server.run_command(command, b"")
+        self.assertEqual(result, b"")
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestAsyncServer, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
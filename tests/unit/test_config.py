@@ -0,0 +1,112 @@
+"""Tests for oa.config"""
+
+import logging
+import unittest
+
+try:
+    from unittest.mock import patch, Mock
+except ImportError:
+    from mock import patch, Mock
+
+import oa.config
+import oa.metrics
+
+
+class TestLogQueue(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        oa.metrics.reset()
+        self.handler = logging.Handler()
+        self.handler.emit = Mock()
+        self.handler.setLevel(logging.INFO)
+        self.log_queue = oa.config.LogQueue([self.handler], max_size=2)
+        self.logger = logging.Logger("oa-test-logger", logging.DEBUG)
+        self.logger.addHandler(self.log_queue.handler)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.log_queue.stop()
+        oa.metrics.reset()
+        patch.stopall()
+
+    def test_write(self):
+        self.log_queue.start()
+        self.logger.info("Test %s", "message")
+        self.log_queue.stop()
+        record = self.handler.emit.call_args[0][0]
+        self.assertEqual(record.getMessage(), "Test message")
+
+    def test_handler_level(self):
+        self.log_queue.start()
+        self.logger.debug("Test")
+        self.log_queue.stop()
+        self.assertFalse(self.handler.emit.called)
+
+    def test_drop(self):
+        for i in range(4):
+            self.logger.info("Test %s", i)
+        self.assertEqual(oa.metrics.get("log_records_dropped"), 2)
+        self.log_queue.start()
+        self.log_queue.stop()
+        self.assertEqual(
+            [args[0][0].getMessage()
+             for args in self.handler.emit.call_args_list],
+            ["Test 0", "Test 1"]
+        )
+
+    def test_after_fork(self):
+        self.log_queue.start()
+        self.log_queue.stop()
+        self.logger.info("Test")
+        self.log_queue.after_fork()
+        self.log_queue.stop()
+        self.assertFalse(self.handler.emit.called)
+
+
+class TestSetupLogging(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.logger = logging.getLogger("oa-test-setup")
+        self.mock_queue = patch("oa.config.LogQueue").start()
+        patch("oa.config.atexit").start()
+        patch("oa.config._log_queue", None).start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.logger.handlers = []
+        patch.stopall()
+
+    def test_setup(self):
+        oa.config.setup_logging("oa-test-setup")
+        self.assertEqual(len(self.logger.handlers), 1)
+        self.assertFalse(self.mock_queue.called)
+
+    def test_setup_queue(self):
+        oa.config.setup_logging("oa-test-setup", queue_size=100)
+        handlers = self.mock_queue.call_args[0][0]
+        self.assertEqual(len(handlers), 1)
+        self.mock_queue.return_value.start.assert_called_with()
+        self.assertEqual(self.logger.handlers,
+                         [self.mock_queue.return_value.handler])
+
+    def test_flush(self):
+        oa.config.setup_logging("oa-test-setup", queue_size=100)
+        oa.config.flush_logging()
+        self.mock_queue.return_value.stop.assert_called_with()
+
+    def test_restart(self):
+        oa.config.setup_logging("oa-test-setup", queue_size=100)
+        oa.config.restart_logging()
+        self.mock_queue.return_value.after_fork.assert_called_with()
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestLogQueue, "test"))
+    test_suite.addTest(unittest.makeSuite(TestSetupLogging, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
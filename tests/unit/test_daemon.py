@@ -1,6 +1,8 @@
 """Unittest for scripts.oad"""
 
+import sys
 import signal
+import argparse
 import unittest
 
 try:
@@ -15,7 +17,8 @@ import scripts.oad
 class TestDaemon(unittest.TestCase):
     def setUp(self):
         unittest.TestCase.setUp(self)
-        patch("scripts.oad.oa.config.setup_logging").start()
+        self.mock_logging = patch(
+            "scripts.oad.oa.config.setup_logging").start()
         self.mock_pfs = patch("scripts.oad.oa.server.PreForkServer").start()
         self.mock_s = patch("scripts.oad.oa.server.Server").start()
         self.argv = ["oad.py"]
@@ -49,6 +52,201 @@ class TestDaemon(unittest.TestCase):
         self.assertEqual(self.mock_pfs.return_value.prefork, 6)
         self.mock_pfs.return_value.serve_forever.assert_called_with()
 
+    def test_preforked_recycle(self):
+        self.argv.extend(["--prefork=6", "--worker-max-requests=1000",
+                          "--worker-max-rss=256", "--worker-max-age=3600",
+                          "--worker-respawn-delay=5",
+                          "--worker-report-interval=60"])
+        scripts.oad.main()
+        server = self.mock_pfs.return_value
+        self.assertEqual(server.max_requests, 1000)
+        self.assertEqual(server.max_rss, 256)
+        self.assertEqual(server.max_age, 3600)
+        self.assertEqual(server.respawn_delay, 5)
+        self.assertEqual(server.report_interval, 60)
+
+    def test_preforked_reuse_port(self):
+        self.argv.extend(["--prefork=6", "--reuse-port"])
+        scripts.oad.main()
+        self.assertEqual(self.mock_pfs.return_value.reuse_port, True)
+
+    def test_socketpath(self):
+        self.argv.extend(["--socketpath=/var/run/oad.sock",
+                          "--socketmode=0660"])
+        mock_chmod = patch("scripts.oad.os.chmod").start()
+        mock_remove = patch("scripts.oad.os.remove").start()
+        scripts.oad.main()
+        self.mock_s.assert_called_with(
+            "/var/run/oad.sock", '/etc/mail/spamassassin',
+            '/etc/mail/spamassassin', paranoid=False,
+            ignore_unknown=True,
+        )
+        mock_chmod.assert_called_with("/var/run/oad.sock", 0o660)
+        mock_remove.assert_called_with("/var/run/oad.sock")
+
+    def test_socketmode_invalid(self):
+        self.argv.extend(["--socketpath=/var/run/oad.sock",
+                          "--socketmode=rw"])
+        with patch("scripts.oad.argparse.ArgumentParser.error",
+                   side_effect=SystemExit) as mock_error:
+            self.assertRaises(SystemExit, scripts.oad.main)
+        self.assertTrue(mock_error.called)
+
+    def test_socket_mode(self):
+        self.assertEqual(scripts.oad.socket_mode("0660"), 0o660)
+        self.assertEqual(scripts.oad.socket_mode("660"), 0o660)
+
+    def test_socket_mode_out_of_range(self):
+        self.assertRaises(argparse.ArgumentTypeError,
+                          scripts.oad.socket_mode, "10000")
+
+    def test_socketpath_reuse_port(self):
+        self.argv.extend(["--socketpath=/var/run/oad.sock", "--prefork=2",
+                          "--reuse-port"])
+        with patch("scripts.oad.argparse.ArgumentParser.error",
+                   side_effect=SystemExit) as mock_error:
+            self.assertRaises(SystemExit, scripts.oad.main)
+        self.assertTrue(mock_error.called)
+
+    def test_keepalive(self):
+        self.argv.extend(["--keepalive-timeout=2.5",
+                          "--max-keepalive-requests=20"])
+        scripts.oad.main()
+        self.assertEqual(self.mock_s.return_value.keepalive_timeout, 2.5)
+        self.assertEqual(self.mock_s.return_value.max_keepalive_requests, 20)
+
+    def test_max_message_size(self):
+        self.argv.append("--max-message-size=1024")
+        scripts.oad.main()
+        self.assertEqual(self.mock_s.return_value.max_message_size, 1024)
+
+    def test_slow_clients(self):
+        self.argv.extend(["--header-timeout=10", "--body-timeout=20",
+                          "--min-transfer-rate=512", "--max-connections=50"])
+        scripts.oad.main()
+        self.assertEqual(self.mock_s.return_value.header_timeout, 10)
+        self.assertEqual(self.mock_s.return_value.body_timeout, 20)
+        self.assertEqual(self.mock_s.return_value.min_transfer_rate, 512)
+        self.assertEqual(self.mock_s.return_value.max_connections, 50)
+
+    def test_slow_clients_default(self):
+        scripts.oad.main()
+        self.assertEqual(self.mock_s.return_value.header_timeout, 30)
+        self.assertEqual(self.mock_s.return_value.body_timeout, 60)
+        self.assertIsNone(self.mock_s.return_value.min_transfer_rate)
+        self.assertIsNone(self.mock_s.return_value.max_connections)
+
+    def test_log_queue(self):
+        self.argv.append("--log-queue-size=500")
+        scripts.oad.main()
+        self.mock_logging.assert_called_with("oa-logger", debug=False,
+                                             filepath="/var/log/oad.log",
+                                             queue_size=500)
+
+    def test_no_log_queue(self):
+        scripts.oad.main()
+        self.mock_logging.assert_called_with("oa-logger", debug=False,
+                                             filepath="/var/log/oad.log",
+                                             queue_size=None)
+
+    def test_threads(self):
+        self.argv.append("--threads=8")
+        mock_tps = patch("scripts.oad.oa.server.ThreadPoolServer").start()
+        scripts.oad.main()
+        mock_tps.assert_called_with(
+            ("0.0.0.0", 783), '/etc/mail/spamassassin',
+            '/etc/mail/spamassassin', paranoid=False,
+            ignore_unknown=True, threads=8
+        )
+        mock_tps.return_value.serve_forever.assert_called_with()
+        self.assertFalse(self.mock_s.called)
+
+    def test_result_cache(self):
+        self.argv.extend(["--result-cache-size=100", "--result-cache-ttl=60"])
+        scripts.oad.main()
+        cache = self.mock_s.return_value.result_cache
+        self.assertEqual(cache.max_size, 100)
+        self.assertEqual(cache.ttl, 60)
+        self.assertIsNone(cache.backend)
+
+    def test_result_cache_db(self):
+        self.argv.append("--result-cache-db=/var/lib/oa/results.db")
+        scripts.oad.main()
+        cache = self.mock_s.return_value.result_cache
+        self.assertEqual(cache.max_size, 1024)
+        self.assertEqual(cache.backend.path, "/var/lib/oa/results.db")
+
+    def test_near_duplicates(self):
+        self.argv.extend(["--near-duplicate-distance=3",
+                          "--near-duplicate-min-tokens=50"])
+        scripts.oad.main()
+        cache = self.mock_s.return_value.result_cache
+        self.assertEqual(cache.near_duplicates.max_distance, 3)
+        self.assertEqual(cache.near_duplicates.max_size, 1024)
+        self.assertEqual(cache.min_tokens, 50)
+
+    def test_shared_dns_cache(self):
+        self.argv.extend(["--prefork=6", "--shared-dns-cache=1024"])
+        scripts.oad.main()
+        server = self.mock_pfs.return_value
+        backend = server.set_dns_cache_backend.call_args[0][0]
+        self.assertEqual(backend.slots, 1024)
+
+    def test_no_shared_dns_cache(self):
+        scripts.oad.main()
+        self.assertFalse(self.mock_s.return_value.set_dns_cache_backend.called)
+
+    def test_no_result_cache(self):
+        self.mock_s.return_value.result_cache = None
+        scripts.oad.main()
+        self.assertIsNone(self.mock_s.return_value.result_cache)
+
+    def test_threads_admission(self):
+        self.argv.extend(["--threads=8", "--max-queue-size=64",
+                          "--max-queue-wait=2.5"])
+        mock_tps = patch("scripts.oad.oa.server.ThreadPoolServer").start()
+        scripts.oad.main()
+        self.assertEqual(mock_tps.return_value.max_queue_size, 64)
+        self.assertEqual(mock_tps.return_value.max_queue_wait, 2.5)
+
+    def check_error(self, *args):
+        self.argv.extend(args)
+        with patch("scripts.oad.argparse.ArgumentParser.error",
+                   side_effect=SystemExit) as mock_error:
+            self.assertRaises(SystemExit, scripts.oad.main)
+        self.assertTrue(mock_error.called)
+
+    def test_prefork_admission(self):
+        self.check_error("--prefork=4", "--max-queue-size=64")
+
+    def test_prefork_queue_wait(self):
+        self.check_error("--prefork=4", "--max-queue-wait=2")
+
+    def test_admission_single_process(self):
+        self.check_error("--max-queue-size=64")
+
+    def test_prefork_threads(self):
+        self.check_error("--prefork=4", "--threads=8")
+
+    def test_prefork_async(self):
+        self.check_error("--prefork=4", "--async")
+
+    def test_threads_async(self):
+        self.check_error("--threads=8", "--async")
+
+    @unittest.skipIf(sys.version_info < (3, 5), "Requires asyncio")
+    def test_async(self):
+        self.argv.extend(["--async", "--async-workers=8"])
+        mock_as = patch("oa.async_server.AsyncServer").start()
+        scripts.oad.main()
+        mock_as.assert_called_with(
+            ("0.0.0.0", 783), '/etc/mail/spamassassin',
+            '/etc/mail/spamassassin', paranoid=False,
+            ignore_unknown=True, max_workers=8
+        )
+        mock_as.return_value.serve_forever.assert_called_with()
+        self.assertFalse(self.mock_s.called)
+
 
 class TestAction(unittest.TestCase):
     def setUp(self):
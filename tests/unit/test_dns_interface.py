@@ -1,18 +1,32 @@
 """Tests for pad.dns_interface """
 
+import os
+import time
+import pickle
+import threading
 import logging
 import datetime
 import unittest
 import ipaddress
 
 try:
-    from unittest.mock import patch
+    from unittest.mock import patch, Mock
 except ImportError:
-    from mock import patch
+    from mock import patch, Mock
 
 from builtins import str
 
-from oa.dns_interface import DNSInterface
+import dns.name
+import dns.rrset
+import dns.message
+import dns.exception
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+
+import oa.metrics
+import oa.dns_interface
+from oa.dns_interface import DNSInterface, DNSCache, SharedDNSCache
 
 
 class TestDNSInterface(unittest.TestCase):
@@ -29,6 +43,12 @@ class TestDNSInterface(unittest.TestCase):
         patch.stopall()
         super(TestDNSInterface, self).tearDown()
 
+    def test_timeout(self):
+        self.dns.timeout = 0.5
+        self.dns.lifetime = 1.0
+        self.assertEqual(self.resolver.timeout, 0.5)
+        self.assertEqual(self.resolver.lifetime, 1.0)
+
     def test_test_interval_seconds(self):
         self.dns.test_interval="60s"
         self.assertEqual(self.dns.test_interval,
@@ -70,17 +90,94 @@ class TestDNSInterface(unittest.TestCase):
     def test_dns_available_test(self):
         patch("oa.dns_interface.DNSInterface._query").start()
         self.dns.available = "test"
-        self.assertTrue(self.dns.available)
+        self.assertTrue(self.dns.probe())
+        self.assertTrue(self.dns._available)
 
     def test_dns_available_test_fail(self):
         patch("oa.dns_interface.DNSInterface._query", return_value=[]).start()
         self.dns.available = "test"
-        self.assertFalse(self.dns.available)
+        self.assertFalse(self.dns.probe())
+        self.assertFalse(self.dns._available)
 
     def test_dns_available_test_custom_dns(self):
-        patch("oa.dns_interface.DNSInterface._query", return_value=[]).start()
+        query = patch("oa.dns_interface.DNSInterface._query",
+                      return_value=[]).start()
         self.dns.available = "test: example.com 1.example.com 2.example.com"
-        self.assertFalse(self.dns.available)
+        self.dns.probe()
+        self.assertFalse(self.dns._available)
+        self.assertEqual(
+            sorted(c[0][0] for c in query.call_args_list),
+            ["1.example.com", "2.example.com", "example.com"])
+
+    def test_dns_available_test_assumed(self):
+        """DNS is available until the first test is done."""
+        start = patch("oa.dns_interface.DNSInterface._start_probe").start()
+        self.dns.available = "test"
+        self.assertTrue(self.dns.available)
+        start.assert_called_with()
+
+    def test_dns_available_test_down_hysteresis(self):
+        query = patch("oa.dns_interface.DNSInterface._query").start()
+        self.dns.test_failures = 3
+        self.dns.available = "test"
+        self.dns.probe()
+        query.return_value = []
+        self.dns.probe()
+        self.dns.probe()
+        self.assertTrue(self.dns._available)
+        self.dns.probe()
+        self.assertFalse(self.dns._available)
+        self.assertEqual(oa.metrics.get("dns_available"), 0)
+
+    def test_dns_available_test_up_hysteresis(self):
+        query = patch("oa.dns_interface.DNSInterface._query",
+                      return_value=[]).start()
+        self.dns.test_successes = 2
+        self.dns.available = "test"
+        self.dns.probe()
+        query.return_value = ["127.0.0.1"]
+        self.dns.probe()
+        self.assertFalse(self.dns._available)
+        self.dns.probe()
+        self.assertTrue(self.dns._available)
+        self.assertEqual(oa.metrics.get("dns_available"), 1)
+
+    def test_dns_available_test_flapping(self):
+        """A single failed test doesn't mark DNS as unavailable."""
+        query = patch("oa.dns_interface.DNSInterface._query").start()
+        self.dns.available = "test"
+        self.dns.probe()
+        for result in ([], ["127.0.0.1"], [], [], ["127.0.0.1"]):
+            query.return_value = result
+            self.dns.probe()
+            self.assertTrue(self.dns._available)
+
+    def test_dns_available_test_background(self):
+        """The tests run in a background thread."""
+        tested = threading.Event()
+
+        def _query(qname, qtype):
+            tested.set()
+            return []
+
+        patch("oa.dns_interface.DNSInterface._query",
+              side_effect=_query).start()
+        self.dns.available = "test"
+        try:
+            self.assertTrue(self.dns.available)
+            self.assertTrue(tested.wait(5))
+            self.assertEqual(self.dns._probe_pid, os.getpid())
+        finally:
+            self.dns.available = "yes"
+        self.assertIsNone(self.dns._probe_pid)
+
+    def test_dns_available_pickle(self):
+        patch("oa.dns_interface.DNSInterface._start_probe").start()
+        self.dns.available = "test"
+        self.dns._probe_pid = os.getpid()
+        dns_interface = pickle.loads(pickle.dumps(self.dns))
+        self.assertIsNone(dns_interface._probe_pid)
+        self.assertTrue(dns_interface.test)
 
     def test_is_query_restricted_empty(self):
         """Test a domain that when no restrictions apply"""
@@ -137,6 +234,318 @@ class TestDNSInterface(unittest.TestCase):
     def test_query_error(self):
         pass
 
+    def test_query_async(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        pending = self.dns.query_async("example.com", "A")
+        self.assertEqual(pending.result(5), self.resolver.query.return_value)
+        self.assertTrue(pending.done())
+
+    def test_query_async_cached(self):
+        self.dns.cache.set("example.com", "A", ["127.0.0.2"], 60)
+        pending = self.dns.query_async("example.com", "A")
+        self.assertTrue(pending.done())
+        self.assertEqual(pending.result(), ["127.0.0.2"])
+        self.resolver.query.assert_not_called()
+
+    def test_query_async_restricted(self):
+        self.dns.query_restrictions = {"example.com": True}
+        pending = self.dns.query_async("example.com", "A")
+        self.assertEqual(pending.result(), [])
+        self.resolver.query.assert_not_called()
+
+    def test_query_async_error(self):
+        self.resolver.query.side_effect = dns.resolver.NXDOMAIN()
+        pending = self.dns.query_async("example.com", "A")
+        self.assertEqual(pending.result(5), [])
+
+    def test_pending_query_timeout(self):
+        pending = oa.dns_interface.PendingQuery("example.com", "A")
+        self.assertEqual(pending.result(0), [])
+        self.assertFalse(pending.done())
+
+    def test_query_budget(self):
+        """The query is done in this thread, in what is left of the
+        budget.
+        """
+        self.resolver.query.return_value.expiration = time.time() + 60
+        self.resolver.lifetime = 5.0
+        budget = oa.dns_interface.DNSBudget(2)
+        with patch("oa.dns_interface._query_pool") as pool:
+            result = self.dns.query("example.com", "A", budget=budget)
+        pool.submit.assert_not_called()
+        self.assertEqual(result, self.resolver.query.return_value)
+        lifetime = self.resolver.query.call_args[1]["lifetime"]
+        self.assertLessEqual(lifetime, 2)
+        self.assertFalse(budget.exhausted)
+
+    def test_query_budget_lifetime(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        self.resolver.lifetime = 1.0
+        budget = oa.dns_interface.DNSBudget(30)
+        self.dns.query("example.com", "A", budget=budget)
+        self.resolver.query.assert_called_with("example.com", "A",
+                                               lifetime=1.0)
+
+    def test_query_budget_abandoned(self):
+        self.resolver.lifetime = 5.0
+        budget = oa.dns_interface.DNSBudget(30)
+
+        def query(qname, qtype, lifetime):
+            budget.deadline = time.time() - 1
+            raise dns.exception.Timeout()
+        self.resolver.query.side_effect = query
+        self.assertEqual(self.dns.query("example.com", "A", budget=budget),
+                         [])
+        self.assertEqual(budget.skipped, 1)
+
+    def test_query_budget_spent(self):
+        budget = oa.dns_interface.DNSBudget(30)
+        budget.deadline = time.time() - 1
+        self.assertEqual(self.dns.query("example.com", "A", budget=budget),
+                         [])
+        self.resolver.query.assert_not_called()
+        self.assertEqual(budget.skipped, 1)
+
+    def test_query_budget_unlimited(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        budget = oa.dns_interface.DNSBudget()
+        self.dns.query("example.com", "A", budget=budget)
+        self.resolver.query.assert_called_with("example.com", "A")
+
+    def test_new_budget(self):
+        self.dns.message_budget = 10
+        budget = self.dns.new_budget()
+        self.assertAlmostEqual(budget.deadline, time.time() + 10, delta=1)
+
+    def test_budget_timeout(self):
+        budget = oa.dns_interface.DNSBudget(2)
+        self.assertLessEqual(budget.get_timeout(5), 2)
+        self.assertLessEqual(budget.get_timeout(), 2)
+        self.assertEqual(budget.get_timeout(1), 1)
+
+    def test_budget_timeout_unlimited(self):
+        budget = oa.dns_interface.DNSBudget()
+        self.assertEqual(budget.get_timeout(5), 5)
+        self.assertIsNone(budget.get_timeout())
+
+    def test_budget_wait_spent(self):
+        budget = oa.dns_interface.DNSBudget(30)
+        budget.deadline = time.time() - 1
+        pending = oa.dns_interface.PendingQuery("example.com", "A")
+        self.assertEqual(budget.wait(pending, 5), [])
+        self.assertTrue(budget.exhausted)
+
     def test_reverse_ip(self):
         result = self.dns.reverse_ip(ipaddress.ip_address(str("127.0.0.1")))
         self.assertEqual("1.0.0.127", result)
+
+    def test_reverse_ipv6(self):
+        result = self.dns.reverse_ip(ipaddress.ip_address(str("2001:db8::1")))
+        self.assertEqual("1." + "0." * 23 + "8.b.d.0.1.0.0.2", result)
+
+    def test_reverse_ipv4_mapped(self):
+        result = self.dns.reverse_ip(
+            ipaddress.ip_address(str("::ffff:1.2.3.4")))
+        self.assertEqual("4.3.2.1", result)
+
+    def test_query_cached(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        result = self.dns.query("example.com", "A")
+        self.assertEqual(self.dns.query("example.com", "A"), result)
+        self.resolver.query.assert_called_once_with("example.com", "A")
+        self.assertEqual(self.dns.cache.stats(),
+                         {"hits": 1, "shared_hits": 0, "misses": 1,
+                          "evictions": 0, "size": 1})
+
+    def test_query_cached_expired(self):
+        self.resolver.query.return_value.expiration = time.time() - 1
+        self.dns.query("example.com", "A")
+        self.dns.query("example.com", "A")
+        self.assertEqual(self.resolver.query.call_count, 2)
+
+    def test_query_cached_max_ttl(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        self.dns.cache.max_ttl = 0
+        self.dns.query("example.com", "A")
+        self.dns.query("example.com", "A")
+        self.assertEqual(self.resolver.query.call_count, 2)
+
+    def test_query_cached_qtype(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        self.dns.query("example.com", "A")
+        self.dns.query("example.com", "TXT")
+        self.assertEqual(self.resolver.query.call_count, 2)
+
+    def test_query_cached_negative(self):
+        self.resolver.query.side_effect = dns.resolver.NXDOMAIN()
+        self.assertEqual(self.dns.query("example.com", "A"), [])
+        self.assertEqual(self.dns.query("example.com", "A"), [])
+        self.resolver.query.assert_called_once_with("example.com", "A")
+
+    def test_query_cached_negative_soa_ttl(self):
+        response = Mock(authority=[Mock(rdtype=dns.rdatatype.SOA, ttl=30)])
+        response.authority[0].__getitem__ = Mock(
+            return_value=Mock(minimum=10))
+        error = dns.resolver.NoAnswer(response=response)
+        self.assertEqual(self.dns.cache._negative_ttl(error), 10)
+
+    def test_query_timeout_not_cached(self):
+        self.resolver.query.side_effect = dns.exception.Timeout()
+        self.dns.query("example.com", "A")
+        self.dns.query("example.com", "A")
+        self.assertEqual(self.resolver.query.call_count, 2)
+
+    def test_query_cache_evictions(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        self.dns.cache.max_size = 1
+        self.dns.query("1.example.com", "A")
+        self.dns.query("2.example.com", "A")
+        self.dns.query("1.example.com", "A")
+        self.assertEqual(self.resolver.query.call_count, 3)
+        self.assertEqual(self.dns.cache.stats()["evictions"], 2)
+
+    def test_query_cache_disabled(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        self.dns.cache.max_size = 0
+        self.dns.query("example.com", "A")
+        self.dns.query("example.com", "A")
+        self.assertEqual(self.resolver.query.call_count, 2)
+
+    def test_add_query_restriction_invalidates_cache(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        self.dns.query("example.com", "A")
+        self.dns.add_query_restriction("example.net", True)
+        self.assertEqual(len(self.dns.cache), 0)
+        self.assertEqual(self.dns.query("example.net", "A"), [])
+
+    def test_available_invalidates_cache(self):
+        self.resolver.query.return_value.expiration = time.time() + 60
+        self.dns.query("example.com", "A")
+        self.dns.available = "yes"
+        self.assertEqual(len(self.dns.cache), 0)
+
+    def test_cache_pickle(self):
+        self.dns.cache.set("example.com", "A", [], 60)
+        cache = pickle.loads(pickle.dumps(self.dns.cache))
+        self.assertEqual(len(cache), 0)
+        cache.set("example.com", "A", [], 60)
+        self.assertEqual(cache.get("example.com", "A"), [])
+
+
+class TestSharedDNSCache(unittest.TestCase):
+    """Test the DNS cache shared by the workers."""
+
+    def setUp(self):
+        super(TestSharedDNSCache, self).setUp()
+        self.shared = SharedDNSCache(slots=8, slot_size=128, ways=2)
+
+    def test_get_missing(self):
+        self.assertIsNone(self.shared.get("example.com/A"))
+
+    def test_set_get(self):
+        expires = time.time() + 60
+        self.shared.set("example.com/A", b"data", expires)
+        self.assertEqual(self.shared.get("example.com/A"), (expires, b"data"))
+
+    def test_expired(self):
+        self.shared.set("example.com/A", b"data", time.time() - 1)
+        self.assertIsNone(self.shared.get("example.com/A"))
+
+    def test_too_large(self):
+        self.shared.set("example.com/A", b"x" * 128, time.time() + 60)
+        self.assertIsNone(self.shared.get("example.com/A"))
+
+    def test_replace(self):
+        expires = time.time() + 60
+        self.shared.set("example.com/A", b"old", expires)
+        self.shared.set("example.com/A", b"new", expires)
+        self.assertEqual(self.shared.get("example.com/A"), (expires, b"new"))
+
+    def test_replaces_first_expiring(self):
+        now = time.time()
+        with patch.object(SharedDNSCache, "_hash", side_effect=[8, 16, 24,
+                                                                 8, 16, 24]):
+            self.shared.set("1", b"1", now + 10)
+            self.shared.set("2", b"2", now + 60)
+            self.shared.set("3", b"3", now + 60)
+            self.assertIsNone(self.shared.get("1"))
+            self.assertEqual(self.shared.get("2"), (now + 60, b"2"))
+            self.assertEqual(self.shared.get("3"), (now + 60, b"3"))
+
+    def test_corrupted(self):
+        self.shared.set("example.com/A", b"data", time.time() + 60)
+        for slot in range(self.shared.slots):
+            start = slot * self.shared.slot_size + self.shared._header.size
+            self.shared._map[start:start + 1] = b"X"
+        self.assertIsNone(self.shared.get("example.com/A"))
+
+    def test_clear(self):
+        self.shared.set("example.com/A", b"data", time.time() + 60)
+        self.shared.clear()
+        self.assertIsNone(self.shared.get("example.com/A"))
+
+    def test_shared_with_child(self):
+        pid = os.fork()
+        if not pid:
+            self.shared.set("example.com/A", b"child", time.time() + 60)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.shared.get("example.com/A")[1], b"child")
+
+
+class TestDNSCacheBackend(unittest.TestCase):
+    """Test the DNS cache with a shared backend."""
+
+    def setUp(self):
+        super(TestDNSCacheBackend, self).setUp()
+        self.backend = SharedDNSCache(slots=16)
+        self.cache = DNSCache()
+        self.cache.backend = self.backend
+
+    def get_answer(self, qname="example.com", ttl=60):
+        query = dns.message.make_query(qname, "A")
+        response = dns.message.make_response(query)
+        response.answer.append(dns.rrset.from_text(
+            qname + ".", ttl, "IN", "A", "127.0.0.2"))
+        # Like a response received from the resolver.
+        response = dns.message.from_wire(response.to_wire())
+        return dns.resolver.Answer(dns.name.from_text(qname),
+                                   dns.rdatatype.A, dns.rdataclass.IN,
+                                   response)
+
+    def test_shared_answer(self):
+        self.cache.set_answer("example.com", "A", self.get_answer())
+        other = DNSCache()
+        other.backend = self.backend
+        answer = other.get("example.com", "A")
+        self.assertEqual([str(rdata) for rdata in answer], ["127.0.0.2"])
+        self.assertEqual(other.stats()["shared_hits"], 1)
+        # Now also kept in this cache.
+        other.get("example.com", "A")
+        self.assertEqual(other.stats()["hits"], 1)
+
+    def test_shared_expiration(self):
+        self.cache.set_answer("example.com", "A", self.get_answer(ttl=60))
+        other = DNSCache()
+        other.backend = self.backend
+        answer = other.get("example.com", "A")
+        self.assertLessEqual(answer.expiration, time.time() + 60)
+
+    def test_shared_negative(self):
+        self.cache.set_negative("example.com", "A", dns.resolver.NXDOMAIN())
+        other = DNSCache()
+        other.backend = self.backend
+        self.assertEqual(other.get("example.com", "A"), [])
+
+    def test_shared_invalid(self):
+        self.backend.set("example.com/A", b"invalid", time.time() + 60)
+        self.assertIsNone(self.cache.get("example.com", "A"))
+
+    def test_clear(self):
+        self.cache.set_answer("example.com", "A", self.get_answer())
+        self.cache.clear()
+        self.assertIsNone(self.backend.get("example.com/A"))
+
+    def test_pickle(self):
+        cache = pickle.loads(pickle.dumps(self.cache))
+        self.assertIsNone(cache.backend)
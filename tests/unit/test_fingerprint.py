@@ -0,0 +1,151 @@
+"""Tests for oa.fingerprint"""
+
+import unittest
+
+try:
+    from unittest.mock import patch, Mock
+except ImportError:
+    from mock import patch, Mock
+
+import oa.fingerprint
+
+TEXT = ("Dear %s, we are happy to announce that our spring collection is "
+        "now available in all the stores. Visit our website to see the "
+        "new models, get a discount of twenty percent on your next order "
+        "and free delivery for all the orders placed before the end of "
+        "the month. Click here http://example.com/track/%s to unsubscribe.")
+
+
+class TestTokens(unittest.TestCase):
+    def test_tokens(self):
+        self.assertEqual(list(oa.fingerprint.body_tokens(
+            "Hello, World! It's a 'test'... ok"
+        )), ["hello", "world!", "it's", "test"])
+
+    def test_long_tokens(self):
+        self.assertEqual(list(oa.fingerprint.body_tokens(
+            "abcdefghijklmnopqrstuvwxyz"
+        )), ["sk:abcdefg"])
+
+
+class TestSimhash(unittest.TestCase):
+    def get_fingerprint(self, name, track):
+        msg = Mock(text=TEXT % (name, track))
+        return oa.fingerprint.message_fingerprint(msg)
+
+    def test_same(self):
+        self.assertEqual(self.get_fingerprint("Alex", "a1b2c3"),
+                         self.get_fingerprint("Alex", "a1b2c3"))
+
+    def test_similar(self):
+        fingerprint1 = self.get_fingerprint("Alex", "a1b2c3")
+        fingerprint2 = self.get_fingerprint("Sam", "x9y8z7")
+        self.assertNotEqual(fingerprint1, fingerprint2)
+        self.assertLessEqual(
+            oa.fingerprint.distance(fingerprint1, fingerprint2), 8
+        )
+
+    def test_different(self):
+        fingerprint1 = self.get_fingerprint("Alex", "a1b2c3")
+        msg = Mock(text="The quarterly report shows that the revenue of "
+                        "the company grew in every region, and the board "
+                        "approved the budget for the new offices that will "
+                        "open next year in three cities across the country.")
+        fingerprint2 = oa.fingerprint.message_fingerprint(msg)
+        self.assertGreater(
+            oa.fingerprint.distance(fingerprint1, fingerprint2), 8
+        )
+
+    def test_too_short(self):
+        msg = Mock(text="Short message")
+        self.assertIsNone(oa.fingerprint.message_fingerprint(msg))
+
+    def test_distance(self):
+        self.assertEqual(oa.fingerprint.distance(0b1011, 0b0110), 3)
+
+
+class TestNearDuplicateIndex(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.mock_time = patch("oa.fingerprint.time.time",
+                               return_value=1000).start()
+        self.index = oa.fingerprint.NearDuplicateIndex(max_size=2,
+                                                       max_distance=3,
+                                                       ttl=60)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def test_find(self):
+        self.index.add(0xff00ff00ff00ff00, "value")
+        self.assertEqual(self.index.find(0xff00ff00ff00ff07),
+                         ("value", 3))
+
+    def test_find_closest(self):
+        self.index.add(0xff00ff00ff00ff03, "far")
+        self.index.add(0xff00ff00ff00ff01, "close")
+        self.assertEqual(self.index.find(0xff00ff00ff00ff00),
+                         ("close", 1))
+
+    def test_find_accept(self):
+        self.index.add(0xff00ff00ff00ff01, "close")
+        self.index.add(0xff00ff00ff00ff03, "far")
+        self.assertEqual(self.index.find(0xff00ff00ff00ff00,
+                                         lambda value: value == "far"),
+                         ("far", 2))
+        self.assertIsNone(self.index.find(0xff00ff00ff00ff00,
+                                          lambda value: False))
+
+    def test_too_far(self):
+        self.index.add(0xff00ff00ff00ff00, "value")
+        self.assertIsNone(self.index.find(0xff00ff00ff00ff0f))
+
+    def test_different_bands(self):
+        """The differences are spread over all the bands."""
+        self.index.add(0, "value")
+        fingerprint = 1 | 1 << 16 | 1 << 32 | 1 << 48
+        self.assertIsNone(self.index.find(fingerprint))
+        self.assertEqual(self.index.find(fingerprint & ~1), ("value", 3))
+
+    def test_expired(self):
+        self.index.add(0xff00, "value")
+        self.mock_time.return_value = 1061
+        self.assertIsNone(self.index.find(0xff00))
+        self.assertEqual(len(self.index), 0)
+
+    def test_max_size(self):
+        self.index.add(0xff00, "value1")
+        self.index.add(0xff00 << 32, "value2")
+        self.index.add(0xff00 << 48, "value3")
+        self.assertEqual(len(self.index), 2)
+        self.assertIsNone(self.index.find(0xff00))
+        self.assertEqual(self.index.find(0xff00 << 48), ("value3", 0))
+
+    def test_replace(self):
+        self.index.add(0xff00, "value1")
+        self.index.add(0xff00, "value2")
+        self.assertEqual(len(self.index), 1)
+        self.assertEqual(self.index.find(0xff00), ("value2", 0))
+
+    def test_clear(self):
+        self.index.add(0xff00, "value")
+        self.index.clear()
+        self.assertIsNone(self.index.find(0xff00))
+
+    def test_invalid_distance(self):
+        self.assertRaises(ValueError, oa.fingerprint.NearDuplicateIndex,
+                          max_distance=64)
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestTokens, "test"))
+    test_suite.addTest(unittest.makeSuite(TestSimhash, "test"))
+    test_suite.addTest(unittest.makeSuite(TestNearDuplicateIndex, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
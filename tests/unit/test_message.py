@@ -13,6 +13,7 @@ except ImportError:
     from mock import patch, Mock, call, MagicMock
 
 import oa.message
+import oa.dns_interface
 import oa.config
 
 HTML_TEXT = """<html><head><title>Email spam</title></head><body>
@@ -103,6 +104,12 @@ class TestParseMessage(unittest.TestCase):
         msg = oa.message.Message(self.mock_ctxt, "")
         self.assertEqual(msg.raw_text, payload)
 
+    def test_local_only(self):
+        msg = oa.message.Message(self.mock_ctxt, "")
+        self.assertFalse(msg.local_only)
+        msg = oa.message.Message(self.mock_ctxt, "", local_only=True)
+        self.assertTrue(msg.local_only)
+
     def test_text_payload(self):
         payload = "text payload 1\ntext payload 2"
         self.parts.append((payload, self.plain_part))
@@ -181,6 +188,19 @@ class TestMessageMisc(unittest.TestCase):
         msg_id = "%s@sa_generated" % hashlib.sha1(combined.encode('utf-8')).hexdigest()
         self.assertEqual(msg_id, found_id)
 
+    def test_bytes_utf8(self):
+        msg = oa.message.Message(MagicMock(), (
+            u"Subject: caf\u00e9\n\nCaf\u00e9".encode("utf-8")))
+        self.assertEqual(msg.raw_msg, u"Subject: caf\u00e9\n\nCaf\u00e9")
+
+    def test_bytes_other_charset(self):
+        """No byte is lost from messages that aren't UTF-8."""
+        msg = oa.message.Message(MagicMock(), (
+            b"Subject: test\n"
+            b"Content-Type: text/plain; charset=iso-8859-1\n\n"
+            b"\xe9t\xe9"))
+        self.assertEqual(msg.text, u"test \u00e9t\u00e9")
+
     def test_receive_date(self):
         """Test the receive_date method."""
         msg = ("""Received: from server6.seinternal.com ([178.63.74.9])\r
@@ -191,6 +211,24 @@ class TestMessageMisc(unittest.TestCase):
         result = oa.message.Message(MagicMock(), msg).receive_date
         self.assertEqual(expected, result)
 
+    def test_lookup_names(self):
+        """The names the DNS lookups need are computed once parsed."""
+        ctxt = MagicMock()
+        ctxt.dns.reverse_ip = oa.dns_interface.DNSInterface.reverse_ip
+        ctxt.conf = {"originating_ip_headers": [],
+                     "always_trust_envelope_sender": False,
+                     "envelope_sender_header": []}
+        msg = oa.message.Message(ctxt, (
+            "Received: from relay.example.net ([192.0.2.1])\n"
+            "\t(envelope-from <bounce@sender.example.com>)\n"
+            "\tby mx.example.com; Mon, 09 May 2016 14:00:25 +0200\n"
+            "From: Alice <alice@from.example.com>\n\nHello world!"))
+        self.assertEqual([str(ip) for ip in msg.untrusted_ips],
+                         ["192.0.2.1"])
+        self.assertEqual(msg.reversed_untrusted_ips, ["1.2.0.192"])
+        self.assertEqual(msg.sender_domain, "sender.example.com")
+        self.assertEqual(msg.from_domains, ["from.example.com"])
+
 
 class TestIterPartsMessage(unittest.TestCase):
     """Test the Message._iter_parts method."""
@@ -0,0 +1,66 @@
+"""Tests for oa.metrics"""
+
+import unittest
+import threading
+
+import oa.metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        oa.metrics.reset()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        oa.metrics.reset()
+
+    def test_incr(self):
+        oa.metrics.incr("timeouts_body")
+        oa.metrics.incr("timeouts_body", 2)
+        self.assertEqual(oa.metrics.get("timeouts_body"), 3)
+
+    def test_get_default(self):
+        self.assertEqual(oa.metrics.get("timeouts_body"), 0)
+        self.assertIsNone(oa.metrics.get("timeouts_body", None))
+
+    def test_gauge(self):
+        oa.metrics.set_gauge("connections", 5)
+        oa.metrics.add_gauge("connections", -2)
+        self.assertEqual(oa.metrics.get("connections"), 3)
+
+    def test_snapshot(self):
+        oa.metrics.incr("timeouts_body")
+        oa.metrics.set_gauge("connections", 5)
+        self.assertEqual(oa.metrics.snapshot(),
+                         {"timeouts_body": 1, "connections": 5})
+        self.assertEqual(oa.metrics.get_counters(), {"timeouts_body": 1})
+
+    def test_reset(self):
+        oa.metrics.incr("timeouts_body")
+        oa.metrics.set_gauge("connections", 5)
+        oa.metrics.reset()
+        self.assertEqual(oa.metrics.snapshot(), {})
+
+    def test_threads(self):
+        def incr():
+            for dummy in range(1000):
+                oa.metrics.incr("requests")
+
+        threads = [threading.Thread(target=incr) for dummy in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(oa.metrics.get("requests"), 4000)
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestMetrics, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,124 @@
+"""Tests for the near_duplicates script"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import patch, Mock
+except ImportError:
+    from mock import patch, Mock
+
+import scripts.near_duplicates
+
+
+class TestEvaluate(unittest.TestCase):
+    def test_evaluate(self):
+        samples = [
+            ("spam", 0xff00, frozenset(["RCVD_IN_TEST"])),
+            ("spam", 0xff01, frozenset(["RCVD_IN_TEST"])),
+            ("ham", 0xff03, frozenset()),
+            ("ham", None, None),
+            ("ham", 0xff00 << 32, frozenset()),
+        ]
+        stats = scripts.near_duplicates.evaluate(samples, 2)
+        self.assertEqual(stats, {
+            "messages": 5,
+            "fingerprinted": 4,
+            "near_hits": 2,
+            "label_mismatches": 1,
+            "network_mismatches": 1,
+        })
+
+    def test_evaluate_exact(self):
+        samples = [
+            ("spam", 0xff00, None),
+            ("spam", 0xff01, None),
+            (None, 0xff00, None),
+        ]
+        stats = scripts.near_duplicates.evaluate(samples, 0)
+        self.assertEqual(stats["near_hits"], 1)
+        self.assertEqual(stats["label_mismatches"], 0)
+
+    def test_evaluate_empty(self):
+        stats = scripts.near_duplicates.evaluate([], 3)
+        self.assertEqual(stats["near_hits"], 0)
+
+
+class TestSamples(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.mock_msg = patch("scripts.near_duplicates."
+                              "oa.message.Message").start()
+        self.mock_fingerprint = patch(
+            "scripts.near_duplicates.oa.fingerprint.message_fingerprint",
+            return_value=0xff00
+        ).start()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+        patch.stopall()
+
+    def write(self, name, content):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "w") as msgf:
+            msgf.write(content)
+        return path
+
+    def test_iter_paths(self):
+        path2 = self.write("2", "")
+        path1 = self.write("1", "")
+        self.assertEqual(
+            list(scripts.near_duplicates.iter_paths([self.tmpdir, path2])),
+            [path1, path2, path2]
+        )
+
+    def test_get_sample(self):
+        path = self.write("1", "Subject: test\n\nTest")
+        ruleset = Mock()
+        sample = scripts.near_duplicates.get_sample(ruleset, path, "spam", 20)
+        self.assertEqual(sample, ("spam", 0xff00, None))
+        self.mock_msg.assert_called_with(ruleset.ctxt,
+                                         "Subject: test\n\nTest")
+        self.mock_fingerprint.assert_called_with(self.mock_msg.return_value,
+                                                 20)
+        self.assertFalse(ruleset.match.called)
+
+    def test_get_sample_match(self):
+        path = self.write("1", "Subject: test\n\nTest")
+        ruleset = Mock(checked={
+            "RCVD_IN_TEST": Mock(tflags=["net"]),
+            "RCVD_IN_OTHER": Mock(tflags=["net"]),
+            "TEST_RULE": Mock(tflags=None),
+        })
+        self.mock_msg.return_value.rules_checked = {
+            "RCVD_IN_TEST": True, "RCVD_IN_OTHER": False, "TEST_RULE": True
+        }
+        sample = scripts.near_duplicates.get_sample(ruleset, path, None, 20,
+                                                    match=True)
+        self.assertEqual(sample, (None, 0xff00, frozenset(["RCVD_IN_TEST"])))
+
+    def test_parse_arguments(self):
+        options = scripts.near_duplicates.parse_arguments([
+            "--siteconfigpath", ".", "--configpath", ".", "--spam", "spam/",
+            "--ham", "ham/", "--ham", "ham2/", "other/", "-d", "2", "4"
+        ])
+        self.assertEqual(options.spam, ["spam/"])
+        self.assertEqual(options.ham, ["ham/", "ham2/"])
+        self.assertEqual(options.distances, [2, 4])
+        self.assertEqual(options.messages, ["other/"])
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestEvaluate, "test"))
+    test_suite.addTest(unittest.makeSuite(TestSamples, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
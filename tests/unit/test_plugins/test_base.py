@@ -41,6 +41,16 @@ class TestBasePlugin(unittest.TestCase):
         self.mock_ctxt.set_plugin_data.assert_called_with("BasePlugin",
                                                           "test_bool", False)
 
+    def test_init_options_defaults_copied(self):
+        """The list defaults aren't shared between the instances."""
+        default = []
+        self.options["test_append"] = ("append", default)
+
+        oa.plugins.base.BasePlugin(self.mock_ctxt)
+        value = self.mock_ctxt.set_plugin_data.call_args[0][2]
+        self.assertEqual(value, [])
+        self.assertIsNot(value, default)
+
     def test_set_global(self):
         plugin = oa.plugins.base.BasePlugin(self.mock_ctxt)
 
@@ -6,6 +6,8 @@ except ImportError:
     from mock import patch, Mock, MagicMock, call
 
 import dkim
+import dns.rrset
+import dns.resolver
 
 import oa.plugins.dkim
 
@@ -23,13 +25,14 @@ class TestGetHeader(unittest.TestCase):
         )
         self.mock_msg = MagicMock(**{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
-            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.setdefault(k, v),
+            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.__setitem__(k, v),
         })
 
         self.mock_addr_header = patch(
             "oa.message.Message.get_all_addr_header").start()
 
         self.plug = oa.plugins.dkim.DKIMPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
@@ -104,13 +107,14 @@ class TestGetTxt(unittest.TestCase):
         )
         self.mock_msg = MagicMock(**{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
-            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.setdefault(k, v),
+            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.__setitem__(k, v),
         })
 
         self.mock_get_txt_dnspython = patch(
             "oa.plugins.dkim.DKIMPlugin.get_txt_dnspython").start()
 
         self.plug = oa.plugins.dkim.DKIMPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
@@ -129,6 +133,42 @@ class TestGetTxt(unittest.TestCase):
         result = self.plug.get_txt(b'20120113._domainkey.gmail.com.')
         self.assertEqual(result, txt.encode('utf-8'))
 
+    def test_get_txt_budget(self):
+        budget = Mock()
+        self.mock_get_txt_dnspython.return_value = None
+        self.plug.get_txt(b'20120113._domainkey.gmail.com.', budget)
+        self.mock_get_txt_dnspython.assert_called_with(
+            '20120113._domainkey.gmail.com.', budget)
+
+
+class TestGetTxtDnspython(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.mock_ctxt = MagicMock()
+        self.plug = oa.plugins.dkim.DKIMPlugin(self.mock_ctxt)
+
+    def test_get_txt_dnspython(self):
+        rrset = dns.rrset.from_text("sel._domainkey.example.com.", 300, "IN",
+                                    "TXT", '"v=DKIM1; " "p=abc"')
+        self.mock_ctxt.dns.query.return_value.response.answer = [rrset]
+        result = self.plug.get_txt_dnspython("sel._domainkey.example.com.")
+        self.assertEqual(result, "v=DKIM1; p=abc")
+
+    def test_get_txt_dnspython_unavailable(self):
+        self.mock_ctxt.dns.query.return_value = []
+        result = self.plug.get_txt_dnspython("sel._domainkey.example.com.")
+        self.assertIsNone(result)
+
+    def test_get_txt_dnspython_none(self):
+        self.mock_ctxt.dns.query.return_value = None
+        result = self.plug.get_txt_dnspython("sel._domainkey.example.com.")
+        self.assertIsNone(result)
+
+    def test_get_txt_dnspython_nxdomain(self):
+        self.mock_ctxt.dns.query.side_effect = dns.resolver.NXDOMAIN
+        result = self.plug.get_txt_dnspython("sel._domainkey.example.com.")
+        self.assertIsNone(result)
+
 
 class TestGetAuthors(unittest.TestCase):
     def setUp(self):
@@ -143,13 +183,14 @@ class TestGetAuthors(unittest.TestCase):
         )
         self.mock_msg = MagicMock(**{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
-            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.setdefault(k, v),
+            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.__setitem__(k, v),
         })
 
         self.mock_get_addr_header = patch(
             "oa.message.Message.get_addr_header").start()
 
         self.plug = oa.plugins.dkim.DKIMPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
@@ -173,7 +214,7 @@ class TestCheckDKIM(unittest.TestCase):
         )
         self.mock_msg = MagicMock(**{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
-            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.setdefault(k, v),
+            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.__setitem__(k, v),
         })
 
         self.mock_get_authors = patch(
@@ -186,185 +227,195 @@ class TestCheckDKIM(unittest.TestCase):
             "oa.plugins.dkim.DKIMPlugin.check_dkim_signature").start()
 
         self.plug = oa.plugins.dkim.DKIMPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
         patch.stopall()
 
+    def test_check_start_resets_message_state(self):
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_valid"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.plug.check_start(self.mock_msg)
+        self.assertEqual((self.msg_data["dkim_checked_signature"],
+                          self.msg_data["dkim_valid"],
+                          self.msg_data["author_domains"]), (0, 0, []))
+
     def test_check_dkim_adsp_all(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b"example.com": "all"}
         result = self.plug.check_dkim_adsp(self.mock_msg, "A")
         self.assertTrue(result)
 
     def test_check_dkim_adsp_discardable(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b"example.com": ""}
         result = self.plug.check_dkim_adsp(self.mock_msg, "D")
         self.assertTrue(result)
 
     def test_check_dkim_adsp_custom_low(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b"example.com": "custom_low"}
         result = self.plug.check_dkim_adsp(self.mock_msg, "1")
         self.assertTrue(result)
 
     def test_check_dkim_adsp_nxdomain(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b"example.com": "all"}
         result = self.plug.check_dkim_adsp(self.mock_msg, "*", "example.com")
         self.assertTrue(result)
 
     def test_check_dkim_adsp_false(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b"example.com": "all"}
         result = self.plug.check_dkim_adsp(self.mock_msg, "*", "exam.com")
         self.assertFalse(result)
 
     def test_check_dkim_adsp_valid_signature(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_valid = 1
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_valid"] = 1
         result = self.plug.check_dkim_adsp(self.mock_msg, "*", "exam.com")
         self.assertFalse(result)
 
     def test_check_dkim_adsp_no_signature(self):
-        self.plug.dkim_checked_signature = 0
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = None
+        self.msg_data["dkim_checked_signature"] = 0
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = None
         self.mock_parse_input.return_value = {b"example.com": "all"}
         self.mock_check_signature.return_value = True
         result = self.plug.check_dkim_adsp(self.mock_msg, "*", "example.com")
         self.assertTrue(result)
 
     def test_check_dkim_signed_false(self):
-        self.plug.dkim_checked_signature = 0
-        self.plug.dkim_signed = 0
+        self.msg_data["dkim_checked_signature"] = 0
+        self.msg_data["dkim_signed"] = 0
         result = self.plug.check_dkim_signed(self.mock_msg)
         self.assertFalse(result)
 
     def test_check_dkim_signed_no_acceptable_domains(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_signed = 1
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_signed"] = 1
         result = self.plug.check_dkim_signed(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_dkim_signed_true(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_signed = 1
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_signed"] = 1
         self.mock_check_signed_by.return_value = True
         result = self.plug.check_dkim_signed(self.mock_msg, 'gmail.com')
         self.assertTrue(result)
 
     def test_check_dkim_valid_true(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_valid = 1
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_valid"] = 1
         self.mock_check_signed_by.return_value = True
         result = self.plug.check_dkim_valid(self.mock_msg, 'gmail.com')
         self.assertTrue(result)
 
     def test_check_dkim_valid_no_acceptable_domains(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_valid = 1
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_valid"] = 1
         result = self.plug.check_dkim_valid(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_dkim_valid_false(self):
-        self.plug.dkim_checked_signature = 0
-        self.plug.dkim_valid = 0
+        self.msg_data["dkim_checked_signature"] = 0
+        self.msg_data["dkim_valid"] = 0
         result = self.plug.check_dkim_valid(self.mock_msg, 'gmail.com')
         self.assertFalse(result)
 
     def test_check_dkim_valid_author_sig_true(self):
-        self.plug.dkim_checked_signature = 0
-        self.plug.dkim_has_valid_author_sig = 1
+        self.msg_data["dkim_checked_signature"] = 0
+        self.msg_data["dkim_has_valid_author_sig"] = 1
         self.mock_check_signed_by.return_value = True
         result = self.plug.check_dkim_valid_author_sig(self.mock_msg, 'gmail.com')
         self.assertTrue(result)
 
     def test_check_dkim_valid_author_sig_no_acceptable_domains(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_has_valid_author_sig = 1
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_has_valid_author_sig"] = 1
         result = self.plug.check_dkim_valid_author_sig(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_dkim_valid_author_sig_false(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_has_valid_author_sig = 0
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_has_valid_author_sig"] = 0
         result = self.plug.check_dkim_valid_author_sig(self.mock_msg, 'gmail.com')
         self.assertFalse(result)
 
     def test_check_dkim_signature_dependable(self):
-        self.plug.dkim_checked_signature = 0
-        self.plug.dkim_signatures_dependable = 1
+        self.msg_data["dkim_checked_signature"] = 0
+        self.msg_data["dkim_signatures_dependable"] = 1
         result = self.plug.check_dkim_dependable(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_whitelist_from(self):
-        self.plug.dkim_checked_signature = 0
-        self.plug.dkim_valid = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 0
+        self.msg_data["dkim_valid"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b"test@example.com":
                                                   "example.com"}
         result = self.plug.check_for_dkim_whitelist_from(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_whitelist_from_no_address(self):
-        self.plug.dkim_checked_signature = 0
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = []
+        self.msg_data["dkim_checked_signature"] = 0
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = []
         self.mock_parse_input.return_value = {b"test@example.com":
                                                   "example.com"}
         result = self.plug.check_for_dkim_whitelist_from(self.mock_msg)
         self.assertFalse(result)
 
     def test_check_whitelist_from_false(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b"test@examp.com": "example.com"}
         result = self.plug.check_for_dkim_whitelist_from(self.mock_msg)
         self.assertFalse(result)
 
     def test_check_def_whitelist_from(self):
-        self.plug.dkim_checked_signature = 0
-        self.plug.dkim_valid = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 0
+        self.msg_data["dkim_valid"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b".*@example.com": "example.com"}
         result = self.plug.check_for_def_dkim_whitelist_from(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_def_whitelist_from_false(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_valid = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_valid"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b".*@exampl.com": "example.com"}
         result = self.plug.check_for_def_dkim_whitelist_from(self.mock_msg)
         self.assertFalse(result)
 
     def test_check_def_whitelist_from_invalid_signature(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_valid = 0
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_valid"] = 0
         result = self.plug.check_for_def_dkim_whitelist_from(self.mock_msg)
         self.assertFalse(result)
 
     def test_check_def_whitelist_from_no_domain(self):
-        self.plug.dkim_checked_signature = 1
-        self.plug.dkim_valid = 1
-        self.plug.author_domains = [b"example.com"]
-        self.plug.author_addresses = ["test@example.com"]
+        self.msg_data["dkim_checked_signature"] = 1
+        self.msg_data["dkim_valid"] = 1
+        self.msg_data["author_domains"] = [b"example.com"]
+        self.msg_data["author_addresses"] = ["test@example.com"]
         self.mock_parse_input.return_value = {b".*@example.com": ""}
         result = self.plug.check_for_def_dkim_whitelist_from(self.mock_msg)
         self.assertTrue(result)
@@ -383,7 +434,7 @@ class TestCheckSignature(unittest.TestCase):
         )
         self.mock_msg = MagicMock(**{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
-            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.setdefault(k, v),
+            "set_plugin_data.side_effect": lambda p, k, v: self.msg_data.__setitem__(k, v),
         })
 
         self.mock_get_authors = patch(
@@ -396,6 +447,7 @@ class TestCheckSignature(unittest.TestCase):
             "dkim.validate_signature_fields").start()
 
         self.plug = oa.plugins.dkim.DKIMPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
@@ -416,8 +468,8 @@ class TestCheckSignature(unittest.TestCase):
                                   b'TMoOYbv/exIF/VIiC9IXiCFmFY0NVCbqi1ksbjt/0cp+S1NeEl95d2FkAkOUPsCu9kto\n         '
                                   b'eriiEP6KqssKrmmX4XC2ovcTg9fxJZeS2VsgBOT0WHXDMEtp1KldthDIOZYVMZFbXRlc\n         '
                                   b'RsvA=='}
-        self.plug.is_valid = 1
-        self.plug.author_domains = [b'gmail.com']
+        self.msg_data["is_valid"] = 1
+        self.msg_data["author_domains"] = [b'gmail.com']
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
 
@@ -440,8 +492,8 @@ class TestCheckSignature(unittest.TestCase):
                                   b'TMoOYbv/exIF/VIiC9IXiCFmFY0NVCbqi1ksbjt/0cp+S1NeEl95d2FkAkOUPsCu9kto\n         '
                                   b'eriiEP6KqssKrmmX4XC2ovcTg9fxJZeS2VsgBOT0WHXDMEtp1KldthDIOZYVMZFbXRlc\n         '
                                   b'RsvA=='}
-        self.plug.is_valid = 0
-        self.plug.author_domains = [b'gmail.com']
+        self.msg_data["is_valid"] = 0
+        self.msg_data["author_domains"] = [b'gmail.com']
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
 
@@ -463,8 +515,8 @@ class TestCheckSignature(unittest.TestCase):
                                   b'TMoOYbv/exIF/VIiC9IXiCFmFY0NVCbqi1ksbjt/0cp+S1NeEl95d2FkAkOUPsCu9kto\n         '
                                   b'eriiEP6KqssKrmmX4XC2ovcTg9fxJZeS2VsgBOT0WHXDMEtp1KldthDIOZYVMZFbXRlc\n         '
                                   b'RsvA=='}
-        self.plug.is_valid = 1
-        self.plug.author_domains = [b'gmail.com']
+        self.msg_data["is_valid"] = 1
+        self.msg_data["author_domains"] = [b'gmail.com']
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
 
@@ -487,8 +539,8 @@ class TestCheckSignature(unittest.TestCase):
                                   b'TMoOYbv/exIF/VIiC9IXiCFmFY0NVCbqi1ksbjt/0cp+S1NeEl95d2FkAkOUPsCu9kto\n         '
                                   b'eriiEP6KqssKrmmX4XC2ovcTg9fxJZeS2VsgBOT0WHXDMEtp1KldthDIOZYVMZFbXRlc\n         '
                                   b'RsvA=='}
-        self.plug.is_valid = 1
-        self.plug.author_domains = [b'gmail.com']
+        self.msg_data["is_valid"] = 1
+        self.msg_data["author_domains"] = [b'gmail.com']
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
 
@@ -517,11 +569,11 @@ class TestCheckSignature(unittest.TestCase):
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
         self.mock_dkim_verify.return_value = True
-        self.plug.author_domains = [b"gmail.com"]
+        self.msg_data["author_domains"] = [b"gmail.com"]
         self.plug.check_dkim_signature(self.mock_msg)
 
-        self.assertEqual((self.plug.dkim_valid, self.plug.dkim_signed,
-                          self.plug.dkim_has_valid_author_sig), (1, 1, 1))
+        self.assertEqual((self.msg_data["dkim_valid"], self.msg_data["dkim_signed"],
+                          self.msg_data["dkim_has_valid_author_sig"]), (1, 1, 1))
 
     def test_check_dkim_signature_message_format_error(self):
         message = "Message"
@@ -544,11 +596,11 @@ class TestCheckSignature(unittest.TestCase):
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
         self.mock_dkim_verify.side_effect = dkim.MessageFormatError
-        self.plug.author_domains = [b"gmail.com"]
+        self.msg_data["author_domains"] = [b"gmail.com"]
         self.plug.check_dkim_signature(self.mock_msg)
 
-        self.assertEqual((self.plug.dkim_valid, self.plug.dkim_signed,
-                          self.plug.dkim_has_valid_author_sig), (0, 1, 0))
+        self.assertEqual((self.msg_data["dkim_valid"], self.msg_data["dkim_signed"],
+                          self.msg_data["dkim_has_valid_author_sig"]), (0, 1, 0))
 
     def test_check_dkim_signature_message_validation_error(self):
         message = "Message"
@@ -571,11 +623,11 @@ class TestCheckSignature(unittest.TestCase):
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
         self.mock_dkim_verify.side_effect = dkim.ValidationError
-        self.plug.author_domains = [b"gmail.com"]
+        self.msg_data["author_domains"] = [b"gmail.com"]
         self.plug.check_dkim_signature(self.mock_msg)
 
-        self.assertEqual((self.plug.dkim_valid, self.plug.dkim_signed,
-                          self.plug.dkim_has_valid_author_sig), (0, 1, 0))
+        self.assertEqual((self.msg_data["dkim_valid"], self.msg_data["dkim_signed"],
+                          self.msg_data["dkim_has_valid_author_sig"]), (0, 1, 0))
 
     def test_check_dkim_signature_message_key_format_error(self):
         message = "Message"
@@ -598,11 +650,11 @@ class TestCheckSignature(unittest.TestCase):
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
         self.mock_dkim_verify.side_effect = dkim.KeyFormatError
-        self.plug.author_domains = [b"gmail.com"]
+        self.msg_data["author_domains"] = [b"gmail.com"]
         self.plug.check_dkim_signature(self.mock_msg)
 
-        self.assertEqual((self.plug.dkim_valid, self.plug.dkim_signed,
-                          self.plug.dkim_has_valid_author_sig), (0, 1, 0))
+        self.assertEqual((self.msg_data["dkim_valid"], self.msg_data["dkim_signed"],
+                          self.msg_data["dkim_has_valid_author_sig"]), (0, 1, 0))
 
     def test_check_dkim_signature_uncorrect_signature_domain(self):
         message = "Message"
@@ -625,11 +677,11 @@ class TestCheckSignature(unittest.TestCase):
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
         self.mock_dkim_verify.return_value = True
-        self.plug.author_domains = [b"gmail.com"]
+        self.msg_data["author_domains"] = [b"gmail.com"]
         self.plug.check_dkim_signature(self.mock_msg)
 
-        self.assertEqual((self.plug.dkim_valid, self.plug.dkim_signed,
-                          self.plug.dkim_has_valid_author_sig), (0, 0, 0))
+        self.assertEqual((self.msg_data["dkim_valid"], self.msg_data["dkim_signed"],
+                          self.msg_data["dkim_has_valid_author_sig"]), (0, 0, 0))
 
     def test_check_dkim_signature_result_false(self):
         message = "Message"
@@ -652,11 +704,11 @@ class TestCheckSignature(unittest.TestCase):
         self.mock_msg.get.return_value = dkim_signature
         self.mock_dkim_parse_tag.return_value = parsed_signature
         self.mock_dkim_verify.return_value = False
-        self.plug.author_domains = [b"gmail.com"]
+        self.msg_data["author_domains"] = [b"gmail.com"]
         self.plug.check_dkim_signature(self.mock_msg)
 
-        self.assertEqual((self.plug.dkim_valid, self.plug.dkim_signed,
-                          self.plug.dkim_has_valid_author_sig), (0, 1, 1))
+        self.assertEqual((self.msg_data["dkim_valid"], self.msg_data["dkim_signed"],
+                          self.msg_data["dkim_has_valid_author_sig"]), (0, 1, 1))
 
 
 def suite():
@@ -1,4 +1,7 @@
 """Test DNSEval"""
+import os
+import shutil
+import tempfile
 import unittest
 import oa.dns_interface
 import collections
@@ -11,6 +14,7 @@ except ImportError:
 import ipaddress
 
 import oa.context
+import oa.rbldnsd
 import oa.plugins.dns_eval
 
 
@@ -20,13 +24,16 @@ class TestDNSEval(unittest.TestCase):
         unittest.TestCase.setUp(self)
         self.ips = [ipaddress.ip_address(u"127.0.0.1")]
         self.local_data = {}
-        self.global_data = {}
+        self.global_data = {"rbl_local_zone": [], "rbl_local_zone_dir": "",
+                            "rbl_local_zone_check": 60}
         self.mock_ctxt = MagicMock()
-        self.mock_ctxt.dns.reverse_ip = oa.dns_interface.DNSInterface().reverse_ip
         self.mock_ctxt.skip_rbl_checks = False
         self.mock_msg = MagicMock()
+        self.mock_msg.dns_budget = oa.dns_interface.DNSBudget()
         self.mock_msg.sender_address = "sender@example.com"
-        self.mock_msg.get_untrusted_ips.return_value = self.ips
+        self.mock_msg.sender_domain = "example.com"
+        self.mock_msg.untrusted_ips = self.ips
+        self.mock_msg.reversed_untrusted_ips = ["1.0.0.127"]
         self.plugin = oa.plugins.dns_eval.DNSEval(self.mock_ctxt)
         self.plugin.set_local = lambda m, k, v: self.local_data.__setitem__(k, v)
         self.plugin.get_local = lambda m, k: self.local_data.__getitem__(k)
@@ -53,7 +60,8 @@ class TestDNSEval(unittest.TestCase):
             self.mock_msg, "example_ser", "example.com"
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "1.0.0.127.example.com", 'A')
+            "1.0.0.127.example.com", 'A',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_rbl_subnet(self):
         """Test the check_rbl method."""
@@ -61,7 +69,8 @@ class TestDNSEval(unittest.TestCase):
             self.mock_msg, "example_ser", "example.com", "127.0.0.1"
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "1.0.0.127.example.com", 'A')
+            "1.0.0.127.example.com", 'A',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_rbl_txt(self):
         """Test the check_rbl_txt method."""
@@ -69,7 +78,8 @@ class TestDNSEval(unittest.TestCase):
             self.mock_msg, "example_ser", "example.com", "127.0.0.2"
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "1.0.0.127.example.com", 'TXT')
+            "1.0.0.127.example.com", 'TXT',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_rbl_sub(self):
         """Test the check_rbl_sub method."""
@@ -80,7 +90,8 @@ class TestDNSEval(unittest.TestCase):
             self.mock_msg, "example_ser", "127.0.0.1",
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "1.0.0.127.example.com", 'A')
+            "1.0.0.127.example.com", 'A',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_rbl_sub_multi(self):
         """Test the _check_multi_rbl method."""
@@ -97,12 +108,13 @@ class TestDNSEval(unittest.TestCase):
             self.mock_msg, "example_ser", "127.0.0.1",
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "1.0.0.127.rbl.example.com.", 'A')
+            "1.0.0.127.rbl.example.com.", 'A',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_dns_sender_with_a_records(self):
         """Test the check_dns_sender rule"""
 
-        def mock_query(domain, rtype="A"):
+        def mock_query(domain, rtype="A", budget=None):
             return ["127.0.0.1"]
 
         self.mock_ctxt.dns.query.side_effect = mock_query
@@ -112,10 +124,10 @@ class TestDNSEval(unittest.TestCase):
     def test_check_dns_sender_no_mx(self):
         """Test the check_dns_sender rule"""
 
-        def mock_query_a(domain, rtype="A"):
+        def mock_query_a(domain, rtype="A", budget=None):
             return []
 
-        def mock_query_mx(domain, rtype="MX"):
+        def mock_query_mx(domain, rtype="MX", budget=None):
             return ["127.0.0.1"]
 
         self.mock_ctxt.dns.query.side_effect = mock_query_a
@@ -126,10 +138,10 @@ class TestDNSEval(unittest.TestCase):
     def test_check_dns_sender_invalid(self):
         """Test the check_dns_sender rule"""
 
-        def mock_query_a(domain, rtype="A"):
+        def mock_query_a(domain, rtype="A", budget=None):
             return ["127.0.0.1"]
 
-        def mock_query_mx(domain, rtype="MX"):
+        def mock_query_mx(domain, rtype="MX", budget=None):
             return []
 
         self.mock_ctxt.dns.query.side_effect = mock_query_a
@@ -144,38 +156,39 @@ class TestDNSEval(unittest.TestCase):
             self.mock_msg, "example_set", "example.org"
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "example.com.example.org", 'A')
+            "example.com.example.org", 'A',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_rbl_from_host(self):
         """Test the check_rbl_from_host eval rule"""
-        from_host = ["test@example.net"]
-        self.mock_msg.get_addr_header.return_value = from_host
+        self.mock_msg.from_domains = ["example.net"]
         self.plugin.check_rbl_from_host(
             self.mock_msg, "example_set", "example.com"
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "example.net.example.com", 'A')
+            "example.net.example.com", 'A',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_rbl_from_domain(self):
         """Test the check_rbl_from_domain eval rule"""
-        from_headers = ["test@example.org"]
-        self.mock_msg.get_addr_header.return_value = from_headers
+        self.mock_msg.from_domains = ["example.org"]
         self.plugin.check_rbl_from_domain(
             self.mock_msg, "example_set", "example.com"
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "example.org.example.com", 'A')
+            "example.org.example.com", 'A',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_rbl_from_domain_addr(self):
         """Test the check_rbl_from_domain eval rule"""
-        from_headers = ["test@example.org", "teo@example.test",
-                        "from@example.net", "domain.example.com"]
-        self.mock_msg.get_addr_header.return_value = from_headers
+        self.mock_msg.from_domains = ["example.org", "example.test",
+                                      "example.net", "domain.example.com"]
         self.plugin.check_rbl_from_domain(
             self.mock_msg, "example_set", "example.com", "127.0.0.1"
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "domain.example.com.example.com", 'A')
+            "domain.example.com.example.com", 'A',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_rbl_accreditor(self):
         """Test the check_rbl_accreditor eval rule"""
@@ -184,7 +197,8 @@ class TestDNSEval(unittest.TestCase):
             self.mock_msg, "accredit", "example.com", "127.0.0.1", "accreditor"
         )
         self.mock_ctxt.dns.query.assert_called_with(
-            "1.0.0.127.example.com", 'A')
+            "1.0.0.127.example.com", 'A',
+            budget=self.mock_msg.dns_budget)
 
     def test_check_rbl_accreditor_from_header_no_match(self):
         """Test the check_rbl_accreditor eval rule when accreditor doen't
@@ -209,7 +223,8 @@ class TestDNSEval(unittest.TestCase):
         )
         # accredit', 'example.net', '127.0.1.2','accreditor1'
         self.mock_ctxt.dns.query.assert_called_with(
-            "1.0.0.127.example.com", 'A')
+            "1.0.0.127.example.com", 'A',
+            budget=self.mock_msg.dns_budget)
 
 
     def test_check_rbl_skip_rbl_check(self):
@@ -222,12 +237,12 @@ class TestDNSEval(unittest.TestCase):
 
         self.mock_ctxt.dns.query.assert_not_called()
 
-    def test_check_rbl_addr_skip_rbl_check(self):
+    def test_check_rbl_domains_skip_rbl_check(self):
         """Test the check_rbl method with skip_rbl_checks True."""
         self.mock_ctxt.skip_rbl_checks = True
 
-        self.plugin._check_rbl_addr(
-            ['test@example.com'], "example_ser" 
+        self.plugin._check_rbl_domains(
+            ['example.com'], "example_ser" 
         )
 
         self.mock_ctxt.dns.query.assert_not_called()
@@ -241,3 +256,273 @@ class TestDNSEval(unittest.TestCase):
         )
 
         self.mock_ctxt.dns.query.assert_not_called()
+
+
+class DNSEvalLookupsTestBase(unittest.TestCase):
+    """Parse messages with the lookups of the rules started."""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.local_data = {}
+        self.global_data = {"rbl_timeout": 15, "rbl_local_zone": [],
+                            "rbl_local_zone_dir": "",
+                            "rbl_local_zone_check": 60}
+        self.mock_ctxt = MagicMock()
+        self.mock_ctxt.skip_rbl_checks = False
+        self.mock_ctxt.dns.query_async.side_effect = self.query_async
+        self.mock_msg = MagicMock(local_only=False)
+        self.mock_msg.dns_budget = oa.dns_interface.DNSBudget()
+        self.mock_msg.sender_address = "sender@example.com"
+        self.mock_msg.sender_domain = "example.com"
+        self.mock_msg.untrusted_ips = [
+            ipaddress.ip_address(u"127.0.0.1"),
+            ipaddress.ip_address(u"127.0.0.2"),
+        ]
+        self.mock_msg.reversed_untrusted_ips = ["1.0.0.127", "2.0.0.127"]
+        self.mock_msg.from_domains = ["example.org"]
+        self.mock_msg.get_decoded_header.return_value = []
+        self.plugin = oa.plugins.dns_eval.DNSEval(self.mock_ctxt)
+        self.plugin.set_local = lambda m, k, v: self.local_data.__setitem__(k, v)
+        self.plugin.get_local = lambda m, k: self.local_data.__getitem__(k)
+        self.plugin.set_global = self.global_data.__setitem__
+        self.plugin.get_global = self.global_data.__getitem__
+        self.mock_ruleset = MagicMock(checked={}, not_checked={})
+        patch("oa.plugins.dns_eval.isinstance", return_value=True,
+              create=True).start()
+        self.pending = {}
+
+    def tearDown(self):
+        patch.stopall()
+        unittest.TestCase.tearDown(self)
+
+    def query_async(self, qname, qtype):
+        pending = oa.dns_interface.PendingQuery(qname, qtype)
+        self.pending[(qname, qtype)] = pending
+        return pending
+
+    def add_rule(self, name, eval_rule_name, *args):
+        rule = MagicMock(eval_rule_name=eval_rule_name, eval_args=args)
+        self.mock_ruleset.checked[name] = rule
+
+    def parse(self):
+        self.plugin.finish_parsing_end(self.mock_ruleset)
+        self.plugin.parsed_metadata(self.mock_msg)
+
+
+class TestDNSEvalLookups(DNSEvalLookupsTestBase):
+    """Test the lookups started when the message is parsed."""
+
+    def test_lookups_ips(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.add_rule("RBL_TXT", "check_rbl_txt", "zen", "zen.example.com")
+        self.parse()
+        self.assertEqual(sorted(self.pending), [
+            ("1.0.0.127.zen.example.com", "A"),
+            ("1.0.0.127.zen.example.com", "TXT"),
+            ("2.0.0.127.zen.example.com", "A"),
+            ("2.0.0.127.zen.example.com", "TXT"),
+        ])
+
+    def test_lookups_addresses(self):
+        self.add_rule("ENVFROM", "check_rbl_envfrom", "dbl", "dbl.example")
+        self.add_rule("FROM", "check_rbl_from_domain", "dbl", "dbl.example")
+        self.add_rule("SENDER", "check_dns_sender")
+        self.parse()
+        self.assertEqual(sorted(self.pending), [
+            ("example.com", "A"),
+            ("example.com", "MX"),
+            ("example.com.dbl.example", "A"),
+            ("example.org.dbl.example", "A"),
+        ])
+
+    def test_lookups_deduplicated(self):
+        self.add_rule("RBL1", "check_rbl", "zen", "zen.example.com")
+        self.add_rule("RBL2", "check_rbl", "zen", "zen.example.com",
+                      "127.0.0.2")
+        self.parse()
+        self.assertEqual(len(self.pending), 2)
+        self.assertEqual(self.mock_ctxt.dns.query_async.call_count, 2)
+
+    def test_lookups_accreditor(self):
+        self.add_rule("ACCREDITOR", "check_rbl_accreditor", "acc",
+                      "acc.example.com", "127.0.0.1", "accreditor")
+        self.parse()
+        self.assertEqual(self.pending, {})
+        self.mock_msg.sender_address = "sender@a--accreditor.example.com"
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertEqual(len(self.pending), 2)
+
+    def test_lookups_local_only(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.mock_msg.local_only = True
+        self.parse()
+        self.assertEqual(self.pending, {})
+
+    def test_lookups_skip_rbl_checks(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.mock_ctxt.skip_rbl_checks = True
+        self.parse()
+        self.assertEqual(self.pending, {})
+
+    def test_check_rbl_uses_lookups(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.parse()
+        self.pending[("1.0.0.127.zen.example.com", "A")].set_result([])
+        self.pending[("2.0.0.127.zen.example.com", "A")].set_result(
+            ["127.0.0.2"])
+        self.assertTrue(self.plugin.check_rbl(self.mock_msg, "zen",
+                                              "zen.example.com"))
+        self.mock_ctxt.dns.query.assert_not_called()
+
+    def test_check_rbl_other_lookup(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.parse()
+        self.mock_ctxt.dns.query.return_value = []
+        self.plugin.check_rbl(self.mock_msg, "bl", "bl.example.com")
+        self.mock_ctxt.dns.query.assert_called_with(
+            "2.0.0.127.bl.example.com", "A",
+            budget=self.mock_msg.dns_budget)
+
+    def test_check_rbl_deadline(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.parse()
+        self.local_data["deadline"] = 0
+        self.assertFalse(self.plugin.check_rbl(self.mock_msg, "zen",
+                                               "zen.example.com"))
+        self.mock_ctxt.dns.query.assert_not_called()
+
+    def test_check_rbl_budget_spent(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.parse()
+        self.mock_msg.dns_budget.deadline = 0
+        self.assertFalse(self.plugin.check_rbl(self.mock_msg, "zen",
+                                               "zen.example.com"))
+        self.assertTrue(self.mock_msg.dns_budget.exhausted)
+
+    def test_zone_lookup_shared(self):
+        """All the rules of a zone share the lookups of the message."""
+        self.add_rule("RBL", "check_rbl", "zen-lastexternal",
+                      "zen.example.com")
+        self.parse()
+        self.local_data["lookups"] = {}
+        self.mock_ctxt.dns.query.return_value = ["127.0.0.4"]
+        self.plugin.check_rbl(self.mock_msg, "zen-lastexternal",
+                              "zen.example.com", "127.0.0.2")
+        self.plugin.check_rbl(self.mock_msg, "zen-lastexternal",
+                              "zen.example.com", "127.0.0.3")
+        self.plugin.check_rbl_sub(self.mock_msg, "zen", "127.0.0.4")
+        self.plugin.check_rbl_sub(self.mock_msg, "zen", "127.0.0.8")
+        self.assertEqual(self.mock_ctxt.dns.query.call_args_list, [
+            call("1.0.0.127.zen.example.com", "A", budget=self.mock_msg.dns_budget),
+            call("2.0.0.127.zen.example.com", "A", budget=self.mock_msg.dns_budget),
+        ])
+
+    def test_zone_subtests(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.parse()
+        self.pending[("1.0.0.127.zen.example.com", "A")].set_result(
+            ["127.0.0.4"])
+        self.pending[("2.0.0.127.zen.example.com", "A")].set_result([])
+        self.assertTrue(self.plugin.check_rbl(
+            self.mock_msg, "zen", "zen.example.com", r"127\.0\.0\.4"))
+        self.assertFalse(self.plugin.check_rbl(
+            self.mock_msg, "zen", "zen.example.com", r"127\.0\.0\.2"))
+        self.assertTrue(self.plugin.check_rbl_sub(self.mock_msg, "zen", "4"))
+        self.assertFalse(self.plugin.check_rbl_sub(self.mock_msg, "zen", "2"))
+
+    def test_subtests_parsed_once(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com",
+                      "127.0.0.2")
+        self.add_rule("RBL_SUB", "check_rbl_sub", "zen", "127.0.0.4")
+        self.plugin.finish_parsing_end(self.mock_ruleset)
+        self.assertEqual(list(self.plugin["subtests"]), ["127.0.0.2"])
+        self.assertEqual(self.plugin["masks"], {"127.0.0.4": 2130706436})
+        with patch("oa.plugins.dns_eval.Regex") as mock_regex:
+            self.plugin._get_subtest("127.0.0.2")
+        mock_regex.assert_not_called()
+
+    def test_invalid_mask(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.parse()
+        self.assertFalse(self.plugin.check_rbl_sub(self.mock_msg, "zen",
+                                                   "invalid"))
+
+
+class TestDNSEvalLocalZones(DNSEvalLookupsTestBase):
+    """Test the lists answered from local zone files."""
+
+    def setUp(self):
+        DNSEvalLookupsTestBase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.global_data["rbl_local_zone_dir"] = os.path.join(
+            self.directory, "snapshots")
+        self.add_zone("zen.example.com", "ip4set",
+                      ":127.0.0.2:Listed $\n127.0.0.1 :4\n")
+        self.add_zone("dbl.example.com", "dnset", "example.org\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        oa.rbldnsd._snapshots.clear()
+        DNSEvalLookupsTestBase.tearDown(self)
+
+    def add_zone(self, name, kind, data):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as zone_file:
+            zone_file.write(data)
+        self.global_data["rbl_local_zone"].append(
+            "%s %s %s" % (name, kind, path))
+
+    def test_local_zone_not_queried(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.add_rule("DBL", "check_rbl_from_domain", "dbl",
+                      "dbl.example.com")
+        self.parse()
+        self.mock_ctxt.dns.query_async.assert_not_called()
+
+    def test_local_zone_check_rbl(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.parse()
+        self.assertTrue(self.plugin.check_rbl(self.mock_msg, "zen",
+                                              "zen.example.com"))
+        self.assertTrue(self.plugin.check_rbl(
+            self.mock_msg, "zen", "zen.example.com", r"127\.0\.0\.4"))
+        self.assertFalse(self.plugin.check_rbl(
+            self.mock_msg, "zen", "zen.example.com", r"127\.0\.0\.3"))
+        self.mock_ctxt.dns.query.assert_not_called()
+
+    def test_local_zone_check_rbl_txt(self):
+        self.add_rule("RBL", "check_rbl_txt", "zen", "zen.example.com")
+        self.parse()
+        self.assertTrue(self.plugin.check_rbl_txt(
+            self.mock_msg, "zen", "zen.example.com",
+            r'"Listed 127\.0\.0\.1"'))
+
+    def test_local_zone_check_rbl_sub(self):
+        self.add_rule("RBL", "check_rbl", "zen", "zen.example.com")
+        self.parse()
+        self.assertTrue(self.plugin.check_rbl_sub(self.mock_msg, "zen", "4"))
+        self.assertFalse(self.plugin.check_rbl_sub(self.mock_msg, "zen",
+                                                   "8"))
+
+    def test_local_zone_check_rbl_from_domain(self):
+        self.add_rule("DBL", "check_rbl_from_domain", "dbl",
+                      "dbl.example.com")
+        self.parse()
+        self.assertTrue(self.plugin.check_rbl_from_domain(
+            self.mock_msg, "dbl", "dbl.example.com"))
+        self.mock_msg.from_domains = ["example.net"]
+        self.local_data["answers"] = {}
+        self.assertFalse(self.plugin.check_rbl_from_domain(
+            self.mock_msg, "dbl", "dbl.example.com"))
+
+    def test_local_zone_other_list(self):
+        self.add_rule("RBL", "check_rbl", "bl", "bl.example.com")
+        self.parse()
+        self.assertEqual(self.mock_ctxt.dns.query_async.call_count, 2)
+
+    def test_local_zone_invalid(self):
+        self.global_data["rbl_local_zone"].append(
+            "bl.example.com ip6set /dev/null")
+        self.parse()
+        self.assertEqual(len(self.plugin["local_zones"]), 2)
+        self.assertTrue(self.mock_ctxt.err.called)
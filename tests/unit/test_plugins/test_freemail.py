@@ -38,31 +38,36 @@ class TestFreeMailBase(unittest.TestCase):
 
 class TestCheckStart(TestFreeMailBase):
 
+    def test_finish_parsing_end(self):
+        """Test if global_data is filled after parsing"""
+        self.plugin.finish_parsing_end(self.mock_ruleset)
+        self.assertTrue("email_re" in self.global_data.keys())
+
     def test_check_start(self):
-        """Test if global_data is filled in the start"""
+        """Test if local_data is filled in the start"""
         self.plugin.check_start(self.mock_msg)
-        self.assertTrue("email_re" in self.global_data.keys())
-        self.assertTrue("body_emails" in self.global_data.keys())
-        self.assertTrue("check_if_parsed" in self.global_data.keys())
+        self.assertEqual(self.local_data["body_emails"], set())
+        self.assertFalse(self.local_data["check_if_parsed"])
+        self.assertFalse("body_emails" in self.global_data.keys())
 
     def test_check_start_valid_freemail_domains(self):
         """Test if bad domains are removed from freemail_domains"""
         expected_length = len(self.global_data["freemail_domains"])
         self.global_data["freemail_domains"].append("inv*&&a_lidq.com")
-        self.plugin.check_start(self.mock_msg)
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         self.assertEqual(expected_length,
                          len(self.global_data["freemail_domains"]))
 
     def test_check_start_wild_domains(self):
         """Test if wildcard appears in domain"""
         self.global_data["freemail_domains"].append("*.example.org")
-        self.plugin.check_start(self.mock_msg)
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         self.assertTrue("freemail_domains_re" in self.global_data.keys())
 
     def test_check_start_regexes(self):
         """Test if regexes are compiled corectly"""
         self.global_data["freemail_domains"].append("*.example.org")
-        self.plugin.check_start(self.mock_msg)
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         self.assertIsNotNone(self.global_data['email_re'].search("email@test.com"))
         self.assertIsNone(self.global_data['email_re'].search("email@test.co.za"))
         self.assertIsNotNone(self.global_data['freemail_domains_re'].search("test@anything.example.org"))
@@ -78,6 +83,7 @@ class TestEvalRules(TestFreeMailBase):
 
     def setUp(self):
         super(TestEvalRules, self).setUp()
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         self.plugin.check_start(self.mock_msg)
 
     def test_freemail_replyto_invalid_option(self):
@@ -134,7 +140,7 @@ class TestEvalRules(TestFreeMailBase):
     def test_freemail_replyto_with_parse_body_true(self):
         patch("oa.plugins.free_mail.FreeMail._parse_body", return_value=True).start()
         self.global_data['freemail_skip_bulk_envfrom'] = False
-        self.global_data['freemail_body_emails'] = ["test@freemail.example.com"]
+        self.local_data['freemail_body_emails'] = ["test@freemail.example.com"]
         self.mock_msg.msg["Reply-To"] = "test@freemail2.example.com"
         self.mock_msg.msg["From"] = "test2@paidomain.com"
         self.global_data["freemail_add_describe_email"] = 0
@@ -145,7 +151,7 @@ class TestEvalRules(TestFreeMailBase):
     def test_freemail_replyto_with_parse_body_true_false(self):
         patch("oa.plugins.free_mail.FreeMail._parse_body", return_value=True).start()
         self.global_data['freemail_skip_bulk_envfrom'] = False
-        self.global_data['freemail_body_emails'] = ["test@freemail.example.com"]
+        self.local_data['freemail_body_emails'] = ["test@freemail.example.com"]
         self.mock_msg.msg["Reply-To"] = "test@freemail.example.com"
         self.mock_msg.msg["From"] = "test2@paidomain.com"
         result = self.plugin.check_freemail_replyto(self.mock_msg)
@@ -250,10 +256,10 @@ class TestEvalRules(TestFreeMailBase):
 #~~~~~~~~~~~~~~~~~~~~~~
     def test_freemail_body_parsed(self):
         patch("oa.plugins.free_mail.FreeMail._parse_body", return_value=True).start()
-        self.global_data["body_emails"] = ["body@example.com",
+        self.local_data["body_emails"] = ["body@example.com",
                                            "body@freemail.example.com",
                                            "body2@freemail2.example.com"]
-        self.global_data["freemail_body_emails"] = ["body@freemail.example.com",
+        self.local_data["freemail_body_emails"] = ["body@freemail.example.com",
                                                     "body2@freemail2.example.com"]
         self.global_data["freemail_add_describe_email"] = 0
         expected_result = "Body has freemails"
@@ -262,10 +268,10 @@ class TestEvalRules(TestFreeMailBase):
 
     def test_freemail_body_parsed_regex(self):
         patch("oa.plugins.free_mail.FreeMail._parse_body", return_value=True).start()
-        self.global_data["body_emails"] = ["body@example.com",
+        self.local_data["body_emails"] = ["body@example.com",
                                            "body@freemail.example.com",
                                            "body2@freemail2.example.com"]
-        self.global_data["freemail_body_emails"] = ["body@freemail.example.com",
+        self.local_data["freemail_body_emails"] = ["body@freemail.example.com",
                                                     "body2@freemail2.example.com"]
         self.global_data["freemail_add_describe_email"] = 0
         expected_result = "Address from body is freemail and matches regex"
@@ -277,12 +283,12 @@ class TestIsFreemail(TestFreeMailBase):
     """Test _is_freemail(email) method"""
 
     def test_with_no_email(self):
-        self.plugin.check_start(self.mock_msg)
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         result = self.plugin._is_freemail(email=None)
         self.assertFalse(result)
 
     def test_freemail_whitelist(self):
-        self.plugin.check_start(self.mock_msg)
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         whitelist_domain = self.global_data['freemail_whitelist'][0]
         email = "test@" + whitelist_domain
         result = self.plugin._is_freemail(email=email)
@@ -290,20 +296,20 @@ class TestIsFreemail(TestFreeMailBase):
 
     def test_freemail_whitelist_with_re(self):
         self.global_data['freemail_domains'].append("*.test.example.com")
-        self.plugin.check_start(self.mock_msg)
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         email = "test@anything.test.example.com"
         result = self.plugin._is_freemail(email=email)
         self.assertTrue(result)
 
     def test_freemail_domains(self):
-        self.plugin.check_start(self.mock_msg)
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         freemail_domain = self.global_data['freemail_domains'][0]
         email = "test@" + freemail_domain
         result = self.plugin._is_freemail(email=email)
         self.assertTrue(result)
 
     def test_email_whitelist_re(self):
-        self.plugin.check_start(self.mock_msg)
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         email = "support@example.com"
         result = self.plugin._is_freemail(email=email)
         self.assertFalse(result)
@@ -314,44 +320,45 @@ class TestParseBody(TestFreeMailBase):
 
     def setUp(self):
         super(TestParseBody, self).setUp()
+        self.plugin.finish_parsing_end(self.mock_ruleset)
         self.plugin.check_start(self.mock_msg)
 
     def test_parse_body_already_parsed(self):
-        self.global_data["check_if_parsed"] = True
-        result = self.plugin._parse_body()
+        self.local_data["check_if_parsed"] = True
+        result = self.plugin._parse_body(self.mock_msg)
         self.assertTrue(result)
 
     def test_parse_body_no_body_emails_skip(self):
         self.global_data["freemail_max_body_emails"] = 5
         self.global_data["freemail_skip_when_over_max"] = True
-        result = self.plugin._parse_body()
+        result = self.plugin._parse_body(self.mock_msg)
         self.assertTrue(result)
 
     def test_parse_body_with_emails(self):
-        self.global_data["body_emails"] = ["body@example.com",
+        self.local_data["body_emails"] = ["body@example.com",
                                            "body2@example.com",
                                            "body3@example.com"]
         self.global_data["freemail_max_body_emails"] = 2
         self.global_data["freemail_skip_when_over_max"] = True
-        result = self.plugin._parse_body()
+        result = self.plugin._parse_body(self.mock_msg)
         self.assertFalse(result)
 
     def test_parse_body_with_freemail(self):
-        self.global_data["body_emails"] = ["body@freemail.example.com",
+        self.local_data["body_emails"] = ["body@freemail.example.com",
                                            "body2@freemail2.example.com"]
         self.global_data["freemail_max_body_emails"] = 5
         self.global_data["freemail_skip_when_over_max"] = True
         self.global_data["freemail_max_body_freemails"] = 3
-        result = self.plugin._parse_body()
+        result = self.plugin._parse_body(self.mock_msg)
         self.assertTrue(result)
-        self.assertEqual(self.global_data["body_emails"],
-                         self.global_data["freemail_body_emails"])
+        self.assertEqual(self.local_data["body_emails"],
+                         self.local_data["freemail_body_emails"])
 
     def test_parse_body_with_freemail_limit(self):
-        self.global_data["body_emails"] = ["body@freemail.example.com",
+        self.local_data["body_emails"] = ["body@freemail.example.com",
                                            "body2@freemail2.example.com"]
         self.global_data["freemail_max_body_emails"] = 5
         self.global_data["freemail_skip_when_over_max"] = True
         self.global_data["freemail_max_body_freemails"] = 1
-        result = self.plugin._parse_body()
+        result = self.plugin._parse_body(self.mock_msg)
         self.assertFalse(result)
@@ -669,7 +669,7 @@ for ; Sat, 18 Jun 2016 05:00:14 GMT"""]
         self.mock_gated.return_value = False
         self.plugin._check_for_forged_hotmail_received_headers(
             self.mock_msg)
-        self.assertEqual(self.plugin.hotmail_addr_with_forged_hotmail_received, 1)
+        self.assertEqual(self.local_data["hotmail_addr_with_forged_hotmail_received"], 1)
 
     def test_check_forged_hotmail_hotmail_addr(self):
         self.mock_msg.msg.get.side_effect = [
@@ -682,7 +682,7 @@ for ; Sat, 18 Jun 2016 05:00:14 GMT"""]
         self.mock_gated.return_value = False
         self.plugin._check_for_forged_hotmail_received_headers(
             self.mock_msg)
-        self.assertEqual(self.plugin.hotmail_addr_but_no_hotmail_received, 1)
+        self.assertEqual(self.local_data["hotmail_addr_but_no_hotmail_received"], 1)
 
     def test_check_forged_hotmail_hotmail_addr_false(self):
         self.mock_msg.msg.get.side_effect = [
@@ -738,8 +738,8 @@ for ; Sat, 18 Jun 2016 05:00:14 GMT"""]
         result = self.plugin._check_for_forged_hotmail_received_headers(
             self.mock_msg)
         self.assertFalse(result)
-        self.assertEqual((self.plugin.hotmail_addr_but_no_hotmail_received,
-                          self.plugin.hotmail_addr_with_forged_hotmail_received),
+        self.assertEqual((self.local_data["hotmail_addr_but_no_hotmail_received"],
+                          self.local_data["hotmail_addr_with_forged_hotmail_received"]),
                          (0, 0))
 
     def test_check_forged_hotmail_originating_ip_regex2(self):
@@ -750,8 +750,8 @@ for ; Sat, 18 Jun 2016 05:00:14 GMT"""]
         result = self.plugin._check_for_forged_hotmail_received_headers(
             self.mock_msg)
         self.assertFalse(result)
-        self.assertEqual((self.plugin.hotmail_addr_but_no_hotmail_received,
-                          self.plugin.hotmail_addr_with_forged_hotmail_received),
+        self.assertEqual((self.local_data["hotmail_addr_but_no_hotmail_received"],
+                          self.local_data["hotmail_addr_with_forged_hotmail_received"]),
                          (0, 0))
 
     def test_check_forged_hotmail_originating_ip_regex3(self):
@@ -762,8 +762,8 @@ for ; Sat, 18 Jun 2016 05:00:14 GMT"""]
         result = self.plugin._check_for_forged_hotmail_received_headers(
             self.mock_msg)
         self.assertFalse(result)
-        self.assertEqual((self.plugin.hotmail_addr_but_no_hotmail_received,
-                          self.plugin.hotmail_addr_with_forged_hotmail_received),
+        self.assertEqual((self.local_data["hotmail_addr_but_no_hotmail_received"],
+                          self.local_data["hotmail_addr_with_forged_hotmail_received"]),
                          (0, 0))
 
     def test_check_forged_hotmail_originating_ip_regex4(self):
@@ -774,8 +774,8 @@ for ; Sat, 18 Jun 2016 05:00:14 GMT"""]
         result = self.plugin._check_for_forged_hotmail_received_headers(
             self.mock_msg)
         self.assertFalse(result)
-        self.assertEqual((self.plugin.hotmail_addr_but_no_hotmail_received,
-                          self.plugin.hotmail_addr_with_forged_hotmail_received),
+        self.assertEqual((self.local_data["hotmail_addr_but_no_hotmail_received"],
+                          self.local_data["hotmail_addr_with_forged_hotmail_received"]),
                          (0, 0))
 
     def test_get_received_headers_times(self):
@@ -1005,11 +1005,11 @@ class TestForgedHotmailRcvd(TestHeaderEvalBase):
                                          "_received_headers").start()
 
     def test_check_for_forged_hotmail_received_headers(self):
-        self.plugin.hotmail_addr_with_forged_hotmail_received = 1
+        self.local_data["hotmail_addr_with_forged_hotmail_received"] = 1
         result = self.plugin.check_for_forged_hotmail_received_headers(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_no_hotmail_received_headers(self):
-        self.plugin.hotmail_addr_but_no_hotmail_received = 1
+        self.local_data["hotmail_addr_but_no_hotmail_received"] = 1
         result = self.plugin.check_for_no_hotmail_received_headers(self.mock_msg)
         self.assertTrue(result)
@@ -129,8 +129,10 @@ class TestEvalRules(TestRelayEvalBase):
                                            u"by": u"example.com",
                                            u"helo": u"22.33.44.55"}]
         self.plugin._check_for_forged_received(self.mock_msg)
-        mismatch_ip_helo = self.plugin.get_global("mismatch_ip_helo")
+        mismatch_ip_helo = self.plugin.get_local(self.mock_msg,
+                                                 "mismatch_ip_helo")
         self.assertEqual(mismatch_ip_helo, 1)
+        self.assertNotIn("mismatch_ip_helo", self.global_data)
 
     def test_check_for_forged_received_mismatch_from(self):
         self.mock_msg.untrusted_relays = [{u"ip": u"83.45.21.22",
@@ -142,8 +144,9 @@ class TestEvalRules(TestRelayEvalBase):
                                            u"by": u"example.com",
                                            u"helo": u"22.33.44.55"}]
         self.plugin._check_for_forged_received(self.mock_msg)
-        mismatch_ip_helo = self.plugin.get_global("mismatch_ip_helo")
-        mismatch_from = self.plugin.get_global("mismatch_from")
+        mismatch_ip_helo = self.plugin.get_local(self.mock_msg,
+                                                 "mismatch_ip_helo")
+        mismatch_from = self.plugin.get_local(self.mock_msg, "mismatch_from")
         self.assertEqual(mismatch_ip_helo, 2)
         self.assertEqual(mismatch_from, 1)
 
@@ -164,3 +167,16 @@ class TestEvalRules(TestRelayEvalBase):
         result = self.plugin.check_for_forged_received_ip_helo(self.mock_msg)
         self.assertTrue(result)
 
+    def test_check_for_forged_received_ip_helo_per_message(self):
+        """The result for one message is not reused for the next one."""
+        self.mock_msg.untrusted_relays = [{u"ip": u"83.45.21.22",
+                                           u"rdns": u"test.example.com",
+                                           u"by": u"example.com",
+                                           u"helo": u"22.33.44.55"}]
+        result = self.plugin.check_for_forged_received_ip_helo(self.mock_msg)
+        self.assertTrue(result)
+        self.local_data.clear()
+        self.mock_msg.untrusted_relays = []
+        result = self.plugin.check_for_forged_received_ip_helo(self.mock_msg)
+        self.assertFalse(result)
+
@@ -8,6 +8,7 @@ try:
 except ImportError:
     from mock import patch, Mock, MagicMock, call
 
+import oa.dns_interface
 import oa.plugins.spf
 
 
@@ -24,11 +25,11 @@ class TestParsed(unittest.TestCase):
                                                   v: self.global_data.
                                    setdefault(k, v)}
                                    )
-        self.mock_msg = MagicMock(**{
+        self.mock_msg = MagicMock(local_only=False, **{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
             "set_plugin_data.side_effect": lambda p, k,
                                                   v: self.msg_data.
-                                  setdefault(k, v),
+                                  __setitem__(k, v),
         })
         self.mock_rcvd_headers = patch("oa.plugins.spf."
                                        "SpfPlugin.received_headers").start()
@@ -36,6 +37,7 @@ class TestParsed(unittest.TestCase):
                                        "SpfPlugin.check_spf_header").start()
 
         self.plug = oa.plugins.spf.SpfPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
@@ -84,11 +86,11 @@ class TestCheckSPF(unittest.TestCase):
                                                   v: self.global_data.
                                    setdefault(k, v)}
                                    )
-        self.mock_msg = MagicMock(**{
+        self.mock_msg = MagicMock(local_only=False, **{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
             "set_plugin_data.side_effect": lambda p, k,
                                                   v: self.msg_data.
-                                  setdefault(k, v),
+                                  __setitem__(k, v),
         })
 
         self.mock_check_whitelist = patch("oa.plugins.spf.SpfPlugin."
@@ -102,78 +104,86 @@ class TestCheckSPF(unittest.TestCase):
             "oa.plugins.spf.SpfPlugin.received_headers").start()
 
         self.plug = oa.plugins.spf.SpfPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
         patch.stopall()
 
     def test_check_for_spf_pass(self):
-        self.plug.check_result["check_spf_pass"] = 1
+        self.msg_data["check_result"]["check_spf_pass"] = 1
         result = self.plug.check_for_spf_pass(self.mock_msg)
         self.assertTrue(result)
 
+    def test_check_for_spf_pass_per_message(self):
+        self.msg_data["check_result"]["check_spf_pass"] = 1
+        self.assertEqual(self.plug.check_result["check_spf_pass"], 0)
+        self.plug.check_start(self.mock_msg)
+        result = self.plug.check_for_spf_pass(self.mock_msg)
+        self.assertFalse(result)
+
     def test_check_for_spf_helo_pass(self):
-        self.plug.check_result["check_spf_helo_pass"] = 1
+        self.msg_data["check_result"]["check_spf_helo_pass"] = 1
         result = self.plug.check_for_spf_helo_pass(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_neutral(self):
-        self.plug.check_result["check_spf_neutral"] = 1
+        self.msg_data["check_result"]["check_spf_neutral"] = 1
         result = self.plug.check_for_spf_neutral(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_helo_neutral(self):
-        self.plug.check_result["check_spf_helo_neutral"] = 1
+        self.msg_data["check_result"]["check_spf_helo_neutral"] = 1
         result = self.plug.check_for_spf_helo_neutral(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_none(self):
-        self.plug.check_result["check_spf_none"] = 1
+        self.msg_data["check_result"]["check_spf_none"] = 1
         result = self.plug.check_for_spf_none(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_helo_none(self):
-        self.plug.check_result["check_spf_helo_none"] = 1
+        self.msg_data["check_result"]["check_spf_helo_none"] = 1
         result = self.plug.check_for_spf_helo_none(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_fail(self):
-        self.plug.check_result["check_spf_fail"] = 1
+        self.msg_data["check_result"]["check_spf_fail"] = 1
         result = self.plug.check_for_spf_fail(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_helo_fail(self):
-        self.plug.check_result["check_spf_helo_fail"] = 1
+        self.msg_data["check_result"]["check_spf_helo_fail"] = 1
         result = self.plug.check_for_spf_helo_fail(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_softfail(self):
-        self.plug.check_result["check_spf_softfail"] = 1
+        self.msg_data["check_result"]["check_spf_softfail"] = 1
         result = self.plug.check_for_spf_softfail(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_helo_softfail(self):
-        self.plug.check_result["check_spf_helo_softfail"] = 1
+        self.msg_data["check_result"]["check_spf_helo_softfail"] = 1
         result = self.plug.check_for_spf_helo_softfail(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_permerror(self):
-        self.plug.check_result["check_spf_permerror"] = 1
+        self.msg_data["check_result"]["check_spf_permerror"] = 1
         result = self.plug.check_for_spf_permerror(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_helo_permerror(self):
-        self.plug.check_result["check_spf_helo_permerror"] = 1
+        self.msg_data["check_result"]["check_spf_helo_permerror"] = 1
         result = self.plug.check_for_spf_helo_permerror(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_temperror(self):
-        self.plug.check_result["check_spf_temperror"] = 1
+        self.msg_data["check_result"]["check_spf_temperror"] = 1
         result = self.plug.check_for_spf_temperror(self.mock_msg)
         self.assertTrue(result)
 
     def test_check_for_spf_helo_temperror(self):
-        self.plug.check_result["check_spf_helo_temperror"] = 1
+        self.msg_data["check_result"]["check_spf_helo_temperror"] = 1
         result = self.plug.check_for_spf_helo_temperror(self.mock_msg)
         self.assertTrue(result)
 
@@ -193,17 +203,17 @@ class TestCheckSPF(unittest.TestCase):
         self.global_data["use_newest_received_spf_header"] = 0
         self.plug.check_spf_header(self.mock_msg)
         self.mock_check_spf_received_header.assert_called_with(
-            self.mock_msg.get_decoded_header())
+            self.mock_msg, self.mock_msg.get_decoded_header())
         self.mock_received_header.assert_called_with(self.mock_msg, '')
 
     def test_check_spf_header_received_sender_helo_true(self):
-        self.plug.spf_check_helo = True
+        self.msg_data["spf_check_helo"] = True
         self.mock_msg["authentication-results"] = []
         self.mock_msg["received"] = ["heade1"]
         self.global_data["use_newest_received_spf_header"] = 0
         self.plug.check_spf_header(self.mock_msg)
         self.mock_check_spf_received_header.assert_called_with(
-            self.mock_msg.get_decoded_header())
+            self.mock_msg, self.mock_msg.get_decoded_header())
         self.mock_received_header.assert_called_with(self.mock_msg,
                                                      self.mock_msg.sender_address)
 
@@ -235,11 +245,11 @@ class TestCheckWhitelist(unittest.TestCase):
                                                   v: self.global_data.
                                    setdefault(k, v)}
                                    )
-        self.mock_msg = MagicMock(**{
+        self.mock_msg = MagicMock(local_only=False, **{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
             "set_plugin_data.side_effect": lambda p, k,
                                                   v: self.msg_data.
-                                  setdefault(k, v),
+                                  __setitem__(k, v),
         })
 
         self.mock_parse_list = patch("oa.plugins.spf.SpfPlugin."
@@ -248,6 +258,7 @@ class TestCheckWhitelist(unittest.TestCase):
                                      "check_for_spf_pass").start()
 
         self.plug = oa.plugins.spf.SpfPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
@@ -294,17 +305,20 @@ class TestReceivedHeaders(unittest.TestCase):
                                                   v: self.global_data.
                                    setdefault(k, v)}
                                    )
-        self.mock_msg = MagicMock(**{
+        self.mock_msg = MagicMock(local_only=False, **{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
             "set_plugin_data.side_effect": lambda p, k,
                                                   v: self.msg_data.
-                                  setdefault(k, v),
+                                  __setitem__(k, v),
         })
 
+        self.mock_msg.dns_budget = oa.dns_interface.DNSBudget()
+
         self.mock_query_spf = patch("oa.plugins.spf.SpfPlugin."
                                      "_query_spf").start()
 
         self.plug = oa.plugins.spf.SpfPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
@@ -312,7 +326,7 @@ class TestReceivedHeaders(unittest.TestCase):
 
     def test_received_headers_check_helo_True(self):
         self.spf_timeout = 4
-        self.plug.spf_check_helo = True
+        self.msg_data["spf_check_helo"] = True
         self.mock_msg.external_relays = [{'auth': '', 'ident': '',
                                           'envfrom': 'envfrom@google.com',
                                           'helo': 'spamexperts.com',
@@ -347,6 +361,48 @@ class TestReceivedHeaders(unittest.TestCase):
         self.mock_query_spf.return_value = "error"
         self.plug.received_headers(self.mock_msg, "user@example.com")
 
+    def test_received_headers_budget_timeout(self):
+        self.mock_msg.external_relays = [{'helo': 'spamexperts.com',
+                                          'ip': '5.79.73.204'}]
+        self.mock_msg.dns_budget = oa.dns_interface.DNSBudget(2)
+        self.mock_query_spf.return_value = "pass"
+        self.plug.received_headers(self.mock_msg, "user@example.com")
+        timeout = self.mock_query_spf.call_args[0][0]
+        self.assertLessEqual(timeout, 2)
+
+    def test_received_headers_budget_spent(self):
+        self.mock_msg.external_relays = [{'helo': 'spamexperts.com',
+                                          'ip': '5.79.73.204'}]
+        self.mock_msg.dns_budget.deadline = 0
+        self.plug.received_headers(self.mock_msg, "user@example.com")
+        self.mock_query_spf.assert_not_called()
+        self.assertTrue(self.mock_msg.dns_budget.exhausted)
+
+    def test_received_headers_local_only(self):
+        """No SPF lookups for messages checked locally."""
+        self.mock_msg.external_relays = [{'helo': 'spamexperts.com',
+                                          'ip': '5.79.73.204'}]
+        self.mock_msg.local_only = True
+        self.plug.received_headers(self.mock_msg, "user@example.com")
+        self.mock_query_spf.assert_not_called()
+
+    def test_parsed_metadata_local_only(self):
+        """The resolver is never used for messages checked locally."""
+        patch.stopall()
+        lookup = patch("oa.plugins.spf.spf.DNSLookup").start()
+        self.global_data["ignore_received_spf_header"] = True
+        self.global_data["spf_timeout"] = 5
+        self.mock_msg.external_relays = [{'helo': 'spamexperts.com',
+                                          'ip': '5.79.73.204'}]
+        self.mock_msg.get_decoded_header.return_value = ["lala"]
+        self.mock_msg.sender_address = "user@example.com"
+        self.mock_msg.local_only = True
+        self.plug.parsed_metadata(self.mock_msg)
+        lookup.assert_not_called()
+        self.mock_msg.local_only = False
+        self.plug.parsed_metadata(self.mock_msg)
+        self.assertTrue(lookup.called)
+
     def test_received_headers_return(self):
         self.spf_timeout = 4
         self.mock_msg.external_relays = []
@@ -358,7 +414,7 @@ class TestReceivedHeaders(unittest.TestCase):
                     192.0.2.1 as permitted sender) smtp.mailfrom=test@example.com;
                     dkim=pass header.i=@example.com;
                     dmarc=pass (p=NONE dis=NONE) header.from=example.com"""
-        self.plug.check_authres_header(authres)
+        self.plug.check_authres_header(self.mock_msg, authres)
 
     def test_check_authres_header_helo(self):
         authres = """example.com;
@@ -366,7 +422,7 @@ class TestReceivedHeaders(unittest.TestCase):
                     192.0.2.1 as permitted sender) smtp.helo=test@example.com;
                     dkim=pass header.i=@example.com;
                     dmarc=pass (p=NONE dis=NONE) header.from=example.com"""
-        self.plug.check_authres_header(authres)
+        self.plug.check_authres_header(self.mock_msg, authres)
 
 
 class TestCheckHeaders(unittest.TestCase):
@@ -382,51 +438,58 @@ class TestCheckHeaders(unittest.TestCase):
                                                   v: self.global_data.
                                    setdefault(k, v)}
                                    )
-        self.mock_msg = MagicMock(**{
+        self.mock_msg = MagicMock(local_only=False, **{
             "get_plugin_data.side_effect": lambda p, k: self.msg_data[k],
             "set_plugin_data.side_effect": lambda p, k,
                                                   v: self.msg_data.
-                                  setdefault(k, v),
+                                  __setitem__(k, v),
         })
 
         self.mock_query_spf = patch("oa.plugins.spf.SpfPlugin."
                                     "_query_spf").start()
 
         self.plug = oa.plugins.spf.SpfPlugin(self.mock_ctxt)
+        self.plug.check_start(self.mock_msg)
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
         patch.stopall()
 
     def test_check_spf_received_header_no_valid_header(self):
-        self.plug.check_spf_received_header(received_spf_headers=["header"])
+        self.plug.check_spf_received_header(self.mock_msg,
+                                           received_spf_headers=["header"])
 
     def test_check_spf_received_header(self):
-        self.plug.spf_check = True
+        self.msg_data["spf_check"] = True
         received_spf_headers = ['softfail (example.com: domain of test@example.com)']
-        self.plug.check_spf_received_header(received_spf_headers)
+        self.plug.check_spf_received_header(self.mock_msg,
+                                           received_spf_headers)
 
     def test_check_spf_received_header_identity_check_True(self):
-        self.plug.spf_check_helo = True
-        self.plug.spf_check = True
+        self.msg_data["spf_check_helo"] = True
+        self.msg_data["spf_check"] = True
         received_spf_headers = [
             'softfail (example.com: domain of test@example.com) identity=helo']
-        self.plug.check_spf_received_header(received_spf_headers)
+        self.plug.check_spf_received_header(self.mock_msg,
+                                           received_spf_headers)
 
     def test_check_spf_received_header_identity_check_False(self):
-        self.plug.spf_check_helo = False
+        self.msg_data["spf_check_helo"] = False
         received_spf_headers = [
             'softfail (example.com: domain of test@example.com) identity=helo']
-        self.plug.check_spf_received_header(received_spf_headers)
+        self.plug.check_spf_received_header(self.mock_msg,
+                                           received_spf_headers)
 
     def test_check_spf_received_header_identity_mfrom_spf_check_true(self):
-        self.plug.spf_check = True
+        self.msg_data["spf_check"] = True
         received_spf_headers = [
             'softfail (example.com: domain of test@example.com) identity=mfrom']
-        self.plug.check_spf_received_header(received_spf_headers)
+        self.plug.check_spf_received_header(self.mock_msg,
+                                           received_spf_headers)
 
     def test_check_spf_received_header_identity_mfrom_spf_check_false(self):
-        self.plug.spf_check = False
+        self.msg_data["spf_check"] = False
         received_spf_headers = [
             'softfail (example.com: domain of test@example.com) identity=mfrom']
-        self.plug.check_spf_received_header(received_spf_headers)
+        self.plug.check_spf_received_header(self.mock_msg,
+                                           received_spf_headers)
@@ -0,0 +1,236 @@
+"""Tests for pad.plugins.uri_dnsbl"""
+
+import unittest
+
+try:
+    from unittest.mock import patch, MagicMock
+except ImportError:
+    from mock import patch, MagicMock
+
+import oa.dns_interface
+import oa.plugins.uri_dnsbl
+
+
+class TestGetURIHost(unittest.TestCase):
+
+    def test_absolute(self):
+        self.assertEqual(oa.plugins.uri_dnsbl.get_uri_host(
+            "https://user:pw@WWW.Example.com:8080/a?b#c"), "www.example.com")
+
+    def test_no_scheme(self):
+        self.assertEqual(oa.plugins.uri_dnsbl.get_uri_host(
+            "www.example.com/path"), "www.example.com")
+
+    def test_mailto(self):
+        self.assertEqual(oa.plugins.uri_dnsbl.get_uri_host(
+            "mailto:user@mail.example.com?subject=Hi"), "mail.example.com")
+
+    def test_relative(self):
+        self.assertIsNone(oa.plugins.uri_dnsbl.get_uri_host("/path/page"))
+        self.assertIsNone(oa.plugins.uri_dnsbl.get_uri_host("page.html"))
+
+    def test_ipv6(self):
+        self.assertIsNone(oa.plugins.uri_dnsbl.get_uri_host("http://[::1]/"))
+
+
+class TestURIDNSBL(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.local_data = {}
+        self.global_data = {
+            "urirhsbl": ["URIBL_BLACK multi.uribl.example. A"],
+            "urirhssub": ["URIBL_DBL dbl.example. A 127.0.1.2",
+                          "URIBL_GREY multi.uribl.example. A 4"],
+            "uridnsbl_max_domains": 20,
+            "uridnsbl_skip_domain": ["skip.example.com"],
+            "uridnsbl_timeout": 15,
+            "uridnsbl_public_suffix_list": "",
+            "util_rb_tld": ["com", "uk"],
+            "util_rb_2tld": ["co.uk"],
+            "util_rb_3tld": [],
+        }
+        self.mock_ctxt = MagicMock()
+        self.mock_ctxt.skip_rbl_checks = False
+        self.mock_ctxt.dns.query_async.side_effect = self.query_async
+        self.mock_msg = MagicMock(local_only=False)
+        self.mock_msg.dns_budget = oa.dns_interface.DNSBudget()
+        self.mock_msg.uri_list = {"http://www.example.com/a",
+                                  "http://example.com/b",
+                                  "http://www.example.co.uk/",
+                                  "http://skip.example.com/",
+                                  "http://93.184.216.34/x",
+                                  "http://10.0.0.1/x"}
+        self.mock_msg.uri_detail_links = {
+            "http://news.example.net/track?id=1": {},
+            "/relative": {},
+            "mailto:user@example.org": {},
+        }
+        self.plugin = oa.plugins.uri_dnsbl.URIDNSBLPlugin(self.mock_ctxt)
+        self.plugin.set_local = lambda m, k, v: self.local_data.__setitem__(k, v)
+        self.plugin.get_local = lambda m, k: self.local_data.__getitem__(k)
+        self.plugin.set_global = self.global_data.__setitem__
+        self.plugin.get_global = self.global_data.__getitem__
+        self.answers = {}
+        self.queries = []
+        self.plugin.finish_parsing_end(MagicMock(checked={}, not_checked={}))
+
+    def tearDown(self):
+        patch.stopall()
+        unittest.TestCase.tearDown(self)
+
+    def query_async(self, qname, qtype):
+        self.queries.append((qname, qtype))
+        pending = oa.dns_interface.PendingQuery(qname, qtype)
+        pending.set_result(self.answers.get(qname, []))
+        return pending
+
+    def test_finish_parsing_end(self):
+        self.assertEqual(self.plugin["rules"], {
+            "URIBL_BLACK": ("multi.uribl.example.", "A", None),
+            "URIBL_DBL": ("dbl.example.", "A", "127.0.1.2"),
+            "URIBL_GREY": ("multi.uribl.example.", "A", 4),
+        })
+        self.assertEqual(self.plugin["lookups"],
+                         [("dbl.example.", "A"),
+                          ("multi.uribl.example.", "A")])
+
+    def test_finish_parsing_end_invalid(self):
+        self.global_data["urirhsbl"].append("URIBL_INVALID zone.example.")
+        self.global_data["urirhssub"].append(
+            "URIBL_SUB zone.example. A invalid")
+        self.plugin.finish_parsing_end(MagicMock(checked={}, not_checked={}))
+        self.assertEqual(self.mock_ctxt.err.call_count, 2)
+        self.assertNotIn("URIBL_SUB", self.plugin["rules"])
+
+    def test_get_domains(self):
+        self.assertEqual(self.plugin.get_domains(self.mock_msg), [
+            "example.net", "example.org", "34.216.184.93", "example.com",
+            "example.co.uk",
+        ])
+
+    def test_get_domains_max(self):
+        self.global_data["uridnsbl_max_domains"] = 2
+        self.assertEqual(self.plugin.get_domains(self.mock_msg),
+                         ["example.net", "example.org"])
+
+    def test_get_domains_no_links(self):
+        del self.mock_msg.uri_detail_links
+        self.mock_msg.raw_text = "Visit http://a.example.com/"
+        self.mock_msg.uri_list = {"http://a.example.com/",
+                                  "http://b.example.com/"}
+        self.assertEqual(self.plugin.get_domains(self.mock_msg),
+                         ["example.com"])
+
+    def test_get_domains_parses_links(self):
+        """The HTML links come first even if the URIDetail plugin
+        didn't parse them yet.
+        """
+        del self.mock_msg.uri_detail_links
+        self.mock_msg.raw_text = ('<a href="http://www.example.org/">'
+                                  'Offer</a>')
+        self.mock_msg.uri_list = {"http://www.example.org/",
+                                  "http://a.example.com/"}
+        self.assertEqual(self.plugin.get_domains(self.mock_msg),
+                         ["example.org", "example.com"])
+
+    def test_lookups_started(self):
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertEqual(len(self.queries), 10)
+        self.assertEqual(len(set(self.queries)), 10)
+        self.assertIn(("example.co.uk.dbl.example.", "A"), self.queries)
+
+    def test_lookups_local_only(self):
+        self.mock_msg.local_only = True
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertEqual(self.queries, [])
+        self.assertFalse(self.plugin.check_uridnsbl(self.mock_msg,
+                                                    "URIBL_BLACK"))
+
+    def test_lookups_skip_rbl_checks(self):
+        self.mock_ctxt.skip_rbl_checks = True
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertEqual(self.queries, [])
+
+    def test_check_urirhsbl(self):
+        self.answers["example.co.uk.multi.uribl.example."] = ["127.0.0.2"]
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertTrue(self.plugin.check_uridnsbl(self.mock_msg,
+                                                   "URIBL_BLACK"))
+        self.assertFalse(self.plugin.check_uridnsbl(self.mock_msg,
+                                                    "URIBL_DBL"))
+
+    def test_check_urirhsbl_not_listed(self):
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertFalse(self.plugin.check_uridnsbl(self.mock_msg,
+                                                    "URIBL_BLACK"))
+
+    def test_check_urirhssub_ip(self):
+        self.answers["example.org.dbl.example."] = ["127.0.1.2"]
+        self.answers["example.net.dbl.example."] = ["127.0.1.3"]
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertTrue(self.plugin.check_uridnsbl(self.mock_msg,
+                                                   "URIBL_DBL"))
+        del self.answers["example.org.dbl.example."]
+        self.local_data["answers"] = {}
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertFalse(self.plugin.check_uridnsbl(self.mock_msg,
+                                                    "URIBL_DBL"))
+
+    def test_check_urirhssub_mask(self):
+        self.answers["example.com.multi.uribl.example."] = ["127.0.0.6"]
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertTrue(self.plugin.check_uridnsbl(self.mock_msg,
+                                                   "URIBL_GREY"))
+        self.answers["example.com.multi.uribl.example."] = ["127.0.0.2"]
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertFalse(self.plugin.check_uridnsbl(self.mock_msg,
+                                                    "URIBL_GREY"))
+
+    def test_check_answers_shared(self):
+        """The rules that check the same list share the answers."""
+        self.plugin.parsed_metadata(self.mock_msg)
+        pending = self.local_data["lookups"][
+            ("example.com.multi.uribl.example.", "A")]
+        with patch.object(pending, "result",
+                          return_value=["127.0.0.4"]) as result:
+            self.plugin.check_uridnsbl(self.mock_msg, "URIBL_BLACK")
+            self.plugin.check_uridnsbl(self.mock_msg, "URIBL_GREY")
+        self.assertEqual(result.call_count, 1)
+
+    def test_check_waits_for_budget(self):
+        self.mock_msg.dns_budget = oa.dns_interface.DNSBudget(10)
+        self.plugin.parsed_metadata(self.mock_msg)
+        pending = oa.dns_interface.PendingQuery("example.net", "A")
+        self.local_data["lookups"][
+            ("example.net.multi.uribl.example.", "A")] = pending
+        with patch.object(self.mock_msg.dns_budget, "wait",
+                          return_value=[]) as wait:
+            self.plugin.check_uridnsbl(self.mock_msg, "URIBL_BLACK")
+        wait.assert_called_once_with(pending, wait.call_args[0][1])
+        self.assertLessEqual(wait.call_args[0][1], 15)
+
+    def test_check_not_started(self):
+        """Lookups that weren't started are done now."""
+        self.local_data["domains"] = ["example.com"]
+        self.local_data["lookups"] = {}
+        self.local_data["answers"] = {}
+        self.mock_ctxt.dns.query.return_value = ["127.0.0.2"]
+        self.assertTrue(self.plugin.check_uridnsbl(self.mock_msg,
+                                                   "URIBL_BLACK"))
+        self.mock_ctxt.dns.query.assert_called_with(
+            "example.com.multi.uribl.example.", "A",
+            budget=self.mock_msg.dns_budget)
+
+    def test_check_unknown_rule(self):
+        self.plugin.parsed_metadata(self.mock_msg)
+        self.assertFalse(self.plugin.check_uridnsbl(self.mock_msg,
+                                                    "URIBL_UNKNOWN"))
+        self.assertTrue(self.mock_ctxt.err.called)
+
+    def test_public_suffix_list_missing(self):
+        self.global_data["uridnsbl_public_suffix_list"] = "/nonexistent.dat"
+        self.plugin.finish_parsing_end(MagicMock(checked={}, not_checked={}))
+        self.assertTrue(self.mock_ctxt.err.called)
+        self.assertEqual(self.plugin.get_domains(self.mock_msg)[-1],
+                         "example.co.uk")
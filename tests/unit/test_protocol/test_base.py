@@ -1,5 +1,6 @@
 """Tests for pad.protocol.base"""
 
+import zlib
 import unittest
 
 try:
@@ -8,6 +9,7 @@ except ImportError:
     from mock import patch, Mock, call
 
 import oa
+import oa.errors
 import oa.protocol.base
 
 
@@ -18,7 +20,8 @@ class TestBaseCommand(unittest.TestCase):
         self.mock_m = patch("oa.protocol.base.oa.message.Message").start()
         self.mockr = Mock()
         self.mockw = Mock()
-        self.mockserver = Mock()
+        self.mockserver = Mock(max_message_size=None, degraded=False,
+                               result_cache=None)
         self.mockrules = Mock()
         self.mockserver.get_user_ruleset.return_value = self.mockrules
 
@@ -46,6 +49,31 @@ class TestBaseCommand(unittest.TestCase):
         self.mock_h.assert_called_with(None, {"content-length": "20",
                                               "user": "Alex"})
 
+    def test_keep_alive(self):
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"Keep-Alive: yes", b""]
+        base = self.get_base()
+        self.assertTrue(base.keep_alive)
+
+    def test_keep_alive_no(self):
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"Keep-Alive: no", b""]
+        base = self.get_base()
+        self.assertFalse(base.keep_alive)
+
+    def test_keep_alive_not_set(self):
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"User: Alex", b""]
+        base = self.get_base()
+        self.assertIsNone(base.keep_alive)
+
+    def test_keep_alive_invalid_option(self):
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"Keep-Alive: yes", b"User Alex",
+                                           b""]
+        base = self.get_base()
+        self.assertFalse(base.keep_alive)
+
     def test_init_message(self):
         """Test creating a new base protocol command."""
         message = b"Subject: Test\n\nTest message"
@@ -53,8 +81,17 @@ class TestBaseCommand(unittest.TestCase):
         self.mockr.read.side_effect = [message, None]
         base = self.get_base()
         self.mock_h.assert_called_with(self.mock_m.return_value, {})
-        self.mock_m.assert_called_with(self.mockrules.ctxt,
-                                       message.decode("utf8"))
+        self.mock_m.assert_called_with(self.mockrules.ctxt, message)
+
+    def test_init_message_degraded(self):
+        """Test reading a message while the server is overloaded."""
+        message = b"Subject: Test\n\nTest message"
+        oa.protocol.base.BaseProtocol.has_message = True
+        self.mockserver.degraded = True
+        self.mockr.read.side_effect = [message, None]
+        base = self.get_base()
+        self.mock_m.assert_called_with(self.mockrules.ctxt, message,
+                                       local_only=True)
 
     def test_init_message_chunked(self):
         """Test creating a new base protocol command."""
@@ -64,8 +101,7 @@ class TestBaseCommand(unittest.TestCase):
                                        None]
         base = self.get_base()
         self.mock_h.assert_called_with(self.mock_m.return_value, {})
-        self.mock_m.assert_called_with(self.mockrules.ctxt,
-                                       message.decode("utf8"))
+        self.mock_m.assert_called_with(self.mockrules.ctxt, message)
 
     def test_init_message_options(self):
         """Test creating a new base protocol command."""
@@ -78,8 +114,119 @@ class TestBaseCommand(unittest.TestCase):
         base = self.get_base()
         self.mock_h.assert_called_with(
             self.mock_m.return_value, {"content-length": "27", "user": "Alex"})
-        self.mock_m.assert_called_with(self.mockrules.ctxt,
-                                       message.decode("utf8"))
+        self.mock_m.assert_called_with(self.mockrules.ctxt, message)
+
+    def test_init_message_zlib(self):
+        message = b"Subject: Test\n\nTest message"
+        compressed = zlib.compress(message)
+        oa.protocol.base.BaseProtocol.has_message = True
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"Compress: zlib", b""]
+        self.mockr.read.side_effect = [compressed[:5], compressed[5:], None]
+        base = self.get_base()
+        self.mock_m.assert_called_with(self.mockrules.ctxt, message)
+
+    def test_init_message_zlib_invalid(self):
+        oa.protocol.base.BaseProtocol.has_message = True
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"Compress: zlib", b""]
+        self.mockr.read.side_effect = [b"Subject: Test\n\nTest message",
+                                       None]
+        base = self.get_base()
+        self.assertFalse(self.mock_h.called)
+        self.assertFalse(base.keep_alive)
+        self.assertIn(b" 65 EX_DATAERR", self.mockw.write.call_args[0][0])
+
+    def test_init_message_zlib_truncated(self):
+        compressed = zlib.compress(b"Subject: Test\n\nTest message" * 10)
+        oa.protocol.base.BaseProtocol.has_message = True
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"Compress: zlib", b""]
+        self.mockr.read.side_effect = [compressed[:-6], None]
+        base = self.get_base()
+        self.assertFalse(self.mock_h.called)
+        self.assertIn(b" 65 EX_DATAERR", self.mockw.write.call_args[0][0])
+
+    def test_max_size_content_length(self):
+        """The message is rejected without being read."""
+        self.mockserver.max_message_size = 10
+        oa.protocol.base.BaseProtocol.has_message = True
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"Content-Length: 27", b""]
+        base = self.get_base()
+        self.assertFalse(self.mockr.read.called)
+        self.assertFalse(self.mock_h.called)
+        self.assertFalse(base.keep_alive)
+        self.assertIn(b" 65 EX_DATAERR", self.mockw.write.call_args[0][0])
+
+    def test_max_size_read(self):
+        self.mockserver.max_message_size = 20
+        oa.protocol.base.BaseProtocol.has_message = True
+        self.mockr.read.side_effect = [b"Subject: Test\n\nT", b"est message",
+                                       b"more", None]
+        base = self.get_base()
+        self.assertEqual(self.mockr.read.call_count, 2)
+        self.assertFalse(self.mock_h.called)
+
+    def test_max_size_ok(self):
+        message = b"Subject: Test\n\nTest message"
+        self.mockserver.max_message_size = len(message)
+        oa.protocol.base.BaseProtocol.has_message = True
+        self.mockr.read.side_effect = [message, None]
+        base = self.get_base()
+        self.mock_m.assert_called_with(self.mockrules.ctxt, message)
+
+    def test_max_size_zlib(self):
+        """The decompressed size of the message is limited."""
+        compressed = zlib.compress(b"A" * 100000)
+        self.mockserver.max_message_size = 1000
+        oa.protocol.base.BaseProtocol.has_message = True
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"Compress: zlib", b""]
+        self.mockr.read.side_effect = [compressed, None]
+        base = self.get_base()
+        self.assertFalse(self.mock_h.called)
+        self.assertIn(b" 65 EX_DATAERR", self.mockw.write.call_args[0][0])
+
+    def test_max_size_zlib_flush(self):
+        """The data left in the decompressor is limited too."""
+        self.mockserver.max_message_size = 1000
+        oa.protocol.base.BaseProtocol.has_message = True
+        oa.protocol.base.BaseProtocol.has_options = True
+        self.mockr.readline.side_effect = [b"Compress: zlib", b""]
+        self.mockr.read.side_effect = [b"compressed", None]
+        decompressor = patch("oa.protocol.base.zlib.decompressobj").start()
+        decompressor.return_value.decompress.return_value = b"A" * 500
+        decompressor.return_value.flush.return_value = b"A" * 501
+        decompressor.return_value.eof = True
+        base = self.get_base()
+        self.assertFalse(self.mock_h.called)
+        self.assertIn(b" 65 EX_DATAERR", self.mockw.write.call_args[0][0])
+
+    def test_body_deadline(self):
+        oa.protocol.base.BaseProtocol.has_message = True
+        self.mockr.read.side_effect = [b"Subject: Test\n\nTest", None]
+        base = self.get_base()
+        self.mockr.set_deadline.assert_called_with(
+            "body", self.mockserver.body_timeout,
+            self.mockserver.min_transfer_rate
+        )
+
+    def test_body_timeout(self):
+        oa.protocol.base.BaseProtocol.has_message = True
+        self.mockr.read.side_effect = oa.errors.ReadTimeout("too slow")
+        base = self.get_base()
+        self.assertFalse(self.mock_h.called)
+        self.assertFalse(base.keep_alive)
+        self.mockw.write.assert_called_with(
+            ("SPAMD/%s 79 EX_TIMEOUT: (too slow)\r\n" %
+             oa.__version__).encode("utf8")
+        )
+
+    def test_init_response_bytes(self):
+        self.mock_h.return_value = ["Content-length: 2\r\n\r\n", b"\x78\x9c"]
+        base = self.get_base()
+        self.mockw.write.assert_called_with(b"\x78\x9c")
 
     def test_init_response(self):
         """Test creating a new base protocol command."""
@@ -0,0 +1,153 @@
+"""Tests for oa.protocol.batch"""
+
+import io
+import unittest
+
+try:
+    from unittest.mock import patch, Mock
+except ImportError:
+    from mock import patch, Mock
+
+import oa.errors
+import oa.protocol.batch
+
+
+class TestBatchCommand(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        patch("oa.protocol.batch.BatchCommand.get_and_handle").start()
+        self.mock_msg = patch("oa.protocol.batch.oa.message.Message").start()
+        self.mock_msg.side_effect = self.create_msg
+        self.conf = {
+            "required_score": 5
+        }
+        self.mockserver = Mock(batch_workers=2, max_message_size=None,
+                               degraded=False, result_cache=None)
+        self.mockrules = Mock(conf=self.conf)
+        self.mockrules.match.side_effect = self.match
+        self.mockserver.get_user_ruleset.return_value = self.mockrules
+        self.mockw = Mock()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def create_msg(self, ctxt, raw_msg, local_only=False):
+        return Mock(raw_msg=raw_msg, score=0, local_only=local_only,
+                    rules_checked={"TEST_RULE": True},
+                    dns_budget=Mock(exhausted=False))
+
+    def match(self, msg):
+        if msg.raw_msg == b"spam":
+            msg.score = 10
+        elif msg.raw_msg == b"error":
+            raise ValueError("Test error")
+
+    def get_command(self, data):
+        cmd = oa.protocol.batch.BatchCommand(io.BytesIO(data), self.mockw,
+                                             self.mockserver)
+        cmd.ruleset = self.mockrules
+        return cmd
+
+    def get_results(self, data, options=None):
+        if options is None:
+            options = {}
+        cmd = self.get_command(data)
+        messages = cmd.read_message(options)
+        response = "".join(cmd.handle(messages, options))
+        results = {}
+        body = response.rpartition("Messages: ")[0]
+        for part in body.split("Message: ")[1:]:
+            index, sep, result = part.partition("\r\n")
+            results[int(index)] = result
+        return response, results
+
+    def test_read_frames(self):
+        cmd = self.get_command(b"4\r\nspam\r\n3\r\nham0\r\n")
+        self.assertEqual(list(cmd.read_frames()), [b"spam", b"ham"])
+
+    def test_read_frames_eof(self):
+        cmd = self.get_command(b"4\r\nspam")
+        self.assertEqual(list(cmd.read_frames()), [b"spam"])
+
+    def test_read_frames_stops_at_end(self):
+        cmd = self.get_command(b"4\r\nspam0\r\nPING SPAMC/1.5\r\n")
+        self.assertEqual(list(cmd.read_frames()), [b"spam"])
+        self.assertEqual(cmd.rfile.readline(), b"PING SPAMC/1.5\r\n")
+
+    def test_read_frames_invalid_length(self):
+        cmd = self.get_command(b"spam\r\n")
+        with self.assertRaises(oa.errors.InvalidOption):
+            list(cmd.read_frames())
+
+    def test_read_frames_incomplete(self):
+        cmd = self.get_command(b"10\r\nspam")
+        with self.assertRaises(oa.errors.InvalidOption):
+            list(cmd.read_frames())
+
+    def test_read_frames_too_large(self):
+        self.mockserver.max_message_size = 3
+        cmd = self.get_command(b"4\r\nspam")
+        with self.assertRaises(oa.errors.MessageTooLarge):
+            list(cmd.read_frames())
+
+    def test_invalid_batch_command(self):
+        cmd = self.get_command(b"")
+        with self.assertRaises(oa.errors.InvalidOption):
+            cmd.read_message({"batch-command": "PROCESS"})
+
+    def test_handle_symbols(self):
+        response, results = self.get_results(b"4\r\nspam3\r\nham0\r\n")
+        self.assertEqual(results, {
+            0: "Spam: True ; 10.0 / 5\r\nContent-length: 9\r\n\r\n"
+               "TEST_RULE",
+            1: "Spam: False ; 0.0 / 5\r\nContent-length: 9\r\n\r\n"
+               "TEST_RULE",
+        })
+        self.assertTrue(response.endswith("Messages: 2\r\n\r\n"))
+
+    def test_handle_check(self):
+        response, results = self.get_results(b"4\r\nspam0\r\n",
+                                             {"batch-command": "check"})
+        self.assertEqual(results, {
+            0: "Spam: True ; 10.0 / 5\r\nContent-length: 0\r\n\r\n",
+        })
+
+    def test_handle_degraded(self):
+        self.mockserver.degraded = True
+        response, results = self.get_results(b"4\r\nspam0\r\n",
+                                             {"batch-command": "check"})
+        self.assertEqual(results, {
+            0: "Spam: True ; 10.0 / 5\r\nDegraded: local-only\r\n"
+               "Content-length: 0\r\n\r\n",
+        })
+
+    def test_handle_error(self):
+        response, results = self.get_results(b"5\r\nerror3\r\nham0\r\n")
+        self.assertEqual(results[0], "Error: Test error\r\n\r\n")
+        self.assertTrue(results[1].startswith("Spam: False"))
+        self.assertTrue(response.endswith("Messages: 1\r\n\r\n"))
+
+    def test_handle_invalid_frame(self):
+        response, results = self.get_results(b"3\r\nhamspam\r\n")
+        self.assertTrue(results[1].startswith("Error: Invalid message"))
+        self.assertTrue(response.endswith("Messages: 1\r\n\r\n"))
+
+    def test_handle_match_once(self):
+        self.get_results(b"4\r\nspam3\r\nham3\r\nham0\r\n")
+        self.assertEqual(self.mockrules.match.call_count, 3)
+
+    def test_handle_empty(self):
+        response, results = self.get_results(b"0\r\n")
+        self.assertEqual(response, "Messages: 0\r\n\r\n")
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestBatchCommand, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
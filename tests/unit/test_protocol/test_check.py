@@ -18,13 +18,14 @@ class TestCheckCommand(unittest.TestCase):
         for klass in ("CheckCommand", "SymbolsCommand", "ReportCommand",
                       "ReportIfSpamCommand"):
             patch("oa.protocol.check.%s.get_and_handle" % klass).start()
-        self.msg = Mock(score=0)
+        self.msg = Mock(score=0, local_only=False,
+                        dns_budget=Mock(exhausted=False))
         self.mockr = Mock()
         self.mockw = Mock()
         self.conf = {
             "required_score": 5
         }
-        self.mockserver = Mock()
+        self.mockserver = Mock(degraded=False, result_cache=None)
         self.mockrules = Mock(conf=self.conf)
         self.mockserver.get_user_ruleset.return_value = self.mockrules
 
@@ -100,6 +101,34 @@ class TestCheckCommand(unittest.TestCase):
                     'Content-length: 11\r\n\r\n', 'Test report']
         self.assertEqual(result, expected)
 
+    def test_check_result_cache(self):
+        cmd = oa.protocol.check.CheckCommand(self.mockr, self.mockw,
+                                             self.mockserver)
+        self.mockserver.result_cache = Mock()
+        list(cmd.handle(self.msg, {}))
+        self.mockserver.result_cache.match.assert_called_with(
+            self.mockrules, self.msg
+        )
+        self.assertFalse(self.mockrules.match.called)
+
+    def test_check_degraded(self):
+        cmd = oa.protocol.check.CheckCommand(self.mockr, self.mockw,
+                                             self.mockserver)
+        self.msg.local_only = True
+        result = list(cmd.handle(self.msg, {}))
+        self.assertEqual(result, ["Spam: False ; 0.0 / 5\r\n",
+                                  "Degraded: local-only\r\n",
+                                  "Content-length: 0\r\n\r\n", ""])
+
+    def test_check_dns_budget(self):
+        cmd = oa.protocol.check.CheckCommand(self.mockr, self.mockw,
+                                             self.mockserver)
+        self.msg.dns_budget.exhausted = True
+        result = list(cmd.handle(self.msg, {}))
+        self.assertEqual(result, ["Spam: False ; 0.0 / 5\r\n",
+                                  "Degraded: dns-budget\r\n",
+                                  "Content-length: 0\r\n\r\n", ""])
+
     def test_report_ifspam_score(self):
         cmd = oa.protocol.check.ReportIfSpamCommand(
                 self.mockr, self.mockw, self.mockserver)
@@ -120,6 +149,14 @@ class TestCheckCommand(unittest.TestCase):
                                                  '0\r\n\r\n', '']
         self.assertEqual(result, expected)
 
+    def test_check_not_compressed(self):
+        cmd = oa.protocol.check.CheckCommand(self.mockr, self.mockw,
+                                             self.mockserver)
+        result = list(cmd.handle(self.msg, {"accept-compress": "zlib"}))
+        self.assertEqual(result, ["Spam: %s ; %.1f / %s\r\n" % (False, 0, 5),
+                                  'Content-length: 0\r\n\r\n', ""])
+
+
 def suite():
     """Gather all the tests from this package in a test suite."""
     test_suite = unittest.TestSuite()
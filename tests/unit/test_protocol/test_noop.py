@@ -8,6 +8,7 @@ except ImportError:
     from mock import patch, Mock, call
 
 import oa
+import oa.metrics
 import oa.protocol.noop
 
 
@@ -35,6 +36,19 @@ class TestNoopCommand(unittest.TestCase):
 
         self.mockw.write.assert_has_calls(calls)
 
+    def test_stats(self):
+        oa.metrics.reset()
+        oa.metrics.incr("timeouts_body", 2)
+        oa.metrics.set_gauge("connections", 1)
+        oa.protocol.noop.StatsCommand(self.mockr, self.mockw, self.mockrules)
+        response = b"".join(args[0] for args, kwargs in
+                            self.mockw.write.call_args_list)
+        body = b"connections: 1\r\ntimeouts_body: 2\r\n"
+        self.assertTrue(response.endswith(
+            ("Content-length: %d\r\n\r\n" % len(body)).encode("utf8") + body
+        ))
+        oa.metrics.reset()
+
 
 def suite():
     """Gather all the tests from this package in a test suite."""
@@ -1,5 +1,6 @@
 """Tests for pad.protocol.base"""
 
+import zlib
 import unittest
 
 try:
@@ -19,12 +20,13 @@ class TestProcessCommand(unittest.TestCase):
         self.conf = {
             "required_score": 5
         }
-        self.mockserver = Mock()
+        self.mockserver = Mock(degraded=False, result_cache=None)
         self.mockrules = Mock(conf=self.conf)
         self.mockserver.get_user_ruleset.return_value = self.mockrules
         for klass in ("ProcessCommand", "HeadersCommand"):
             patch("oa.protocol.process.%s.get_and_handle" % klass).start()
-        self.msg = Mock(score=0)
+        self.msg = Mock(score=0, local_only=False,
+                        dns_budget=Mock(exhausted=False))
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
@@ -46,6 +48,24 @@ class TestProcessCommand(unittest.TestCase):
                                   'Content-length: 4\r\n\r\n', 'Test'])
         self.mockrules.get_adjusted_message.assert_called_with(self.msg)
 
+    def test_process_result_compressed(self):
+        cmd = oa.protocol.process.ProcessCommand(self.mockr, self.mockw,
+                                                 self.mockserver)
+        self.mockrules.get_adjusted_message.return_value = "Test"
+        result = list(cmd.handle(self.msg, {"accept-compress": "zlib"}))
+        compressed = zlib.compress(b"Test")
+        self.assertEqual(result, ['Spam: False ; 0.0 / 5\r\n',
+                                  'Compress: zlib\r\n',
+                                  'Content-length: %s\r\n\r\n' %
+                                  len(compressed), compressed])
+
+    def test_headers_result_compressed(self):
+        cmd = oa.protocol.process.HeadersCommand(self.mockr, self.mockw,
+                                                 self.mockserver)
+        self.mockrules.get_adjusted_message.return_value = "Test"
+        result = list(cmd.handle(self.msg, {"accept-compress": "zlib"}))
+        self.assertEqual(zlib.decompress(result[-1]), b"Test")
+
     def test_headers(self):
         cmd = oa.protocol.process.HeadersCommand(self.mockr, self.mockw,
                                                  self.mockserver)
@@ -16,12 +16,13 @@ class TestTellCommand(unittest.TestCase):
         unittest.TestCase.setUp(self)
         self.mockr = Mock()
         self.mockw = Mock()
-        self.mockserver = Mock()
+        self.mockserver = Mock(degraded=False, result_cache=None)
         self.mockrules = Mock()
         self.mockserver.get_user_ruleset.return_value = self.mockrules
         for klass in ("TellCommand",):
             patch("oa.protocol.tell.%s.get_and_handle" % klass).start()
-        self.msg = Mock(score=0)
+        self.msg = Mock(score=0, local_only=False,
+                        dns_budget=Mock(exhausted=False))
 
     def tearDown(self):
         unittest.TestCase.tearDown(self)
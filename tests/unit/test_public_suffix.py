@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+"""Tests for pad.public_suffix"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import oa.public_suffix
+
+RULES = u"""// A comment
+com
+uk
+co.uk
+
+*.ck
+!www.ck
+jp
+*.kobe.jp
+!city.kobe.jp
+公司.cn
+"""
+
+
+class TestPublicSuffixList(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.suffixes = oa.public_suffix.PublicSuffixList(RULES.splitlines())
+
+    def get(self, host):
+        return self.suffixes.get_registrable_domain(host)
+
+    def test_len(self):
+        # The international rule is added in its IDNA form too.
+        self.assertEqual(len(self.suffixes), 10)
+
+    def test_simple(self):
+        self.assertEqual(self.get("www.example.com"), "example.com")
+        self.assertEqual(self.get("example.com"), "example.com")
+
+    def test_longest_match(self):
+        self.assertEqual(self.get("a.b.example.co.uk"), "example.co.uk")
+        self.assertEqual(self.get("example.uk"), "example.uk")
+
+    def test_suffix_only(self):
+        self.assertIsNone(self.get("co.uk"))
+        self.assertIsNone(self.get("com"))
+
+    def test_wildcard(self):
+        self.assertEqual(self.get("www.example.foo.ck"), "example.foo.ck")
+        self.assertIsNone(self.get("foo.ck"))
+        self.assertEqual(self.get("a.b.c.kobe.jp"), "b.c.kobe.jp")
+
+    def test_exception(self):
+        self.assertEqual(self.get("www.ck"), "www.ck")
+        self.assertEqual(self.get("a.www.ck"), "www.ck")
+        self.assertEqual(self.get("www.city.kobe.jp"), "city.kobe.jp")
+
+    def test_unlisted(self):
+        """Names no rule covers have a one label suffix."""
+        self.assertEqual(self.get("www.example.test"), "example.test")
+        self.assertIsNone(self.get("test"))
+
+    def test_case_and_dot(self):
+        self.assertEqual(self.get("WWW.Example.CO.UK."), "example.co.uk")
+
+    def test_idna(self):
+        self.assertEqual(self.get(u"www.example.公司.cn"),
+                         u"example.公司.cn")
+        self.assertEqual(self.get("www.example.xn--55qx5d.cn"),
+                         "example.xn--55qx5d.cn")
+
+    def test_empty_label(self):
+        self.assertIsNone(self.get("example..com"))
+
+    def test_load_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "public_suffix_list.dat")
+            with open(path, "wb") as suffix_file:
+                suffix_file.write(RULES.encode("utf-8"))
+            suffixes = oa.public_suffix.PublicSuffixList()
+            suffixes.load_file(path)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(suffixes.get_registrable_domain("a.b.co.uk"),
+                         "b.co.uk")
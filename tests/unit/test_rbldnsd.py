@@ -0,0 +1,278 @@
+"""Tests for pad.rbldnsd"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+import oa.rbldnsd
+
+IP4SET = """# A comment
+$TTL 300
+:127.0.0.2:Listed, see http://example.com/?ip=$
+10.0.0.0/8
+10.1.2.3 :4:Special
+!10.1.2.4
+192.168.1.1-10
+172.16
+invalid
+"""
+
+DNSET = """:3:Listed $
+example.com
+.spam.example :5:
+*.wild.example
+!ok.spam.example
+"""
+
+
+class TestParseZone(unittest.TestCase):
+
+    def test_parse_ip4set(self):
+        entries = oa.rbldnsd.parse_zone("ip4set", IP4SET.splitlines())
+        default = ("127.0.0.2", "Listed, see http://example.com/?ip=$")
+        self.assertEqual(entries, [
+            ((0x0A000000, 0x0AFFFFFF), default),
+            ((0x0A010203, 0x0A010203), ("127.0.0.4", "Special")),
+            ((0x0A010204, 0x0A010204), None),
+            ((0xC0A80101, 0xC0A8010A), default),
+            ((0xAC100000, 0xAC10FFFF), default),
+        ])
+
+    def test_parse_dnset(self):
+        entries = oa.rbldnsd.parse_zone("dnset", DNSET.splitlines())
+        self.assertEqual(entries, [
+            ("example.com", ("127.0.0.3", "Listed $")),
+            ("spam.example", ("127.0.0.5", "")),
+            ("*.spam.example", ("127.0.0.5", "")),
+            ("*.wild.example", ("127.0.0.3", "Listed $")),
+            ("ok.spam.example", None),
+        ])
+
+    def test_parse_invalid_logged(self):
+        log = logging.getLogger("oa-logger")
+        with patch.object(log, "warning") as warning:
+            oa.rbldnsd.parse_zone("ip4set", ["10.0.0.0/33", "1.2.3.4-300"],
+                                  log)
+        self.assertEqual(warning.call_count, 2)
+
+    def test_parse_unknown_type(self):
+        self.assertRaises(ValueError, oa.rbldnsd.parse_zone, "combined", [])
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def get_snapshot(self, kind, zone):
+        entries = oa.rbldnsd.parse_zone(kind, zone.splitlines())
+        return oa.rbldnsd.Snapshot(oa.rbldnsd.build_snapshot(kind, entries))
+
+    def find_ip(self, snapshot, ip):
+        index = snapshot.find_ip(oa.rbldnsd._ip_to_int(ip))
+        if index is None:
+            return None
+        return snapshot.get_value(index)[0]
+
+    def test_most_specific(self):
+        snapshot = self.get_snapshot("ip4trie", IP4SET)
+        self.assertEqual(self.find_ip(snapshot, "10.1.2.3"), "127.0.0.4")
+        self.assertEqual(self.find_ip(snapshot, "10.1.2.2"), "127.0.0.2")
+        self.assertEqual(self.find_ip(snapshot, "10.255.255.255"),
+                         "127.0.0.2")
+
+    def test_excluded(self):
+        snapshot = self.get_snapshot("ip4set", IP4SET)
+        self.assertIsNone(self.find_ip(snapshot, "10.1.2.4"))
+        self.assertEqual(self.find_ip(snapshot, "10.1.2.5"), "127.0.0.2")
+
+    def test_not_listed(self):
+        snapshot = self.get_snapshot("ip4set", IP4SET)
+        self.assertIsNone(self.find_ip(snapshot, "9.255.255.255"))
+        self.assertIsNone(self.find_ip(snapshot, "192.168.1.11"))
+        self.assertIsNone(self.find_ip(snapshot, "0.0.0.0"))
+        self.assertIsNone(self.find_ip(snapshot, "255.255.255.255"))
+
+    def test_ranges(self):
+        snapshot = self.get_snapshot("ip4set", IP4SET)
+        self.assertEqual(self.find_ip(snapshot, "192.168.1.1"), "127.0.0.2")
+        self.assertEqual(self.find_ip(snapshot, "192.168.1.10"), "127.0.0.2")
+        self.assertEqual(self.find_ip(snapshot, "172.16.200.1"), "127.0.0.2")
+
+    def test_overlapping_ranges(self):
+        snapshot = self.get_snapshot(
+            "ip4set", "10.0.0.1-100 :2:\n10.0.0.50-200 :3:\n")
+        self.assertEqual(self.find_ip(snapshot, "10.0.0.10"), "127.0.0.2")
+        self.assertEqual(self.find_ip(snapshot, "10.0.0.60"), "127.0.0.2")
+        self.assertEqual(self.find_ip(snapshot, "10.0.0.150"), "127.0.0.3")
+
+    def test_flatten_merges(self):
+        ranges = [(0, 9, 1), (10, 19, 1), (20, 29, 2)]
+        self.assertEqual(oa.rbldnsd._flatten(ranges),
+                         [(0, 19, 1), (20, 29, 2)])
+
+    def test_find_name(self):
+        snapshot = self.get_snapshot("dnset", DNSET)
+        self.assertIsNotNone(snapshot.find_name("example.com"))
+        self.assertIsNotNone(snapshot.find_name("*.spam.example"))
+        self.assertIsNone(snapshot.find_name("www.example.com"))
+
+    def test_empty(self):
+        snapshot = self.get_snapshot("dnset", "")
+        self.assertEqual(len(snapshot), 0)
+        self.assertIsNone(snapshot.find_name("example.com"))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, oa.rbldnsd.Snapshot, b"OAZ0" * 10)
+        self.assertRaises(ValueError, oa.rbldnsd.Snapshot, b"OAZ1")
+
+
+class TestZone(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        self.directory = tempfile.mkdtemp()
+        self.snapshots = os.path.join(self.directory, "snapshots")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        oa.rbldnsd._snapshots.clear()
+        unittest.TestCase.tearDown(self)
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as zone_file:
+            zone_file.write(data)
+        return path
+
+    def get_zone(self, kind, zone, name="list.example.com"):
+        path = self.write("%s.txt" % kind, zone)
+        return oa.rbldnsd.Zone(name, kind, path, self.snapshots)
+
+    def test_lookup_ip_a(self):
+        zone = self.get_zone("ip4set", IP4SET)
+        self.assertEqual(zone.lookup(["3", "2", "1", "10"]), ["127.0.0.4"])
+
+    def test_lookup_ip_txt(self):
+        zone = self.get_zone("ip4set", IP4SET)
+        self.assertEqual(zone.lookup(["5", "2", "1", "10"], "TXT"),
+                         ['"Listed, see http://example.com/?ip=10.1.2.5"'])
+
+    def test_lookup_ip_not_listed(self):
+        zone = self.get_zone("ip4set", IP4SET)
+        self.assertEqual(zone.lookup(["4", "2", "1", "10"]), [])
+
+    def test_lookup_ip_other_type(self):
+        zone = self.get_zone("ip4set", IP4SET)
+        self.assertEqual(zone.lookup(["5", "2", "1", "10"], "MX"), [])
+
+    def test_lookup_ipv6(self):
+        zone = self.get_zone("ip4set", IP4SET)
+        self.assertEqual(zone.lookup(["1", "0"] * 16), [])
+
+    def test_lookup_domain(self):
+        zone = self.get_zone("dnset", DNSET)
+        self.assertEqual(zone.lookup(["example", "com"]), ["127.0.0.3"])
+        self.assertEqual(zone.lookup(["www", "example", "com"]), [])
+
+    def test_lookup_domain_txt(self):
+        zone = self.get_zone("dnset", DNSET)
+        self.assertEqual(zone.lookup(["example", "com"], "TXT"),
+                         ['"Listed example.com"'])
+
+    def test_lookup_domain_subdomains(self):
+        zone = self.get_zone("dnset", DNSET)
+        self.assertEqual(zone.lookup(["spam", "example"]), ["127.0.0.5"])
+        self.assertEqual(zone.lookup(["a", "b", "spam", "example"]),
+                         ["127.0.0.5"])
+        self.assertEqual(zone.lookup(["ok", "spam", "example"]), [])
+
+    def test_lookup_domain_wildcard(self):
+        zone = self.get_zone("dnset", DNSET)
+        self.assertEqual(zone.lookup(["wild", "example"]), [])
+        self.assertEqual(zone.lookup(["www", "wild", "example"]),
+                         ["127.0.0.3"])
+
+    def test_snapshot_shared(self):
+        """The zones of the same file share one snapshot."""
+        first = self.get_zone("ip4set", IP4SET)
+        second = oa.rbldnsd.Zone("other.example.com", "ip4set", first.path,
+                                 self.snapshots)
+        self.assertIs(first.snapshot, second.snapshot)
+        self.assertEqual(len(os.listdir(self.snapshots)), 1)
+
+    def test_snapshot_reused(self):
+        """Another process opens the snapshot instead of building it."""
+        zone = self.get_zone("ip4set", IP4SET)
+        oa.rbldnsd._snapshots.clear()
+        with patch("oa.rbldnsd.build_snapshot") as build:
+            other = oa.rbldnsd.Zone("list.example.com", "ip4set", zone.path,
+                                    self.snapshots)
+        build.assert_not_called()
+        self.assertEqual(other.lookup(["3", "2", "1", "10"]), ["127.0.0.4"])
+
+    def test_reload(self):
+        zone = self.get_zone("ip4set", IP4SET)
+        old = zone.snapshot
+        self.write("ip4set.txt", "10.1.2.3 :9:\n")
+        os.utime(zone.path, (0, 0))
+        zone.check()
+        self.assertIs(zone.snapshot, old)
+        zone._next_check = 0
+        zone.check()
+        self.assertIsNot(zone.snapshot, old)
+        self.assertEqual(zone.lookup(["3", "2", "1", "10"]), ["127.0.0.9"])
+        self.assertEqual(zone.lookup(["5", "2", "1", "10"]), [])
+        # The previous snapshot is removed.
+        self.assertEqual(len(os.listdir(self.snapshots)), 1)
+
+    def test_reload_missing(self):
+        """The previous version is kept if the file can't be read."""
+        zone = self.get_zone("ip4set", IP4SET)
+        os.remove(zone.path)
+        zone.load()
+        self.assertEqual(zone.lookup(["3", "2", "1", "10"]), ["127.0.0.4"])
+
+    def test_missing(self):
+        self.assertRaises(OSError, oa.rbldnsd.Zone, "list.example.com",
+                          "ip4set", os.path.join(self.directory, "missing"),
+                          self.snapshots)
+
+
+class TestLocalZones(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.zones = oa.rbldnsd.LocalZones()
+        self.zone = oa.rbldnsd.Zone.__new__(oa.rbldnsd.Zone)
+        self.zone.name = "list.example.com"
+        self.zone.kind = "ip4set"
+        entries = oa.rbldnsd.parse_zone("ip4set", IP4SET.splitlines())
+        self.zone.snapshot = oa.rbldnsd.Snapshot(
+            oa.rbldnsd.build_snapshot("ip4set", entries))
+        self.zones.add(self.zone)
+
+    def test_get_zone(self):
+        self.assertEqual(self.zones.get_zone("3.2.1.10.list.example.com."),
+                         (self.zone, ["3", "2", "1", "10"]))
+
+    def test_get_zone_case(self):
+        self.assertEqual(self.zones.get_zone("3.2.1.10.LIST.example.com"),
+                         (self.zone, ["3", "2", "1", "10"]))
+
+    def test_get_zone_other(self):
+        self.assertEqual(self.zones.get_zone("3.2.1.10.example.com"),
+                         (None, None))
+        self.assertEqual(self.zones.get_zone("list.example.com"),
+                         (None, None))
+
+    def test_lookup(self):
+        self.assertEqual(self.zones.lookup("3.2.1.10.list.example.com"),
+                         ["127.0.0.4"])
+        self.assertEqual(self.zones.lookup("3.2.1.9.list.example.com"), [])
+        self.assertIsNone(self.zones.lookup("3.2.1.10.example.com"))
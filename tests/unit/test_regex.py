@@ -82,11 +82,38 @@ class TestPattern(unittest.TestCase):
         self.assertEqual(result, 1)
 
 
+class TestRegex(unittest.TestCase):
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def test_lazy_compile(self):
+        patch("oa.config.LAZY_MODE", True).start()
+        regex = oa.regex.Regex("test")
+        self.assertTrue(regex.search("a test"))
+        self.assertIsNone(regex.compiled)
+
+    def test_not_lazy_compile(self):
+        patch("oa.config.LAZY_MODE", False).start()
+        regex = oa.regex.Regex("test")
+        self.assertTrue(regex.search("a test"))
+        self.assertIsNotNone(regex.compiled)
+
+    def test_precompile(self):
+        patch("oa.config.LAZY_MODE", True).start()
+        regex = oa.regex.Regex("test", re.I)
+        compiled = regex.precompile()
+        self.assertEqual(compiled.flags & re.I, re.I)
+        self.assertIs(regex.compile(), compiled)
+        self.assertTrue(regex.search("a TEST"))
+
+
 def suite():
     """Gather all the tests from this package in a test suite."""
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(TestPerl2Re, "test"))
     test_suite.addTest(unittest.makeSuite(TestPattern, "test"))
+    test_suite.addTest(unittest.makeSuite(TestRegex, "test"))
     return test_suite
 
 if __name__ == '__main__':
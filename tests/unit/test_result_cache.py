@@ -0,0 +1,448 @@
+"""Tests for oa.result_cache"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest.mock import patch, Mock, MagicMock
+except ImportError:
+    from mock import patch, Mock, MagicMock
+
+import oa.metrics
+import oa.fingerprint
+import oa.rules.uri
+import oa.rules.body
+import oa.rules.full
+import oa.rules.meta
+import oa.rules.eval_
+import oa.rules.header
+import oa.result_cache
+
+
+class TestRulesetInfo(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.plugin = Mock(cacheable_eval_rules=("check_rbl",))
+        self.ruleset = Mock(checked={})
+        self.ruleset.ctxt.plugins = {"DNSEvalPlugin": self.plugin,
+                                     "WLBLEvalPlugin": Mock(spec=[])}
+        self.ruleset.ctxt.userprefs = None
+
+    def add_rule(self, rule):
+        self.ruleset.checked[rule.name] = rule
+        return rule
+
+    def add_meta(self, name, *subrules):
+        rule = self.add_rule(oa.rules.meta.MetaRule(name, " && ".join(
+            subrules)))
+        rule._location = dict((subrule, Mock()) for subrule in subrules)
+        rule._location["match"] = Mock()
+        return rule
+
+    def get_info(self):
+        return oa.result_cache._RulesetInfo(self.ruleset)
+
+    def test_header(self):
+        self.add_rule(oa.rules.header._PatternHeaderRule(
+            "TEST_RULE", pattern=Mock(), header_name="X-Spam-Test"
+        ))
+        info = self.get_info()
+        self.assertIn("x-spam-test", info.headers)
+        self.assertIn("subject", info.headers)
+        self.assertEqual(info.recompute, set())
+
+    def test_header_recipient(self):
+        self.add_rule(oa.rules.header._PatternHeaderRule(
+            "TEST_RULE", pattern=Mock(), header_name="To"
+        ))
+        self.add_rule(oa.rules.header._ToCcHeaderRule("TEST_TOCC", Mock()))
+        self.add_rule(oa.rules.header._AllHeaderRule("TEST_ALL", Mock()))
+        info = self.get_info()
+        self.assertNotIn("to", info.headers)
+        self.assertEqual(info.recompute,
+                         {"TEST_RULE", "TEST_TOCC", "TEST_ALL"})
+
+    def test_body(self):
+        self.add_rule(oa.rules.body.BodyRule("TEST_BODY", Mock()))
+        self.add_rule(oa.rules.body.RawBodyRule("TEST_RAWBODY", Mock()))
+        self.add_rule(oa.rules.uri.URIRule("TEST_URI", Mock()))
+        self.assertEqual(self.get_info().recompute, set())
+
+    def test_full(self):
+        """Full and MIME header rules see all the headers."""
+        self.add_rule(oa.rules.full.FullRule("TEST_FULL", Mock()))
+        self.add_rule(oa.rules.header._PatternMimeHeaderRule(
+            "TEST_MIME", pattern=Mock(), header_name="Subject"
+        ))
+        self.add_meta("TEST_META", "TEST_FULL")
+        self.assertEqual(self.get_info().recompute,
+                         {"TEST_FULL", "TEST_MIME", "TEST_META"})
+
+    def test_unknown(self):
+        rule = Mock(tflags=None)
+        rule.name = "TEST_PLUGIN_RULE"
+        self.add_rule(rule)
+        self.assertEqual(self.get_info().recompute, {"TEST_PLUGIN_RULE"})
+
+    def test_eval(self):
+        """Only the eval rules that plugins list as cacheable are
+        reused.
+        """
+        self.add_rule(oa.rules.eval_.EvalRule(
+            "TEST_WL", "check_from_in_whitelist()"
+        ))
+        self.add_rule(oa.rules.eval_.EvalRule(
+            "TEST_HELO", "check_for_numeric_helo()"
+        ))
+        self.add_rule(oa.rules.eval_.EvalRule(
+            "TEST_RBL", "check_rbl('test', 'rbl.example.com.')"
+        ))
+        self.assertEqual(self.get_info().recompute, {"TEST_WL", "TEST_HELO"})
+
+    def test_meta(self):
+        self.add_rule(oa.rules.eval_.EvalRule(
+            "TEST_WL", "check_from_in_whitelist()"
+        ))
+        self.add_meta("TEST_META", "TEST_WL", "TEST_OTHER")
+        self.add_meta("TEST_META2", "TEST_META")
+        self.add_meta("TEST_META3", "TEST_OTHER")
+        self.assertEqual(self.get_info().recompute,
+                         {"TEST_WL", "TEST_META", "TEST_META2"})
+
+    def test_identity(self):
+        self.assertEqual(self.get_info().identity, "")
+
+    @patch("oa.result_cache.config_generation", return_value="abcd")
+    def test_identity_user(self, mock_generation):
+        self.ruleset.ctxt.username = "alex"
+        self.ruleset.ctxt.userprefs = "/home/alex/.spamassassin/user_prefs"
+        self.assertEqual(self.get_info().identity, "alex:abcd")
+        mock_generation.assert_called_with(
+            ["/home/alex/.spamassassin/user_prefs"]
+        )
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        oa.metrics.reset()
+        self.mock_time = patch("oa.result_cache.time.time",
+                               return_value=1000).start()
+        self.cache = oa.result_cache.ResultCache(max_size=2, ttl=60)
+        self.headers = {
+            "Subject": ["Buy now"],
+            "To": ["alex@example.com"],
+        }
+        self.msg = self.get_msg()
+        self.rule = Mock(tflags=None, score=2)
+        self.recipient_rule = Mock(tflags=None, score=1)
+        self.ruleset = Mock(checked={"TEST_RULE": self.rule,
+                                     "TEST_TO": self.recipient_rule})
+        self.ruleset.ctxt.plugins = {}
+        self.ruleset.match.side_effect = self.match
+        self.mock_info = patch("oa.result_cache._RulesetInfo").start()
+        self.mock_info.return_value.headers = ["subject"]
+        self.mock_info.return_value.recompute = {"TEST_TO"}
+        self.mock_info.return_value.identity = ""
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        oa.metrics.reset()
+        patch.stopall()
+
+    def get_msg(self, body="Test body", to="alex@example.com",
+                boundary=None):
+        headers = dict(self.headers, To=[to])
+        part = Mock(**{"get_boundary.return_value": boundary})
+        msg = Mock(raw_msg="Subject: Buy now\nTo: %s\n\n%s" % (to, body),
+                   sender_address="bounce-1@example.com", local_only=False,
+                   rules_checked={}, rules_descriptions={})
+        msg.get_raw_header.side_effect = lambda name: headers.get(
+            name.title(), [])
+        msg.untrusted_ips = ["192.0.2.1"]
+        msg.msg.walk.return_value = [part]
+        return msg
+
+    def match(self, msg, cached=None):
+        cached = cached or {}
+        msg.rules_checked["TEST_RULE"] = cached.get("TEST_RULE", True)
+        msg.rules_descriptions["TEST_RULE"] = "Test rule"
+        msg.rules_checked["TEST_TO"] = False
+
+    def test_key_ignores_recipient(self):
+        key = self.cache.get_key(self.msg, ["subject"])
+        other = self.get_msg(to="other@example.com")
+        self.assertEqual(self.cache.get_key(other, ["subject"]), key)
+
+    def test_key_body(self):
+        key = self.cache.get_key(self.msg, ["subject"])
+        other = self.get_msg(body="Other body")
+        self.assertNotEqual(self.cache.get_key(other, ["subject"]), key)
+
+    def test_key_whitespace(self):
+        key = self.cache.get_key(self.msg, ["subject"])
+        other = self.get_msg(body="Test \n  body\n")
+        self.assertEqual(self.cache.get_key(other, ["subject"]), key)
+
+    def test_key_boundary(self):
+        msg = self.get_msg(body="--abc\nTest\n--abc--", boundary="abc")
+        other = self.get_msg(body="--xyz\nTest\n--xyz--", boundary="xyz")
+        self.assertEqual(self.cache.get_key(msg, ["subject"]),
+                         self.cache.get_key(other, ["subject"]))
+
+    def test_key_relays(self):
+        key = self.cache.get_key(self.msg, ["subject"])
+        self.msg.untrusted_ips = ["192.0.2.2"]
+        self.assertNotEqual(self.cache.get_key(self.msg, ["subject"]), key)
+
+    def test_key_generation(self):
+        key = self.cache.get_key(self.msg, ["subject"])
+        self.cache.generation = "abcd"
+        self.assertNotEqual(self.cache.get_key(self.msg, ["subject"]), key)
+
+    def test_key_identity(self):
+        key = self.cache.get_key(self.msg, ["subject"])
+        self.assertNotEqual(self.cache.get_key(self.msg, ["subject"],
+                                               "alex:abcd"), key)
+
+    def test_miss(self):
+        self.cache.match(self.ruleset, self.msg)
+        self.ruleset.match.assert_called_with(self.msg)
+        key = self.cache.get_key(self.msg, ["subject"])
+        self.assertEqual(self.cache.get(key), {"TEST_RULE": "Test rule"})
+        self.assertEqual(oa.metrics.get("result_cache_misses"), 1)
+
+    def test_hit(self):
+        self.cache.match(self.ruleset, self.msg)
+        msg = self.get_msg(to="other@example.com")
+        self.cache.match(self.ruleset, msg)
+        self.ruleset.match.assert_called_with(
+            msg, cached={"TEST_RULE": "Test rule"}
+        )
+        self.assertEqual(oa.metrics.get("result_cache_hits"), 1)
+
+    def test_other_user(self):
+        """The results of the ruleset of another user are not used."""
+        self.cache.match(self.ruleset, self.msg)
+        self.mock_info.return_value.identity = "alex:abcd"
+        msg = self.get_msg()
+        self.cache.match(self.ruleset, msg)
+        self.ruleset.match.assert_called_with(msg)
+        self.assertEqual(oa.metrics.get("result_cache_misses"), 2)
+
+    def test_hit_local_only(self):
+        self.cache.match(self.ruleset, self.msg)
+        msg = self.get_msg()
+        msg.local_only = True
+        self.cache.match(self.ruleset, msg)
+        self.assertTrue(msg.local_only)
+        self.ruleset.match.assert_called_with(
+            msg, cached={"TEST_RULE": "Test rule"}
+        )
+
+    def test_local_only_not_cached(self):
+        self.msg.local_only = True
+        self.cache.match(self.ruleset, self.msg)
+        key = self.cache.get_key(self.msg, ["subject"])
+        self.assertIsNone(self.cache.get(key))
+
+    def test_stopped_not_cached(self):
+        self.ruleset.match.side_effect = None
+        self.cache.match(self.ruleset, self.msg)
+        key = self.cache.get_key(self.msg, ["subject"])
+        self.assertIsNone(self.cache.get(key))
+
+    def set_near_duplicates(self):
+        self.cache.near_duplicates = oa.fingerprint.NearDuplicateIndex()
+        self.mock_info.return_value.network = {"TEST_NET"}
+        self.ruleset.checked["TEST_NET"] = Mock(tflags=["net"], score=1)
+        patch("oa.result_cache.oa.fingerprint.message_fingerprint",
+              side_effect=lambda msg, min_tokens: msg.fingerprint).start()
+
+    def check_near_duplicate(self, msg):
+        """Check the message after a near duplicate with a network rule
+        that matched.
+        """
+        self.set_near_duplicates()
+
+        def match(msg, cached=None):
+            self.match(msg, cached)
+            msg.rules_checked["TEST_NET"] = True
+            msg.rules_descriptions["TEST_NET"] = "Listed"
+        self.ruleset.match.side_effect = match
+        self.msg.fingerprint = 0xff00ff00
+        self.cache.match(self.ruleset, self.msg)
+        msg.fingerprint = 0xff00ff01
+        self.cache.match(self.ruleset, msg)
+
+    def test_near_duplicate(self):
+        msg = self.get_msg(body="Other body")
+        self.check_near_duplicate(msg)
+        self.ruleset.match.assert_called_with(msg,
+                                              cached={"TEST_NET": "Listed"})
+        self.assertEqual(oa.metrics.get("result_cache_near_hits"), 1)
+        self.assertEqual(oa.metrics.get("result_cache_misses"), 1)
+
+    def test_near_duplicate_local_only(self):
+        msg = self.get_msg(body="Other body")
+        msg.local_only = True
+        self.check_near_duplicate(msg)
+        self.assertTrue(msg.local_only)
+        self.ruleset.match.assert_called_with(msg,
+                                              cached={"TEST_NET": "Listed"})
+
+    def test_near_duplicate_other_relay(self):
+        """The network results of another relay are not used."""
+        msg = self.get_msg(body="Other body")
+        msg.untrusted_ips = ["192.0.2.2"]
+        self.check_near_duplicate(msg)
+        self.ruleset.match.assert_called_with(msg)
+        self.assertEqual(oa.metrics.get("result_cache_misses"), 2)
+
+    def test_near_duplicate_other_sender(self):
+        msg = self.get_msg(body="Other body")
+        msg.sender_address = "bounce-1@example.org"
+        self.check_near_duplicate(msg)
+        self.ruleset.match.assert_called_with(msg)
+        self.assertEqual(oa.metrics.get("result_cache_misses"), 2)
+
+    def test_near_duplicate_other_user(self):
+        self.set_near_duplicates()
+        self.msg.fingerprint = 0xff00ff00
+        self.cache.match(self.ruleset, self.msg)
+        self.mock_info.return_value.identity = "alex:abcd"
+        msg = self.get_msg(body="Other body")
+        msg.fingerprint = 0xff00ff01
+        self.cache.match(self.ruleset, msg)
+        self.ruleset.match.assert_called_with(msg)
+        self.assertEqual(oa.metrics.get("result_cache_misses"), 2)
+
+    def test_near_duplicate_too_far(self):
+        self.set_near_duplicates()
+        self.msg.fingerprint = 0xff00ff00
+        self.cache.match(self.ruleset, self.msg)
+        msg = self.get_msg(body="Other body")
+        msg.fingerprint = 0xff00ff0f
+        self.cache.match(self.ruleset, msg)
+        self.ruleset.match.assert_called_with(msg)
+        self.assertEqual(oa.metrics.get("result_cache_misses"), 2)
+
+    def test_near_duplicate_too_short(self):
+        self.set_near_duplicates()
+        self.msg.fingerprint = None
+        self.cache.match(self.ruleset, self.msg)
+        self.assertEqual(len(self.cache.near_duplicates), 0)
+
+    def test_ttl(self):
+        self.cache.set("key", {"TEST_RULE": True})
+        self.mock_time.return_value = 1061
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_lru(self):
+        self.cache.set("key1", {})
+        self.cache.set("key2", {})
+        self.cache.get("key1")
+        self.cache.set("key3", {})
+        self.assertIsNone(self.cache.get("key2"))
+        self.assertEqual(self.cache.get("key1"), {})
+
+    def test_clear(self):
+        self.cache.near_duplicates = Mock()
+        self.cache.set("key", {})
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("key"))
+        self.cache.near_duplicates.clear.assert_called_with()
+
+    def test_backend(self):
+        backend = Mock(**{"get.return_value": {"TEST_RULE": False}})
+        self.cache.backend = backend
+        self.assertEqual(self.cache.get("key"), {"TEST_RULE": False})
+        backend.get.assert_called_with("key")
+        self.cache.get("key")
+        self.assertEqual(backend.get.call_count, 1)
+        self.cache.set("key2", {})
+        backend.set.assert_called_with("key2", {}, 60)
+
+
+class TestSQLiteBackend(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.backend = oa.result_cache.SQLiteBackend(
+            os.path.join(self.tmpdir, "results.db")
+        )
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+        patch.stopall()
+
+    def test_get_set(self):
+        self.backend.set("key", {"TEST_RULE": "Test rule"}, 60)
+        self.assertEqual(self.backend.get("key"), {"TEST_RULE": "Test rule"})
+        self.assertIsNone(self.backend.get("key2"))
+
+    def test_shared(self):
+        self.backend.set("key", {"TEST_RULE": False}, 60)
+        other = oa.result_cache.SQLiteBackend(self.backend.path)
+        self.assertEqual(other.get("key"), {"TEST_RULE": False})
+
+    def test_expired(self):
+        self.backend.set("key", {}, -1)
+        self.assertIsNone(self.backend.get("key"))
+
+    def test_prune(self):
+        self.backend.prune_interval = 2
+        self.backend.set("key", {}, -1)
+        self.backend.set("key2", {}, 60)
+        conn = self.backend._get_connection()
+        self.assertEqual(
+            conn.execute("SELECT digest FROM results").fetchall(),
+            [("key2",)]
+        )
+
+    def test_error(self):
+        backend = oa.result_cache.SQLiteBackend(
+            os.path.join(self.tmpdir, "missing", "results.db")
+        )
+        self.assertIsNone(backend.get("key"))
+        backend.set("key", {}, 60)
+
+    def test_forked(self):
+        conn = self.backend._get_connection()
+        patch("oa.result_cache.os.getpid", return_value=-1).start()
+        self.assertIsNot(self.backend._get_connection(), conn)
+
+
+class TestConfigGeneration(unittest.TestCase):
+    def test_generation(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "local.cf")
+            with open(path, "w") as conf:
+                conf.write("required_score 5\n")
+            generation = oa.result_cache.config_generation([path])
+            self.assertEqual(oa.result_cache.config_generation([path]),
+                             generation)
+            with open(path, "a") as conf:
+                conf.write("report_safe 0\n")
+            self.assertNotEqual(oa.result_cache.config_generation([path]),
+                                generation)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def suite():
+    """Gather all the tests from this package in a test suite."""
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TestRulesetInfo, "test"))
+    test_suite.addTest(unittest.makeSuite(TestResultCache, "test"))
+    test_suite.addTest(unittest.makeSuite(TestSQLiteBackend, "test"))
+    test_suite.addTest(unittest.makeSuite(TestConfigGeneration, "test"))
+    return test_suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -61,6 +61,50 @@ class TestRuleSet(unittest.TestCase):
         ruleset.match(mock_msg)
         self.assertEqual(mock_msg.score, 0)
 
+    def test_match_local_only(self):
+        mock_msg = MagicMock(rules_checked={}, score=0, local_only=True)
+        mock_rule = MagicMock(score=1, tflags=[])
+        mock_net_rule = MagicMock(score=2, tflags=["net"])
+        mock_learn_rule = MagicMock(score=4, tflags=["learn", "noautolearn"])
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+        ruleset.checked = {"TEST_RULE": mock_rule,
+                           "TEST_NET_RULE": mock_net_rule,
+                           "TEST_LEARN_RULE": mock_learn_rule}
+
+        ruleset.match(mock_msg)
+        self.assertEqual(mock_msg.score, 1)
+        self.assertFalse(mock_net_rule.match.called)
+        self.assertFalse(mock_learn_rule.match.called)
+        self.assertFalse(self.mock_ctxt.hook_auto_learn.called)
+
+    def test_match_cached(self):
+        mock_msg = MagicMock(rules_checked={}, rules_descriptions={}, score=0,
+                             local_only=False)
+        mock_rule = MagicMock(score=1, tflags=[])
+        mock_net_rule = MagicMock(score=2, tflags=["net"])
+        mock_to_rule = MagicMock(score=4, tflags=[])
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+        ruleset.checked = {"TEST_RULE": mock_rule,
+                           "TEST_NET_RULE": mock_net_rule,
+                           "TEST_TO_RULE": mock_to_rule}
+
+        ruleset.match(mock_msg, cached={"TEST_RULE": False,
+                                        "TEST_NET_RULE": "Listed"})
+        self.assertEqual(mock_msg.score, 6)
+        self.assertFalse(mock_rule.match.called)
+        self.assertFalse(mock_net_rule.match.called)
+        mock_to_rule.match.assert_called_with(mock_msg)
+        self.assertEqual(mock_msg.rules_descriptions["TEST_NET_RULE"],
+                         "Listed")
+
+    def test_match_auto_learn(self):
+        mock_msg = MagicMock(rules_checked={}, score=0, local_only=False)
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+        ruleset.checked = {}
+
+        ruleset.match(mock_msg)
+        self.mock_ctxt.hook_auto_learn.assert_called_with(ruleset, mock_msg)
+
     def test_get_rule(self):
         mock_rule = Mock()
         ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
@@ -182,6 +226,73 @@ class TestRuleSet(unittest.TestCase):
         result = ruleset._interpolate("test %(REQD)s test", mock_msg)
         self.assertEqual(result, "test 5.0 test")
 
+    def test_interpolate_only_referenced(self):
+        mock_msg = MagicMock(rules_checked={"TEST_RULE": True},
+                             interpolate_data={}, plugin_tags={}, score=4)
+        mock_summary = patch("oa.rules.ruleset.RuleSet."
+                             "get_summary_report").start()
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+
+        result = ruleset._interpolate("%(TESTS)s %(YESNOCAPS)s", mock_msg)
+        self.assertEqual(result, "TEST_RULE NO")
+        self.assertEqual(mock_msg.interpolate_data,
+                         {"TESTS": "TEST_RULE", "YESNOCAPS": "NO"})
+        self.assertFalse(mock_summary.called)
+
+    def test_interpolate_shared_tags(self):
+        mock_msg = MagicMock(rules_checked={}, interpolate_data={},
+                             plugin_tags={}, score=4)
+        mock_report = patch("oa.rules.ruleset.RuleSet.get_matched_report",
+                            return_value="report").start()
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+
+        ruleset._interpolate("%(REPORT)s", mock_msg)
+        result = ruleset._interpolate("%(REPORT)s %(SCORE)s", mock_msg)
+        self.assertEqual(result, "report 4.0")
+        self.assertEqual(mock_report.call_count, 1)
+
+    def test_interpolate_plugin_and_unknown_tags(self):
+        mock_msg = MagicMock(rules_checked={}, interpolate_data={},
+                             plugin_tags={"SCORE": "plugin"}, score=4)
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+
+        result = ruleset._interpolate("%(SCORE)s %(UNKNOWN)s", mock_msg)
+        self.assertEqual(result, "plugin @@UNKNOWN@@")
+
+    def test_hostname_cached(self):
+        mock_hostname = patch("oa.rules.ruleset.socket.gethostname",
+                              return_value="example.com").start()
+        patch("oa.rules.ruleset._hostname", None).start()
+        self.assertEqual(oa.rules.ruleset.get_hostname(), "example.com")
+        self.assertEqual(oa.rules.ruleset.get_hostname(), "example.com")
+        self.assertEqual(mock_hostname.call_count, 1)
+
+    def test_post_parsing_compile_templates(self):
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+        ruleset.conf["report"].append("_YESNO_ _SCORE_")
+        ruleset.conf["add_header"].append("all Status _TESTS_")
+        ruleset.post_parsing()
+        self.assertEqual(ruleset._templates["%(YESNO)s %(SCORE)s"],
+                         (("", " ", ""), ("YESNO", "SCORE")))
+        self.assertEqual(ruleset._templates["%(TESTS)s"],
+                         (("", ""), ("TESTS",)))
+
+    def test_compile_template(self):
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+        template = ruleset._compile_template("Score %(SCORE)s, 100%% "
+                                             "%(SCORE)s")
+        self.assertEqual(template.literals, ("Score ", ", 100% ", ""))
+        self.assertEqual(template.tags, ("SCORE", "SCORE"))
+        self.assertIs(ruleset._compile_template("Score %(SCORE)s, 100%% "
+                                                "%(SCORE)s"), template)
+
+    def test_interpolate_literal_percent(self):
+        mock_msg = MagicMock(rules_checked={}, interpolate_data={},
+                             plugin_tags={}, score=4)
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+        result = ruleset._interpolate("%(SCORE)s 100%% %(SCORE)s", mock_msg)
+        self.assertEqual(result, "4.0 100% 4.0")
+
     def test_convert_tags(self):
         original = '"test _YESNO_ test"'
         expected = 'test %(YESNO)s test'
@@ -317,71 +428,77 @@ class TestRuleSet(unittest.TestCase):
                            "email.message_from_string").start()
         mock_bounce = patch("oa.rules.ruleset.RuleSet."
                             "_get_bounce_message").start()
-        mock_adjust = patch("oa.rules.ruleset.RuleSet."
-                            "_adjust_headers").start()
-        mock_msg = MagicMock(score=4)
+        mock_msg = MagicMock(score=4, raw_msg="Subject: test\n\nBody\n",
+                             interpolate_data={"TEST": "test"})
         ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
-        ruleset.header_mod["all"].append("All mod")
-        ruleset.header_mod["ham"].append("Ham mod")
+        ruleset.header_mod["all"].append((False, "X-Spam-All", "%(TEST)s"))
+        ruleset.header_mod["ham"].append((False, "X-Spam-Ham", "ham"))
+        ruleset.header_mod["spam"].append((False, "X-Spam-Spam", "spam"))
         result = ruleset.get_adjusted_message(mock_msg)
 
-        newmsg = mock_email(mock_msg.raw_msg)
-        self.assertEqual(result, newmsg.as_string())
-
-        calls = [
-            call(mock_msg, newmsg, ["All mod"]),
-            call(mock_msg, newmsg, ["Ham mod"])
-        ]
-
-        mock_adjust.assert_has_calls(calls)
+        self.assertEqual(result, "Subject: test\nX-Spam-All: test\n"
+                                 "X-Spam-Ham: ham\n\nBody\n")
+        self.assertFalse(mock_email.called)
+        self.assertFalse(mock_bounce.called)
 
     def test_adjusted_header_only_spam(self):
-        mock_email = patch("oa.rules.ruleset."
-                           "email.message_from_string").start()
         mock_bounce = patch("oa.rules.ruleset.RuleSet."
                             "_get_bounce_message").start()
-        mock_adjust = patch("oa.rules.ruleset.RuleSet."
-                            "_adjust_headers").start()
-        mock_msg = MagicMock(score=6)
+        mock_msg = MagicMock(score=6, raw_msg="Subject: test\n\nBody\n",
+                             interpolate_data={"TEST": "test"})
         ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
-        ruleset.header_mod["all"].append("All mod")
-        ruleset.header_mod["spam"].append("Spam mod")
+        ruleset.header_mod["all"].append((False, "X-Spam-All", "all"))
+        ruleset.header_mod["spam"].append((False, "X-Spam-Spam", "spam"))
         result = ruleset.get_adjusted_message(mock_msg, True)
 
-        newmsg = mock_email(mock_msg.raw_msg)
-        self.assertEqual(
-            result, newmsg.as_string().split("\n\n", 1)[0] + "\n\n")
-
-        calls = [
-            call(mock_msg, newmsg, ["All mod"]),
-            call(mock_msg, newmsg, ["Spam mod"])
-        ]
-
-        mock_adjust.assert_has_calls(calls)
+        self.assertEqual(result, "Subject: test\nX-Spam-All: all\n"
+                                 "X-Spam-Spam: spam\n\n")
+        self.assertFalse(mock_bounce.called)
 
     def test_adjusted_header_only_not_spam(self):
-        mock_email = patch("oa.rules.ruleset."
-                           "email.message_from_string").start()
-        mock_bounce = patch("oa.rules.ruleset.RuleSet."
-                            "_get_bounce_message").start()
-        mock_adjust = patch("oa.rules.ruleset.RuleSet."
-                            "_adjust_headers").start()
-        mock_msg = MagicMock(score=4)
+        mock_msg = MagicMock(score=4,
+                             raw_msg="Subject: test\r\n\r\nBody\r\n",
+                             interpolate_data={"TEST": "test"})
         ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
-        ruleset.header_mod["all"].append("All mod")
-        ruleset.header_mod["ham"].append("Ham mod")
+        ruleset.header_mod["ham"].append((False, "X-Spam-Ham", "ham"))
         result = ruleset.get_adjusted_message(mock_msg, True)
 
-        newmsg = mock_email(mock_msg.raw_msg)
-        self.assertEqual(
-            result, newmsg.as_string().split("\n\n", 1)[0] + "\n\n")
+        self.assertEqual(result, "Subject: test\r\nX-Spam-Ham: ham\r\n\r\n")
 
-        calls = [
-            call(mock_msg, newmsg, ["All mod"]),
-            call(mock_msg, newmsg, ["Ham mod"])
-        ]
+    def test_adjusted_report_safe_0(self):
+        patch("oa.rules.ruleset.RuleSet.get_matched_report",
+              return_value="\r\n* 1.0 TEST_RULE Test").start()
+        mock_msg = MagicMock(score=6, raw_msg="Subject: test\n\nBody\n",
+                             interpolate_data={"TEST": "test"})
+        ruleset = oa.rules.ruleset.RuleSet(self.mock_ctxt)
+        ruleset.conf["report_safe"] = 0
+        result = ruleset.get_adjusted_message(mock_msg)
 
-        mock_adjust.assert_has_calls(calls)
+        self.assertEqual(result, "Subject: test\nX-Spam-Report: \n"
+                                 "\t* 1.0 TEST_RULE Test\n\nBody\n")
+
+    def test_splice_headers_remove(self):
+        mock_msg = MagicMock(raw_msg="X-Spam-Flag: YES\n\tfolded\n"
+                                     "Subject: test\nx-spam-flag: NO\n"
+                                     "\nBody\n\nMore\n")
+        result = oa.rules.ruleset.RuleSet._splice_headers(
+            mock_msg, [(True, "X-Spam-Flag", None)]
+        )
+        self.assertEqual(result, "Subject: test\n\nBody\n\nMore\n")
+
+    def test_splice_headers_no_body(self):
+        mock_msg = MagicMock(raw_msg="Subject: test")
+        result = oa.rules.ruleset.RuleSet._splice_headers(
+            mock_msg, [(False, "X-Spam-Flag", "YES")]
+        )
+        self.assertEqual(result, "Subject: test\nX-Spam-Flag: YES\n\n")
+
+    def test_splice_headers_no_headers(self):
+        mock_msg = MagicMock(raw_msg="\nBody\n")
+        result = oa.rules.ruleset.RuleSet._splice_headers(
+            mock_msg, [(False, "X-Spam-Flag", "YES")]
+        )
+        self.assertEqual(result, "X-Spam-Flag: YES\n\nBody\n")
 
     def test_adjust_headers(self):
         rules = [(False, "X-Spam-Test", "value")]
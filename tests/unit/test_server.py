@@ -1,5 +1,13 @@
 """Unittest for scripts.oad"""
 
+import io
+import os
+import stat
+import time
+import errno
+import shutil
+import socket
+import tempfile
 import signal
 import logging
 import unittest
@@ -11,7 +19,46 @@ except ImportError:
     from mock import patch, Mock, call, MagicMock, ANY
 
 
+import oa.regex
+import oa.errors
 import oa.server
+import oa.metrics
+
+
+def mock_connection(*chunks):
+    """Return a mock socket that receives these chunks of data, or
+    raises them if they are exceptions.
+    """
+    chunks = list(chunks)
+
+    def recv_into(buf):
+        if not chunks:
+            return 0
+        chunk = chunks.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+        if len(chunk) > len(buf):
+            chunks.insert(0, chunk[len(buf):])
+            chunk = chunk[:len(buf)]
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    mock_request = MagicMock()
+    mock_request.recv_into.side_effect = recv_into
+    return mock_request
+
+
+def mock_server(**kwargs):
+    """Return a mock server with the default limits."""
+    limits = {
+        "keepalive_timeout": 5.0,
+        "max_keepalive_requests": 100,
+        "header_timeout": 30.0,
+        "body_timeout": 60.0,
+        "min_transfer_rate": None,
+    }
+    limits.update(kwargs)
+    return MagicMock(**limits)
 
 
 class TestServer(unittest.TestCase):
@@ -48,19 +95,136 @@ class TestServer(unittest.TestCase):
                          self.mock_rules.return_value.results)
         self.assertEqual(server._ruleset, self.mainset)
 
+    def test_load_config_result_cache(self):
+        server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
+                                   "/etc/spamassassin/")
+        server.result_cache = Mock(generation="")
+        patch("oa.server.oa.result_cache.config_generation",
+              return_value="abcd").start()
+        server.load_config()
+        server.result_cache.clear.assert_called_with()
+        self.assertEqual(server.result_cache.generation, "abcd")
+        self.assertEqual(server.config_generation, "abcd")
+
+    def test_load_config_dns_cache_backend(self):
+        server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
+                                   "/etc/spamassassin/")
+        backend = Mock()
+        server.set_dns_cache_backend(backend)
+        self.assertEqual(self.mainset.ctxt.dns.cache.backend, backend)
+        self.mainset.ctxt.dns.cache.backend = None
+        server.load_config()
+        self.assertEqual(self.mainset.ctxt.dns.cache.backend, backend)
+
+    def test_user_ruleset_dns_cache_backend(self):
+        self.conf["allow_user_rules"] = True
+        server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
+                                   "/etc/spamassassin/")
+        backend = Mock()
+        server.set_dns_cache_backend(backend)
+        with patch("oa.server.os.path.exists", return_value=True):
+            result = server.get_user_ruleset(user="alex")
+        self.assertEqual(result.ctxt.dns.cache.backend, backend)
+
     def test_handler(self):
         mock_check = MagicMock()
-        mock_rfile = MagicMock()
-        mock_rfile.readline.return_value = b"CHECK SPAMC/1.2"
-        mock_request = MagicMock()
-        mock_request.makefile.return_value = mock_rfile
-        mock_server = MagicMock()
+        mock_request = mock_connection(b"CHECK SPAMC/1.2")
+        server = mock_server()
+
+        mock_check.return_value.keep_alive = None
+        patch("oa.server.COMMANDS", {"CHECK": mock_check}, create=True).start()
+        oa.server.RequestHandler(mock_request, ("127.0.0.1", 47563),
+                                 server)
+        mock_check.assert_called_with(ANY, ANY, server)
+        rfile = mock_check.call_args[0][0]
+        self.assertIsInstance(rfile, oa.server.DeadlineFile)
 
+    def handle_connection(self, data, keep_alive=(None,)):
+        """Run the request handler on the data and return the list
+        of handlers that were called.
+        """
+        calls = []
+        keep_alive = list(keep_alive)
+
+        def command(rfile, wfile, server):
+            calls.append(rfile.readline())
+            result = Mock(keep_alive=keep_alive.pop(0))
+            return result
+
+        if isinstance(data, bytes):
+            data = (data,)
+        mock_request = mock_connection(*data)
+        self.mock_server = mock_server()
+        patch("oa.server.COMMANDS", {"CHECK": command}, create=True).start()
+        oa.server.RequestHandler(mock_request, ("127.0.0.1", 47563),
+                                 self.mock_server)
+        self.mock_connection = mock_request
+        return calls
+
+    def test_handler_one_request(self):
+        calls = self.handle_connection(b"CHECK SPAMC/1.2\r\nA\r\n"
+                                       b"CHECK SPAMC/1.2\r\nB\r\n")
+        self.assertEqual(calls, [b"A\r\n"])
+
+    def test_handler_keep_alive(self):
+        calls = self.handle_connection((b"CHECK SPAMC/1.2\r\nA\r\n",
+                                        b"\r\nCHECK SPAMC/1.2\r\nB\r\n",
+                                        b"CHECK SPAMC/1.2\r\nC\r\n"),
+                                       keep_alive=(True, None, False))
+        self.assertEqual(calls, [b"A\r\n", b"B\r\n", b"C\r\n"])
+        timeouts = [args[0] for args, kwargs in
+                    self.mock_connection.settimeout.call_args_list]
+        self.assertTrue(any(4 < timeout <= 5.0 for timeout in timeouts))
+
+    def test_handler_keep_alive_stop(self):
+        calls = self.handle_connection(b"CHECK SPAMC/1.2\r\nA\r\n"
+                                       b"CHECK SPAMC/1.2\r\nB\r\n"
+                                       b"CHECK SPAMC/1.2\r\nC\r\n",
+                                       keep_alive=(True, False, True))
+        self.assertEqual(calls, [b"A\r\n", b"B\r\n"])
+
+    def test_handler_keep_alive_closed(self):
+        calls = self.handle_connection(b"CHECK SPAMC/1.2\r\nA\r\n",
+                                       keep_alive=(True,))
+        self.assertEqual(calls, [b"A\r\n"])
+
+    def test_handler_keep_alive_max_requests(self):
+        calls = []
+
+        def command(rfile, wfile, server):
+            calls.append(rfile.readline())
+            return Mock(keep_alive=True)
+
+        mock_request = mock_connection(b"CHECK SPAMC/1.2\r\nA\r\n" * 3)
+        server = mock_server(max_keepalive_requests=2)
+        patch("oa.server.COMMANDS", {"CHECK": command}, create=True).start()
+        oa.server.RequestHandler(mock_request, ("127.0.0.1", 47563),
+                                 server)
+        self.assertEqual(len(calls), 2)
+
+    def test_handler_keep_alive_timeout(self):
+        self.mock_socket.timeout = socket.timeout
+        mock_request = mock_connection(b"CHECK SPAMC/1.2\r\n",
+                                       socket.timeout("timed out"))
+        mock_check = Mock(return_value=Mock(keep_alive=True))
         patch("oa.server.COMMANDS", {"CHECK": mock_check}, create=True).start()
         oa.server.RequestHandler(mock_request, ("127.0.0.1", 47563),
-                                 mock_server)
-        mock_check.assert_called_with(mock_rfile, ANY,
-                                      mock_server)
+                                 mock_server())
+        self.assertEqual(mock_check.call_count, 1)
+
+    def test_handler_header_timeout(self):
+        """A client that doesn't send the command line in time is
+        disconnected.
+        """
+        self.mock_socket.timeout = socket.timeout
+        oa.metrics.reset()
+        mock_request = mock_connection(b"CHE", socket.timeout("timed out"))
+        mock_check = Mock()
+        patch("oa.server.COMMANDS", {"CHECK": mock_check}, create=True).start()
+        oa.server.RequestHandler(mock_request, ("127.0.0.1", 47563),
+                                 mock_server())
+        self.assertFalse(mock_check.called)
+        self.assertEqual(oa.metrics.get("timeouts_header"), 1)
 
     def test_server(self):
         server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
@@ -68,6 +232,37 @@ class TestServer(unittest.TestCase):
         self.mock_bind.assert_called_with()
         self.mock_active.assert_called_with()
 
+    def test_max_connections(self):
+        server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
+                                   "/etc/spamassassin/")
+        server.max_connections = 2
+        requests = [Mock(), Mock(), Mock()]
+        results = [server.verify_request(request, ("127.0.0.1", 1))
+                   for request in requests]
+        self.assertEqual(results, [True, True, False])
+        self.assertFalse(requests[0].sendall.called)
+        requests[2].sendall.assert_called_with(
+            ("SPAMD/%s 75 EX_TEMPFAIL: (too many connections)\r\n" %
+             oa.__version__).encode("utf8")
+        )
+
+    def test_max_connections_closed(self):
+        patch("oa.server.spoon.server.TCPSpoon.shutdown_request",
+              create=True).start()
+        server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
+                                   "/etc/spamassassin/")
+        server.max_connections = 1
+        self.assertTrue(server.verify_request(Mock(), ("127.0.0.1", 1)))
+        server.shutdown_request(Mock())
+        self.assertTrue(server.verify_request(Mock(), ("127.0.0.1", 1)))
+        self.assertEqual(oa.metrics.get("connections"), 1)
+
+    def test_max_connections_no_limit(self):
+        server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
+                                   "/etc/spamassassin/")
+        for dummy in range(10):
+            self.assertTrue(server.verify_request(Mock(), ("127.0.0.1", 1)))
+
     def test_user_ruleset_none(self):
         server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
                                    "/etc/spamassassin/")
@@ -108,6 +303,15 @@ class TestServer(unittest.TestCase):
             "/home/alex/.spamassassin/user_prefs"
         )
 
+    def test_user_ruleset_userprefs(self):
+        self.conf["allow_user_rules"] = True
+        server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
+                                   "/etc/spamassassin/")
+        with patch("oa.server.os.path.exists", return_value=True):
+            result = server.get_user_ruleset(user="alex")
+        self.assertEqual(result.ctxt.userprefs,
+                         "/home/alex/.spamassassin/user_prefs")
+
     def test_user_ruleset_user_cached(self):
         self.conf["allow_user_rules"] = True
         server = oa.server.Server(("0.0.0.0", 783), "/dev/null",
@@ -119,12 +323,608 @@ class TestServer(unittest.TestCase):
         self.assertEqual(result, cached_result)
 
 
+class TestDeadlineFile(unittest.TestCase):
+    """Read from a real socket pair."""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        oa.metrics.reset()
+        self.client, self.server = socket.socketpair()
+        self.rfile = oa.server.DeadlineFile(self.server)
+        self.sender = None
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+        if self.sender is not None:
+            self.sender.join()
+        self.rfile.close()
+        self.client.close()
+        self.server.close()
+
+    def trickle(self, data, delay):
+        """Send the data one chunk at a time."""
+        def send():
+            for chunk in data:
+                time.sleep(delay)
+                try:
+                    self.client.sendall(chunk)
+                except (IOError, OSError):
+                    break
+        self.sender = threading.Thread(target=send)
+        self.sender.start()
+
+    def test_read(self):
+        self.rfile.set_deadline("header", 1.0)
+        self.client.sendall(b"CHECK SPAMC/1.2\r\nUser: alex\r\n")
+        self.assertEqual(self.rfile.readline(), b"CHECK SPAMC/1.2\r\n")
+        self.assertEqual(self.rfile.readline(), b"User: alex\r\n")
+
+    def test_read_no_deadline(self):
+        self.rfile.set_deadline("header", None)
+        self.client.sendall(b"CHECK SPAMC/1.2\r\n")
+        self.assertEqual(self.rfile.readline(), b"CHECK SPAMC/1.2\r\n")
+        self.assertIsNone(self.server.gettimeout())
+
+    def test_timeout(self):
+        self.rfile.set_deadline("header", 0.2)
+        self.client.sendall(b"CHECK")
+        self.assertRaises(oa.errors.ReadTimeout, self.rfile.readline)
+        self.assertEqual(oa.metrics.get("timeouts_header"), 1)
+
+    def test_timeout_trickle(self):
+        """Sending a few bytes at a time doesn't extend the deadline."""
+        self.rfile.set_deadline("body", 0.3)
+        self.trickle([b"x"] * 10, 0.05)
+        start = time.time()
+        self.assertRaises(oa.errors.ReadTimeout, self.rfile.read, 100)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(oa.metrics.get("timeouts_body"), 1)
+
+    def test_min_rate(self):
+        patch("oa.server.Deadline.rate_grace", 0.1).start()
+        self.rfile.set_deadline("body", 10.0, min_rate=1000)
+        self.trickle([b"x" * 10] * 20, 0.05)
+        start = time.time()
+        self.assertRaises(oa.errors.ReadTimeout, self.rfile.read, 200)
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_min_rate_fast_enough(self):
+        patch("oa.server.Deadline.rate_grace", 0.1).start()
+        self.rfile.set_deadline("body", 10.0, min_rate=100)
+        self.trickle([b"x" * 100] * 3, 0.05)
+        self.assertEqual(self.rfile.read(300), b"x" * 300)
+
+
+class TestUnixSocketServer(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        patch("oa.server.oa.config.get_config_files").start()
+        self.mock_rules = patch("oa.server."
+                                "oa.rules.parser.parse_pad_rules").start()
+        self.mainset = self.mock_rules.return_value.get_ruleset.return_value
+        self.mainset.conf = {"allow_user_rules": False}
+        self.path = os.path.join(tempfile.mkdtemp(), "oad.sock")
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+        shutil.rmtree(os.path.dirname(self.path), True)
+
+    def test_listen(self):
+        server = oa.server.Server(self.path, "/dev/null",
+                                  "/etc/spamassassin/")
+        try:
+            self.assertEqual(server.socket.family, socket.AF_UNIX)
+            self.assertEqual(server.server_address, self.path)
+            self.assertTrue(stat.S_ISSOCK(os.stat(self.path).st_mode))
+        finally:
+            server.server_close()
+
+    def test_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.path)
+        stale.close()
+        server = oa.server.Server(self.path, "/dev/null",
+                                  "/etc/spamassassin/")
+        server.server_close()
+
+    def test_not_socket(self):
+        with open(self.path, "w") as path_file:
+            path_file.write("test")
+        self.assertRaises(OSError, oa.server.Server, self.path, "/dev/null",
+                          "/etc/spamassassin/")
+        with open(self.path) as path_file:
+            self.assertEqual(path_file.read(), "test")
+
+
+class TestThreadPoolServer(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        patch("oa.server.Server.socket", create=True).start()
+        patch("oa.server.oa.config.get_config_files").start()
+        patch("oa.server.Server.server_bind").start()
+        patch("oa.server.Server.server_activate").start()
+        self.mock_rules = patch("oa.server."
+                                "oa.rules.parser.parse_pad_rules").start()
+        self.mainset = self.mock_rules.return_value.get_ruleset.return_value
+        self.mainset.conf = {"allow_user_rules": False}
+        self.mock_finish = patch("oa.server.ThreadPoolServer."
+                                 "finish_request").start()
+        self.mock_shutdown = patch("oa.server.ThreadPoolServer."
+                                   "shutdown_request").start()
+        self.mock_error = patch("oa.server.ThreadPoolServer."
+                                "handle_error").start()
+        self.server = oa.server.ThreadPoolServer(
+            ("0.0.0.0", 783), "/dev/null", "/etc/spamassassin/", threads=3
+        )
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def test_init(self):
+        self.assertEqual(self.server.threads, 3)
+        self.assertEqual(self.server._ruleset, self.mainset)
+
+    def test_process_request(self):
+        self.server.process_request("request", ("127.0.0.1", 47563))
+        self.assertEqual(self.server._requests.get_nowait()[:2],
+                         ("request", ("127.0.0.1", 47563)))
+        self.assertFalse(self.mock_finish.called)
+
+    def test_process_request_queue_full(self):
+        oa.metrics.reset()
+        self.server.max_queue_size = 2
+        requests = [Mock(), Mock(), Mock()]
+        for request in requests:
+            self.server.process_request(request, ("127.0.0.1", 47563))
+        self.assertEqual(self.server._requests.qsize(), 2)
+        requests[2].sendall.assert_called_with(
+            ("SPAMD/%s 75 EX_TEMPFAIL: (server busy)\r\n" %
+             oa.__version__).encode("utf8")
+        )
+        self.mock_shutdown.assert_called_with(requests[2])
+        self.assertEqual(oa.metrics.get("requests_shed"), 1)
+        self.assertEqual(oa.metrics.get("queue_depth"), 2)
+
+    def test_process_requests_degraded(self):
+        oa.metrics.reset()
+        self.server.max_queue_wait = 1.0
+        degraded = []
+        self.mock_finish.side_effect = lambda request, address: (
+            degraded.append(self.server.degraded)
+        )
+        self.server._requests.put(("request1", ("127.0.0.1", 47563),
+                                   time.time() - 5))
+        self.server._requests.put(("request2", ("127.0.0.1", 47564),
+                                   time.time()))
+        self.server._requests.put(None)
+        self.server.process_requests()
+        self.assertEqual(degraded, [True, False])
+        self.assertFalse(self.server.degraded)
+        self.assertEqual(oa.metrics.get("requests_degraded"), 1)
+
+    def test_process_requests_no_max_wait(self):
+        degraded = []
+        self.mock_finish.side_effect = lambda request, address: (
+            degraded.append(self.server.degraded)
+        )
+        self.server._requests.put(("request1", ("127.0.0.1", 47563),
+                                   time.time() - 500))
+        self.server._requests.put(None)
+        self.server.process_requests()
+        self.assertEqual(degraded, [False])
+
+    def test_process_requests(self):
+        self.server.process_request("request1", ("127.0.0.1", 47563))
+        self.server.process_request("request2", ("127.0.0.1", 47564))
+        self.server._requests.put(None)
+        self.server.process_requests()
+        self.mock_finish.assert_has_calls([
+            call("request1", ("127.0.0.1", 47563)),
+            call("request2", ("127.0.0.1", 47564)),
+        ])
+        self.mock_shutdown.assert_has_calls([call("request1"),
+                                             call("request2")])
+
+    def test_process_requests_error(self):
+        self.mock_finish.side_effect = ValueError
+        self.server.process_request("request", ("127.0.0.1", 47563))
+        self.server._requests.put(None)
+        self.server.process_requests()
+        self.mock_error.assert_called_with("request", ("127.0.0.1", 47563))
+        self.mock_shutdown.assert_called_with("request")
+
+    def test_serve_forever(self):
+        def serve_forever(poll_interval):
+            self.server.process_request("request", ("127.0.0.1", 47563))
+
+        with patch("oa.server.Server.serve_forever",
+                   side_effect=serve_forever):
+            self.server.serve_forever()
+        self.assertEqual(len(self.server._workers), 3)
+        for worker in self.server._workers:
+            self.assertFalse(worker.is_alive())
+        self.mock_finish.assert_called_with("request", ("127.0.0.1", 47563))
+
+
+class TestPreForkServer(unittest.TestCase):
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        oa.metrics.reset()
+        logging.getLogger("oa-logger").handlers = [logging.NullHandler()]
+        patch("oa.server.Server.socket", create=True).start()
+        patch("oa.server.oa.config.get_config_files").start()
+        patch("oa.server.Server.server_bind").start()
+        patch("oa.server.Server.server_activate").start()
+        self.mock_rules = patch("oa.server."
+                                "oa.rules.parser.parse_pad_rules").start()
+        self.mainset = self.mock_rules.return_value.get_ruleset.return_value
+        self.mainset.conf = {"allow_user_rules": False}
+        self.mock_gc = patch("oa.server.gc").start()
+        self.server = oa.server.PreForkServer(
+            ("0.0.0.0", 783), "/dev/null", "/etc/spamassassin/"
+        )
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        patch.stopall()
+
+    def test_warm_up_compiles(self):
+        regex = oa.regex.Regex(r"test\d+")
+        self.mock_gc.get_objects.return_value = [regex, object()]
+        with patch("oa.config.LAZY_MODE", True):
+            self.server.warm_up()
+            self.assertIsNotNone(regex.compiled)
+            self.assertIs(regex.compile(), regex.compiled)
+
+    def test_warm_up_freeze(self):
+        self.mock_gc.get_objects.return_value = []
+        self.server.warm_up()
+        self.mock_gc.collect.assert_called_with()
+        self.mock_gc.freeze.assert_called_with()
+
+    def test_serve_forever_single(self):
+        self.server.prefork = 1
+        with patch("oa.server.spoon.server._SporkMixIn."
+                   "serve_forever") as mock_serve:
+            self.server.serve_forever()
+        mock_serve.assert_called_with(poll_interval=0.1)
+        self.assertFalse(self.mock_gc.freeze.called)
+
+    def test_serve_forever(self):
+        calls = []
+        self.server.prefork = 3
+        self.mock_gc.get_objects.return_value = []
+        self.mock_gc.freeze.side_effect = lambda: calls.append("freeze")
+        patch("oa.server.os.pipe", return_value=(10, 11)).start()
+        mock_close = patch("oa.server.os.close").start()
+        patch("oa.server.PreForkServer.spawn_worker",
+              side_effect=lambda *args: calls.append("fork")).start()
+        mock_supervise = patch("oa.server.PreForkServer.supervise").start()
+        self.server.serve_forever()
+        self.assertEqual(calls, ["freeze", "fork", "fork", "fork"])
+        mock_supervise.assert_called_with(10, 0.1)
+        mock_close.assert_has_calls([call(10), call(11)])
+        self.assertIsNone(self.server._status_w)
+
+    def test_spawn_worker(self):
+        patch("oa.server.os.fork", return_value=123).start()
+        self.server.pids = []
+        self.server.worker_load = {}
+        self.assertEqual(self.server.spawn_worker(10), 123)
+        self.assertEqual(self.server.pids, [123])
+        self.assertEqual(self.server.worker_load[123]["requests"], 0)
+
+    def test_spawn_worker_child(self):
+        patch("oa.server.os.fork", return_value=0).start()
+        mock_close = patch("oa.server.os.close").start()
+        mock_exit = patch("oa.server.os._exit").start()
+        mock_serve = patch("oa.server.PreForkServer.serve_worker").start()
+        mock_restart = patch("oa.server.oa.config.restart_logging").start()
+        mock_flush = patch("oa.server.oa.config.flush_logging").start()
+        self.server.pids = []
+        self.server.worker_load = {}
+        self.server.spawn_worker(10)
+        mock_close.assert_called_with(10)
+        mock_serve.assert_called_with(0.1)
+        mock_exit.assert_called_with(0)
+        mock_restart.assert_called_with()
+        mock_flush.assert_called_with()
+
+    def test_spawn_worker_child_error(self):
+        patch("oa.server.os.fork", return_value=0).start()
+        patch("oa.server.os.close").start()
+        mock_exit = patch("oa.server.os._exit").start()
+        patch("oa.server.PreForkServer.serve_worker",
+              side_effect=ValueError).start()
+        self.server.pids = []
+        self.server.worker_load = {}
+        self.server.spawn_worker(10)
+        mock_exit.assert_called_with(1)
+
+    def test_read_status(self):
+        self.server.worker_load = {123: {"requests": 0, "busy": 0.0,
+                                         "rss": 0.0}}
+        patch("oa.server.os.read",
+              return_value=b"2 1.5 30.0\n456 1 0.1 20.0\n123 4 0.5").start()
+        rest = self.server._read_status(10, b"123 ")
+        self.assertEqual(self.server.worker_load[123],
+                         {"requests": 2, "busy": 1.5, "rss": 30.0})
+        self.assertEqual(rest, b"123 4 0.5")
+
+    def test_read_status_metrics(self):
+        self.server.worker_load = {123: {}}
+        patch("oa.server.os.read",
+              return_value=b"123 2 1.5 30.0 timeouts_body=3 bad=x\n").start()
+        self.server._read_status(10, b"")
+        self.assertEqual(self.server.worker_load[123]["metrics"],
+                         {"timeouts_body": 3})
+
+    def test_reap_workers(self):
+        patch("oa.server.os.waitpid",
+              side_effect=[(123, 0), (456, 0), (0, 0)]).start()
+        self.server.pids = [123, 789]
+        self.server.worker_load = {123: {"requests": 5}, 789: {}}
+        self.server._reap_workers()
+        self.assertEqual(self.server.pids, [789])
+        self.assertNotIn(123, self.server.worker_load)
+
+    def test_reap_workers_metrics(self):
+        patch("oa.server.os.waitpid",
+              side_effect=[(123, 0), (0, 0)]).start()
+        self.server.pids = [123]
+        self.server.worker_load = {123: {"metrics": {"timeouts_body": 2}}}
+        self.server._reap_workers()
+        self.assertEqual(oa.metrics.get("timeouts_body"), 2)
+
+    def test_reap_workers_no_children(self):
+        patch("oa.server.os.waitpid",
+              side_effect=OSError(errno.ECHILD, "No child")).start()
+        self.server.pids = [123]
+        self.server._reap_workers()
+        self.assertEqual(self.server.pids, [])
+
+    def supervise(self, stop_after):
+        """Run the supervise loop for a number of iterations."""
+        calls = []
+
+        def select(*args):
+            calls.append(args)
+            if len(calls) >= stop_after:
+                self.server.pids = []
+            return [[], [], []]
+
+        patch("oa.server.select.select", side_effect=select).start()
+        self.server.supervise(10)
+
+    def test_supervise_respawn(self):
+        patch("oa.server.os.waitpid", side_effect=[(2, 0), (0, 0)]).start()
+        mock_spawn = patch("oa.server.PreForkServer.spawn_worker").start()
+        self.server.prefork = 2
+        self.server.pids = [1, 2]
+        self.server.worker_load = {}
+        self.server.respawn_delay = 0
+        self.supervise(stop_after=2)
+        mock_spawn.assert_called_with(10, 0.1)
+
+    def test_supervise_respawn_delay(self):
+        patch("oa.server.os.waitpid", side_effect=[(2, 0), (0, 0)]).start()
+        mock_spawn = patch("oa.server.PreForkServer.spawn_worker").start()
+        self.server.prefork = 2
+        self.server.pids = [1, 2]
+        self.server.worker_load = {}
+        self.server.respawn_delay = 60
+        self.server._last_spawn = time.time()
+        self.supervise(stop_after=2)
+        self.assertFalse(mock_spawn.called)
+
+    def test_supervise_stopping(self):
+        patch("oa.server.os.waitpid", side_effect=[(2, 0), (0, 0)]).start()
+        mock_spawn = patch("oa.server.PreForkServer.spawn_worker").start()
+        self.server.prefork = 2
+        self.server.pids = [1, 2]
+        self.server.worker_load = {}
+        self.server.respawn_delay = 0
+        self.server._stopping = True
+        self.supervise(stop_after=2)
+        self.assertFalse(mock_spawn.called)
+
+    def test_supervise_report(self):
+        patch("oa.server.os.waitpid", return_value=(0, 0)).start()
+        mock_report = patch("oa.server.PreForkServer.report_load").start()
+        self.server.prefork = 1
+        self.server.pids = [1]
+        self.server.report_interval = -1
+        self.server._stopping = True
+        self.supervise(stop_after=1)
+        mock_report.assert_called_with()
+
+    def test_report_load(self):
+        mock_log = patch.object(self.server, "log").start()
+        self.server.worker_load = {
+            1: {"requests": 30, "busy": 1.0, "rss": 20.0,
+                "started": time.time() - 10},
+            2: {"requests": 10, "busy": 0.5, "rss": 20.0,
+                "started": time.time() - 10},
+        }
+        self.server.report_load()
+        self.assertEqual(mock_log.info.call_count, 2)
+        self.assertEqual(mock_log.info.call_args_list[0][0][3], 75.0)
+
+    def test_report_load_metrics(self):
+        mock_log = patch.object(self.server, "log").start()
+        oa.metrics.incr("timeouts_body", 1)
+        self.server.worker_load = {
+            1: {"requests": 30, "busy": 1.0, "rss": 20.0,
+                "started": time.time() - 10,
+                "metrics": {"timeouts_body": 2, "timeouts_header": 1}},
+        }
+        self.server.report_load()
+        mock_log.info.assert_called_with(
+            "Metrics: %s", "timeouts_body=3, timeouts_header=1"
+        )
+
+    def start_worker(self):
+        self.server.pids = None
+        self.server._status_w = 11
+        self.server._started = time.time()
+        self.mock_thread = patch("oa.server.threading.Thread").start()
+
+    def test_process_request(self):
+        self.start_worker()
+        mock_write = patch("oa.server.os.write").start()
+        patch("oa.server.get_rss", return_value=12.5).start()
+        with patch("socketserver.BaseServer.process_request") as mock_pr:
+            self.server.process_request("request", ("127.0.0.1", 47563))
+        mock_pr.assert_called_with("request", ("127.0.0.1", 47563))
+        self.assertEqual(self.server._served, 1)
+        status = mock_write.call_args[0][1].decode("ascii").split()
+        self.assertEqual(status[1], "1")
+        self.assertEqual(status[3], "12.5")
+        self.assertFalse(self.mock_thread.called)
+
+    def test_process_request_metrics(self):
+        self.start_worker()
+        oa.metrics.incr("timeouts_header", 2)
+        mock_write = patch("oa.server.os.write").start()
+        patch("oa.server.get_rss", return_value=12.5).start()
+        with patch("socketserver.BaseServer.process_request"):
+            self.server.process_request("request", ("127.0.0.1", 47563))
+        status = mock_write.call_args[0][1].decode("ascii").split()
+        self.assertEqual(status[4:], ["timeouts_header=2"])
+
+    def test_check_limits_requests(self):
+        self.start_worker()
+        self.server.max_requests = 10
+        self.server._served = 10
+        self.server.check_limits()
+        self.mock_thread.assert_called_with(target=self.server.shutdown)
+        self.assertTrue(self.server._recycling)
+        # Only recycle once.
+        self.server.check_limits()
+        self.assertEqual(self.mock_thread.call_count, 1)
+
+    def test_check_limits_age(self):
+        self.start_worker()
+        self.server.max_age = 60
+        self.server._started = time.time() - 61
+        self.server.check_limits()
+        self.mock_thread.assert_called_with(target=self.server.shutdown)
+
+    def test_check_limits_rss(self):
+        self.start_worker()
+        patch("oa.server.get_rss", return_value=101.0).start()
+        self.server.max_rss = 100
+        self.server.check_limits()
+        self.mock_thread.assert_called_with(target=self.server.shutdown)
+
+    def test_check_limits_under(self):
+        self.start_worker()
+        patch("oa.server.get_rss", return_value=99.0).start()
+        self.server.max_requests = 10
+        self.server.max_age = 60
+        self.server.max_rss = 100
+        self.server._served = 9
+        self.server.check_limits()
+        self.assertFalse(self.mock_thread.called)
+
+    def test_check_limits_not_worker(self):
+        self.server.max_requests = 1
+        self.server._served = 1
+        mock_thread = patch("oa.server.threading.Thread").start()
+        self.server.check_limits()
+        self.assertFalse(mock_thread.called)
+
+    def test_shutdown_parent(self):
+        mock_kill = patch("oa.server.os.kill").start()
+        self.server.pids = [1, 2]
+        self.server.shutdown()
+        self.assertTrue(self.server._stopping)
+        mock_kill.assert_has_calls([call(1, signal.SIGTERM),
+                                    call(2, signal.SIGTERM)])
+
+    def test_shutdown_worker(self):
+        self.server.pids = None
+        with patch("socketserver.BaseServer.shutdown") as mock_shutdown:
+            self.server.shutdown()
+        mock_shutdown.assert_called_with()
+
+    def test_load_config_parent(self):
+        mock_kill = patch("oa.server.os.kill").start()
+        self.mock_gc.get_objects.return_value = []
+        self.server.pids = [1, 2]
+        self.server.load_config()
+        self.mock_gc.freeze.assert_called_with()
+        mock_kill.assert_has_calls([call(1, signal.SIGUSR1),
+                                    call(2, signal.SIGUSR1)])
+
+    def test_serve_forever_reuse_port(self):
+        self.server.prefork = 2
+        self.server.reuse_port = True
+        self.mock_gc.get_objects.return_value = []
+        mock_socket = patch.object(self.server, "socket").start()
+        patch("oa.server.os.pipe", return_value=(10, 11)).start()
+        patch("oa.server.os.close").start()
+        patch("oa.server.PreForkServer.spawn_worker").start()
+        patch("oa.server.PreForkServer.supervise").start()
+        self.server.serve_forever()
+        mock_socket.close.assert_called_with()
+
+    def test_serve_worker_reuse_port(self):
+        self.server.reuse_port = True
+        mock_setup = patch("oa.server.PreForkServer._setup_socket").start()
+        mock_serve = patch("oa.server.spoon.server.TCPSpoon."
+                           "serve_forever").start()
+        patch("oa.server.select.select", return_value=[[], [], []]).start()
+        mock_close = patch("oa.server.PreForkServer.server_close").start()
+        self.server.serve_worker()
+        self.assertIsNone(self.server.pids)
+        mock_setup.assert_called_with()
+        mock_serve.assert_called_with(self.server, poll_interval=0.1)
+        mock_close.assert_called_with()
+
+    def test_serve_worker_reuse_port_drain(self):
+        self.server.reuse_port = True
+        patch("oa.server.PreForkServer._setup_socket").start()
+        patch("oa.server.spoon.server.TCPSpoon.serve_forever").start()
+        patch("oa.server.select.select",
+              side_effect=[[[1], [], []], [[1], [], []],
+                           [[], [], []]]).start()
+        patch("oa.server.PreForkServer.server_close").start()
+        mock_handle = patch("oa.server.PreForkServer.handle_request").start()
+        self.server.serve_worker()
+        self.assertEqual(mock_handle.call_count, 2)
+
+    def test_serve_worker(self):
+        mock_setup = patch("oa.server.PreForkServer._setup_socket").start()
+        patch("oa.server.spoon.server.TCPSpoon.serve_forever").start()
+        self.server.serve_worker()
+        self.assertFalse(mock_setup.called)
+
+    def test_server_bind_reuse_port(self):
+        self.server.reuse_port = True
+        mock_socket = patch.object(self.server, "socket").start()
+        self.server.server_bind()
+        mock_socket.setsockopt.assert_called_with(
+            socket.SOL_SOCKET, socket.SO_REUSEPORT, 1
+        )
+
+    def test_get_rss(self):
+        self.assertGreater(oa.server.get_rss(), 0)
+
 
 def suite():
     """Gather all the tests from this package in a test suite."""
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(TestServer, "test"))
+    test_suite.addTest(unittest.makeSuite(TestDeadlineFile, "test"))
     test_suite.addTest(unittest.makeSuite(TestPreForkServer, "test"))
+    test_suite.addTest(unittest.makeSuite(TestUnixSocketServer, "test"))
+    test_suite.addTest(unittest.makeSuite(TestThreadPoolServer, "test"))
     return test_suite
 
 if __name__ == '__main__':
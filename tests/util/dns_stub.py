@@ -0,0 +1,384 @@
+"""A local DNS server that answers from a records file, for benchmarks
+that must not depend on the network.
+
+Records are listed one per line::
+
+    # name              [ttl] type      data
+    example.com          300  A         93.184.216.34
+    example.com               TXT       "v=spf1 ip4:93.184.216.0/24 -all"
+    *.zen.example.com         A         127.0.0.2
+    unknown.example.com       NXDOMAIN
+
+Names that are not listed get a NXDOMAIN answer, names that are listed
+with other types an empty one. The server can delay its answers, drop
+queries and answer NXDOMAIN for listed names, to reproduce the
+conditions of a real resolver.
+
+Unknown names can also be forwarded to an upstream resolver, and its
+answers written to a records file to be replayed later::
+
+    python -m tests.util.dns_stub --port 30053 --upstream 8.8.8.8 \\
+        --record queries.txt
+    python -m tests.util.dns_stub --port 30053 --records queries.txt \\
+        --latency 0.02 --jitter 0.03 --loss 0.01
+
+Point the rules at it with::
+
+    dns_server 127.0.0.1:30053
+"""
+
+from __future__ import absolute_import, print_function, division
+
+import sys
+import time
+import heapq
+import random
+import socket
+import struct
+import argparse
+import threading
+import collections
+
+import dns.name
+import dns.rcode
+import dns.query
+import dns.rdata
+import dns.rrset
+import dns.message
+import dns.exception
+import dns.rdataclass
+import dns.rdatatype
+
+NXDOMAIN = "NXDOMAIN"
+DEFAULT_TTL = 300
+# The SOA record of the negative answers.
+SOA = "ns.stub.invalid. hostmaster.stub.invalid. 1 3600 600 86400 60"
+
+
+def parse_records(lines):
+    """Parse the lines of a records file.
+
+    :return: A dictionary that maps the lowercase names to a dictionary
+      of the types and their (ttl, data) records. Names that don't
+      exist map to None.
+    """
+    records = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split(None, 1)
+        name = parts[0].lower().rstrip(".")
+        rest = parts[1].split(None, 1) if len(parts) > 1 else [NXDOMAIN]
+        ttl = DEFAULT_TTL
+        if rest[0].isdigit():
+            ttl = int(rest[0])
+            rest = rest[1].split(None, 1)
+        rtype = rest[0].upper()
+        if rtype == NXDOMAIN:
+            records[name] = None
+            continue
+        data = rest[1].strip() if len(rest) > 1 else ""
+        types = records.get(name)
+        if types is None:
+            types = records[name] = {}
+        types.setdefault(rtype, []).append((ttl, data))
+    return records
+
+
+class StubDNSServer(object):
+    """Answer DNS queries over UDP and TCP from the records.
+
+    :param records: The records, as returned by `parse_records`.
+    :param latency: The number of seconds every answer is delayed.
+    :param jitter: The mean of an exponentially distributed extra
+      delay, which gives the answers a long tail.
+    :param loss: The fraction of the queries that are dropped.
+    :param nxdomain: The fraction of the queries for listed names
+      that are answered NXDOMAIN.
+    :param upstream: The address of a resolver that answers the names
+      that are not listed.
+    :param record: A file the answers of the upstream resolver are
+      written to, in the records format.
+    """
+
+    def __init__(self, records=None, host="127.0.0.1", port=0, latency=0.0,
+                 jitter=0.0, loss=0.0, nxdomain=0.0, upstream=None,
+                 record=None, seed=None):
+        self.records = records or {}
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.nxdomain = nxdomain
+        self.upstream = upstream
+        self.record = record
+        self.stats = collections.Counter()
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_cond = threading.Condition(self._lock)
+        self._running = False
+        self._threads = []
+        self._udp = None
+        self._tcp = None
+
+    @property
+    def address(self):
+        """The address to use in the `dns_server` option."""
+        return "%s:%s" % (self.host, self.port)
+
+    def start(self):
+        """Bind the sockets and start answering in background
+        threads.
+        """
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp.bind((self.host, self.port))
+        self.port = self._udp.getsockname()[1]
+        self._tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._tcp.bind((self.host, self.port))
+        self._tcp.listen(64)
+        self._running = True
+        for target in (self._serve_udp, self._send_udp, self._serve_tcp):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._pending_cond:
+            self._pending_cond.notify()
+        for sock in (self._udp, self._tcp):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            sock.close()
+        for thread in self._threads:
+            thread.join(5)
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def get_delay(self):
+        delay = self.latency
+        if self.jitter:
+            with self._random_lock:
+                delay += self._random.expovariate(1 / self.jitter)
+        return delay
+
+    def _chance(self, rate):
+        if not rate:
+            return False
+        with self._random_lock:
+            return self._random.random() < rate
+
+    def _find(self, name):
+        """Get the types listed for this name, trying the wildcards
+        of its parents if it's not listed.
+        """
+        name = name.lower().rstrip(".")
+        if name in self.records:
+            return True, self.records[name]
+        labels = name.split(".")
+        for i in range(1, len(labels)):
+            wildcard = "*." + ".".join(labels[i:])
+            if wildcard in self.records:
+                return True, self.records[wildcard]
+        return False, None
+
+    def _set_nxdomain(self, response, qname):
+        response.set_rcode(dns.rcode.NXDOMAIN)
+        response.authority.append(dns.rrset.from_text(
+            qname.parent() if len(qname) > 1 else qname, 60,
+            dns.rdataclass.IN, dns.rdatatype.SOA, SOA))
+
+    def _forward(self, query, question):
+        """Get the answer from the upstream resolver and record it."""
+        response = dns.query.udp(query, self.upstream, timeout=5)
+        if self.record is None:
+            return response
+        name = question.name.to_text()
+        lines = []
+        if response.rcode() == dns.rcode.NXDOMAIN:
+            lines.append("%s %s\n" % (name, NXDOMAIN))
+        for rrset in response.answer:
+            for rdata in rrset:
+                lines.append("%s %s %s %s\n" % (
+                    rrset.name.to_text(), rrset.ttl,
+                    dns.rdatatype.to_text(rrset.rdtype), rdata.to_text()))
+        with self._lock:
+            parse = parse_records(lines)
+            for key, value in parse.items():
+                if value is None or self.records.get(key) is None:
+                    self.records[key] = value
+                else:
+                    self.records[key].update(value)
+            self.record.writelines(lines)
+            self.record.flush()
+        return response
+
+    def handle(self, data):
+        """Get the answer to a query as wire data, or None if the
+        query is dropped.
+        """
+        self.stats["queries"] += 1
+        if self._chance(self.loss):
+            self.stats["dropped"] += 1
+            return None
+        try:
+            query = dns.message.from_wire(data)
+            question = query.question[0]
+        except (dns.exception.DNSException, IndexError):
+            self.stats["invalid"] += 1
+            return None
+        listed, types = self._find(question.name.to_text())
+        if not listed and self.upstream:
+            try:
+                return self._forward(query, question).to_wire()
+            except (dns.exception.DNSException, socket.error) as e:
+                print("Upstream error for %s: %s" % (question.name, e),
+                      file=sys.stderr)
+        response = dns.message.make_response(query)
+        if types is None or self._chance(self.nxdomain):
+            self.stats["nxdomain"] += 1
+            self._set_nxdomain(response, question.name)
+            return response.to_wire()
+        rtype = dns.rdatatype.to_text(question.rdtype)
+        for ttl, text in types.get(rtype, ()):
+            rrset = response.find_rrset(response.answer, question.name,
+                                        dns.rdataclass.IN, question.rdtype,
+                                        create=True)
+            rrset.add(dns.rdata.from_text(dns.rdataclass.IN,
+                                          question.rdtype, text), ttl)
+        if not response.answer:
+            self.stats["empty"] += 1
+        return response.to_wire()
+
+    def _serve_udp(self):
+        while self._running:
+            try:
+                data, addr = self._udp.recvfrom(4096)
+            except (OSError, socket.error):
+                break
+            answer = self.handle(data)
+            if answer is None:
+                continue
+            due = time.time() + self.get_delay()
+            with self._pending_cond:
+                heapq.heappush(self._pending, (due, answer, addr))
+                self._pending_cond.notify()
+
+    def _send_udp(self):
+        """Send the delayed UDP answers when they are due."""
+        with self._pending_cond:
+            while self._running:
+                if not self._pending:
+                    self._pending_cond.wait()
+                    continue
+                due, answer, addr = self._pending[0]
+                wait = due - time.time()
+                if wait > 0:
+                    self._pending_cond.wait(wait)
+                    continue
+                heapq.heappop(self._pending)
+                try:
+                    self._udp.sendto(answer, addr)
+                except (OSError, socket.error):
+                    pass
+
+    def _serve_tcp(self):
+        while self._running:
+            try:
+                connection, dummy = self._tcp.accept()
+            except (OSError, socket.error):
+                break
+            thread = threading.Thread(target=self._handle_tcp,
+                                      args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _recv_exactly(self, connection, size):
+        data = b""
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _handle_tcp(self, connection):
+        try:
+            while self._running:
+                length = self._recv_exactly(connection, 2)
+                if length is None:
+                    break
+                data = self._recv_exactly(connection,
+                                          struct.unpack("!H", length)[0])
+                if data is None:
+                    break
+                self.stats["tcp"] += 1
+                answer = self.handle(data)
+                if answer is None:
+                    continue
+                time.sleep(self.get_delay())
+                connection.sendall(struct.pack("!H", len(answer)) + answer)
+        except (OSError, socket.error):
+            pass
+        finally:
+            connection.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=30053)
+    parser.add_argument("--records", type=argparse.FileType("r"),
+                        action="append", default=[],
+                        help="A file with the records to answer from")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Delay every answer by this many seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="The mean of an extra random delay")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="The fraction of the queries dropped")
+    parser.add_argument("--nxdomain", type=float, default=0.0,
+                        help="The fraction of the listed names answered "
+                             "NXDOMAIN")
+    parser.add_argument("--upstream", default=None,
+                        help="Forward the names that are not listed to "
+                             "this resolver")
+    parser.add_argument("--record", type=argparse.FileType("a"),
+                        default=None,
+                        help="Append the upstream answers to this file")
+    options = parser.parse_args(args)
+    records = {}
+    for records_file in options.records:
+        records.update(parse_records(records_file))
+    server = StubDNSServer(records, options.host, options.port,
+                           options.latency, options.jitter, options.loss,
+                           options.nxdomain, options.upstream,
+                           options.record)
+    server.start()
+    print("Answering on %s" % server.address)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(dict(server.stats))
+
+
+if __name__ == "__main__":
+    main()